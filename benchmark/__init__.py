@@ -0,0 +1,7 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Benchmarks for Flocker.
+
+Each module can be run directly, e.g. ``python -m benchmark.codec``.
+"""
@@ -0,0 +1,83 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Synthetic deployments for benchmarks.
+"""
+
+from uuid import UUID
+
+from pyrsistent import pmap
+
+from twisted.python.filepath import FilePath
+
+from flocker.control import (
+    Deployment, Node, Application, DockerImage, AttachedVolume, Port,
+    Manifestation, Dataset, NodeState,
+)
+
+
+def _dataset_id(i):
+    """
+    :param int i: Index of a dataset.
+
+    :return unicode: A dataset ID which is stable across runs.
+    """
+    return unicode(UUID(int=i))
+
+
+def make_application(node_index, application_index):
+    """
+    Create an ``Application`` with a volume and a port.
+
+    :param int node_index: Index of the node the application is on.
+    :param int application_index: Index of the application on its node.
+
+    :return Application: The application.
+    """
+    name = u"app-%d-%d" % (node_index, application_index)
+    dataset = Dataset(
+        dataset_id=_dataset_id(node_index * 1000000 + application_index),
+        maximum_size=1024 * 1024 * 1024,
+        metadata=pmap({u"name": name}))
+    return Application(
+        name=name,
+        image=DockerImage(repository=u"clusterhq/app", tag=u"1.0"),
+        ports=frozenset([Port(internal_port=80,
+                              external_port=10000 + application_index)]),
+        volume=AttachedVolume(
+            manifestation=Manifestation(dataset=dataset, primary=True),
+            mountpoint=FilePath(b"/data")),
+        environment=frozenset([(u"NAME", name)]),
+    )
+
+
+def make_deployment(nodes=1000, applications=10000):
+    """
+    Create a ``Deployment`` with applications spread evenly across nodes.
+
+    :param int nodes: The number of nodes.
+    :param int applications: The total number of applications.
+
+    :return Deployment: The deployment.
+    """
+    per_node = applications // nodes
+    return Deployment(nodes=frozenset(
+        Node(hostname=u"10.0.%d.%d" % divmod(i, 256),
+             applications=frozenset(
+                 make_application(i, j) for j in range(per_node)))
+        for i in range(nodes)))
+
+
+def make_node_state(applications=10):
+    """
+    Create a ``NodeState`` as reported by a single agent.
+
+    :param int applications: The number of running applications.
+
+    :return NodeState: The node state.
+    """
+    return NodeState(
+        hostname=u"10.0.0.0",
+        running=[make_application(0, j) for j in range(applications)],
+        not_running=[],
+        used_ports=frozenset(range(10000, 10000 + applications)))
@@ -0,0 +1,95 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Compare ``flocker.control._codec`` with ``pickle``.
+
+Run with::
+
+    $ python -m benchmark.codec [--nodes N] [--applications N]
+"""
+
+from __future__ import print_function
+
+import sys
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from time import time
+
+from twisted.python.usage import Options
+
+from flocker.control._codec import encode, decode
+
+from ._deployments import make_deployment, make_node_state
+
+
+class CodecBenchmarkOptions(Options):
+    """
+    Command line options for the codec benchmark.
+    """
+    optParameters = [
+        ["nodes", None, 1000, "The number of nodes in the deployment.", int],
+        ["applications", None, 10000,
+         "The total number of applications in the deployment.", int],
+        ["repeat", None, 5, "Take the best time of this many runs.", int],
+    ]
+
+
+def best_time(repeat, f, *args):
+    """
+    :param int repeat: How many times to call ``f``.
+    :param f: The callable to time.
+    :param args: Positional arguments for ``f``.
+
+    :return: ``tuple`` of the fastest time in seconds and the result of
+        the last call.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time()
+        result = f(*args)
+        times.append(time() - start)
+    return min(times), result
+
+
+SERIALIZERS = [
+    (u"pickle (protocol 0)", dumps, loads),
+    (u"pickle (protocol 2)",
+     lambda value: dumps(value, HIGHEST_PROTOCOL), loads),
+    (u"codec", encode, decode),
+    (u"codec (uncompressed)",
+     lambda value: encode(value, compression_threshold=None), decode),
+]
+
+
+def report(name, value, repeat):
+    """
+    Print the size and timings of each serializer for a value.
+
+    :param unicode name: Description of the value.
+    :param value: The value to serialize.
+    :param int repeat: Number of runs to take the best time from.
+    """
+    print(name)
+    print(u"%-22s %12s %12s %12s" % (
+        u"", u"bytes", u"encode (ms)", u"decode (ms)"))
+    for label, serialize, deserialize in SERIALIZERS:
+        encode_time, data = best_time(repeat, serialize, value)
+        decode_time, result = best_time(repeat, deserialize, data)
+        assert result == value
+        print(u"%-22s %12d %12.1f %12.1f" % (
+            label, len(data), encode_time * 1000, decode_time * 1000))
+    print()
+
+
+def main(argv=None):
+    options = CodecBenchmarkOptions()
+    options.parseOptions(sys.argv[1:] if argv is None else argv)
+    report(u"Deployment: %d nodes, %d applications" % (
+        options["nodes"], options["applications"]),
+        make_deployment(options["nodes"], options["applications"]),
+        options["repeat"])
+    report(u"NodeState: 10 applications", make_node_state(10),
+           options["repeat"] * 100)
+
+
+if __name__ == '__main__':
+    main()
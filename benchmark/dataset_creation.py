@@ -0,0 +1,71 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Measure how long the REST API's configuration change takes to add datasets
+to a large configuration.
+
+Run with::
+
+    $ python -m benchmark.dataset_creation [--nodes N] [--datasets N]
+"""
+
+from __future__ import print_function
+
+import sys
+from time import time
+from uuid import UUID
+
+from twisted.python.usage import Options
+
+from flocker.control import Dataset
+from flocker.control.httpapi import add_primary_dataset
+
+from ._deployments import make_deployment
+
+
+class DatasetCreationBenchmarkOptions(Options):
+    """
+    Command line options for the dataset creation benchmark.
+    """
+    optParameters = [
+        ["nodes", None, 1000, "The number of nodes in the deployment.", int],
+        ["applications", None, 10000,
+         "The total number of applications already in the deployment.", int],
+        ["datasets", None, 10000, "The number of datasets to create.", int],
+    ]
+
+
+def create_datasets(deployment, count):
+    """
+    Add datasets to a deployment one at a time, spreading them across its
+    nodes, the way a series of ``POST /configuration/datasets`` requests
+    would.
+
+    :param Deployment deployment: The initial configuration.
+    :param int count: The number of datasets to create.
+
+    :return Deployment: The configuration including the new datasets.
+    """
+    hostnames = sorted(node.hostname for node in deployment.nodes)
+    for i in range(count):
+        deployment = add_primary_dataset(
+            deployment, hostnames[i % len(hostnames)],
+            Dataset(dataset_id=unicode(UUID(int=2 ** 64 + i))))
+    return deployment
+
+
+def main(argv=None):
+    options = DatasetCreationBenchmarkOptions()
+    options.parseOptions(sys.argv[1:] if argv is None else argv)
+    deployment = make_deployment(options["nodes"], options["applications"])
+    start = time()
+    create_datasets(deployment, options["datasets"])
+    elapsed = time() - start
+    print(u"Created %d datasets on %d nodes with %d applications" % (
+        options["datasets"], options["nodes"], options["applications"]))
+    print(u"%12.1f s total %12.3f ms per dataset" % (
+        elapsed, elapsed * 1000 / options["datasets"]))
+
+
+if __name__ == '__main__':
+    main()
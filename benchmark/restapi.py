@@ -0,0 +1,154 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Measure the per-request overhead of ``flocker.restapi.structured`` for a
+dataset listing response.
+
+Run with::
+
+    $ python -m benchmark.restapi [--datasets N] [--requests N]
+"""
+
+from __future__ import print_function
+
+import sys
+from json import dumps
+from time import time
+from uuid import UUID
+
+from jsonschema.validators import validator_for
+from jsonschema import draft4_format_checker
+
+from klein import Klein
+
+from twisted.python.usage import Options
+from twisted.web.http_headers import Headers
+
+from flocker.control.httpapi import SCHEMAS
+from flocker.restapi import structured, OutputValidation
+from flocker.restapi._schema import LocalRefResolver, getValidator
+from flocker.restapi.testtools import dummyRequest, render
+
+
+DATASETS_ARRAY = {'$ref': '/v1/endpoints.json#/definitions/datasets_array'}
+
+
+class RestAPIBenchmarkOptions(Options):
+    """
+    Command line options for the REST API benchmark.
+    """
+    optParameters = [
+        ["datasets", None, 1000, "The number of datasets in the response.",
+         int],
+        ["requests", None, 20, "The number of requests to time.", int],
+    ]
+
+
+def make_datasets(count):
+    """
+    :param int count: The number of datasets.
+
+    :return: A ``list`` of ``dict``\ s matching the ``datasets_array``
+        schema.
+    """
+    return [{u"dataset_id": unicode(UUID(int=i)),
+             u"primary": u"10.0.%d.%d" % (i // 256 % 256, i % 256),
+             u"maximum_size": 1024 * 1024 * 1024,
+             u"metadata": {u"name": u"dataset-%d" % (i,)}}
+            for i in range(count)]
+
+
+class Endpoints(object):
+    """
+    The same response served directly with Klein and through
+    ``structured``.
+
+    :ivar OutputValidation output_validation: The policy of the structured
+        endpoint.
+    """
+    app = Klein()
+    logger = None
+
+    def __init__(self, datasets, output_validation):
+        self.datasets = datasets
+        self.output_validation = output_validation
+
+    @app.route("/raw")
+    def raw(self, request):
+        request.responseHeaders.setRawHeaders(
+            b"content-type", [b"application/json"])
+        return dumps(self.datasets)
+
+    @app.route("/structured")
+    @structured(inputSchema={}, outputSchema=DATASETS_ARRAY,
+                schema_store=SCHEMAS)
+    def structured(self):
+        return self.datasets
+
+
+def time_requests(resource, path, count):
+    """
+    :param resource: The resource to request.
+    :param bytes path: The path to request.
+    :param int count: The number of requests.
+
+    :return float: The mean time in seconds taken by each request.
+    """
+    start = time()
+    for _ in range(count):
+        render(resource, dummyRequest(b"GET", path, Headers(), b""))
+    return (time() - start) / count
+
+
+def time_validation(validator, value, count):
+    """
+    :param validator: A ``jsonschema`` validator.
+    :param value: The value to validate.
+    :param int count: The number of times to validate it.
+
+    :return float: The mean time in seconds taken by each validation.
+    """
+    start = time()
+    for _ in range(count):
+        validator.validate(value)
+    return (time() - start) / count
+
+
+def main(argv=None):
+    options = RestAPIBenchmarkOptions()
+    options.parseOptions(sys.argv[1:] if argv is None else argv)
+    datasets = make_datasets(options["datasets"])
+    count = options["requests"]
+
+    print(u"Requests for %d datasets (ms per request)" % (len(datasets),))
+    resource = Endpoints(datasets, None).app.resource()
+    print(u"%-40s %12.3f" % (
+        u"Klein only", time_requests(resource, b"/raw", count) * 1000))
+    for label, sample_every in [(u"structured, no output validation", 0),
+                                (u"structured, validating 1 in 10", 10),
+                                (u"structured, validating all", 1)]:
+        resource = Endpoints(
+            datasets, OutputValidation(sample_every)).app.resource()
+        print(u"%-40s %12.3f" % (
+            label, time_requests(resource, b"/structured", count) * 1000))
+    print()
+
+    # Validators built the way they were before getValidator resolved
+    # references in advance:
+    resolver = LocalRefResolver(
+        base_uri=b'', referrer=DATASETS_ARRAY, store=SCHEMAS)
+    resolver.resolution_scope = b''
+    following = validator_for(DATASETS_ARRAY)(
+        DATASETS_ARRAY, resolver=resolver,
+        format_checker=draft4_format_checker)
+    print(u"Validating %d datasets (ms)" % (len(datasets),))
+    print(u"%-40s %12.3f" % (
+        u"following references", time_validation(
+            following, datasets, count) * 1000))
+    print(u"%-40s %12.3f" % (
+        u"references resolved in advance", time_validation(
+            getValidator(DATASETS_ARRAY, SCHEMAS), datasets, count) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,15 @@
 # Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.control.test.test_clusterstate -*-
 
 """
 Combine and retrieve current cluster state.
 """
 
+from operator import itemgetter
+
 from twisted.application.service import Service
 
-from ._model import Deployment
+from ._model import Deployment, Manifestation
 
 
 class ClusterStateService(Service):
@@ -14,12 +17,28 @@ class ClusterStateService(Service):
     Store known current cluster state, and combine partial updates with
     the existing known state.
 
+    The combined state is maintained incrementally: each update replaces
+    the changed node in the combined ``Deployment`` using
+    ``Deployment.update_node``, which carries its hostname, dataset and
+    metadata indexes over, so lookups never scan the whole cluster.
+
     https://clusterhq.atlassian.net/browse/FLOC-1269 will deal with
     semantics of expiring data, which should happen so stale information
     isn't treated as correct.
+
+    :ivar int generation: Incremented every time the cluster state
+        changes, so readers can cheaply tell whether it has.
+    :ivar list _change_callbacks: Callables to call when the cluster state
+        changes.
+    :ivar dict _nodes: Map hostnames to the latest ``NodeState`` reported
+        for that node.
+    :ivar Deployment _deployment: The ``Deployment`` combining all nodes.
     """
     def __init__(self):
+        self.generation = 0
+        self._change_callbacks = []
         self._nodes = {}
+        self._deployment = Deployment(nodes=frozenset())
 
     def update_node_state(self, node_state):
         """
@@ -29,14 +48,104 @@ class ClusterStateService(Service):
         consistency here. See https://clusterhq.atlassian.net/browse/FLOC-1303
 
         :param NodeState node_state: The state of the node.
+
+        :return bool: ``True`` if the state of the node changed, ``False``
+            if it is identical to the previously known state.
         """
-        self._nodes[node_state.hostname] = node_state
+        hostname = node_state.hostname
+        if self._nodes.get(hostname) == node_state:
+            return False
+        self._nodes[hostname] = node_state
+        self._deployment = self._deployment.update_node(node_state.to_node())
+        self.generation += 1
+        for callback in self._change_callbacks:
+            callback()
+        return True
+
+    def register(self, change_callback):
+        """
+        Register a function to be called whenever the cluster state changes.
+
+        :param change_callback: Callable that takes no arguments, will be
+            called when the cluster state changes.
+        """
+        self._change_callbacks.append(change_callback)
 
     def as_deployment(self):
         """
         Return cluster state as a Deployment object.
 
+        The same object is returned until the cluster state changes.
+
         :return Deployment: Current state of the cluster.
         """
-        return Deployment(nodes=frozenset(
-            (node_state.to_node() for node_state in self._nodes.values())))
+        return self._deployment
+
+    def get_node(self, hostname):
+        """
+        Look up the state of a single node.
+
+        :param unicode hostname: The hostname of the node.
+
+        :return: The ``Node`` describing the node's state, or ``None`` if
+            the node's state is not known.
+        """
+        return self._deployment.get_node(hostname)
+
+    def get_manifestation(self, dataset_id):
+        """
+        Look up the primary manifestation of a dataset.
+
+        :param unicode dataset_id: The ID of the dataset.
+
+        :return: ``tuple`` of the hostname of the node with the primary
+            manifestation of the dataset and the ``Manifestation``, or
+            ``None`` if no node reported a primary manifestation of the
+            dataset.  If multiple nodes report a primary manifestation the
+            one with the lowest hostname is returned.
+        """
+        primaries = self._deployment.get_primaries(dataset_id)
+        if not primaries:
+            return None
+        hostname, dataset = min(primaries, key=itemgetter(0))
+        return hostname, Manifestation(dataset=dataset, primary=True)
+
+    def primary_dataset_ids(self):
+        """
+        :return tuple: The IDs of all datasets with a reported primary
+            manifestation, sorted.
+        """
+        return self._deployment.primary_dataset_ids()
+
+    def get_primaries(self, dataset_id):
+        """
+        Look up all reported primary manifestations of a dataset.
+
+        :param unicode dataset_id: The ID of the dataset.
+
+        :return frozenset: ``tuple``\ s of the hostname of the node and the
+            ``Dataset`` for each primary manifestation of the dataset.
+        """
+        return self._deployment.get_primaries(dataset_id)
+
+    def datasets_with_metadata(self, key, value):
+        """
+        Find the datasets with the given metadata.
+
+        :param unicode key: A metadata key.
+        :param unicode value: The metadata value.
+
+        :return frozenset: The IDs of the datasets with a reported primary
+            manifestation whose metadata maps ``key`` to ``value``.
+        """
+        return self._deployment.datasets_with_metadata(key, value)
+
+    def primary_manifestations(self):
+        """
+        :return: Iterable of ``tuple``\ s of hostname and ``Manifestation``,
+            for all primary manifestations on all nodes.
+        """
+        for dataset_id in self._deployment.primary_dataset_ids():
+            for hostname, dataset in self._deployment.get_primaries(
+                    dataset_id):
+                yield hostname, Manifestation(dataset=dataset, primary=True)
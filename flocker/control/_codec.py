@@ -0,0 +1,361 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.control.test.test_codec -*-
+
+"""
+Compact, versioned serialization of the deployment model.
+
+This replaces ``pickle``, which is slow, produces large output and allows
+whoever produced the serialized bytes to execute arbitrary code in the
+process loading them.
+
+The encoded form consists of a fixed header followed by a (possibly
+``zlib`` compressed) body:
+
+* ``MAGIC``: 3 bytes identifying the format.
+* The format version: 1 byte.
+* Flags: 1 byte; ``FLAG_ZLIB`` indicates the body is compressed.
+
+The body is a JSON array of three items:
+
+1. A table of all the strings used in the encoded objects. Each distinct
+   string (hostnames, image names, dataset IDs, ...) is only stored once.
+   ``unicode`` strings are stored as JSON strings, ``bytes`` are stored as
+   a single-item array containing the Latin-1 decoding of the bytes.
+2. An integer identifying the type of the root object.
+3. The root object. Records are encoded as arrays of their attributes in
+   the order given by the ``_record`` definitions below, strings are
+   encoded as indexes into the string table and collections are encoded
+   as arrays.
+
+The JSON module's C accelerated encoder and decoder do the heavy lifting,
+and unlike ``pickle`` or ``marshal`` decoding is safe for untrusted input.
+Decoding bypasses the record types' ``__init__``, just as ``pickle`` does.
+"""
+
+from json import dumps, loads
+from struct import Struct
+from zlib import compress, decompress
+
+from pyrsistent import pmap
+
+from twisted.python.filepath import FilePath
+
+from ._model import (
+    DockerImage, Port, Link, Dataset, Manifestation, AttachedVolume,
+    Application, Node, Deployment, NodeState, RestartNever, RestartAlways,
+    RestartOnFailure, DeploymentDiff,
+)
+
+
+MAGIC = b"FLC"
+VERSION = 1
+FLAG_ZLIB = 1
+
+_HEADER = Struct(b"!3sBB")
+
+# Bodies smaller than this aren't worth compressing:
+COMPRESSION_THRESHOLD = 4096
+
+
+class CodecError(Exception):
+    """
+    The given bytes could not be decoded.
+    """
+
+
+class _Field(object):
+    """
+    Encoder and decoder for a single kind of value.
+
+    :ivar encode: Callable taking a ``_Strings`` and a value, returning a
+        JSON-compatible encoding of the value.
+    :ivar decode: Callable taking the decoded string table and the JSON
+        encoding of a value, returning the value.
+    """
+    def __init__(self, encode, decode):
+        self.encode = encode
+        self.decode = decode
+
+
+class _Strings(object):
+    """
+    The string table being built while encoding.
+
+    :ivar list table: The strings, in the JSON-compatible form they are
+        stored in.
+    :ivar dict _indexes: Map strings to their index in ``table``.
+    """
+    def __init__(self):
+        self.table = []
+        self._indexes = {}
+
+    def intern(self, value):
+        """
+        :param value: ``unicode`` or ``bytes`` to add to the table.
+
+        :return int: The index of the string in the table.
+        """
+        # u"a" == b"a" in Python 2, so the type is part of the key:
+        key = (value.__class__, value)
+        try:
+            return self._indexes[key]
+        except KeyError:
+            index = self._indexes[key] = len(self.table)
+            if isinstance(value, bytes):
+                self.table.append([value.decode("latin-1")])
+            else:
+                self.table.append(value)
+            return index
+
+
+def _decode_table(table):
+    """
+    Convert a decoded JSON string table back into strings.
+
+    :param list table: The first item of an encoded body.
+
+    :return list: ``unicode`` and ``bytes``, in the same order.
+    """
+    return [value[0].encode("latin-1") if isinstance(value, list) else value
+            for value in table]
+
+
+def _optional(field):
+    """
+    :param _Field field: Field for non-``None`` values.
+
+    :return _Field: A field that also supports ``None``.
+    """
+    encode, decode = field.encode, field.decode
+    return _Field(
+        lambda strings, value:
+            None if value is None else encode(strings, value),
+        lambda table, value:
+            None if value is None else decode(table, value))
+
+
+_STRING = _Field(
+    lambda strings, value: strings.intern(value),
+    lambda table, value: table[value])
+
+_INTEGER = _Field(lambda strings, value: value, lambda table, value: value)
+
+_BOOLEAN = _INTEGER
+
+_PATH = _Field(
+    lambda strings, value: strings.intern(value.path),
+    lambda table, value: FilePath(table[value]))
+
+_STRING_MAP = _Field(
+    lambda strings, value: [strings.intern(item) for pair in value.items()
+                            for item in pair],
+    lambda table, value: pmap(
+        {table[k]: table[v] for k, v in zip(value[::2], value[1::2])}))
+
+_STRING_PAIRS = _Field(
+    lambda strings, value: [strings.intern(item) for pair in value
+                            for item in pair],
+    lambda table, value: frozenset(
+        (table[k], table[v]) for k, v in zip(value[::2], value[1::2])))
+
+_RESTART_POLICY = _Field(
+    lambda strings, value:
+        [0] if isinstance(value, RestartNever) else
+        [1] if isinstance(value, RestartAlways) else
+        [2, value.maximum_retry_count],
+    lambda table, value:
+        RestartNever() if value[0] == 0 else
+        RestartAlways() if value[0] == 1 else
+        RestartOnFailure(maximum_retry_count=value[1]))
+
+
+def _collection(field, collection_type):
+    """
+    :param _Field field: Field for the items of the collection.
+    :param collection_type: Callable creating the collection from a list.
+
+    :return _Field: A field for collections of the given type.
+    """
+    encode, decode = field.encode, field.decode
+    return _Field(
+        lambda strings, value: [encode(strings, item) for item in value],
+        lambda table, value: collection_type(
+            [decode(table, item) for item in value]))
+
+
+def _set_of(field):
+    return _collection(field, frozenset)
+
+
+def _list_of(field):
+    return _collection(field, list)
+
+
+def _record(record_type, fields):
+    """
+    :param record_type: A ``characteristic`` record class.
+    :param list fields: Pairs of attribute names and the ``_Field`` used to
+        encode them.
+
+    :return _Field: A field for instances of ``record_type``.
+    """
+    names = [name for (name, _) in fields]
+    encoders = [(name, field.encode) for (name, field) in fields]
+    decoders = [field.decode for (_, field) in fields]
+    new = record_type.__new__
+
+    def encode(strings, value):
+        if value.__class__ is not record_type:
+            raise TypeError("Expected {}, got {!r}".format(
+                record_type.__name__, value))
+        return [encoder(strings, getattr(value, name))
+                for (name, encoder) in encoders]
+
+    def decode(table, value):
+        record = new(record_type)
+        record.__dict__.update(zip(
+            names, [decoder(table, item)
+                    for (decoder, item) in zip(decoders, value)]))
+        return record
+    return _Field(encode, decode)
+
+
+_DOCKER_IMAGE = _record(DockerImage, [
+    ("repository", _STRING), ("tag", _STRING)])
+
+_PORT = _record(Port, [
+    ("internal_port", _INTEGER), ("external_port", _INTEGER)])
+
+_LINK = _record(Link, [
+    ("local_port", _INTEGER), ("remote_port", _INTEGER),
+    ("alias", _STRING)])
+
+_DATASET = _record(Dataset, [
+    ("dataset_id", _optional(_STRING)),
+    ("maximum_size", _INTEGER),
+    ("metadata", _STRING_MAP)])
+
+_MANIFESTATION = _record(Manifestation, [
+    ("dataset", _DATASET), ("primary", _BOOLEAN)])
+
+_ATTACHED_VOLUME = _record(AttachedVolume, [
+    ("manifestation", _MANIFESTATION), ("mountpoint", _PATH)])
+
+_APPLICATION = _record(Application, [
+    ("name", _STRING),
+    ("image", _DOCKER_IMAGE),
+    ("ports", _optional(_set_of(_PORT))),
+    ("volume", _optional(_ATTACHED_VOLUME)),
+    ("links", _optional(_set_of(_LINK))),
+    ("environment", _optional(_STRING_PAIRS)),
+    ("memory_limit", _INTEGER),
+    ("cpu_shares", _INTEGER),
+    ("restart_policy", _RESTART_POLICY)])
+
+_NODE = _record(Node, [
+    ("hostname", _STRING),
+    ("applications", _set_of(_APPLICATION)),
+    ("other_manifestations", _set_of(_MANIFESTATION))])
+
+_DEPLOYMENT = _record(Deployment, [("nodes", _set_of(_NODE))])
+
+_NODE_STATE = _record(NodeState, [
+    ("hostname", _STRING),
+    ("running", _list_of(_APPLICATION)),
+    ("not_running", _list_of(_APPLICATION)),
+    ("used_ports", _set_of(_INTEGER)),
+    ("other_manifestations", _set_of(_MANIFESTATION))])
+
+_NODES = _set_of(_NODE)
+
+_DEPLOYMENT_DIFF = _record(DeploymentDiff, [
+    ("changed", _NODES), ("removed", _set_of(_STRING))])
+
+# The types of objects that can be encoded at the root, identified by the
+# integer stored in the encoded body:
+_ROOTS = {
+    0: _DEPLOYMENT,
+    1: _NODE_STATE,
+    2: _NODES,
+    3: _DEPLOYMENT_DIFF,
+}
+
+
+def _root_type(value):
+    """
+    :param value: An object to encode.
+
+    :return int: The root type identifier for the object.
+    """
+    if isinstance(value, Deployment):
+        return 0
+    elif isinstance(value, NodeState):
+        return 1
+    elif isinstance(value, frozenset):
+        return 2
+    elif isinstance(value, DeploymentDiff):
+        return 3
+    raise TypeError("Can't encode {!r}".format(value))
+
+
+def encode(value, compression_threshold=COMPRESSION_THRESHOLD):
+    """
+    Serialize a ``Deployment``, a ``NodeState``, a ``frozenset`` of
+    ``Node``\ s or a ``DeploymentDiff``.
+
+    :param value: The object to serialize.
+    :param int compression_threshold: Bodies of at least this many bytes
+        are compressed. ``None`` disables compression.
+
+    :raise TypeError: If the object, or any object it refers to, is of a
+        type that can't be encoded.
+
+    :return bytes: The serialized object.
+    """
+    root_type = _root_type(value)
+    strings = _Strings()
+    tree = _ROOTS[root_type].encode(strings, value)
+    body = dumps([strings.table, root_type, tree], separators=(",", ":"))
+    flags = 0
+    if compression_threshold is not None and (
+            len(body) >= compression_threshold):
+        body = compress(body)
+        flags |= FLAG_ZLIB
+    return _HEADER.pack(MAGIC, VERSION, flags) + body
+
+
+def is_encoded(data):
+    """
+    :param bytes data: Some bytes.
+
+    :return bool: Whether the bytes look like the output of ``encode``.
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def decode(data):
+    """
+    Deserialize the output of ``encode``.
+
+    :param bytes data: The serialized object.
+
+    :raise CodecError: If the data is not in a supported format.
+
+    :return: The deserialized object.
+    """
+    try:
+        magic, version, flags = _HEADER.unpack_from(data)
+    except Exception:
+        raise CodecError("Truncated header")
+    if magic != MAGIC:
+        raise CodecError("Not an encoded object")
+    if version != VERSION:
+        raise CodecError("Unsupported format version {}".format(version))
+    body = data[_HEADER.size:]
+    try:
+        if flags & FLAG_ZLIB:
+            body = decompress(body)
+        table, root_type, tree = loads(body)
+        return _ROOTS[root_type].decode(_decode_table(table), tree)
+    except Exception as e:
+        raise CodecError("Corrupt encoded object: {}".format(e))
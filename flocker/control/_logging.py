@@ -0,0 +1,64 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+This module defines the Eliot log events emitted by the control service.
+"""
+
+__all__ = [
+    "LOG_BROADCAST",
+    "LOG_SLOW_AGENT",
+    ]
+
+from eliot import Field, MessageType
+
+
+def _system(name):
+    return u"flocker:controlservice:" + name
+
+
+GENERATION = Field.forTypes(
+    u"generation", [int],
+    u"The generation of the cluster status being sent.")
+
+CONNECTIONS = Field.forTypes(
+    u"connections", [int],
+    u"The number of convergence agent connections an update was sent to.")
+
+SENT_BYTES = Field.forTypes(
+    u"sent_bytes", [int],
+    u"The total number of serialized bytes of configuration and state "
+    u"sent to all connections.")
+
+ENCODE_SECONDS = Field.forTypes(
+    u"encode_seconds", [float],
+    u"The time spent serializing configuration and state.")
+
+DELAYED = Field.forTypes(
+    u"delayed", [int],
+    u"The number of connections which will be sent the update once they "
+    u"acknowledge the previous one.")
+
+AGENT = Field.forTypes(
+    u"agent", [unicode],
+    u"The address of a convergence agent connection.")
+
+RESPONSE_SECONDS = Field.forTypes(
+    u"response_seconds", [float],
+    u"The time between sending a cluster status and receiving a response.")
+
+SUPERSEDED = Field.forTypes(
+    u"superseded", [int],
+    u"The number of updates that were merged into the next one because "
+    u"the convergence agent hadn't responded yet.")
+
+
+LOG_BROADCAST = MessageType(
+    _system(u"broadcast"),
+    [GENERATION, CONNECTIONS, SENT_BYTES, ENCODE_SECONDS, DELAYED],
+    u"Cluster status was sent to convergence agents.")
+
+LOG_SLOW_AGENT = MessageType(
+    _system(u"slow_agent"),
+    [AGENT, GENERATION, RESPONSE_SECONDS, SUPERSEDED],
+    u"A convergence agent responded to a cluster status after newer "
+    u"updates had become available.")
@@ -5,6 +5,8 @@
 Record types for representing deployment models.
 """
 
+from bisect import bisect_left
+
 from characteristic import attributes, Attribute
 from pyrsistent import pmap
 from zope.interface import Interface, implementer
@@ -231,6 +233,111 @@ class Node(object):
              if application.volume is not None])
 
 
+def _index_entries(node):
+    """
+    :param Node node: A node.
+
+    :return: ``tuple`` of three ``frozenset``\ s of key/item pairs the node
+        contributes to the dataset, primary and metadata indexes of
+        ``_DeploymentIndex``.
+    """
+    hostname = node.hostname
+    datasets, primaries, metadata = set(), set(), set()
+    for manifestation in node.manifestations():
+        dataset = manifestation.dataset
+        datasets.add((dataset.dataset_id, hostname))
+        if manifestation.primary:
+            primaries.add((dataset.dataset_id, (hostname, dataset)))
+            for item in dataset.metadata.items():
+                metadata.add((item, (dataset.dataset_id, hostname)))
+    return frozenset(datasets), frozenset(primaries), frozenset(metadata)
+
+
+class _DeploymentIndex(object):
+    """
+    Indexes of the nodes and datasets of a ``Deployment``.
+
+    All but ``nodes`` and ``primary_ids`` map keys to ``frozenset``\ s;
+    keys whose set would be empty are omitted.
+
+    :ivar PMap nodes: Map hostnames to ``Node``\ s.
+    :ivar PMap datasets: Map dataset IDs to the hostnames of the nodes with a
+        manifestation of that dataset.
+    :ivar PMap primaries: Map dataset IDs to ``tuple``\ s of hostname and
+        ``Dataset`` for each primary manifestation of that dataset.
+    :ivar PMap metadata: Map ``tuple``\ s of metadata key and value to
+        ``tuple``\ s of dataset ID and hostname for each primary manifestation
+        of a dataset with that metadata.
+    :ivar tuple primary_ids: The keys of ``primaries``, sorted.
+    """
+    def __init__(self, nodes, datasets, primaries, metadata, primary_ids):
+        self.nodes = nodes
+        self.datasets = datasets
+        self.primaries = primaries
+        self.metadata = metadata
+        self.primary_ids = primary_ids
+
+    @classmethod
+    def build(cls, nodes):
+        """
+        :param nodes: Iterable of ``Node``\ s.
+
+        :return _DeploymentIndex: Indexes of the given nodes.
+        """
+        indexes = ({}, {}, {})
+        for node in nodes:
+            for index, entries in zip(indexes, _index_entries(node)):
+                for key, item in entries:
+                    index.setdefault(key, set()).add(item)
+        datasets, primaries, metadata = [
+            pmap({key: frozenset(items) for (key, items) in index.items()})
+            for index in indexes]
+        return cls(pmap({node.hostname: node for node in nodes}), datasets,
+                   primaries, metadata, tuple(sorted(primaries)))
+
+    def replace(self, node):
+        """
+        :param Node node: A new node, or a replacement for the node with the
+            same hostname.
+
+        :return _DeploymentIndex: Updated indexes.  Only the entries of the
+            replaced and replacing nodes are looked at.
+        """
+        old_node = self.nodes.get(node.hostname)
+        if old_node is None:
+            old_entries = (frozenset(),) * 3
+        else:
+            old_entries = _index_entries(old_node)
+        new_entries = _index_entries(node)
+        updated = []
+        for index, old, new in zip(
+                [self.datasets, self.primaries, self.metadata],
+                old_entries, new_entries):
+            for key, item in old - new:
+                items = index[key] - frozenset([item])
+                index = index.set(key, items) if items else index.remove(key)
+            for key, item in new - old:
+                index = index.set(
+                    key, index.get(key, frozenset()) | frozenset([item]))
+            updated.append(index)
+        datasets, primaries, metadata = updated
+        # Only datasets gaining their first or losing their last primary
+        # manifestation move in the sorted IDs:
+        primary_ids = self.primary_ids
+        for key in {key for (key, _) in old_entries[1] ^ new_entries[1]}:
+            if (key in primaries) == (key in self.primaries):
+                continue
+            position = bisect_left(primary_ids, key)
+            if key in primaries:
+                primary_ids = (primary_ids[:position] + (key,) +
+                               primary_ids[position:])
+            else:
+                primary_ids = (primary_ids[:position] +
+                               primary_ids[position + 1:])
+        return _DeploymentIndex(self.nodes.set(node.hostname, node),
+                                datasets, primaries, metadata, primary_ids)
+
+
 @attributes(["nodes"])
 class Deployment(object):
     """
@@ -238,6 +345,11 @@ class Deployment(object):
     a number of cooperating nodes.  This might describe the real state of an
     existing deployment or be used to represent a desired future state.
 
+    Lookups by hostname, dataset ID and metadata use indexes which are built
+    the first time they are needed and then carried over to the
+    ``Deployment``\ s created by ``update_node``, so a chain of updates never
+    has to scan the whole cluster again.
+
     :ivar frozenset nodes: A ``frozenset`` containing ``Node`` instances
         describing the configuration of each cooperating node.
     """
@@ -251,6 +363,70 @@ class Deployment(object):
             for application in node.applications:
                 yield application
 
+    def _index(self):
+        """
+        :return _DeploymentIndex: The indexes of this deployment.
+        """
+        try:
+            return self._cached_index
+        except AttributeError:
+            self._cached_index = _DeploymentIndex.build(self.nodes)
+            return self._cached_index
+
+    def get_node(self, hostname, default=None):
+        """
+        Find the ``Node`` with the given hostname.
+
+        :param unicode hostname: The hostname of the node.
+        :param default: The value to return if there is no such node.
+
+        :return: The ``Node`` with the given hostname, or ``default``.
+        """
+        return self._index().nodes.get(hostname, default)
+
+    def dataset_hostnames(self, dataset_id):
+        """
+        Find the nodes with a manifestation of the given dataset.
+
+        :param unicode dataset_id: The ID of the dataset.
+
+        :return frozenset: The hostnames of the nodes with a primary or
+            replica manifestation of the dataset; empty if there are none.
+        """
+        return self._index().datasets.get(dataset_id, frozenset())
+
+    def primary_dataset_ids(self):
+        """
+        :return tuple: The IDs of all datasets with a primary manifestation,
+            sorted.
+        """
+        return self._index().primary_ids
+
+    def get_primaries(self, dataset_id):
+        """
+        Find the primary manifestations of the given dataset.
+
+        :param unicode dataset_id: The ID of the dataset.
+
+        :return frozenset: ``tuple``\ s of the hostname of the node and the
+            ``Dataset`` for each primary manifestation of the dataset.
+        """
+        return self._index().primaries.get(dataset_id, frozenset())
+
+    def datasets_with_metadata(self, key, value):
+        """
+        Find the datasets with the given metadata.
+
+        :param unicode key: A metadata key.
+        :param unicode value: The metadata value.
+
+        :return frozenset: The IDs of the datasets with a primary
+            manifestation whose metadata maps ``key`` to ``value``.
+        """
+        return frozenset(
+            dataset_id for (dataset_id, _) in
+            self._index().metadata.get((key, value), frozenset()))
+
     def update_node(self, node):
         """
         Create new ``Deployment`` based on this one which replaces existing
@@ -262,9 +438,65 @@ class Deployment(object):
 
         :return Deployment: Updated with new ``Node``.
         """
+        index = self._index()
+        old_node = index.nodes.get(node.hostname)
+        if old_node is None:
+            updated = Deployment(nodes=self.nodes | frozenset([node]))
+        else:
+            updated = Deployment(
+                nodes=self.nodes - frozenset([old_node]) | frozenset([node]))
+        updated._cached_index = index.replace(node)
+        return updated
+
+
+@attributes(["changed", "removed"])
+class DeploymentDiff(object):
+    """
+    The node-level differences between two ``Deployment``\ s.
+
+    :ivar frozenset changed: ``Node`` instances which are either new or
+        differ from the ``Node`` with the same hostname in the older
+        ``Deployment``.
+
+    :ivar frozenset removed: The ``unicode`` hostnames of nodes which are
+        only present in the older ``Deployment``.
+    """
+    def apply(self, deployment):
+        """
+        Apply these differences to a ``Deployment``.
+
+        :param Deployment deployment: The older ``Deployment`` these
+            differences were calculated against.
+
+        :return Deployment: The newer ``Deployment``.
+        """
+        replaced = self.removed | frozenset(
+            node.hostname for node in self.changed)
         return Deployment(nodes=frozenset(
-            list(n for n in self.nodes if n.hostname != node.hostname) +
-            [node]))
+            [node for node in deployment.nodes
+             if node.hostname not in replaced]) | self.changed)
+
+
+def diff_deployments(old, new):
+    """
+    Calculate the node-level differences between two ``Deployment``\ s.
+
+    :param Deployment old: The older ``Deployment``.
+    :param Deployment new: The newer ``Deployment``.
+
+    :return DeploymentDiff: Differences which, when applied to ``old``,
+        result in ``new``.
+    """
+    old_nodes = {node.hostname: node for node in old.nodes}
+    changed = []
+    for node in new.nodes:
+        old_node = old_nodes.pop(node.hostname, None)
+        # Unchanged nodes are usually the very same object, which is much
+        # cheaper to check than equality:
+        if old_node is not node and old_node != node:
+            changed.append(node)
+    return DeploymentDiff(changed=frozenset(changed),
+                          removed=frozenset(old_nodes))
 
 
 @attributes(['internal_port', 'external_port'])
@@ -1,19 +1,43 @@
 # Copyright Hybrid Logic Ltd.  See LICENSE file for details.
 
+# -*- test-case-name: flocker.control.test.test_persistence -*-
+
 """
 Persistence of cluster configuration.
+
+The configuration is stored as a snapshot of the complete ``Deployment``
+plus a journal of the ``DeploymentDiff``\ s saved since the snapshot was
+taken. Saving a new configuration only appends the differences to the
+journal, so the cost of a save depends on the size of the change rather
+than the size of the cluster. Once the journal grows larger than the
+snapshot, it is compacted into a new snapshot in the background.
+
+All blocking file operations of a running service happen in the reactor's
+thread pool.
+
+Concurrent modifications, e.g. from many API requests, are grouped: all
+modifications made while a write is in progress, or within a short window,
+are applied together and persisted with a single write.
 """
 
-from pickle import dumps, loads
+import os
+from pickle import loads
+from struct import Struct
+from zlib import crc32
+
+from eliot import Logger, writeFailure
 
 from twisted.application.service import Service
-from twisted.internet.defer import succeed
+from twisted.python.failure import Failure
+from twisted.internet.defer import (
+    Deferred, DeferredLock, DeferredList, succeed,
+)
+from twisted.internet.threads import deferToThreadPool
 
-from ._model import Deployment
+from ._model import Deployment, diff_deployments
+from ._codec import encode, decode, is_encoded
 
 
-# These should not use Pickle!@!
-# https://clusterhq.atlassian.net/browse/FLOC-1241
 def serialize_deployment(deployment):
     """
     Convert a ``Deployment`` object to ``bytes``.
@@ -22,7 +46,7 @@ def serialize_deployment(deployment):
 
     :return bytes: Serialized object.
     """
-    return dumps(deployment)
+    return encode(deployment)
 
 
 def deserialize_deployment(data):
@@ -30,38 +54,338 @@ def deserialize_deployment(data):
     Create a ``Deployment`` object that was previously serialized to given
     ``bytes``.
 
+    Configuration saved by older versions of Flocker was serialized using
+    ``pickle``; it is still supported so that it can be upgraded.
+
     :param bytes data: Output of ``serialize_deployment``.
 
+    :raise CodecError: If the data is corrupt.
+
     :return Deployment: Deserialized object.
     """
+    if is_encoded(data):
+        return decode(data)
+    # https://clusterhq.atlassian.net/browse/FLOC-1241
     return loads(data)
 
 
+# Each journal record is the length and CRC-32 of an encoded
+# ``DeploymentDiff``, followed by the encoded ``DeploymentDiff``:
+_RECORD_HEADER = Struct(b"!II")
+
+# Journals smaller than this are never compacted:
+_MINIMUM_COMPACTION_SIZE = 1024 * 1024
+
+
+def _fsync_directory(path):
+    """
+    Flush the entries of a directory to disk, so that files created in or
+    renamed into it survive a crash.
+
+    :param FilePath path: The directory.
+    """
+    fd = os.open(path.path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_file(path, data):
+    """
+    Replace the contents of a file atomically and durably.
+
+    :param FilePath path: The file to write.
+    :param bytes data: The new contents.
+    """
+    temporary = path.temporarySibling()
+    with temporary.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary.path, path.path)
+    _fsync_directory(path.parent())
+
+
+def _read_journal(path):
+    """
+    Read the records of a journal.
+
+    A record that was only partially written, e.g. because of a crash, and
+    anything following it is ignored.
+
+    :param FilePath path: The journal file.
+
+    :return list: The ``DeploymentDiff``\ s in the journal, in the order
+        they were appended.
+    """
+    data = path.getContent()
+    diffs = []
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        length, checksum = _RECORD_HEADER.unpack_from(data, offset)
+        start = offset + _RECORD_HEADER.size
+        record = data[start:start + length]
+        if len(record) < length or crc32(record) & 0xffffffff != checksum:
+            break
+        diffs.append(decode(record))
+        offset = start + length
+    return diffs
+
+
+class _Journal(object):
+    """
+    An append-only file of ``DeploymentDiff`` records.
+
+    All methods block and should be called from a thread.
+
+    :ivar FilePath path: The journal file.
+    :ivar int size: The size in bytes of the complete records in the
+        journal file.
+    :ivar bool damaged: Whether the journal file may end with a partial
+        record, because a write failed and the file couldn't be truncated
+        afterwards.
+    """
+    def __init__(self, path):
+        """
+        Open a journal, creating the file if necessary.
+
+        :param FilePath path: The journal file.
+        """
+        self.path = path
+        self._fd = self._open()
+        self.size = os.fstat(self._fd).st_size
+        self.damaged = False
+
+    def _open(self):
+        """
+        Open the journal file for appending, creating it if necessary.
+
+        :return int: The file descriptor.
+        """
+        return os.open(self.path.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                       0600)
+
+    def append(self, data):
+        """
+        Append a record and flush it to disk.
+
+        :param bytes data: An encoded ``DeploymentDiff``.
+        """
+        self.write(_RECORD_HEADER.pack(
+            len(data), crc32(data) & 0xffffffff) + data)
+
+    def write(self, records):
+        """
+        Append complete records, e.g. read from another journal, and flush
+        them to disk.
+
+        If this fails, none of the records are kept: reading a journal stops
+        at a partial record, so anything appended after one would be lost.
+
+        :param bytes records: The records.
+        """
+        self.repair()
+        written = 0
+        try:
+            while written < len(records):
+                written += os.write(self._fd, records[written:])
+            os.fsync(self._fd)
+        except Exception:
+            try:
+                os.ftruncate(self._fd, self.size)
+            except OSError:
+                self.damaged = True
+            raise
+        self.size += len(records)
+
+    def repair(self):
+        """
+        If the journal is damaged, replace its file with one holding only
+        its complete records.
+        """
+        if not self.damaged:
+            return
+        with self.path.open() as f:
+            records = f.read(self.size)
+        _write_file(self.path, records)
+        fd = self._open()
+        os.close(self._fd)
+        self._fd = fd
+        self.damaged = False
+
+    def close(self):
+        """
+        Close the journal file.
+        """
+        os.close(self._fd)
+
+
 class ConfigurationPersistenceService(Service):
     """
     Persist configuration to disk, and load it back.
 
-    :ivar Deployment _deployment: The current desired deployment configuration.
+    Configuration is stored in three files in the configured directory:
+
+    * ``configuration.snapshot``: An encoded ``Deployment``.
+    * ``configuration.journal``: ``DeploymentDiff``\ s saved since the
+      snapshot was taken.
+    * ``configuration.journal.old``: Only present while the journal is
+      being compacted; the ``DeploymentDiff``\ s saved between the previous
+      snapshot and the start of the compaction.
+
+    Loading the configuration applies the journals, in order, to the
+    snapshot. The snapshot is always taken at a point between the start of
+    the old journal and the end of the journal, and the differences only
+    say which nodes to replace or remove, so replaying them gives the
+    latest configuration whichever snapshot is present.
+
+    Configuration written by older versions to
+    ``current_configuration.pickle`` is loaded if there is no snapshot.
+
+    :ivar Logger logger: The logger to which compaction failures and
+        exceptions raised by change callbacks are logged.
+    :ivar int generation: Incremented every time the configuration
+        changes, so readers can cheaply tell whether it has.
+    :ivar Deployment _deployment: The current desired deployment
+        configuration.
+    :ivar Deployment _durable_deployment: The desired deployment
+        configuration as of the last record written to the journal.
+    :ivar _Journal _journal: The journal new changes are appended to.
+    :ivar int _snapshot_size: The size in bytes of the latest snapshot.
+    :ivar DeferredLock _lock: Serializes writes to the journal.
+    :ivar Deferred _compaction: Fires when the compaction in progress
+        finishes, or ``None`` if the journal isn't being compacted.
+    :ivar float commit_delay: Number of seconds to wait for further
+        modifications before committing a group of them.
+    :ivar list _modifications: ``tuple``\ s of a function passed to
+        ``modify`` and the ``Deferred`` returned for it, for modifications
+        not yet committed.
+    :ivar _commit_call: The ``IDelayedCall`` for the next commit, or
+        ``None`` if no commit is scheduled.
+    :ivar bool _committing: Whether a commit is being written.
     """
-    def __init__(self, reactor, path):
+    def __init__(self, reactor, path, commit_delay=0):
         """
-        :param reactor: Reactor to use for thread pool.
+        :param reactor: Reactor to use for thread pool and to schedule
+            commits.
         :param FilePath path: Directory where desired deployment will be
             persisted.
+        :param float commit_delay: Number of seconds to wait for further
+            modifications before committing a group of them. With the
+            default of ``0`` all modifications in the same reactor
+            iteration are grouped, as well as those made while a previous
+            group is being written.
         """
+        self._reactor = reactor
         self._path = path
+        self.commit_delay = commit_delay
+        self.generation = 0
+        self._modifications = []
+        self._commit_call = None
+        self._committing = False
         self._change_callbacks = []
+        self._lock = DeferredLock()
+        self._compaction = None
+        self.logger = Logger()
 
     def startService(self):
+        Service.startService(self)
         if not self._path.exists():
             self._path.makedirs()
-        self._config_path = self._path.child(b"current_configuration.pickle")
-        if self._config_path.exists():
-            self._deployment = deserialize_deployment(
-                self._config_path.getContent())
+        self._snapshot_path = self._path.child(b"configuration.snapshot")
+        self._journal_path = self._path.child(b"configuration.journal")
+        self._old_journal_path = self._path.child(
+            b"configuration.journal.old")
+        self._deployment = self._load()
+        self._durable_deployment = self._deployment
+        # Start afresh, so the journals don't need to be replayed again:
+        self._snapshot_size = self._write_snapshot(self._deployment)
+        if self._journal_path.exists():
+            self._journal_path.remove()
+        self._journal = _Journal(self._journal_path)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._commit_call is not None:
+            self._commit_call.cancel()
+            self._commit_call = None
+        if self._modifications:
+            # Don't leave pending modifications behind. Their write is
+            # queued before the journal is closed, even if an earlier
+            # commit is still being written:
+            self._commit()
+        d = self._lock.run(self._in_thread, self._journal.close)
+        if self._compaction is not None:
+            d = DeferredList([d, self._compaction], fireOnOneErrback=True,
+                             consumeErrors=True)
+        return d
+
+    def _load(self):
+        """
+        Load the configuration from disk.
+
+        :return Deployment: The latest saved configuration.
+        """
+        if self._snapshot_path.exists():
+            deployment = deserialize_deployment(
+                self._snapshot_path.getContent())
+        else:
+            legacy_path = self._path.child(b"current_configuration.pickle")
+            if legacy_path.exists():
+                deployment = deserialize_deployment(legacy_path.getContent())
+            else:
+                deployment = Deployment(nodes=frozenset())
+        for path in [self._old_journal_path, self._journal_path]:
+            if path.exists():
+                for diff in _read_journal(path):
+                    deployment = diff.apply(deployment)
+        return deployment
+
+    def _write_snapshot(self, deployment):
+        """
+        Durably replace the snapshot and remove the old journal, which the
+        snapshot supersedes. This blocks.
+
+        :param Deployment deployment: The configuration to write.
+
+        :return int: The size of the snapshot in bytes.
+        """
+        data = serialize_deployment(deployment)
+        _write_file(self._snapshot_path, data)
+        if self._old_journal_path.exists():
+            self._old_journal_path.remove()
+        return len(data)
+
+    def _rotate_journal(self):
+        """
+        Move the journal aside so that it can be compacted, and start a new
+        one. This blocks.
+        """
+        self._journal.repair()
+        self._journal.close()
+        if self._old_journal_path.exists():
+            # A previous compaction failed, so its records must be kept too:
+            old_journal = _Journal(self._old_journal_path)
+            old_journal.write(self._journal_path.getContent())
+            old_journal.close()
+            self._journal_path.remove()
         else:
-            self._deployment = Deployment(nodes=frozenset())
-            self._sync_save(self._deployment)
+            os.rename(self._journal_path.path, self._old_journal_path.path)
+        self._journal = _Journal(self._journal_path)
+        _fsync_directory(self._path)
+
+    def _in_thread(self, f, *args):
+        """
+        Run a blocking function in the reactor's thread pool.
+
+        :param f: The function to run.
+        :param args: Positional arguments for ``f``.
+
+        :return Deferred: Fires with the result of ``f``.
+        """
+        return deferToThreadPool(
+            self._reactor, self._reactor.getThreadPool(), f, *args)
 
     def register(self, change_callback):
         """
@@ -72,28 +396,159 @@ class ConfigurationPersistenceService(Service):
         """
         self._change_callbacks.append(change_callback)
 
-    def _sync_save(self, deployment):
+    def _append(self, deployment):
         """
-        Save and flush new deployment to disk synchronously.
+        Append a record of the differences between the configuration on
+        disk and a new configuration to the journal.
+
+        This must be called with ``_lock`` held, so that
+        ``_durable_deployment`` is what the journal describes.
+
+        :param Deployment deployment: The new configuration.
+
+        :return Deferred: Fires when the record is on disk.
         """
-        self._config_path.setContent(serialize_deployment(deployment))
+        diff = diff_deployments(self._durable_deployment, deployment)
+        if not (diff.changed or diff.removed):
+            self._durable_deployment = deployment
+            return succeed(None)
+        d = self._in_thread(self._journal.append, encode(diff))
+
+        def appended(_):
+            self._durable_deployment = deployment
+        d.addCallback(appended)
+        return d
 
     def save(self, deployment):
         """
         Save and flush new deployment to disk.
 
+        The new deployment is immediately returned by ``get``, but change
+        callbacks are only called once it has been written to disk. If the
+        write fails, ``get`` returns the configuration on disk again unless
+        another one has been saved since.
+
         :return Deferred: Fires when write is finished.
         """
-        self._sync_save(deployment)
+        diff = diff_deployments(self._deployment, deployment)
+        if not (diff.changed or diff.removed):
+            return succeed(None).addCallback(self._saved)
         self._deployment = deployment
+        self.generation += 1
+        d = self._lock.run(self._append, deployment)
+
+        def failed(reason):
+            if self._deployment is deployment:
+                # Don't keep serving a configuration that was never
+                # persisted. Readers may have seen it, so this is a new
+                # generation rather than a return to the previous one:
+                self._deployment = self._durable_deployment
+                self.generation += 1
+            return reason
+        d.addCallbacks(self._saved, failed)
+        return d
+
+    def modify(self, transform):
+        """
+        Change the configuration, grouped with other modifications.
+
+        :param transform: One-argument callable that takes the latest
+            ``Deployment`` and returns a new ``Deployment``. It is called
+            at commit time, after the transforms of earlier modifications.
+            If it raises an exception the modification is discarded,
+            without affecting the others in its group.
+
+        :return Deferred: Fires with ``None`` once the modification is
+            written to disk, or fails with the exception raised by
+            ``transform``.
+        """
+        d = Deferred()
+        self._modifications.append((transform, d))
+        self._schedule_commit()
+        return d
+
+    def _commit(self):
+        """
+        Apply all pending modifications and save the result with a single
+        write. Modifications made in the meantime are committed once the
+        write finishes.
+        """
+        self._commit_call = None
+        self._committing = True
+        modifications, self._modifications = self._modifications, []
+        deployment = self._deployment
+        succeeded = []
+        for transform, d in modifications:
+            try:
+                deployment = transform(deployment)
+            except Exception:
+                d.errback()
+            else:
+                succeeded.append(d)
+
+        def committed(result):
+            self._committing = False
+            if self._modifications and self.running:
+                self._schedule_commit()
+            for d in succeeded:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(None)
+        self.save(deployment).addBoth(committed)
+
+    def _schedule_commit(self):
+        """
+        Arrange for pending modifications to be committed, unless a commit
+        is already scheduled or in progress, or the service has stopped.
+        """
+        if not self.running:
+            return
+        if self._commit_call is None and not self._committing:
+            self._commit_call = self._reactor.callLater(
+                self.commit_delay, self._commit)
+
+    def _saved(self, _):
+        """
+        Notify callbacks of a saved change, and compact the journal if it
+        has become too large.
+        """
         # At some future point this will likely involve talking to a
         # distributed system (e.g. ZooKeeper or etcd), so the API doesn't
         # guarantee immediate saving of the data.
         for callback in self._change_callbacks:
-            # Handle errors by catching and logging them
-            # https://clusterhq.atlassian.net/browse/FLOC-1311
-            callback()
-        return succeed(None)
+            # The change was saved regardless, so a failing callback must
+            # not affect the other callbacks or whoever made the change:
+            try:
+                callback()
+            except Exception:
+                writeFailure(Failure(), self.logger,
+                             u"flocker:control:persistence")
+        threshold = max(_MINIMUM_COMPACTION_SIZE, self._snapshot_size)
+        if (self.running and self._compaction is None and
+                self._journal.size > threshold):
+            self._compact()
+
+    def _compact(self):
+        """
+        Replace the snapshot and journal with a new snapshot, without
+        blocking further saves for longer than it takes to start a new
+        journal.
+        """
+        d = self._compaction = self._lock.run(
+            self._in_thread, self._rotate_journal)
+        d.addCallback(lambda _: self._in_thread(
+            self._write_snapshot, self._durable_deployment))
+
+        def compacted(snapshot_size):
+            self._snapshot_size = snapshot_size
+        d.addCallback(compacted)
+        d.addErrback(writeFailure, self.logger,
+                     u"flocker:control:persistence")
+
+        def done(_):
+            self._compaction = None
+        d.addCallback(done)
 
     def get(self):
         """
@@ -22,9 +22,24 @@ Interactions:
   NodeStateCommand, the control service then aggregates that update with
   the rest of the nodes' state and sends a ClusterStatusCommand to all
   convergence agents.
+* Every cluster status sent to an agent is tagged with a generation
+  number. Once an agent has acknowledged a generation, later updates are
+  sent as a ClusterStatusDeltaCommand which only includes the nodes that
+  changed since that generation. Agents that have not acknowledged any
+  generation (e.g. because they just connected) or that fail to apply a
+  delta get a full ClusterStatusCommand instead.
+* At most one cluster status is outstanding per connection. Updates
+  that happen while an agent is still processing the previous one are
+  merged, so when it responds it is sent only the latest configuration
+  and state.
+* AMP limits values to 64KiB, so serialized configuration and state are
+  split across as many keys of the AMP box as necessary.
 """
 
-from pickle import dumps, loads
+from collections import OrderedDict
+from time import time
+
+from eliot import Logger
 
 from characteristic import with_cmp
 
@@ -32,34 +47,143 @@ from zope.interface import Interface
 
 from twisted.application.service import Service
 from twisted.protocols.amp import (
-    Argument, Command, Integer, CommandLocator, AMP,
+    Argument, Command, Integer, ListOf, Unicode, CommandLocator, AMP,
+    MAX_VALUE_LENGTH,
 )
 from twisted.internet.protocol import ServerFactory
 from twisted.application.internet import StreamServerEndpointService
 
-from ._persistence import serialize_deployment, deserialize_deployment
+from ._logging import LOG_BROADCAST, LOG_SLOW_AGENT
+from ._model import DeploymentDiff, diff_deployments
+from ._codec import encode, decode
 
 
-class NodeStateArgument(Argument):
+class _EncodingCache(object):
+    """
+    Cache of serialized objects, keyed on the identity of the object.
+
+    The control service sends the same configuration and state objects to
+    every connected agent, so this ensures they are serialized only once
+    per broadcast (or even less often, for objects that don't change
+    between broadcasts, e.g. the desired configuration).
+
+    Cached objects are kept alive by the cache, so an identity can't be
+    reused by a different object while it is cached.
+
+    :ivar int size: The maximum number of cached objects.
+    :ivar int encoded_bytes: The total number of serialized bytes returned
+        by the cache, whether cached or not.
+    :ivar float encode_seconds: The total time spent serializing objects.
+    :ivar OrderedDict _entries: Map ``(serializer, id(obj))`` to ``(obj,
+        bytes)``, least recently used first.
+    """
+    def __init__(self, size):
+        """
+        :param int size: The maximum number of cached objects.
+        """
+        self.size = size
+        self.encoded_bytes = 0
+        self.encode_seconds = 0.0
+        self._entries = OrderedDict()
+
+    def encode(self, serializer, obj):
+        """
+        Serialize an object, or return its previously serialized form.
+
+        :param serializer: One-argument callable that serializes ``obj``
+            to ``bytes``.
+        :param obj: The object to serialize.
+
+        :return bytes: The serialized object.
+        """
+        key = (serializer, id(obj))
+        try:
+            _, data = entry = self._entries.pop(key)
+        except KeyError:
+            start = time()
+            data = serializer(obj)
+            self.encode_seconds += time() - start
+            entry = (obj, data)
+            while len(self._entries) >= self.size:
+                self._entries.popitem(last=False)
+        self._entries[key] = entry
+        self.encoded_bytes += len(data)
+        return data
+
+
+# Enough to hold the configuration and state of a broadcast, along with the
+# deltas sent to connections that are a few generations behind:
+_encoding_cache = _EncodingCache(size=16)
+
+
+class _ChunkedArgument(Argument):
+    """
+    AMP argument whose serialized form may be larger than AMP's limit on
+    the size of a single value.
+
+    The serialized bytes are split into chunks of at most
+    ``MAX_VALUE_LENGTH`` bytes. The first chunk is stored under the
+    argument's own name, subsequent chunks under the name suffixed with
+    ``.1``, ``.2`` and so on.
+    """
+    def toBox(self, name, strings, objects, proto):
+        data = self.toStringProto(objects.pop(name), proto)
+        strings[name] = data[:MAX_VALUE_LENGTH]
+        for index, offset in enumerate(
+                range(MAX_VALUE_LENGTH, len(data), MAX_VALUE_LENGTH), 1):
+            strings[b"%s.%d" % (name, index)] = data[
+                offset:offset + MAX_VALUE_LENGTH]
+
+    def fromBox(self, name, strings, objects, proto):
+        chunks = [strings.pop(name)]
+        index = 1
+        while True:
+            chunk = strings.pop(b"%s.%d" % (name, index), None)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            index += 1
+        objects[name] = self.fromStringProto(b"".join(chunks), proto)
+
+
+class NodeStateArgument(_ChunkedArgument):
     """
     AMP argument that takes a ``NodeState`` object.
     """
     def fromString(self, in_bytes):
-        return loads(in_bytes)
+        return decode(in_bytes)
 
     def toString(self, node_state):
-        return dumps(node_state)
+        return encode(node_state)
 
 
-class DeploymentArgument(Argument):
+class DeploymentArgument(_ChunkedArgument):
     """
     AMP argument that takes a ``Deployment`` object.
     """
     def fromString(self, in_bytes):
-        return deserialize_deployment(in_bytes)
+        return decode(in_bytes)
 
     def toString(self, deployment):
-        return serialize_deployment(deployment)
+        return _encoding_cache.encode(encode, deployment)
+
+
+class NodesArgument(_ChunkedArgument):
+    """
+    AMP argument that takes a ``frozenset`` of ``Node`` objects.
+    """
+    def fromString(self, in_bytes):
+        return decode(in_bytes)
+
+    def toString(self, nodes):
+        return _encoding_cache.encode(encode, nodes)
+
+
+class UnknownGeneration(Exception):
+    """
+    A delta was received relative to a generation the agent no longer (or
+    never did) know about.
+    """
 
 
 class VersionCommand(Command):
@@ -81,10 +205,30 @@ class ClusterStatusCommand(Command):
     in the convergence agent during startup.
     """
     arguments = [('configuration', DeploymentArgument()),
-                 ('state', DeploymentArgument())]
+                 ('state', DeploymentArgument()),
+                 ('generation', Integer())]
     response = []
 
 
+class ClusterStatusDeltaCommand(Command):
+    """
+    Used by the control service to inform a convergence agent of changes to
+    the cluster state and desired configuration since a generation the
+    agent has previously acknowledged.
+
+    Only the ``Node``\ s which changed are sent, along with the hostnames
+    of nodes that were removed.
+    """
+    arguments = [('generation', Integer()),
+                 ('base_generation', Integer()),
+                 ('configuration_changed', NodesArgument()),
+                 ('configuration_removed', ListOf(Unicode())),
+                 ('state_changed', NodesArgument()),
+                 ('state_removed', ListOf(Unicode()))]
+    response = []
+    errors = {UnknownGeneration: 'UNKNOWN_GENERATION'}
+
+
 class NodeStateCommand(Command):
     """
     Used by a convergence agent to update the control service about the
@@ -108,7 +252,7 @@ class ControlServiceLocator(CommandLocator):
 
     @VersionCommand.responder
     def version(self):
-        return {"major": 1}
+        return {"major": 2}
 
     @NodeStateCommand.responder
     def node_changed(self, node_state):
@@ -142,46 +286,231 @@ class ControlAMPService(Service):
     Control Service AMP server.
 
     Convergence agents connect to this server.
+
+    Changes to configuration and cluster state are not sent immediately.
+    Instead, all changes that happen within ``broadcast_delay`` seconds of
+    the first one are coalesced into a single update per connection.
+    Objects sent to multiple connections are only serialized once, and
+    the cost of every broadcast is logged.
+
+    Each connection has at most one cluster status outstanding. Updates for
+    a connection which hasn't responded yet are delayed until it does, at
+    which point it is sent the latest configuration and state; agents on
+    slow links therefore skip intermediate updates rather than having them
+    queue up.
+
+    :ivar Logger logger: The logger to which broadcasts and slow agents are
+        logged.
+    :ivar int superseded_updates: The total number of updates that were
+        merged into a later one because a connection had an update
+        outstanding.
+
+    :ivar int _generation: The generation of the most recently sent cluster
+        status.
+    :ivar dict _acknowledged: Map connections to a tuple of the latest
+        generation they acknowledged, and the desired configuration and
+        cluster state of that generation.
+    :ivar set _pending: Connections which will be sent an update when the
+        scheduled broadcast happens.
+    :ivar IDelayedCall _broadcast_call: The scheduled broadcast, or
+        ``None`` if no broadcast is scheduled.
+    :ivar dict _in_flight: Map connections with an outstanding cluster
+        status to the time it was sent.
+    :ivar dict _superseded: Map connections with an outstanding cluster
+        status to the number of updates they missed in the meantime. Such
+        connections are sent an update once they respond.
     """
-    def __init__(self, cluster_state, configuration_service, endpoint):
+    def __init__(self, reactor, cluster_state, configuration_service,
+                 endpoint, broadcast_delay=0):
         """
+        :param IReactorTime reactor: Reactor used to schedule broadcasts.
         :param ClusterStateService cluster_state: Object that records known
             cluster state.
         :param ConfigurationPersistenceService configuration_service:
             Persistence service for desired cluster configuration.
         :param endpoint: Endpoint to listen on.
+        :param float broadcast_delay: Number of seconds to wait for further
+            changes before sending updates to connections. With the default
+            of ``0`` all changes in the same reactor iteration are
+            coalesced.
         """
+        self.reactor = reactor
+        self.broadcast_delay = broadcast_delay
+        self.logger = Logger()
         self.connections = set()
+        self._generation = 0
+        self._acknowledged = {}
+        self._pending = set()
+        self._broadcast_call = None
+        self._in_flight = {}
+        self._superseded = {}
+        self.superseded_updates = 0
         self.cluster_state = cluster_state
         self.configuration_service = configuration_service
         self.endpoint_service = StreamServerEndpointService(
             endpoint, ServerFactory.forProtocol(lambda: ControlAMP(self)))
         # When configuration changes, notify all connected clients:
         self.configuration_service.register(
-            lambda: self._send_state_to_connections(self.connections))
+            lambda: self._schedule_broadcast(self.connections))
 
     def startService(self):
         self.endpoint_service.startService()
 
     def stopService(self):
+        if self._broadcast_call is not None:
+            self._broadcast_call.cancel()
+            self._broadcast_call = None
+        self._pending.clear()
         self.endpoint_service.stopService()
         for connection in self.connections:
             connection.transport.loseConnection()
 
+    def _schedule_broadcast(self, connections):
+        """
+        Arrange for desired configuration and cluster state to be sent to
+        the given connections, merged with any other pending updates.
+
+        :param connections: A collection of ``AMP`` instances.
+        """
+        if not connections:
+            return
+        self._pending.update(connections)
+        if self._broadcast_call is None:
+            self._broadcast_call = self.reactor.callLater(
+                self.broadcast_delay, self._broadcast)
+
+    def _broadcast(self):
+        """
+        Send the latest configuration and cluster state to all connections
+        with pending updates.
+        """
+        self._broadcast_call = None
+        # Connections may have been lost since the update was scheduled:
+        connections = self._pending & self.connections
+        self._pending = set()
+        ready = set()
+        for connection in connections:
+            if connection in self._in_flight:
+                self._superseded[connection] = self._superseded.get(
+                    connection, 0) + 1
+                self.superseded_updates += 1
+            else:
+                ready.add(connection)
+        if ready:
+            self._send_state_to_connections(ready)
+
     def _send_state_to_connections(self, connections):
         """
         Send desired configuration and cluster state to all given connections.
 
+        Connections which have acknowledged an earlier generation are only
+        sent the differences since that generation; all others are sent
+        everything.
+
         :param connections: A collection of ``AMP`` instances.
         """
         configuration = self.configuration_service.get()
         state = self.cluster_state.as_deployment()
+        self._generation += 1
+        generation = self._generation
+        encoded_bytes = _encoding_cache.encoded_bytes
+        encode_seconds = _encoding_cache.encode_seconds
+        # Connections which acknowledged the same generation get the same
+        # differences, so only calculate them once:
+        diffs = {}
         for connection in connections:
-            connection.callRemote(ClusterStatusCommand,
-                                  configuration=configuration,
-                                  state=state)
+            acknowledged = self._acknowledged.get(connection)
+            if acknowledged is None:
+                d = connection.callRemote(ClusterStatusCommand,
+                                          configuration=configuration,
+                                          state=state,
+                                          generation=generation)
+            else:
+                base_generation, base_configuration, base_state = acknowledged
+                if base_generation not in diffs:
+                    diffs[base_generation] = (
+                        diff_deployments(base_configuration, configuration),
+                        diff_deployments(base_state, state))
+                configuration_diff, state_diff = diffs[base_generation]
+                d = connection.callRemote(
+                    ClusterStatusDeltaCommand,
+                    generation=generation,
+                    base_generation=base_generation,
+                    configuration_changed=configuration_diff.changed,
+                    configuration_removed=list(configuration_diff.removed),
+                    state_changed=state_diff.changed,
+                    state_removed=list(state_diff.removed))
+            self._in_flight[connection] = self.reactor.seconds()
+            d.addCallbacks(
+                self._status_acknowledged, self._status_failed,
+                callbackArgs=(connection, generation, configuration, state),
+                errbackArgs=(connection,))
+            d.addBoth(self._status_done, connection, generation)
             # Handle errors from callRemote by logging them
             # https://clusterhq.atlassian.net/browse/FLOC-1311
+        LOG_BROADCAST(
+            generation=generation, connections=len(connections),
+            sent_bytes=_encoding_cache.encoded_bytes - encoded_bytes,
+            encode_seconds=_encoding_cache.encode_seconds - encode_seconds,
+            delayed=len(self._superseded),
+        ).write(self.logger)
+
+    def _status_acknowledged(self, result, connection, generation,
+                             configuration, state):
+        """
+        A connection acknowledged a cluster status, so future updates can be
+        sent as differences from it.
+
+        :param ControlAMP connection: The connection that acknowledged.
+        :param int generation: The acknowledged generation.
+        :param Deployment configuration: The configuration of that
+            generation.
+        :param Deployment state: The cluster state of that generation.
+        """
+        if connection not in self.connections:
+            return
+        acknowledged = self._acknowledged.get(connection)
+        if acknowledged is None or acknowledged[0] < generation:
+            self._acknowledged[connection] = (
+                generation, configuration, state)
+
+    def _status_failed(self, reason, connection):
+        """
+        A connection failed to process a cluster status, so it will be sent
+        a full snapshot next time. If it didn't know the generation the
+        differences were relative to, it is sent a full snapshot straight
+        away rather than acting on its stale configuration until the next
+        change.
+
+        :param Failure reason: The failure.
+        :param ControlAMP connection: The connection that failed.
+        """
+        self._acknowledged.pop(connection, None)
+        reason.trap(UnknownGeneration)
+        if connection in self.connections:
+            self._schedule_broadcast([connection])
+
+    def _status_done(self, result, connection, generation):
+        """
+        A connection responded to a cluster status, successfully or not, so
+        it can be sent the next one. If updates were delayed while waiting
+        for the response the connection is sent the latest cluster status.
+
+        :param result: The result of the command, passed through.
+        :param ControlAMP connection: The connection that responded.
+        :param int generation: The generation the connection responded to.
+        """
+        sent = self._in_flight.pop(connection, None)
+        superseded = self._superseded.pop(connection, 0)
+        if superseded and connection in self.connections:
+            LOG_SLOW_AGENT(
+                agent=unicode(connection.transport.getPeer()),
+                generation=generation,
+                response_seconds=float(self.reactor.seconds() - sent),
+                superseded=superseded,
+            ).write(self.logger)
+            self._schedule_broadcast([connection])
+        return result
 
     def connected(self, connection):
         """
@@ -190,7 +519,7 @@ class ControlAMPService(Service):
         :param ControlAMP connection: The new connection.
         """
         self.connections.add(connection)
-        self._send_state_to_connections([connection])
+        self._schedule_broadcast([connection])
 
     def disconnected(self, connection):
         """
@@ -199,16 +528,22 @@ class ControlAMPService(Service):
         :param ControlAMP connection: The lost connection.
         """
         self.connections.remove(connection)
+        self._acknowledged.pop(connection, None)
+        self._in_flight.pop(connection, None)
+        self._superseded.pop(connection, None)
 
     def node_changed(self, node_state):
         """
         We've received a node state update from a connected client.
 
-        :param bytes hostname: The hostname of the node.
+        Agents report their state on every convergence iteration, so
+        nothing is sent to other connections unless the state actually
+        changed.
+
         :param NodeState node_state: The changed state for the node.
         """
-        self.cluster_state.update_node_state(node_state)
-        self._send_state_to_connections(self.connections)
+        if self.cluster_state.update_node_state(node_state):
+            self._schedule_broadcast(self.connections)
 
 
 class IConvergenceAgent(Interface):
@@ -241,10 +576,19 @@ class IConvergenceAgent(Interface):
         """
 
 
+# The maximum number of generations an agent remembers in order to apply
+# deltas sent by the control service:
+_KNOWN_GENERATIONS = 16
+
+
 @with_cmp(["agent"])
 class _AgentLocator(CommandLocator):
     """
     Command locator for convergence agent.
+
+    :ivar OrderedDict _generations: Map recently received generations to
+        a tuple of the desired configuration and cluster state of that
+        generation, oldest first.
     """
     def __init__(self, agent):
         """
@@ -252,10 +596,49 @@ class _AgentLocator(CommandLocator):
         """
         CommandLocator.__init__(self)
         self.agent = agent
+        self._generations = OrderedDict()
 
-    @ClusterStatusCommand.responder
-    def cluster_updated(self, configuration, state):
+    def _update(self, generation, configuration, state):
+        """
+        Remember a new generation and notify the agent of it.
+
+        :param int generation: The generation.
+        :param Deployment configuration: Desired cluster configuration.
+        :param Deployment state: Actual cluster state.
+        """
+        self._generations[generation] = (configuration, state)
+        while len(self._generations) > _KNOWN_GENERATIONS:
+            self._generations.popitem(last=False)
         self.agent.cluster_updated(configuration, state)
+
+    @ClusterStatusCommand.responder
+    def cluster_updated(self, configuration, state, generation):
+        self._update(generation, configuration, state)
+        return {}
+
+    @ClusterStatusDeltaCommand.responder
+    def cluster_changed(self, generation, base_generation,
+                        configuration_changed, configuration_removed,
+                        state_changed, state_removed):
+        try:
+            base_configuration, base_state = self._generations[
+                base_generation]
+        except KeyError:
+            raise UnknownGeneration(base_generation)
+        # The control service only ever sends deltas relative to the
+        # latest acknowledged generation, so older ones are no longer
+        # needed:
+        for known in list(self._generations):
+            if known < base_generation:
+                del self._generations[known]
+        configuration = DeploymentDiff(
+            changed=configuration_changed,
+            removed=frozenset(configuration_removed)).apply(
+                base_configuration)
+        state = DeploymentDiff(
+            changed=state_changed,
+            removed=frozenset(state_removed)).apply(base_state)
+        self._update(generation, configuration, state)
         return {}
 
 
@@ -4,12 +4,17 @@ A HTTP REST API for controlling the Dataset Manager.
 """
 
 import yaml
+from bisect import bisect_right
+from heapq import nsmallest
+from operator import itemgetter
 from uuid import uuid4
 
+from characteristic import attributes, Attribute
 from pyrsistent import pmap, thaw
 
+from twisted.internet.defer import Deferred, succeed
 from twisted.python.filepath import FilePath
-from twisted.web.http import CONFLICT, CREATED
+from twisted.web.http import CONFLICT, CREATED, NOT_FOUND
 from twisted.web.server import Site
 from twisted.web.resource import Resource
 from twisted.application.internet import StreamServerEndpointService
@@ -17,15 +22,20 @@ from twisted.application.internet import StreamServerEndpointService
 from klein import Klein
 
 from ..restapi import (
-    EndpointResponse, structured, user_documentation, make_bad_request
+    EndpointResponse, structured, user_documentation, make_bad_request,
+    RequestMetrics,
 )
-from . import Dataset, Manifestation, Node, Deployment
+from . import Dataset, Manifestation, Node
 from .. import __version__
 
 
 # Default port for REST API:
 REST_API_PORT = 4523
 
+# Default number of seconds a watch request waits for a change before
+# responding anyway; clients are expected to issue another request:
+WATCH_TIMEOUT = 30
+
 
 SCHEMA_BASE = FilePath(__file__).parent().child(b'schema')
 SCHEMAS = {
@@ -40,6 +50,13 @@ DATASET_ID_COLLISION = make_bad_request(
     code=CONFLICT, description=u"The provided dataset_id is already in use.")
 PRIMARY_NODE_NOT_FOUND = make_bad_request(
     description=u"The provided primary node is not part of the cluster.")
+DATASET_NOT_FOUND = make_bad_request(
+    code=NOT_FOUND, description=u"Dataset not found.")
+INVALID_QUERY = make_bad_request(
+    description=u"The query arguments are not valid.")
+
+# The query arguments accepted by the dataset listing endpoints:
+DATASET_QUERY_ARGUMENTS = (b"primary", b"metadata", b"after", b"limit")
 
 
 class DatasetAPIUserV1(object):
@@ -52,16 +69,91 @@ class DatasetAPIUserV1(object):
     """
     app = Klein()
 
-    def __init__(self, persistence_service, cluster_state_service):
+    def __init__(self, persistence_service, cluster_state_service,
+                 reactor=None, watch_timeout=WATCH_TIMEOUT,
+                 output_validation=None, metrics=None):
         """
         :param ConfigurationPersistenceService persistence_service: Service
             for retrieving and setting desired configuration.
 
         :param ClusterStateService cluster_state_service: Service that
             knows about the current state of the cluster.
+
+        :param reactor: Reactor used to time out watch requests; the global
+            reactor by default.
+
+        :param float watch_timeout: Number of seconds a watch request waits
+            for a change before responding anyway.
+
+        :param OutputValidation output_validation: Which responses to
+            validate against their schema; all of them by default.
+
+        :param RequestMetrics metrics: Where to record statistics about the
+            requests handled; by default a new ``RequestMetrics`` timing
+            requests with ``reactor``.
         """
+        if reactor is None:
+            from twisted.internet import reactor
         self.persistence_service = persistence_service
         self.cluster_state_service = cluster_state_service
+        self._reactor = reactor
+        self._watch_timeout = watch_timeout
+        self.output_validation = output_validation
+        if metrics is None:
+            metrics = RequestMetrics(reactor)
+        self.metrics = metrics
+        # Callables checking whether a waiting request can be answered:
+        self._waiters = []
+        persistence_service.register(self._changed)
+        cluster_state_service.register(self._changed)
+        # Generation counters start from zero again when the process
+        # restarts, so entity tags also identify this instance:
+        self._instance_id = uuid4().hex
+
+    def _changed(self):
+        """
+        Answer the waiting requests whose condition is now met.
+        """
+        for check in list(self._waiters):
+            check()
+
+    def _wait_for(self, condition):
+        """
+        Wait until the configuration or cluster state satisfies a condition.
+
+        :param condition: No-argument callable returning whether the wait is
+            over.  It is called now, and again after every change.
+
+        :return: A ``Deferred`` which fires with ``True`` once the condition
+            is satisfied, or ``False`` if it still isn't after the watch
+            timeout.  Cancelling it stops the wait.
+        """
+        if condition():
+            return succeed(True)
+
+        def finish(result):
+            self._waiters.remove(check)
+            if timeout.active():
+                timeout.cancel()
+            if result is not None:
+                waiting.callback(result)
+
+        def check():
+            if condition():
+                finish(True)
+        waiting = Deferred(lambda _: finish(None))
+        self._waiters.append(check)
+        timeout = self._reactor.callLater(self._watch_timeout, finish, False)
+        return waiting
+
+    def _entity_tag(self, service):
+        """
+        :param service: A service with a ``generation`` counter.
+
+        :return bytes: An entity tag identifying the current version of the
+            responses derived from the given service.
+        """
+        return b"%s-%d" % (self._instance_id, service.generation)
 
     @app.route("/version", methods=['GET'])
     @user_documentation("""
@@ -78,12 +170,41 @@ class DatasetAPIUserV1(object):
         """
         return {u"flocker":  __version__}
 
+    @app.route("/metrics", methods=['GET'])
+    @user_documentation("""
+        Get statistics about the requests handled by this API.
+
+        The response uses the Prometheus text exposition format, and gives
+        for each endpoint the number of requests in progress, the number of
+        responses with each response code and histograms of the time taken
+        to respond and of the size of the responses.
+        """)
+    def get_metrics(self, request):
+        """
+        Return the request metrics.
+
+        :param request: The request being responded to.
+
+        :return bytes: The metrics in the Prometheus text exposition format.
+        """
+        request.responseHeaders.setRawHeaders(
+            b"content-type", [self.metrics.CONTENT_TYPE])
+        return self.metrics.render()
+
     @app.route("/configuration/datasets", methods=['GET'])
     @user_documentation(
         """
         Get the cluster's dataset configuration.
+
+        The datasets are ordered by ``dataset_id``.  They can be filtered
+        with the ``primary=<address>`` and ``metadata=<key>=<value>`` query
+        arguments; ``metadata`` may be given more than once.  The
+        ``limit=<count>`` query argument limits the number of datasets
+        returned; to get the next page pass the ``dataset_id`` of the last
+        dataset returned as ``after=<dataset_id>``.
         """,
-        examples=[u"get configured datasets"],
+        examples=[u"get configured datasets",
+                  u"get configured datasets with metadata"],
     )
     @structured(
         inputSchema={},
@@ -91,15 +212,60 @@ class DatasetAPIUserV1(object):
             '$ref': '/v1/endpoints.json#/definitions/datasets_array',
         },
         schema_store=SCHEMAS,
+        etag=lambda self: self._entity_tag(self.persistence_service),
+        query_arguments=DATASET_QUERY_ARGUMENTS,
     )
-    def get_dataset_configuration(self):
+    def get_dataset_configuration(self, primary=None, metadata=None,
+                                  after=None, limit=None):
         """
         Get the configured datasets.
 
-        :return: A ``list`` of ``dict`` representing each of dataset
-            that is configured to exist anywhere on the cluster.
+        The arguments are the values of the query arguments of the same
+        name; see ``DatasetQuery.from_arguments``.
+
+        :return: An iterator of ``dict`` representing each of dataset that
+            is configured to exist anywhere on the cluster and matches the
+            query, so that the response is streamed.
+        """
+        query = DatasetQuery.from_arguments(primary, metadata, after, limit)
+        return _api_datasets(query.select(self.persistence_service.get()))
+
+    @app.route("/configuration/datasets/watch/<int:generation>",
+               methods=['GET'])
+    @user_documentation(
+        """
+        Wait for the cluster's dataset configuration to change.
+        """,
+        examples=[u"watch configured datasets"],
+    )
+    @structured(
+        inputSchema={},
+        outputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/datasets_generation',
+        },
+        schema_store=SCHEMAS,
+    )
+    def watch_dataset_configuration(self, generation):
+        """
+        Get the configured datasets once they differ from a previously
+        retrieved version.
+
+        :param int generation: The ``generation`` from a previous response,
+            or ``0`` initially.
+
+        :return: A ``Deferred`` firing with a ``dict`` of the current
+            ``generation`` and the configured ``datasets``, once the
+            configuration has changed since ``generation`` or the watch
+            times out.
         """
-        return list(datasets_from_deployment(self.persistence_service.get()))
+        service = self.persistence_service
+        waiting = self._wait_for(lambda: service.generation != generation)
+        waiting.addCallback(lambda _: {
+            u"generation": service.generation,
+            u"datasets": list(
+                _api_datasets(DatasetQuery().select(service.get()))),
+        })
+        return waiting
 
     @app.route("/configuration/datasets", methods=['POST'])
     @user_documentation(
@@ -147,90 +313,454 @@ class DatasetAPIUserV1(object):
             cluster configuration or giving error information if this is not
             possible.
         """
-        if dataset_id is None:
-            dataset_id = unicode(uuid4())
-        dataset_id = dataset_id.lower()
-
-        if metadata is None:
-            metadata = {}
-
-        # Use persistence_service to get a Deployment for the cluster
-        # configuration.
-        deployment = self.persistence_service.get()
-        for node in deployment.nodes:
-            for manifestation in node.manifestations():
-                if manifestation.dataset.dataset_id == dataset_id:
-                    raise DATASET_ID_COLLISION
-
         # XXX Check cluster state to determine if the given primary node
         # actually exists.  If not, raise PRIMARY_NODE_NOT_FOUND.
         # See FLOC-1278
 
-        dataset = Dataset(
-            dataset_id=dataset_id,
-            maximum_size=maximum_size,
-            metadata=pmap(metadata)
-        )
-        manifestation = Manifestation(dataset=dataset, primary=True)
-
-        primary_nodes = list(
-            node for node in deployment.nodes if primary == node.hostname
-        )
-        if len(primary_nodes) == 0:
-            # The node wasn't found in the configuration so create a new node
-            # to which a manifestation can be added.  FLOC-1278 will make sure
-            # we're not creating nonsense configuration in this step.
-            primary_node = Node(hostname=primary)
-        else:
-            # One was found.  Add the manifestation to it.
-            (primary_node,) = primary_nodes
+        dataset = new_dataset(dataset_id, maximum_size, metadata)
+        saving = self.persistence_service.modify(
+            lambda deployment: add_primary_dataset(
+                deployment, primary, dataset))
+        saving.addCallback(lambda _: EndpointResponse(
+            CREATED, api_dataset_from_dataset_and_node(dataset, primary)))
+        return saving
 
-        new_node_config = Node(
-            hostname=primary_node.hostname,
-            applications=primary_node.applications,
-            other_manifestations=(
-                primary_node.other_manifestations | frozenset({manifestation})
-            )
-        )
-        other_nodes = frozenset(
-            node for node in deployment.nodes if node is not primary_node
-        )
-        new_deployment = Deployment(
-            nodes=other_nodes | frozenset({new_node_config})
-        )
-        saving = self.persistence_service.save(new_deployment)
+    @app.route("/configuration/datasets/bulk", methods=['POST'])
+    @user_documentation(
+        """
+        Create several new datasets at once.
+        """,
+        examples=[
+            u"create datasets in bulk",
+        ]
+    )
+    @structured(
+        inputSchema={'$ref': '/v1/endpoints.json#/definitions/datasets_bulk'},
+        outputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/datasets_bulk_results'
+            },
+        schema_store=SCHEMAS
+    )
+    def create_datasets_configuration(self, datasets):
+        """
+        Create several new datasets in the cluster configuration, with a
+        single configuration change.
+
+        Every dataset in the request must be valid for the request to be
+        accepted.  Datasets whose ``dataset_id`` is already in use, or used
+        by an earlier dataset in the same request, are not created; the other
+        datasets still are.
+
+        :param list datasets: ``dict``\ s describing the datasets to create,
+            each taking the same keys as the request body for creating a
+            single dataset.
+
+        :return: A ``Deferred`` firing with a ``dict`` whose ``results``
+            give, in the same order as ``datasets``, the response code and
+            description of each dataset and any error creating it.
+        """
+        requested = [
+            (spec[u"primary"],
+             new_dataset(spec.get(u"dataset_id"), spec.get(u"maximum_size"),
+                         spec.get(u"metadata")))
+            for spec in datasets]
+        errors = []
+
+        def add(deployment):
+            deployment, errors[:] = add_primary_datasets(deployment, requested)
+            return deployment
+        saving = self.persistence_service.modify(add)
 
         def saved(ignored):
-            result = {
-                u"dataset_id": dataset_id,
-                u"primary": primary,
-                u"metadata": metadata,
-            }
-            if maximum_size is not None:
-                result[u"maximum_size"] = maximum_size
-            return EndpointResponse(CREATED, result)
+            results = []
+            for (primary, dataset), error in zip(requested, errors):
+                result = {u"dataset": api_dataset_from_dataset_and_node(
+                    dataset, primary)}
+                if error is None:
+                    result[u"code"] = CREATED
+                else:
+                    result[u"code"] = error.code
+                    result[u"description"] = error.result[u"description"]
+                results.append(result)
+            return {u"results": results}
         saving.addCallback(saved)
         return saving
 
     @app.route("/state/datasets", methods=['GET'])
     @user_documentation("""
         Get current cluster datasets.
+
+        This supports the same query arguments as getting the configured
+        datasets.
         """, examples=[u"get state datasets"])
     @structured(
         inputSchema={},
         outputSchema={
             '$ref': '/v1/endpoints.json#/definitions/datasets_array'
             },
-        schema_store=SCHEMAS
+        schema_store=SCHEMAS,
+        etag=lambda self: self._entity_tag(self.cluster_state_service),
+        query_arguments=DATASET_QUERY_ARGUMENTS,
     )
-    def state_datasets(self):
+    def state_datasets(self, primary=None, metadata=None, after=None,
+                       limit=None):
         """
         Return the current primary datasets in the cluster.
 
-        :return: A ``list`` containing all datasets in the cluster.
+        The arguments are the values of the query arguments of the same
+        name; see ``DatasetQuery.from_arguments``.
+
+        :return: An iterator of all datasets in the cluster which match the
+            query, so that the response is streamed.  It selects from a
+            snapshot of the cluster state, so the listing stays consistent
+            while it is written.
+        """
+        query = DatasetQuery.from_arguments(primary, metadata, after, limit)
+        return _api_datasets(
+            query.select(self.cluster_state_service.as_deployment()))
+
+    @app.route("/state/datasets/watch/<int:generation>", methods=['GET'])
+    @user_documentation("""
+        Wait for the current cluster datasets to change.
+        """, examples=[u"watch state datasets"])
+    @structured(
+        inputSchema={},
+        outputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/datasets_generation'
+            },
+        schema_store=SCHEMAS
+    )
+    def watch_state_datasets(self, generation):
+        """
+        Get the current primary datasets in the cluster once the cluster
+        state differs from a previously retrieved version.
+
+        :param int generation: The ``generation`` from a previous response,
+            or ``0`` initially.
+
+        :return: A ``Deferred`` firing with a ``dict`` of the current
+            ``generation`` and the ``datasets`` in the cluster, once the
+            cluster state has changed since ``generation`` or the watch
+            times out.
+        """
+        service = self.cluster_state_service
+        waiting = self._wait_for(lambda: service.generation != generation)
+        waiting.addCallback(lambda _: {
+            u"generation": service.generation,
+            u"datasets": list(_api_datasets(DatasetQuery().select(
+                self.cluster_state_service.as_deployment()))),
+        })
+        return waiting
+
+    @app.route("/state/datasets/<dataset_id>/converged", methods=['GET'])
+    @user_documentation("""
+        Wait for the state of a dataset to match its configuration.
+        """, examples=[u"wait for dataset convergence"])
+    @structured(
+        inputSchema={},
+        outputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/dataset_convergence'
+            },
+        schema_store=SCHEMAS
+    )
+    def wait_for_dataset(self, dataset_id):
+        """
+        Wait until the primary manifestation of a dataset is on the
+        configured node, with the configured maximum size.
+
+        :param unicode dataset_id: The ID of the dataset.
+
+        :return: A ``Deferred`` firing with a ``dict`` saying whether the
+            dataset ``converged`` before the watch timed out and giving
+            its current ``state``, or ``None`` if no node reported a
+            primary manifestation of it.
+        """
+        dataset_id = dataset_id.lower()
+        if configured_primary(
+                self.persistence_service.get(), dataset_id) is None:
+            raise DATASET_NOT_FOUND
+
+        def state():
+            found = self.cluster_state_service.get_manifestation(dataset_id)
+            if found is None:
+                return None
+            hostname, manifestation = found
+            return hostname, manifestation.dataset
+
+        def converged():
+            configured = configured_primary(
+                self.persistence_service.get(), dataset_id)
+            current = state()
+            if configured is None or current is None:
+                return False
+            return (configured[0] == current[0] and
+                    configured[1].maximum_size == current[1].maximum_size)
+
+        waiting = self._wait_for(converged)
+
+        def result(converged):
+            current = state()
+            if current is not None:
+                hostname, dataset = current
+                current = api_dataset_from_dataset_and_node(dataset, hostname)
+            return {u"converged": converged, u"state": current}
+        waiting.addCallback(result)
+        return waiting
+
+
+def new_dataset(dataset_id=None, maximum_size=None, metadata=None):
+    """
+    Create a ``Dataset`` from the values given in a request body.
+
+    :param unicode dataset_id: The requested ID, or ``None`` to generate a
+        new one.
+    :param int maximum_size: The requested maximum size, or ``None``.
+    :param dict metadata: The requested metadata, or ``None`` for none.
+
+    :return Dataset: The dataset to add to the configuration.
+    """
+    if dataset_id is None:
+        dataset_id = unicode(uuid4())
+    if metadata is None:
+        metadata = {}
+    return Dataset(
+        dataset_id=dataset_id.lower(),
+        maximum_size=maximum_size,
+        metadata=pmap(metadata)
+    )
+
+
+def add_primary_dataset(deployment, primary, dataset):
+    """
+    Add a new dataset with its primary manifestation on the given node.
+
+    :param Deployment deployment: The configuration to add the dataset to.
+        This should be the latest configuration, which may include datasets
+        created by concurrent requests.
+    :param unicode primary: The hostname of the node which will hold the
+        primary manifestation.
+    :param Dataset dataset: The dataset to add.
+
+    :raise: ``DATASET_ID_COLLISION`` if a dataset with the same ID is
+        already in the configuration.
+
+    :return Deployment: The configuration including the new dataset.
+    """
+    deployment, [error] = add_primary_datasets(
+        deployment, [(primary, dataset)])
+    if error is not None:
+        raise error
+    return deployment
+
+
+def add_primary_datasets(deployment, requested):
+    """
+    Add new datasets with their primary manifestations on the given nodes.
+
+    Each node gaining datasets is only updated once, however many datasets
+    it gains.
+
+    :param Deployment deployment: The configuration to add the datasets to.
+    :param requested: Sequence of ``tuple``\ s of the hostname of the node
+        which will hold the primary manifestation and the ``Dataset`` to add.
+
+    :return: ``tuple`` of the ``Deployment`` including the datasets that
+        could be added, and a ``list`` giving for each requested dataset
+        either ``None`` if it was added or the ``BadRequest`` explaining why
+        it wasn't.
+    """
+    added = {}
+    errors = []
+    for primary, dataset in requested:
+        if (dataset.dataset_id in added or
+                deployment.dataset_hostnames(dataset.dataset_id)):
+            errors.append(DATASET_ID_COLLISION)
+        else:
+            added[dataset.dataset_id] = (primary, dataset)
+            errors.append(None)
+
+    by_primary = {}
+    for primary, dataset in added.values():
+        by_primary.setdefault(primary, []).append(
+            Manifestation(dataset=dataset, primary=True))
+
+    for primary, manifestations in by_primary.items():
+        # If the node isn't in the configuration a new node is created to
+        # which manifestations can be added.  FLOC-1278 will make sure we're
+        # not creating nonsense configuration in this step.
+        primary_node = deployment.get_node(primary, Node(hostname=primary))
+        deployment = deployment.update_node(Node(
+            hostname=primary_node.hostname,
+            applications=primary_node.applications,
+            other_manifestations=(
+                primary_node.other_manifestations | frozenset(manifestations)
+            )
+        ))
+    return deployment, errors
+
+
+@attributes([Attribute("primary", default_value=None),
+             Attribute("metadata", default_value=frozenset()),
+             Attribute("after", default_value=None),
+             Attribute("limit", default_value=None)])
+class DatasetQuery(object):
+    """
+    Criteria selecting some of the primary datasets in the configuration or
+    the cluster state.
+
+    Selection uses the indexes of the source, so it takes time proportional
+    to the number of candidate datasets rather than the size of the cluster.
+    Without ``primary`` or ``metadata`` every dataset is a candidate, but
+    their IDs are kept sorted, so a page takes time proportional to its
+    size.
+
+    :ivar unicode primary: Only select datasets whose primary manifestation
+        is on the node with this hostname, or ``None`` to select datasets on
+        any node.
+    :ivar frozenset metadata: ``tuple``\ s of metadata key and value, all of
+        which must be in the metadata of selected datasets.
+    :ivar unicode after: Only select datasets whose ID sorts after this one,
+        or ``None`` to start from the first dataset.
+    :ivar int limit: The maximum number of datasets to select, or ``None``
+        for no limit.
+    """
+    @classmethod
+    def from_arguments(cls, primary=None, metadata=None, after=None,
+                       limit=None):
+        """
+        Create a query from query arguments.
+
+        Each argument is ``None`` if the query argument was not given, or a
+        ``list`` of its ``unicode`` values.
+
+        :param primary: A single hostname.
+        :param metadata: Metadata items, each a key and value separated by
+            the first ``=``.
+        :param after: A single dataset ID.
+        :param limit: A single positive integer.
+
+        :raise: ``INVALID_QUERY`` if the arguments are not valid.
+
+        :return DatasetQuery: The query.
+        """
+        def single(values):
+            if values is None:
+                return None
+            if len(values) != 1:
+                raise INVALID_QUERY
+            return values[0]
+
+        items = []
+        for item in metadata or []:
+            key, separator, value = item.partition(u"=")
+            if not separator:
+                raise INVALID_QUERY
+            items.append((key, value))
+
+        after = single(after)
+        limit = single(limit)
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise INVALID_QUERY
+            if limit < 1:
+                raise INVALID_QUERY
+        return cls(primary=single(primary), metadata=frozenset(items),
+                   after=None if after is None else after.lower(),
+                   limit=limit)
+
+    def select(self, source):
+        """
+        Select the datasets matching this query.
+
+        The IDs of the matching datasets are found up front, but their
+        primary manifestations are only looked up as the result is
+        consumed, so the source must not change in the meantime.
+
+        :param source: A ``Deployment`` or a ``ClusterStateService``.
+
+        :return: An iterator of ``tuple``\ s of hostname and ``Dataset``,
+            for each selected primary manifestation, ordered by dataset ID.
+            Datasets with several primary manifestations contribute one
+            entry per manifestation but only count once towards ``limit``.
+        """
+        candidates = None
+        if self.primary is not None:
+            node = source.get_node(self.primary)
+            candidates = frozenset() if node is None else frozenset(
+                manifestation.dataset.dataset_id
+                for manifestation in node.manifestations()
+                if manifestation.primary)
+        for key, value in self.metadata:
+            matching = source.datasets_with_metadata(key, value)
+            if candidates is None:
+                candidates = matching
+            else:
+                candidates = candidates & matching
+        if candidates is None:
+            dataset_ids = source.primary_dataset_ids()
+            start = 0
+            if self.after is not None:
+                start = bisect_right(dataset_ids, self.after)
+            if self.limit is None:
+                dataset_ids = dataset_ids[start:]
+            else:
+                dataset_ids = dataset_ids[start:start + self.limit]
+            return self._manifestations(source, dataset_ids)
+        if self.after is not None:
+            candidates = (dataset_id for dataset_id in candidates
+                          if dataset_id > self.after)
+        if self.limit is None:
+            dataset_ids = sorted(candidates)
+        else:
+            dataset_ids = nsmallest(self.limit, candidates)
+
+        return self._manifestations(source, dataset_ids)
+
+    def _manifestations(self, source, dataset_ids):
+        """
+        :param source: A ``Deployment`` or a ``ClusterStateService``.
+        :param dataset_ids: The IDs of the selected datasets, in order.
+
+        :return: An iterator of ``tuple``\ s of hostname and ``Dataset`` for
+            the matching primary manifestations of the datasets.
         """
-        deployment = self.cluster_state_service.as_deployment()
-        return list(datasets_from_deployment(deployment))
+        for dataset_id in dataset_ids:
+            for hostname, dataset in sorted(
+                    source.get_primaries(dataset_id), key=itemgetter(0)):
+                if (self.primary in (None, hostname) and
+                        self.metadata <= frozenset(dataset.metadata.items())):
+                    yield hostname, dataset
+
+
+def _api_datasets(selected):
+    """
+    :param selected: Iterable of ``tuple``\ s of hostname and ``Dataset``.
+
+    :return: An iterator of ``dict``\ s conforming to
+        ``/v1/endpoints.json#/definitions/datasets_array``.
+    """
+    return (api_dataset_from_dataset_and_node(dataset, hostname)
+            for (hostname, dataset) in selected)
+
+
+def configured_primary(deployment, dataset_id):
+    """
+    Find the configured primary manifestation of a dataset.
+
+    :param Deployment deployment: The configuration.
+    :param unicode dataset_id: The ID of the dataset.
+
+    :return: ``tuple`` of the hostname of the node with the primary
+        manifestation and the ``Dataset``, or ``None`` if the dataset has no
+        primary manifestation in the configuration.  If there are multiple
+        primary manifestations the one with the lowest hostname is returned.
+    """
+    primaries = sorted(deployment.get_primaries(dataset_id), key=itemgetter(0))
+    if not primaries:
+        return None
+    return primaries[0]
 
 
 def datasets_from_deployment(deployment):
@@ -280,7 +810,8 @@ def api_dataset_from_dataset_and_node(dataset, node_hostname):
     return result
 
 
-def create_api_service(persistence_service, cluster_state_service, endpoint):
+def create_api_service(persistence_service, cluster_state_service, endpoint,
+                       reactor=None, output_validation=None):
     """
     Create a Twisted Service that serves the API on the given endpoint.
 
@@ -292,10 +823,17 @@ def create_api_service(persistence_service, cluster_state_service, endpoint):
 
     :param endpoint: Twisted endpoint to listen on.
 
+    :param reactor: Reactor used to time out watch requests; the global
+        reactor by default.
+
+    :param OutputValidation output_validation: Which responses to validate
+        against their schema; all of them by default.
+
     :return: Service that will listen on the endpoint using HTTP API server.
     """
     api_root = Resource()
-    user = DatasetAPIUserV1(persistence_service, cluster_state_service)
+    user = DatasetAPIUserV1(persistence_service, cluster_state_service,
+                            reactor, output_validation=output_validation)
     api_root.putChild('v1', user.app.resource())
     api_root._v1_user = user  # For unit testing purposes, alas
     return StreamServerEndpointService(endpoint, Site(api_root))
@@ -4,11 +4,13 @@
 Script for starting control service server.
 """
 
-from twisted.python.usage import Options
+from twisted.python.usage import Options, UsageError
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.python.filepath import FilePath
 from twisted.application.service import MultiService
 
+from ..restapi import OutputValidation
+
 from .httpapi import create_api_service, REST_API_PORT
 from ._persistence import ConfigurationPersistenceService
 from ._clusterstate import ClusterStateService
@@ -29,8 +31,18 @@ class ControlOptions(Options):
          int],
         ["agent-port", "a", 4524,
          "The port convergence agents will connect to.", int],
+        ["broadcast-delay", None, 0.0,
+         "Seconds to wait for further changes before sending updated "
+         "cluster status to convergence agents.", float],
+        ["validate-output", None, 1,
+         "Validate one in this many API responses against their schema; "
+         "0 disables validation.", int],
     ]
 
+    def postOptions(self):
+        if self["validate-output"] < 0:
+            raise UsageError("--validate-output must not be negative.")
+
 
 class ControlScript(object):
     """
@@ -44,11 +56,15 @@ class ControlScript(object):
         persistence.setServiceParent(top_service)
         cluster_state = ClusterStateService()
         cluster_state.setServiceParent(top_service)
-        create_api_service(persistence, cluster_state, TCP4ServerEndpoint(
-            reactor, options["port"])).setServiceParent(top_service)
+        create_api_service(
+            persistence, cluster_state,
+            TCP4ServerEndpoint(reactor, options["port"]), reactor,
+            OutputValidation(options["validate-output"]),
+        ).setServiceParent(top_service)
         amp_service = ControlAMPService(
-            cluster_state, persistence, TCP4ServerEndpoint(
-                reactor, options["agent-port"]))
+            reactor, cluster_state, persistence, TCP4ServerEndpoint(
+                reactor, options["agent-port"]),
+            broadcast_delay=options["broadcast-delay"])
         amp_service.setServiceParent(top_service)
         return main_for_service(reactor, top_service)
 
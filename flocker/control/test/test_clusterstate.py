@@ -6,12 +6,15 @@ Tests for ``flocker.control._clusterstate``.
 
 from uuid import uuid4
 
+from pyrsistent import pmap
+
 from twisted.trial.unittest import SynchronousTestCase
+from twisted.python.filepath import FilePath
 
 from .._clusterstate import ClusterStateService
 from .._model import (
     Application, DockerImage, NodeState, Node, Deployment, Manifestation,
-    Dataset,
+    Dataset, AttachedVolume,
 )
 
 APP1 = Application(
@@ -96,3 +99,283 @@ class ClusterStateServiceTests(SynchronousTestCase):
                                  hostname=u"host2",
                                  applications=frozenset([APP2])),
                          ])))
+
+    def test_update_changed(self):
+        """
+        ``ClusterStateService.update_node_state`` returns ``True`` if the
+        given state differs from the previously known state of the node.
+        """
+        service = self.service()
+        results = [
+            service.update_node_state(NodeState(
+                hostname=u"host1", running=[APP1], not_running=[])),
+            service.update_node_state(NodeState(
+                hostname=u"host1", running=[APP2], not_running=[])),
+        ]
+        self.assertEqual(results, [True, True])
+
+    def test_update_unchanged(self):
+        """
+        ``ClusterStateService.update_node_state`` returns ``False`` if the
+        given state is identical to the previously known state of the node.
+        """
+        service = self.service()
+        service.update_node_state(NodeState(
+            hostname=u"host1", running=[APP1], not_running=[]))
+        self.assertFalse(service.update_node_state(NodeState(
+            hostname=u"host1", running=[APP1], not_running=[])))
+
+    def test_generation(self):
+        """
+        ``ClusterStateService.generation`` is incremented when the state of a
+        node changes, but not when an identical state is reported.
+        """
+        service = self.service()
+        generations = [service.generation]
+        for applications in [[APP1], [APP1], [APP2]]:
+            service.update_node_state(NodeState(
+                hostname=u"host1", running=applications, not_running=[]))
+            generations.append(service.generation)
+        self.assertEqual(generations, [0, 1, 1, 2])
+
+    def test_register(self):
+        """
+        Callbacks registered with ``ClusterStateService.register`` are called
+        when the state of a node changes, but not when an identical state is
+        reported.
+        """
+        service = self.service()
+        called = []
+        service.register(lambda: called.append(service.generation))
+        for applications in [[APP1], [APP1], [APP2]]:
+            service.update_node_state(NodeState(
+                hostname=u"host1", running=applications, not_running=[]))
+        self.assertEqual(called, [1, 2])
+
+    def test_primaries(self):
+        """
+        ``ClusterStateService.primary_dataset_ids`` and
+        ``ClusterStateService.get_primaries`` only include primary
+        manifestations.
+        """
+        service = self.service()
+        primary = Dataset(dataset_id=unicode(uuid4()))
+        replica = Dataset(dataset_id=unicode(uuid4()))
+        service.update_node_state(NodeState(
+            hostname=u"host1", running=[], not_running=[],
+            other_manifestations=frozenset([
+                Manifestation(dataset=primary, primary=True),
+                Manifestation(dataset=replica, primary=False)])))
+        self.assertEqual(
+            (list(service.primary_dataset_ids()),
+             service.get_primaries(primary.dataset_id),
+             service.get_primaries(replica.dataset_id)),
+            ([primary.dataset_id], frozenset([(u"host1", primary)]),
+             frozenset()))
+
+    def test_datasets_with_metadata(self):
+        """
+        ``ClusterStateService.datasets_with_metadata`` returns the IDs of the
+        datasets whose reported metadata maps the given key to the given
+        value, reflecting the latest state of each node.
+        """
+        service = self.service()
+        dataset_id = unicode(uuid4())
+
+        def report(owner):
+            service.update_node_state(NodeState(
+                hostname=u"host1", running=[], not_running=[],
+                other_manifestations=frozenset([Manifestation(
+                    dataset=Dataset(dataset_id=dataset_id,
+                                    metadata=pmap({u"owner": owner})),
+                    primary=True)])))
+        report(u"alice")
+        before = service.datasets_with_metadata(u"owner", u"alice")
+        report(u"bob")
+        self.assertEqual(
+            (before, service.datasets_with_metadata(u"owner", u"alice"),
+             service.datasets_with_metadata(u"owner", u"bob")),
+            (frozenset([dataset_id]), frozenset(), frozenset([dataset_id])))
+
+    def test_deployment_cached(self):
+        """
+        ``ClusterStateService.as_deployment`` returns the same object until
+        the state changes.
+        """
+        service = self.service()
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1], not_running=[]))
+        first = service.as_deployment()
+        second = service.as_deployment()
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1], not_running=[]))
+        unchanged = service.as_deployment()
+        self.assertEqual((first is second, first is unchanged),
+                         (True, True))
+
+    def test_deployment_invalidated(self):
+        """
+        ``ClusterStateService.as_deployment`` reflects changes made after it
+        was previously called.
+        """
+        service = self.service()
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1], not_running=[]))
+        service.as_deployment()
+        service.update_node_state(NodeState(hostname=u"host2",
+                                            running=[APP2], not_running=[]))
+        self.assertEqual(service.as_deployment(),
+                         Deployment(nodes=frozenset([
+                             Node(hostname=u"host1",
+                                  applications=frozenset([APP1])),
+                             Node(hostname=u"host2",
+                                  applications=frozenset([APP2])),
+                         ])))
+
+    def test_unchanged_nodes_reused(self):
+        """
+        Updating the state of one node does not recreate the ``Node``
+        instances of other nodes.
+        """
+        service = self.service()
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1], not_running=[]))
+        node = service.get_node(u"host1")
+        service.update_node_state(NodeState(hostname=u"host2",
+                                            running=[APP2], not_running=[]))
+        self.assertTrue(
+            any(n is node for n in service.as_deployment().nodes))
+
+    def test_get_node(self):
+        """
+        ``ClusterStateService.get_node`` returns the ``Node`` for the given
+        hostname.
+        """
+        service = self.service()
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1], not_running=[]))
+        self.assertEqual(
+            service.get_node(u"host1"),
+            Node(hostname=u"host1", applications=frozenset([APP1])))
+
+    def test_get_unknown_node(self):
+        """
+        ``ClusterStateService.get_node`` returns ``None`` for unknown
+        hostnames.
+        """
+        self.assertIs(self.service().get_node(u"host1"), None)
+
+    def test_get_manifestation(self):
+        """
+        ``ClusterStateService.get_manifestation`` returns the hostname and
+        ``Manifestation`` of the primary manifestation of a dataset.
+        """
+        service = self.service()
+        service.update_node_state(
+            NodeState(hostname=u"host2", running=[], not_running=[],
+                      other_manifestations=frozenset([MANIFESTATION])))
+        self.assertEqual(
+            service.get_manifestation(MANIFESTATION.dataset.dataset_id),
+            (u"host2", MANIFESTATION))
+
+    def test_get_unknown_manifestation(self):
+        """
+        ``ClusterStateService.get_manifestation`` returns ``None`` for
+        datasets no node reported.
+        """
+        self.assertIs(
+            self.service().get_manifestation(unicode(uuid4())), None)
+
+    def test_get_moved_manifestation(self):
+        """
+        When a manifestation moves from one node to another,
+        ``ClusterStateService.get_manifestation`` returns the new node.
+        """
+        service = self.service()
+        service.update_node_state(
+            NodeState(hostname=u"host1", running=[], not_running=[],
+                      other_manifestations=frozenset([MANIFESTATION])))
+        service.update_node_state(
+            NodeState(hostname=u"host2", running=[], not_running=[],
+                      other_manifestations=frozenset([MANIFESTATION])))
+        service.update_node_state(
+            NodeState(hostname=u"host1", running=[], not_running=[]))
+        self.assertEqual(
+            service.get_manifestation(MANIFESTATION.dataset.dataset_id),
+            (u"host2", MANIFESTATION))
+
+    def test_get_removed_manifestation(self):
+        """
+        When a node no longer reports a manifestation,
+        ``ClusterStateService.get_manifestation`` returns ``None``.
+        """
+        service = self.service()
+        service.update_node_state(
+            NodeState(hostname=u"host1", running=[], not_running=[],
+                      other_manifestations=frozenset([MANIFESTATION])))
+        service.update_node_state(
+            NodeState(hostname=u"host1", running=[], not_running=[]))
+        self.assertIs(
+            service.get_manifestation(MANIFESTATION.dataset.dataset_id),
+            None)
+
+    def test_get_manifestation_ignores_replicas(self):
+        """
+        ``ClusterStateService.get_manifestation`` ignores non-primary
+        manifestations.
+        """
+        service = self.service()
+        replica = Manifestation(dataset=MANIFESTATION.dataset, primary=False)
+        service.update_node_state(
+            NodeState(hostname=u"host1", running=[], not_running=[],
+                      other_manifestations=frozenset([replica])))
+        self.assertIs(
+            service.get_manifestation(MANIFESTATION.dataset.dataset_id),
+            None)
+
+    def test_several_manifestations_of_dataset(self):
+        """
+        A node may report a primary and a replica manifestation of the same
+        dataset: the primary one is found, and both are forgotten once the
+        node no longer reports them.
+        """
+        service = self.service()
+        replica = Manifestation(dataset=MANIFESTATION.dataset, primary=False)
+        service.update_node_state(
+            NodeState(hostname=u"host1", running=[], not_running=[],
+                      other_manifestations=frozenset(
+                          [MANIFESTATION, replica])))
+        found = service.get_manifestation(MANIFESTATION.dataset.dataset_id)
+        service.update_node_state(
+            NodeState(hostname=u"host1", running=[], not_running=[]))
+        self.assertEqual(
+            (found,
+             service.get_manifestation(MANIFESTATION.dataset.dataset_id),
+             list(service.primary_dataset_ids())),
+            ((u"host1", MANIFESTATION), None, []))
+
+    def test_primary_manifestations(self):
+        """
+        ``ClusterStateService.primary_manifestations`` returns the hostname
+        and ``Manifestation`` of all primary manifestations, including
+        those of application volumes.
+        """
+        service = self.service()
+        volume_manifestation = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4())), primary=True)
+        application = Application(
+            name=u"database", image=DockerImage.from_string(u"postgresql"),
+            volume=AttachedVolume(manifestation=volume_manifestation,
+                                  mountpoint=FilePath(b"/var/db")))
+        replica = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4())), primary=False)
+        service.update_node_state(
+            NodeState(hostname=u"host1", running=[application],
+                      not_running=[]))
+        service.update_node_state(
+            NodeState(hostname=u"host2", running=[], not_running=[],
+                      other_manifestations=frozenset(
+                          [MANIFESTATION, replica])))
+        self.assertItemsEqual(
+            list(service.primary_manifestations()),
+            [(u"host1", volume_manifestation), (u"host2", MANIFESTATION)])
@@ -0,0 +1,244 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.control._codec``.
+"""
+
+from uuid import uuid4
+
+from pyrsistent import pmap
+
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.python.filepath import FilePath
+
+from .._codec import (
+    encode, decode, is_encoded, CodecError, MAGIC, VERSION, FLAG_ZLIB,
+    _HEADER,
+)
+from .._model import (
+    Deployment, Application, DockerImage, Node, NodeState, Manifestation,
+    Dataset, Port, Link, AttachedVolume, RestartNever, RestartAlways,
+    RestartOnFailure,
+)
+
+
+DATASET = Dataset(dataset_id=unicode(uuid4()), maximum_size=1024 * 1024,
+                  metadata=pmap({u"name": u"postgres"}))
+MANIFESTATION = Manifestation(dataset=DATASET, primary=True)
+APP1 = Application(
+    name=u'postgres',
+    image=DockerImage(repository=u'postgres', tag=u'9.4'),
+    ports=frozenset([Port(internal_port=5432, external_port=5433)]),
+    volume=AttachedVolume(manifestation=MANIFESTATION,
+                          mountpoint=FilePath(b"/var/lib/postgresql")),
+    environment=frozenset([(u"PGUSER", u"admin"), (u"PGPASS", u"secret")]),
+    memory_limit=100000000,
+    cpu_shares=512,
+    restart_policy=RestartOnFailure(maximum_retry_count=3))
+APP2 = Application(
+    name=u'web',
+    image=DockerImage.from_string(u'nginx'),
+    links=frozenset([Link(local_port=80, remote_port=8080, alias=u"app")]),
+    restart_policy=RestartAlways())
+APP3 = Application(
+    name=u'legacy',
+    image=DockerImage.from_string(u'busybox'),
+    ports=None, links=None,
+    restart_policy=RestartNever())
+OTHER_MANIFESTATION = Manifestation(
+    dataset=Dataset(dataset_id=unicode(uuid4())), primary=False)
+NODE1 = Node(hostname=u'node1.example.com',
+             applications=frozenset([APP1, APP2]),
+             other_manifestations=frozenset([OTHER_MANIFESTATION]))
+NODE2 = Node(hostname=b'node2.example.com',
+             applications=frozenset([APP3]))
+DEPLOYMENT = Deployment(nodes=frozenset([NODE1, NODE2]))
+NODE_STATE = NodeState(hostname=u'node1.example.com',
+                       running=[APP1], not_running=[APP2, APP3],
+                       used_ports=frozenset([1, 2]),
+                       other_manifestations=frozenset([OTHER_MANIFESTATION]))
+
+
+class RoundtripTests(SynchronousTestCase):
+    """
+    Tests for ``encode`` and ``decode`` round-tripping objects.
+    """
+    def assert_roundtrips(self, value):
+        """
+        Assert the given value is equal to itself once encoded and decoded.
+        """
+        self.assertEqual(decode(encode(value)), value)
+
+    def test_empty_deployment(self):
+        """
+        A ``Deployment`` with no nodes can be encoded and decoded.
+        """
+        self.assert_roundtrips(Deployment(nodes=frozenset()))
+
+    def test_deployment(self):
+        """
+        A ``Deployment`` using all the features of the model can be encoded
+        and decoded.
+        """
+        self.assert_roundtrips(DEPLOYMENT)
+
+    def test_node_state(self):
+        """
+        A ``NodeState`` can be encoded and decoded.
+        """
+        self.assert_roundtrips(NODE_STATE)
+
+    def test_node_state_order(self):
+        """
+        The order of the applications in a ``NodeState`` is preserved.
+        """
+        node_state = NodeState(hostname=u'node1.example.com',
+                               running=[APP3, APP2, APP1], not_running=[])
+        self.assertEqual(decode(encode(node_state)).running,
+                         [APP3, APP2, APP1])
+
+    def test_nodes(self):
+        """
+        A ``frozenset`` of ``Node``\ s can be encoded and decoded.
+        """
+        self.assert_roundtrips(frozenset([NODE1, NODE2]))
+
+    def test_string_types(self):
+        """
+        ``bytes`` and ``unicode`` strings keep their type, even when equal.
+        """
+        node = decode(encode(Deployment(nodes=frozenset([
+            Node(hostname=b"a", applications=frozenset([
+                Application(name=u"a", image=DockerImage(
+                    repository=u"a", tag=b"a"))]))])))).nodes
+        [node] = node
+        [application] = node.applications
+        self.assertEqual(
+            [type(node.hostname), type(application.name),
+             type(application.image.tag)],
+            [bytes, unicode, bytes])
+
+    def test_non_ascii(self):
+        """
+        Non-ASCII strings can be encoded and decoded.
+        """
+        self.assert_roundtrips(Deployment(nodes=frozenset([
+            Node(hostname=u"\N{SNOWMAN}"), Node(hostname=b"\xff")])))
+
+    def test_uncompressed(self):
+        """
+        Small objects are not compressed.
+        """
+        data = encode(Deployment(nodes=frozenset()))
+        self.assertEqual(_HEADER.unpack_from(data), (MAGIC, VERSION, 0))
+
+    def test_compressed(self):
+        """
+        Large objects are compressed, and can still be decoded.
+        """
+        deployment = Deployment(nodes=frozenset([
+            Node(hostname=u"node%d" % (i,), applications=frozenset([APP1]))
+            for i in range(100)]))
+        data = encode(deployment)
+        self.assertEqual(
+            (_HEADER.unpack_from(data), decode(data)),
+            ((MAGIC, VERSION, FLAG_ZLIB), deployment))
+
+    def test_compression_disabled(self):
+        """
+        Compression can be disabled by passing ``None`` as the threshold.
+        """
+        deployment = Deployment(nodes=frozenset([
+            Node(hostname=u"node%d" % (i,), applications=frozenset([APP1]))
+            for i in range(100)]))
+        data = encode(deployment, compression_threshold=None)
+        self.assertEqual(
+            (_HEADER.unpack_from(data), decode(data)),
+            ((MAGIC, VERSION, 0), deployment))
+
+    def test_strings_interned(self):
+        """
+        Each distinct string is only stored once.
+        """
+        nodes = [Node(hostname=u"node%d" % (i,),
+                      applications=frozenset([APP1]))
+                 for i in range(100)]
+        one = encode(Deployment(nodes=frozenset(nodes[:1])),
+                     compression_threshold=None)
+        many = encode(Deployment(nodes=frozenset(nodes)),
+                      compression_threshold=None)
+        # Each additional node costs far less than the strings in APP1:
+        self.assertTrue(len(many) - len(one) < 99 * len(one) / 2)
+
+
+class EncodeErrorTests(SynchronousTestCase):
+    """
+    Tests for ``encode`` failures.
+    """
+    def test_unknown_root(self):
+        """
+        ``encode`` raises ``TypeError`` when given an unsupported object.
+        """
+        self.assertRaises(TypeError, encode, object())
+
+    def test_unknown_nested(self):
+        """
+        ``encode`` raises ``TypeError`` when given an object referring to
+        an object of an unexpected type.
+        """
+        self.assertRaises(TypeError, encode, Deployment(nodes=frozenset([
+            Node(hostname=u"node1", applications=frozenset([DATASET]))])))
+
+
+class DecodeTests(SynchronousTestCase):
+    """
+    Tests for ``decode`` and ``is_encoded``.
+    """
+    def test_is_encoded(self):
+        """
+        ``is_encoded`` returns ``True`` for the output of ``encode``.
+        """
+        self.assertTrue(is_encoded(encode(DEPLOYMENT)))
+
+    def test_is_not_encoded(self):
+        """
+        ``is_encoded`` returns ``False`` for other data.
+        """
+        self.assertFalse(is_encoded(b"(lp0\n."))
+
+    def test_wrong_magic(self):
+        """
+        ``decode`` raises ``CodecError`` if the data doesn't start with the
+        expected magic bytes.
+        """
+        self.assertRaises(CodecError, decode, b"XXX" + encode(DEPLOYMENT)[3:])
+
+    def test_truncated_header(self):
+        """
+        ``decode`` raises ``CodecError`` if the data is too short to include
+        a header.
+        """
+        self.assertRaises(CodecError, decode, MAGIC)
+
+    def test_unknown_version(self):
+        """
+        ``decode`` raises ``CodecError`` if the data uses an unsupported
+        format version.
+        """
+        data = _HEADER.pack(MAGIC, VERSION + 1, 0) + b"[[],0,[[]]]"
+        self.assertRaises(CodecError, decode, data)
+
+    def test_corrupt_body(self):
+        """
+        ``decode`` raises ``CodecError`` if the body can't be decoded.
+        """
+        data = _HEADER.pack(MAGIC, VERSION, 0) + b"[[],0"
+        self.assertRaises(CodecError, decode, data)
+
+    def test_corrupt_compressed_body(self):
+        """
+        ``decode`` raises ``CodecError`` if a compressed body can't be
+        decompressed.
+        """
+        data = _HEADER.pack(MAGIC, VERSION, FLAG_ZLIB) + b"[[],0,[[]]]"
+        self.assertRaises(CodecError, decode, data)
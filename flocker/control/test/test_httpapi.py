@@ -11,11 +11,12 @@ from pyrsistent import pmap, thaw
 from zope.interface.verify import verifyObject
 
 from twisted.internet import reactor
-from twisted.internet.defer import gatherResults
+from twisted.internet.defer import gatherResults, CancelledError
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import MemoryReactor
-from twisted.web.http import CREATED, OK, CONFLICT, BAD_REQUEST
+from twisted.web.http import (
+    CREATED, OK, CONFLICT, BAD_REQUEST, NOT_MODIFIED, NOT_FOUND)
 from twisted.web.http_headers import Headers
 from twisted.web.server import Site
 from twisted.web.client import FileBodyProducer, readBody
@@ -23,15 +24,17 @@ from twisted.application.service import IService
 from twisted.python.filepath import FilePath
 
 from ...restapi.testtools import (
-    buildIntegrationTests, dumps, loads)
+    buildIntegrationTests, dumps, loads, MemoryAgent)
+from ...testtools import FakeThreadReactor
 
 from .. import (
     Application, Dataset, Manifestation, Node, NodeState,
-    Deployment, AttachedVolume
+    Deployment, AttachedVolume, DockerImage
 )
 from ..httpapi import (
     DatasetAPIUserV1, create_api_service, datasets_from_deployment,
-    api_dataset_from_dataset_and_node
+    api_dataset_from_dataset_and_node, DatasetQuery, INVALID_QUERY,
+    DATASET_ID_COLLISION, add_primary_dataset, add_primary_datasets,
 )
 from .._persistence import ConfigurationPersistenceService
 from .._clusterstate import ClusterStateService
@@ -158,6 +161,36 @@ RealTestsAPI, MemoryTestsAPI = buildIntegrationTests(
     VersionTestsMixin, "API", _build_app)
 
 
+class MetricsTestsMixin(APITestsMixin):
+    """
+    Tests for the request metrics endpoint at ``/metrics``.
+    """
+    def test_metrics(self):
+        """
+        ``/metrics`` returns the statistics of the requests handled so far
+        in the Prometheus text format.
+        """
+        requesting = self.assertResponseCode(b"GET", b"/version", None, OK)
+        requesting.addCallback(readBody)
+        requesting.addCallback(lambda _: self.assertResponseCode(
+            b"GET", b"/metrics", None, OK))
+
+        def got_response(response):
+            self.assertEqual(
+                response.headers.getRawHeaders(b"content-type"),
+                [b"text/plain; version=0.0.4"])
+            return readBody(response)
+        requesting.addCallback(got_response)
+        requesting.addCallback(lambda body: self.assertIn(
+            b'flocker_api_responses_total{route="version",code="200"} 1',
+            body.splitlines()))
+        return requesting
+
+
+RealTestsMetrics, MemoryTestsMetrics = buildIntegrationTests(
+    MetricsTestsMixin, "Metrics", _build_app)
+
+
 class CreateDatasetTestsMixin(APITestsMixin):
     """
     Tests for the dataset creation endpoint at ``/configuration/datasets``.
@@ -259,6 +292,31 @@ class CreateDatasetTestsMixin(APITestsMixin):
         """
         return self._dataset_id_collision_test(self.NODE_A, unicode.title)
 
+    def test_concurrent_dataset_id_collision(self):
+        """
+        If two concurrent ``POST`` requests try to create a dataset with the
+        same ``dataset_id``, one succeeds and the other gets an error
+        indicating the collision.
+        """
+        dataset_id = unicode(uuid4())
+
+        def create():
+            requesting = self.agent.request(
+                b"POST", b"/configuration/datasets",
+                Headers({b"content-type": [b"application/json"]}),
+                FileBodyProducer(BytesIO(dumps(
+                    {u"primary": self.NODE_A, u"dataset_id": dataset_id}))))
+            return requesting.addCallback(lambda response: response.code)
+        creating = gatherResults([create(), create()])
+
+        def created(codes):
+            self.assertEqual(
+                (sorted(codes), list(get_dataset_ids(
+                    self.persistence_service.get()))),
+                (sorted([CREATED, CONFLICT]), [dataset_id]))
+        creating.addCallback(created)
+        return creating
+
     def test_unknown_primary_node(self):
         """
         If a ``POST`` request made to the endpoint indicates a non-existent
@@ -459,6 +517,257 @@ RealTestsCreateDataset, MemoryTestsCreateDataset = buildIntegrationTests(
     CreateDatasetTestsMixin, "CreateDataset", _build_app)
 
 
+class CreateDatasetsBulkTestsMixin(APITestsMixin):
+    """
+    Tests for the bulk dataset creation endpoint at
+    ``/configuration/datasets/bulk``.
+    """
+    def test_create(self):
+        """
+        All the datasets in the request are added to the configuration, on
+        their respective primaries, and the response describes each of
+        them.
+        """
+        first, second = unicode(uuid4()), unicode(uuid4())
+        creating = self.assertResult(
+            b"POST", b"/configuration/datasets/bulk",
+            {u"datasets": [
+                {u"primary": self.NODE_A, u"dataset_id": first,
+                 u"metadata": {u"name": u"first"}},
+                {u"primary": self.NODE_B, u"dataset_id": second,
+                 u"maximum_size": 1024 * 1024 * 100},
+            ]},
+            OK, {u"results": [
+                {u"code": CREATED, u"dataset": {
+                    u"primary": self.NODE_A, u"dataset_id": first,
+                    u"metadata": {u"name": u"first"}}},
+                {u"code": CREATED, u"dataset": {
+                    u"primary": self.NODE_B, u"dataset_id": second,
+                    u"maximum_size": 1024 * 1024 * 100,
+                    u"metadata": {}}},
+            ]})
+
+        def created(ignored):
+            self.assertEqual(
+                Deployment(nodes=frozenset({
+                    Node(hostname=self.NODE_A, other_manifestations=frozenset({
+                        Manifestation(dataset=Dataset(
+                            dataset_id=first,
+                            metadata=pmap({u"name": u"first"})),
+                            primary=True)})),
+                    Node(hostname=self.NODE_B, other_manifestations=frozenset({
+                        Manifestation(dataset=Dataset(
+                            dataset_id=second,
+                            maximum_size=1024 * 1024 * 100),
+                            primary=True)})),
+                })),
+                self.persistence_service.get())
+        creating.addCallback(created)
+        return creating
+
+    def test_generates_dataset_ids(self):
+        """
+        Datasets without a ``dataset_id`` are assigned distinct new ones,
+        which are returned in the response.
+        """
+        creating = self.assertResponseCode(
+            b"POST", b"/configuration/datasets/bulk",
+            {u"datasets": [{u"primary": self.NODE_A}] * 3}, OK)
+        creating.addCallback(readBody)
+        creating.addCallback(loads)
+
+        def created(result):
+            dataset_ids = [item[u"dataset"][u"dataset_id"]
+                           for item in result[u"results"]]
+            self.assertEqual(
+                (len(set(dataset_ids)),
+                 set(get_dataset_ids(self.persistence_service.get()))),
+                (3, set(dataset_ids)))
+        creating.addCallback(created)
+        return creating
+
+    def test_single_change(self):
+        """
+        All the datasets are added with a single configuration change.
+        """
+        generation = self.persistence_service.generation
+        creating = self.assertResponseCode(
+            b"POST", b"/configuration/datasets/bulk",
+            {u"datasets": [{u"primary": self.NODE_A},
+                           {u"primary": self.NODE_B},
+                           {u"primary": self.NODE_A}]}, OK)
+        creating.addCallback(lambda _: self.assertEqual(
+            generation + 1, self.persistence_service.generation))
+        return creating
+
+    def test_wrong_schema(self):
+        """
+        If any of the datasets in the request doesn't match the
+        ``definitions/datasets`` schema, the response is an error indicating
+        a validation failure and none of the datasets are created.
+        """
+        posting = self.assertResponseCode(
+            b"POST", b"/configuration/datasets/bulk",
+            {u"datasets": [{u"primary": self.NODE_A},
+                           {u"primary": self.NODE_A, u"junk": u"garbage"}]},
+            BAD_REQUEST)
+        posting.addCallback(lambda _: self.assertEqual(
+            [], list(get_dataset_ids(self.persistence_service.get()))))
+        return posting
+
+    def test_no_datasets(self):
+        """
+        A request without any datasets is rejected.
+        """
+        return self.assertResponseCode(
+            b"POST", b"/configuration/datasets/bulk", {u"datasets": []},
+            BAD_REQUEST)
+
+    def test_dataset_id_collision(self):
+        """
+        A dataset whose ``dataset_id`` is already in use, in any case, is
+        reported as a collision in its result and not created, while the
+        other datasets in the request are.
+        """
+        existing, new = unicode(uuid4()), unicode(uuid4())
+        saving = self.persistence_service.save(Deployment(nodes={
+            Node(hostname=self.NODE_B, other_manifestations=frozenset({
+                Manifestation(dataset=Dataset(dataset_id=existing),
+                              primary=True)}))}))
+
+        def saved(ignored):
+            return self.assertResult(
+                b"POST", b"/configuration/datasets/bulk",
+                {u"datasets": [
+                    {u"primary": self.NODE_A, u"dataset_id": new},
+                    {u"primary": self.NODE_A,
+                     u"dataset_id": existing.upper()},
+                ]},
+                OK, {u"results": [
+                    {u"code": CREATED, u"dataset": {
+                        u"primary": self.NODE_A, u"dataset_id": new,
+                        u"metadata": {}}},
+                    {u"code": CONFLICT,
+                     u"description": DATASET_ID_COLLISION.result[
+                         u"description"],
+                     u"dataset": {
+                         u"primary": self.NODE_A, u"dataset_id": existing,
+                         u"metadata": {}}},
+                ]})
+        posting = saving.addCallback(saved)
+        posting.addCallback(lambda _: self.assertItemsEqual(
+            [existing, new],
+            get_dataset_ids(self.persistence_service.get())))
+        return posting
+
+    def test_dataset_id_collision_within_request(self):
+        """
+        If the same ``dataset_id`` is given for more than one dataset in the
+        request, only the first of them is created.
+        """
+        dataset_id = unicode(uuid4())
+        posting = self.assertResult(
+            b"POST", b"/configuration/datasets/bulk",
+            {u"datasets": [
+                {u"primary": self.NODE_A, u"dataset_id": dataset_id},
+                {u"primary": self.NODE_B, u"dataset_id": dataset_id},
+            ]},
+            OK, {u"results": [
+                {u"code": CREATED, u"dataset": {
+                    u"primary": self.NODE_A, u"dataset_id": dataset_id,
+                    u"metadata": {}}},
+                {u"code": CONFLICT,
+                 u"description": DATASET_ID_COLLISION.result[u"description"],
+                 u"dataset": {
+                     u"primary": self.NODE_B, u"dataset_id": dataset_id,
+                     u"metadata": {}}},
+            ]})
+        posting.addCallback(lambda _: self.assertEqual(
+            [(self.NODE_A, dataset_id)],
+            [(node.hostname, manifestation.dataset.dataset_id)
+             for node in self.persistence_service.get().nodes
+             for manifestation in node.manifestations()]))
+        return posting
+
+
+RealTestsCreateDatasetsBulk, MemoryTestsCreateDatasetsBulk = (
+    buildIntegrationTests(
+        CreateDatasetsBulkTestsMixin, "CreateDatasetsBulk", _build_app))
+
+
+class AddPrimaryDatasetsTests(SynchronousTestCase):
+    """
+    Tests for ``add_primary_datasets`` and ``add_primary_dataset``.
+    """
+    NODE = Node(hostname=u"192.0.2.1", applications=frozenset({
+        Application(name=u"app", image=DockerImage.from_string(u"busybox"))}))
+    DEPLOYMENT = Deployment(nodes=frozenset({NODE}))
+
+    def test_existing_node(self):
+        """
+        Datasets added to a node already in the configuration are added to
+        its other manifestations, leaving its applications alone.
+        """
+        first = Dataset(dataset_id=unicode(uuid4()))
+        second = Dataset(dataset_id=unicode(uuid4()))
+        deployment, errors = add_primary_datasets(
+            self.DEPLOYMENT,
+            [(self.NODE.hostname, first), (self.NODE.hostname, second)])
+        self.assertEqual(
+            (deployment, errors),
+            (Deployment(nodes=frozenset({Node(
+                hostname=self.NODE.hostname,
+                applications=self.NODE.applications,
+                other_manifestations=frozenset({
+                    Manifestation(dataset=first, primary=True),
+                    Manifestation(dataset=second, primary=True)}))})),
+             [None, None]))
+
+    def test_new_node(self):
+        """
+        A node is added to the configuration if a dataset's primary isn't
+        already in it.
+        """
+        dataset = Dataset(dataset_id=unicode(uuid4()))
+        deployment, errors = add_primary_datasets(
+            self.DEPLOYMENT, [(u"192.0.2.2", dataset)])
+        self.assertEqual(
+            deployment.get_node(u"192.0.2.2"),
+            Node(hostname=u"192.0.2.2", other_manifestations=frozenset({
+                Manifestation(dataset=dataset, primary=True)})))
+
+    def test_collisions(self):
+        """
+        Datasets whose IDs are already in the configuration, or earlier in
+        the request, are not added and have ``DATASET_ID_COLLISION`` as
+        their error.
+        """
+        existing = Dataset(dataset_id=unicode(uuid4()))
+        deployment = add_primary_dataset(
+            self.DEPLOYMENT, self.NODE.hostname, existing)
+        new = Dataset(dataset_id=unicode(uuid4()))
+        result, errors = add_primary_datasets(
+            deployment, [(u"192.0.2.2", existing), (u"192.0.2.2", new),
+                         (self.NODE.hostname, new)])
+        self.assertEqual(
+            (result, errors),
+            (add_primary_dataset(deployment, u"192.0.2.2", new),
+             [DATASET_ID_COLLISION, None, DATASET_ID_COLLISION]))
+
+    def test_single_collision_raises(self):
+        """
+        ``add_primary_dataset`` raises ``DATASET_ID_COLLISION`` if the
+        dataset's ID is already in the configuration.
+        """
+        dataset = Dataset(dataset_id=unicode(uuid4()))
+        deployment = add_primary_dataset(
+            self.DEPLOYMENT, self.NODE.hostname, dataset)
+        exception = self.assertRaises(
+            type(DATASET_ID_COLLISION), add_primary_dataset,
+            deployment, u"192.0.2.2", dataset)
+        self.assertIs(DATASET_ID_COLLISION, exception)
+
+
 class GetDatasetConfigurationTestsMixin(APITestsMixin):
     """
     Tests for the dataset configuration retrieval endpoint at
@@ -612,6 +921,35 @@ class GetDatasetConfigurationTestsMixin(APITestsMixin):
         ]
         return self._dataset_test(deployment, expected)
 
+    def test_query(self):
+        """
+        Query arguments select which datasets are returned.
+        """
+        alice = self._manifestation(metadata=pmap({u"owner": u"alice"}))
+        bob = self._manifestation(metadata=pmap({u"owner": u"bob"}))
+        other = self._manifestation(metadata=pmap({u"owner": u"alice"}))
+        saving = self.persistence_service.save(Deployment(nodes=frozenset([
+            Node(hostname=self.NODE_A,
+                 other_manifestations=frozenset([alice, bob])),
+            Node(hostname=self.NODE_B,
+                 other_manifestations=frozenset([other])),
+        ])))
+        saving.addCallback(lambda _: self.assertResult(
+            b"GET",
+            b"/configuration/datasets?primary=%s&metadata=owner%%3Dalice" % (
+                self.NODE_A.encode("ascii"),),
+            None, OK, [api_dataset_from_dataset_and_node(
+                alice.dataset, self.NODE_A)]))
+        return saving
+
+    def test_invalid_query(self):
+        """
+        Invalid query arguments result in a ``BAD_REQUEST`` response.
+        """
+        return self.assertResult(
+            b"GET", b"/configuration/datasets?limit=0", None, BAD_REQUEST,
+            {u"description": u"The query arguments are not valid."})
+
 
 RealTestsGetDatasetConfiguration, MemoryTestsGetDatasetConfiguration = (
     buildIntegrationTests(
@@ -625,13 +963,22 @@ class CreateAPIServiceTests(SynchronousTestCase):
     """
     Tests for ``create_api_service``.
     """
+    def services(self):
+        """
+        :return: ``tuple`` of a ``ConfigurationPersistenceService`` and a
+            ``ClusterStateService`` to create the API service with.
+        """
+        return (ConfigurationPersistenceService(
+            reactor, FilePath(self.mktemp())), ClusterStateService())
+
     def test_returns_service(self):
         """
         ``create_api_service`` returns an object providing ``IService``.
         """
         reactor = MemoryReactor()
         endpoint = TCP4ServerEndpoint(reactor, 6789)
-        verifyObject(IService, create_api_service(None, None, endpoint))
+        verifyObject(IService, create_api_service(
+            *(self.services() + (endpoint,))))
 
     def test_listens_endpoint(self):
         """
@@ -640,7 +987,7 @@ class CreateAPIServiceTests(SynchronousTestCase):
         """
         reactor = MemoryReactor()
         endpoint = TCP4ServerEndpoint(reactor, 6789)
-        service = create_api_service(None, None, endpoint)
+        service = create_api_service(*(self.services() + (endpoint,)))
         self.addCleanup(service.stopService)
         service.startService()
         server = reactor.tcpServers[0]
@@ -735,10 +1082,566 @@ class DatasetsStateTestsMixin(APITestsMixin):
             b"GET", b"/state/datasets", None, OK, response
         )
 
+    def test_query(self):
+        """
+        Query arguments select which datasets are returned.
+        """
+        datasets = sorted([Dataset(dataset_id=unicode(uuid4()))
+                           for _ in range(3)],
+                          key=lambda dataset: dataset.dataset_id)
+        self.cluster_state_service.update_node_state(NodeState(
+            hostname=self.NODE_A, running=[], not_running=[],
+            other_manifestations=frozenset([
+                Manifestation(dataset=dataset, primary=True)
+                for dataset in datasets])))
+        return self.assertResult(
+            b"GET", b"/state/datasets?after=%s&limit=1" % (
+                datasets[0].dataset_id.encode("ascii"),),
+            None, OK, [api_dataset_from_dataset_and_node(
+                datasets[1], self.NODE_A)])
+
+
 RealTestsDatasetsStateAPI, MemoryTestsDatasetsStateAPI = buildIntegrationTests(
     DatasetsStateTestsMixin, "DatasetsStateAPI", _build_app)
 
 
+class ConditionalGetTestsMixin(APITestsMixin):
+    """
+    Tests for conditional ``GET`` requests to ``/configuration/datasets``
+    and ``/state/datasets``.
+    """
+    def get(self, path, etag=None):
+        """
+        Issue a ``GET`` request.
+
+        :param bytes path: The resource path to request.
+        :param bytes etag: An entity tag to send in an ``If-None-Match``
+            header, or ``None`` to send an unconditional request.
+
+        :return: A ``Deferred`` that fires with a ``tuple`` of the response
+            code and the entity tag of the response.
+        """
+        headers = Headers()
+        if etag is not None:
+            headers.setRawHeaders(b"if-none-match", [etag])
+        requesting = self.agent.request(b"GET", path, headers, None)
+        requesting.addCallback(lambda response: (
+            response.code,
+            response.headers.getRawHeaders(b"etag", [None])[0]))
+        return requesting
+
+    def _conditional_test(self, path, change):
+        """
+        Assert that a conditional request for the given resource gets a
+        ``NOT_MODIFIED`` response while it is unchanged, and a full response
+        with a new entity tag once it changes.
+
+        :param bytes path: The resource path to request.
+        :param change: A no-argument callable which changes the resource,
+            returning a ``Deferred`` that fires once it is changed.
+
+        :return: A ``Deferred`` that fires when the test is done.
+        """
+        results = []
+        requesting = self.get(path)
+
+        def got(result):
+            results.append(result)
+            code, etag = result
+            return self.get(path, etag)
+        requesting.addCallback(got)
+        requesting.addCallback(results.append)
+        requesting.addCallback(lambda _: change())
+        requesting.addCallback(lambda _: self.get(path, results[0][1]))
+        requesting.addCallback(results.append)
+
+        def check(_):
+            (first_code, first_etag), unmodified, modified = results
+            self.assertEqual(
+                (first_code, unmodified, modified[0],
+                 modified[1] != first_etag),
+                (OK, (NOT_MODIFIED, first_etag), OK, True))
+        requesting.addCallback(check)
+        return requesting
+
+    def test_configuration(self):
+        """
+        ``/configuration/datasets`` supports conditional requests, with the
+        entity tag changing when the configuration changes.
+        """
+        return self._conditional_test(
+            b"/configuration/datasets",
+            lambda: self.persistence_service.save(Deployment(
+                nodes=frozenset([Node(hostname=self.NODE_A)]))))
+
+    def test_state(self):
+        """
+        ``/state/datasets`` supports conditional requests, with the entity
+        tag changing when the cluster state changes.
+        """
+        return self._conditional_test(
+            b"/state/datasets",
+            lambda: self.cluster_state_service.update_node_state(NodeState(
+                hostname=self.NODE_A, running=[], not_running=[])))
+
+
+RealTestsConditionalGet, MemoryTestsConditionalGet = buildIntegrationTests(
+    ConditionalGetTestsMixin, "ConditionalGet", _build_app)
+
+
+class EntityTagTests(SynchronousTestCase):
+    """
+    Tests for ``DatasetAPIUserV1._entity_tag``.
+    """
+    def test_changes_with_generation(self):
+        """
+        The entity tag changes when the service's generation changes.
+        """
+        service = ClusterStateService()
+        user = DatasetAPIUserV1(ConfigurationPersistenceService(
+            reactor, FilePath(self.mktemp())), service)
+        before = user._entity_tag(service)
+        service.generation += 1
+        self.assertNotEqual(before, user._entity_tag(service))
+
+    def test_unique_per_instance(self):
+        """
+        Entity tags from different API instances differ even if the
+        generations are the same, so a tag from before a restart is never
+        mistaken for a current one.
+        """
+        persistence = ConfigurationPersistenceService(
+            reactor, FilePath(self.mktemp()))
+        service = ClusterStateService()
+        self.assertNotEqual(
+            DatasetAPIUserV1(persistence, service)._entity_tag(service),
+            DatasetAPIUserV1(persistence, service)._entity_tag(service))
+
+
+class WatchTests(SynchronousTestCase):
+    """
+    Tests for the endpoints which wait for the configuration or cluster
+    state to change.
+    """
+    NODE_A = u"192.0.2.1"
+    NODE_B = u"192.0.2.2"
+    TIMEOUT = 30
+
+    def setUp(self):
+        self.reactor = FakeThreadReactor()
+        self.persistence_service = ConfigurationPersistenceService(
+            self.reactor, FilePath(self.mktemp()))
+        self.persistence_service.startService()
+        self.addCleanup(self.persistence_service.stopService)
+        self.cluster_state_service = ClusterStateService()
+        self.user = DatasetAPIUserV1(
+            self.persistence_service, self.cluster_state_service,
+            self.reactor, self.TIMEOUT)
+        self.agent = MemoryAgent(self.user.app.resource())
+        self.dataset = Dataset(dataset_id=unicode(uuid4()),
+                               maximum_size=1024 * 1024 * 1024)
+
+    def get(self, path):
+        """
+        Issue a ``GET`` request.
+
+        :param bytes path: The resource path to request.
+
+        :return: A ``Deferred`` firing with a ``tuple`` of the response code
+            and the decoded response body.
+        """
+        requesting = self.agent.request(b"GET", path)
+        requesting.addCallback(lambda response: readBody(response).addCallback(
+            lambda body: (response.code, loads(body))))
+        return requesting
+
+    def configure(self, hostname, dataset):
+        """
+        Save a configuration with the primary manifestation of a dataset on
+        the given node.
+        """
+        self.successResultOf(self.persistence_service.save(Deployment(
+            nodes=frozenset([Node(
+                hostname=hostname,
+                other_manifestations=frozenset([
+                    Manifestation(dataset=dataset, primary=True)]))]))))
+
+    def report(self, hostname, dataset):
+        """
+        Report a node's state, with the primary manifestation of a dataset.
+        """
+        self.cluster_state_service.update_node_state(NodeState(
+            hostname=hostname, running=[], not_running=[],
+            other_manifestations=frozenset([
+                Manifestation(dataset=dataset, primary=True)])))
+
+    def expected_dataset(self, hostname, dataset):
+        """
+        :return: The API representation of a dataset.
+        """
+        return {u"dataset_id": dataset.dataset_id, u"primary": hostname,
+                u"maximum_size": dataset.maximum_size, u"metadata": {}}
+
+    def converged_path(self):
+        """
+        :return bytes: The path of the convergence endpoint for the test
+            dataset.
+        """
+        return b"/state/datasets/%s/converged" % (
+            self.dataset.dataset_id.encode("ascii"),)
+
+    def test_configuration_changed(self):
+        """
+        If the configuration differs from the given generation, the current
+        configuration is returned immediately.
+        """
+        self.configure(self.NODE_A, self.dataset)
+        self.assertEqual(
+            self.successResultOf(self.get(
+                b"/configuration/datasets/watch/0")),
+            (OK, {u"generation": 1, u"datasets": [
+                self.expected_dataset(self.NODE_A, self.dataset)]}))
+
+    def test_configuration_waits(self):
+        """
+        If the configuration is at the given generation, the response is sent
+        once it changes.
+        """
+        watching = self.get(b"/configuration/datasets/watch/0")
+        self.assertNoResult(watching)
+        self.configure(self.NODE_A, self.dataset)
+        self.assertEqual(
+            self.successResultOf(watching),
+            (OK, {u"generation": 1, u"datasets": [
+                self.expected_dataset(self.NODE_A, self.dataset)]}))
+
+    def test_configuration_timeout(self):
+        """
+        If the configuration doesn't change before the timeout, the unchanged
+        configuration is returned.
+        """
+        watching = self.get(b"/configuration/datasets/watch/0")
+        self.reactor.advance(self.TIMEOUT)
+        self.assertEqual(self.successResultOf(watching),
+                         (OK, {u"generation": 0, u"datasets": []}))
+
+    def test_state_waits(self):
+        """
+        If the cluster state is at the given generation, the response is sent
+        once it changes.
+        """
+        watching = self.get(b"/state/datasets/watch/0")
+        self.assertNoResult(watching)
+        self.report(self.NODE_A, self.dataset)
+        self.assertEqual(
+            self.successResultOf(watching),
+            (OK, {u"generation": 1, u"datasets": [
+                self.expected_dataset(self.NODE_A, self.dataset)]}))
+
+    def test_state_changed(self):
+        """
+        If the cluster state differs from the given generation, the current
+        state is returned immediately.
+        """
+        self.report(self.NODE_A, self.dataset)
+        self.assertEqual(
+            self.successResultOf(self.get(b"/state/datasets/watch/0")),
+            (OK, {u"generation": 1, u"datasets": [
+                self.expected_dataset(self.NODE_A, self.dataset)]}))
+
+    def test_converged(self):
+        """
+        If the primary manifestation of the dataset is already where it is
+        configured to be, the wait for convergence finishes immediately.
+        """
+        self.configure(self.NODE_A, self.dataset)
+        self.report(self.NODE_A, self.dataset)
+        self.assertEqual(
+            self.successResultOf(self.get(self.converged_path())),
+            (OK, {u"converged": True, u"state": self.expected_dataset(
+                self.NODE_A, self.dataset)}))
+
+    def test_converged_waits(self):
+        """
+        The wait for convergence finishes once the primary manifestation is
+        reported on the configured node.
+        """
+        self.configure(self.NODE_A, self.dataset)
+        self.report(self.NODE_B, self.dataset)
+        waiting = self.get(self.converged_path())
+        self.assertNoResult(waiting)
+        self.report(self.NODE_B, Dataset(dataset_id=unicode(uuid4())))
+        self.report(self.NODE_A, self.dataset)
+        self.assertEqual(
+            self.successResultOf(waiting),
+            (OK, {u"converged": True, u"state": self.expected_dataset(
+                self.NODE_A, self.dataset)}))
+
+    def test_converged_size(self):
+        """
+        The dataset has only converged once its maximum size matches the
+        configuration.
+        """
+        self.configure(self.NODE_A, self.dataset)
+        self.report(self.NODE_A, Dataset(dataset_id=self.dataset.dataset_id))
+        waiting = self.get(self.converged_path())
+        self.assertNoResult(waiting)
+        self.report(self.NODE_A, self.dataset)
+        self.assertEqual(self.successResultOf(waiting)[1][u"converged"], True)
+
+    def test_converged_timeout(self):
+        """
+        If the dataset doesn't converge before the timeout, the response says
+        so and includes the current state of the dataset.
+        """
+        self.configure(self.NODE_A, self.dataset)
+        self.report(self.NODE_B, self.dataset)
+        waiting = self.get(self.converged_path())
+        self.reactor.advance(self.TIMEOUT)
+        self.assertEqual(
+            self.successResultOf(waiting),
+            (OK, {u"converged": False, u"state": self.expected_dataset(
+                self.NODE_B, self.dataset)}))
+
+    def test_converged_no_state(self):
+        """
+        If no node reports the dataset, its state is ``null``.
+        """
+        self.configure(self.NODE_A, self.dataset)
+        waiting = self.get(self.converged_path())
+        self.reactor.advance(self.TIMEOUT)
+        self.assertEqual(self.successResultOf(waiting),
+                         (OK, {u"converged": False, u"state": None}))
+
+    def test_converged_unknown(self):
+        """
+        Waiting for a dataset which isn't configured results in a
+        ``NOT_FOUND`` response.
+        """
+        self.assertEqual(
+            self.successResultOf(self.get(self.converged_path())),
+            (NOT_FOUND, {u"description": u"Dataset not found."}))
+
+    def test_cancel(self):
+        """
+        Cancelling a wait, e.g. because the client disconnected, stops
+        waiting for changes and cancels the timeout.
+        """
+        waiting = self.user._wait_for(lambda: False)
+        waiting.cancel()
+        self.failureResultOf(waiting, CancelledError)
+        self.assertEqual((self.user._waiters, self.reactor.getDelayedCalls()),
+                         ([], []))
+
+
+class DatasetQueryFromArgumentsTests(SynchronousTestCase):
+    """
+    Tests for ``DatasetQuery.from_arguments``.
+    """
+    def test_defaults(self):
+        """
+        Without arguments the query selects everything.
+        """
+        self.assertEqual(DatasetQuery.from_arguments(), DatasetQuery(
+            primary=None, metadata=frozenset(), after=None, limit=None))
+
+    def test_arguments(self):
+        """
+        Metadata items are split at the first ``=``, the ``after`` dataset ID
+        is normalized to lower case and ``limit`` is converted to an integer.
+        """
+        self.assertEqual(
+            DatasetQuery.from_arguments(
+                primary=[u"192.0.2.1"],
+                metadata=[u"name=a=b", u"owner=", u"=x"],
+                after=[u"ABC"], limit=[u"10"]),
+            DatasetQuery(
+                primary=u"192.0.2.1",
+                metadata=frozenset([(u"name", u"a=b"), (u"owner", u""),
+                                    (u"", u"x")]),
+                after=u"abc", limit=10))
+
+    def assert_invalid(self, **kwargs):
+        """
+        Assert the given arguments are rejected with ``INVALID_QUERY``.
+        """
+        exception = self.assertRaises(
+            type(INVALID_QUERY), DatasetQuery.from_arguments, **kwargs)
+        self.assertIs(exception, INVALID_QUERY)
+
+    def test_metadata_without_separator(self):
+        """
+        Metadata items must include a ``=``.
+        """
+        self.assert_invalid(metadata=[u"name"])
+
+    def test_multiple_primaries(self):
+        """
+        Only one primary may be given.
+        """
+        self.assert_invalid(primary=[u"192.0.2.1", u"192.0.2.2"])
+
+    def test_invalid_limit(self):
+        """
+        ``limit`` must be a positive integer.
+        """
+        for limit in [u"x", u"0", u"-1", u"1.5"]:
+            self.assert_invalid(limit=[limit])
+
+
+class DatasetQuerySelectTestsMixin(object):
+    """
+    Tests for ``DatasetQuery.select``.
+    """
+    NODE_A = u"192.0.2.1"
+    NODE_B = u"192.0.2.2"
+
+    def make_source(self, nodes):
+        """
+        :param list nodes: ``Node``\ s to include.
+
+        :return: The object to select datasets from.
+        """
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.datasets = sorted(
+            [Dataset(dataset_id=unicode(uuid4()),
+                     metadata=pmap({u"owner": owner, u"tier": tier}))
+             for owner, tier in [(u"alice", u"gold"), (u"alice", u"silver"),
+                                 (u"bob", u"gold"), (u"bob", u"silver")]],
+            key=lambda dataset: dataset.dataset_id)
+        self.primaries = {}
+        nodes = {self.NODE_A: set(), self.NODE_B: set()}
+        for i, dataset in enumerate(self.datasets):
+            primary = [self.NODE_A, self.NODE_B][i % 2]
+            self.primaries[dataset.dataset_id] = primary
+            nodes[primary].add(Manifestation(dataset=dataset, primary=True))
+        # A replica isn't selected:
+        nodes[self.NODE_B].add(
+            Manifestation(dataset=self.datasets[0], primary=False))
+        self.source = self.make_source([
+            Node(hostname=hostname,
+                 other_manifestations=frozenset(manifestations))
+            for hostname, manifestations in nodes.items()])
+
+    def select(self, query):
+        """
+        :param DatasetQuery query: A query.
+
+        :return: A ``list`` of the results of selecting from
+            ``self.source``.
+        """
+        return list(query.select(self.source))
+
+    def expected(self, indexes):
+        """
+        :param indexes: Indexes into ``self.datasets``.
+
+        :return: The expected result of ``select`` for those datasets.
+        """
+        return [(self.primaries[self.datasets[i].dataset_id],
+                 self.datasets[i]) for i in indexes]
+
+    def test_all(self):
+        """
+        An empty query selects all datasets, ordered by dataset ID.
+        """
+        self.assertEqual(self.select(DatasetQuery()),
+                         self.expected(range(4)))
+
+    def test_primary(self):
+        """
+        A query with a primary only selects datasets on that node.
+        """
+        self.assertEqual(
+            self.select(DatasetQuery(primary=self.NODE_B)),
+            self.expected([1, 3]))
+
+    def test_unknown_primary(self):
+        """
+        A query with an unknown primary selects nothing.
+        """
+        self.assertEqual(
+            self.select(DatasetQuery(primary=u"192.0.2.3")), [])
+
+    def test_metadata(self):
+        """
+        A query with metadata only selects datasets with all of the given
+        metadata.
+        """
+        self.assertEqual(
+            (self.select(DatasetQuery(
+                metadata=frozenset([(u"owner", u"alice")]))),
+             self.select(DatasetQuery(
+                 metadata=frozenset([(u"owner", u"alice"),
+                                     (u"tier", u"gold")]))),
+             self.select(DatasetQuery(
+                 metadata=frozenset([(u"owner", u"carol")])))),
+            (self.expected(i for i, dataset in enumerate(self.datasets)
+                           if dataset.metadata[u"owner"] == u"alice"),
+             self.expected(i for i, dataset in enumerate(self.datasets)
+                           if dataset.metadata == {u"owner": u"alice",
+                                                   u"tier": u"gold"}),
+             []))
+
+    def test_primary_and_metadata(self):
+        """
+        A query with a primary and metadata only selects datasets matching
+        both.
+        """
+        tier = self.datasets[1].metadata[u"tier"]
+        self.assertEqual(
+            self.select(DatasetQuery(primary=self.NODE_B,
+                                     metadata=frozenset([(u"tier", tier)]))),
+            self.expected(i for i in [1, 3]
+                          if self.datasets[i].metadata[u"tier"] == tier))
+
+    def test_pages(self):
+        """
+        ``limit`` and ``after`` select consecutive pages of datasets.
+        """
+        first = self.select(DatasetQuery(limit=3))
+        second = self.select(DatasetQuery(after=first[-1][1].dataset_id,
+                                          limit=3))
+        self.assertEqual((first, second),
+                         (self.expected([0, 1, 2]), self.expected([3])))
+
+    def test_after_unknown(self):
+        """
+        ``after`` needn't be the ID of a dataset.
+        """
+        after = self.datasets[1].dataset_id + u"0"
+        self.assertEqual(
+            (self.select(DatasetQuery(after=after)),
+             self.select(DatasetQuery(after=after, limit=1)),
+             self.select(DatasetQuery(after=u"g"))),
+            (self.expected([2, 3]), self.expected([2]), []))
+
+
+class DeploymentDatasetQuerySelectTests(DatasetQuerySelectTestsMixin,
+                                        SynchronousTestCase):
+    """
+    Tests for ``DatasetQuery.select`` with a ``Deployment``.
+    """
+    def make_source(self, nodes):
+        return Deployment(nodes=frozenset(nodes))
+
+
+class ClusterStateDatasetQuerySelectTests(DatasetQuerySelectTestsMixin,
+                                          SynchronousTestCase):
+    """
+    Tests for ``DatasetQuery.select`` with a ``ClusterStateService``.
+    """
+    def make_source(self, nodes):
+        service = ClusterStateService()
+        for node in nodes:
+            service.update_node_state(NodeState(
+                hostname=node.hostname, running=[], not_running=[],
+                other_manifestations=node.other_manifestations))
+        return service
+
+
 class DatasetsFromDeploymentTests(SynchronousTestCase):
     """
     Tests for ``datasets_from_deployment``.
@@ -6,6 +6,8 @@ Tests for ``flocker.node._model``.
 
 from uuid import uuid4
 
+from pyrsistent import pmap
+
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
 
@@ -13,7 +15,7 @@ from ...testtools import make_with_init_tests
 from .._model import (
     Application, DockerImage, Node, Deployment, AttachedVolume, Dataset,
     RestartOnFailure, RestartAlways, RestartNever, Manifestation,
-    NodeState,
+    NodeState, DeploymentDiff, diff_deployments,
 )
 
 
@@ -291,6 +293,247 @@ class DeploymentTests(SynchronousTestCase):
                               updated_node, another_node]))))
 
 
+class DeploymentIndexTests(SynchronousTestCase):
+    """
+    Tests for the ``Deployment`` methods that use its indexes.
+    """
+    REPLICA = Manifestation(dataset=MANIFESTATION.dataset, primary=False)
+    OTHER = Manifestation(
+        dataset=Dataset(dataset_id=unicode(uuid4()),
+                        metadata=pmap({u"name": u"other", u"owner": u"bob"})),
+        primary=True)
+    NODE1 = Node(hostname=u"node1.example.com",
+                 applications=frozenset([APP1]),
+                 other_manifestations=frozenset([MANIFESTATION]))
+    NODE2 = Node(hostname=u"node2.example.com",
+                 other_manifestations=frozenset([REPLICA, OTHER]))
+
+    def assert_indexes(self, deployment):
+        """
+        Assert the indexes of ``deployment`` match those of an identical
+        ``Deployment`` whose indexes were built from scratch.
+        """
+        def indexes(deployment):
+            index = deployment._index()
+            return (index.nodes, index.datasets, index.primaries,
+                    index.metadata, index.primary_ids)
+        self.assertEqual(indexes(deployment),
+                         indexes(Deployment(nodes=deployment.nodes)))
+
+    def test_get_node(self):
+        """
+        ``Deployment.get_node`` returns the ``Node`` with the given hostname.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        self.assertIs(deployment.get_node(u"node2.example.com"), self.NODE2)
+
+    def test_get_node_missing(self):
+        """
+        ``Deployment.get_node`` returns the given default if there is no node
+        with the given hostname.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1]))
+        default = object()
+        self.assertEqual(
+            (deployment.get_node(u"node2.example.com"),
+             deployment.get_node(u"node2.example.com", default)),
+            (None, default))
+
+    def test_dataset_hostnames(self):
+        """
+        ``Deployment.dataset_hostnames`` returns the hostnames of all nodes
+        with a primary or replica manifestation of the dataset, whether or not
+        it is attached to an application.
+        """
+        attached = Node(
+            hostname=u"node3.example.com",
+            applications=frozenset([Application(
+                name=u"postgres", image=DockerImage.from_string(u"postgres"),
+                volume=AttachedVolume(manifestation=MANIFESTATION,
+                                      mountpoint=FilePath(b"/data")))]))
+        deployment = Deployment(nodes=frozenset(
+            [self.NODE1, self.NODE2, attached]))
+        self.assertEqual(
+            deployment.dataset_hostnames(MANIFESTATION.dataset.dataset_id),
+            frozenset([u"node1.example.com", u"node2.example.com",
+                       u"node3.example.com"]))
+
+    def test_dataset_hostnames_missing(self):
+        """
+        ``Deployment.dataset_hostnames`` returns an empty ``frozenset`` for an
+        unknown dataset.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1]))
+        self.assertEqual(deployment.dataset_hostnames(unicode(uuid4())),
+                         frozenset())
+
+    def test_update_node_new(self):
+        """
+        The indexes of a ``Deployment`` created by ``update_node`` with a new
+        node include that node.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1]))
+        deployment.get_node(u"node1.example.com")
+        self.assert_indexes(deployment.update_node(self.NODE2))
+
+    def test_update_node_replace(self):
+        """
+        The indexes of a ``Deployment`` created by ``update_node`` replacing a
+        node no longer include manifestations only the old version of the node
+        had.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        deployment.get_node(u"node1.example.com")
+        updated = deployment.update_node(
+            Node(hostname=u"node2.example.com",
+                 other_manifestations=frozenset([self.REPLICA])))
+        self.assert_indexes(updated)
+
+    def test_update_node_remove_dataset(self):
+        """
+        A dataset is removed from the index entirely once no node has a
+        manifestation of it.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        updated = deployment.update_node(
+            Node(hostname=u"node2.example.com",
+                 other_manifestations=frozenset([self.REPLICA])))
+        self.assertEqual(
+            updated.dataset_hostnames(self.OTHER.dataset.dataset_id),
+            frozenset())
+
+    def test_primary_dataset_ids(self):
+        """
+        ``Deployment.primary_dataset_ids`` returns the IDs of the datasets with
+        a primary manifestation, sorted.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        self.assertEqual(
+            deployment.primary_dataset_ids(),
+            tuple(sorted([MANIFESTATION.dataset.dataset_id,
+                          self.OTHER.dataset.dataset_id])))
+
+    def test_update_node_primary_dataset_ids(self):
+        """
+        The sorted IDs of the datasets with a primary manifestation of a
+        ``Deployment`` created by ``update_node`` include datasets that
+        gained one, and not those that lost their last one.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        deployment.get_node(u"node1.example.com")
+        added = [Manifestation(dataset=Dataset(dataset_id=unicode(uuid4())),
+                               primary=True)
+                 for i in range(5)]
+        updated = deployment.update_node(
+            Node(hostname=u"node2.example.com",
+                 other_manifestations=frozenset([self.REPLICA] + added)))
+        self.assert_indexes(updated)
+        self.assertEqual(
+            updated.primary_dataset_ids(),
+            tuple(sorted([MANIFESTATION.dataset.dataset_id] +
+                         [manifestation.dataset.dataset_id
+                          for manifestation in added])))
+
+    def test_get_primaries(self):
+        """
+        ``Deployment.get_primaries`` returns the hostname and ``Dataset`` of
+        each primary manifestation of a dataset, ignoring replicas.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        self.assertEqual(
+            (deployment.get_primaries(MANIFESTATION.dataset.dataset_id),
+             deployment.get_primaries(unicode(uuid4()))),
+            (frozenset([(u"node1.example.com", MANIFESTATION.dataset)]),
+             frozenset()))
+
+    def test_datasets_with_metadata(self):
+        """
+        ``Deployment.datasets_with_metadata`` returns the IDs of the datasets
+        whose metadata maps the given key to the given value.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        self.assertEqual(
+            (deployment.datasets_with_metadata(u"owner", u"bob"),
+             deployment.datasets_with_metadata(u"owner", u"alice")),
+            (frozenset([self.OTHER.dataset.dataset_id]), frozenset()))
+
+    def test_update_node_metadata(self):
+        """
+        The metadata index of a ``Deployment`` created by ``update_node``
+        reflects changes to the metadata of a dataset which stays on the same
+        node.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        renamed = Manifestation(
+            dataset=Dataset(dataset_id=self.OTHER.dataset.dataset_id,
+                            metadata=pmap({u"owner": u"alice"})),
+            primary=True)
+        updated = deployment.update_node(
+            Node(hostname=u"node2.example.com",
+                 other_manifestations=frozenset([self.REPLICA, renamed])))
+        self.assert_indexes(updated)
+        self.assertEqual(
+            (updated.datasets_with_metadata(u"owner", u"bob"),
+             updated.datasets_with_metadata(u"owner", u"alice")),
+            (frozenset(), frozenset([self.OTHER.dataset.dataset_id])))
+
+    def test_indexes_not_compared(self):
+        """
+        Whether or not the indexes have been built does not affect equality.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1]))
+        indexed = Deployment(nodes=frozenset([self.NODE1]))
+        indexed.get_node(u"node1.example.com")
+        self.assertEqual((deployment, hash(deployment)),
+                         (indexed, hash(indexed)))
+
+
+class DiffDeploymentsTests(SynchronousTestCase):
+    """
+    Tests for ``diff_deployments`` and ``DeploymentDiff``.
+    """
+    NODE1 = Node(hostname=u"node1.example.com",
+                 applications=frozenset([APP1]))
+    NODE2 = Node(hostname=u"node2.example.com",
+                 applications=frozenset([APP2]))
+    NODE3 = Node(hostname=u"node3.example.com")
+
+    def test_identical(self):
+        """
+        Identical deployments have no differences.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        self.assertEqual(
+            diff_deployments(deployment, deployment),
+            DeploymentDiff(changed=frozenset(), removed=frozenset()))
+
+    def test_changes(self):
+        """
+        ``diff_deployments`` includes new and changed nodes in ``changed``
+        and the hostnames of missing nodes in ``removed``, but does not
+        include unchanged nodes.
+        """
+        updated_node1 = Node(hostname=self.NODE1.hostname,
+                             applications=frozenset([APP1, APP2]))
+        old = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        new = Deployment(nodes=frozenset([updated_node1, self.NODE3]))
+        self.assertEqual(
+            diff_deployments(old, new),
+            DeploymentDiff(changed=frozenset([updated_node1, self.NODE3]),
+                           removed=frozenset([self.NODE2.hostname])))
+
+    def test_apply(self):
+        """
+        Applying the result of ``diff_deployments`` to the older deployment
+        results in the newer deployment.
+        """
+        updated_node1 = Node(hostname=self.NODE1.hostname,
+                             applications=frozenset([APP1, APP2]))
+        old = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        new = Deployment(nodes=frozenset([updated_node1, self.NODE3]))
+        self.assertEqual(diff_deployments(old, new).apply(old), new)
+
+
 class RestartOnFailureTests(SynchronousTestCase):
     """
     Tests for ``RestartOnFailure``.
@@ -4,12 +4,30 @@
 Tests for ``flocker.control._persistence``.
 """
 
+import os
+from errno import EIO
+from pickle import dumps
+
+from uuid import uuid4
+
+from eliot.testing import validateLogging
+
 from twisted.internet import reactor
-from twisted.trial.unittest import TestCase
+from twisted.trial.unittest import TestCase, SynchronousTestCase
 from twisted.python.filepath import FilePath
+from twisted.python.failure import Failure
 
-from .._persistence import ConfigurationPersistenceService
-from .._model import Deployment, Application, DockerImage, Node
+from ...testtools import FakeThreadReactor
+from .. import _persistence
+from .._codec import is_encoded, encode
+from .._persistence import (
+    ConfigurationPersistenceService, serialize_deployment,
+    deserialize_deployment, _Journal,
+)
+from .._model import (
+    Deployment, Application, DockerImage, Node, Manifestation, Dataset,
+    diff_deployments,
+)
 
 
 TEST_DEPLOYMENT = Deployment(nodes=frozenset([
@@ -54,13 +72,30 @@ class ConfigurationPersistenceServiceTests(TestCase):
         self.service(path)
         self.assertTrue(path.isdir())
 
+    def test_generation(self):
+        """
+        ``ConfigurationPersistenceService.generation`` is incremented by saving
+        a changed configuration, but not by saving the same configuration.
+        """
+        service = self.service(FilePath(self.mktemp()))
+        generations = [service.generation]
+        for deployment in [TEST_DEPLOYMENT, TEST_DEPLOYMENT,
+                           Deployment(nodes=frozenset())]:
+            service.save(deployment)
+            generations.append(service.generation)
+        self.assertEqual(generations, [0, 1, 1, 2])
+
     def test_file_is_created(self):
         """
-        If no configuration file exists in the given path, it is created.
+        If no configuration file exists in the given path, a snapshot and an
+        empty journal are created.
         """
         path = FilePath(self.mktemp())
         self.service(path)
-        self.assertTrue(path.child(b"current_configuration.pickle").exists())
+        self.assertEqual(
+            (path.child(b"configuration.snapshot").exists(),
+             path.child(b"configuration.journal").getContent()),
+            (True, b""))
 
     def test_save_then_get(self):
         """
@@ -88,6 +123,18 @@ class ConfigurationPersistenceServiceTests(TestCase):
         d.addCallback(retrieve_in_new_service)
         return d
 
+    def test_load_pickled_configuration(self):
+        """
+        A configuration saved by an older version, using ``pickle``, is
+        loaded on startup.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        path.child(b"current_configuration.pickle").setContent(
+            dumps(TEST_DEPLOYMENT))
+        service = self.service(path)
+        self.assertEqual(service.get(), TEST_DEPLOYMENT)
+
     def test_register_for_callback(self):
         """
         Callbacks can be registered that are called every time there is a
@@ -108,3 +155,630 @@ class ConfigurationPersistenceServiceTests(TestCase):
             self.assertEqual((l, l2), ([1, 1], [1]))
         d.addCallback(saved_again)
         return d
+
+
+class SerializationTests(SynchronousTestCase):
+    """
+    Tests for ``serialize_deployment`` and ``deserialize_deployment``.
+    """
+    def test_roundtrip(self):
+        """
+        A ``Deployment`` serialized by ``serialize_deployment`` can be
+        deserialized by ``deserialize_deployment``.
+        """
+        self.assertEqual(
+            deserialize_deployment(serialize_deployment(TEST_DEPLOYMENT)),
+            TEST_DEPLOYMENT)
+
+    def test_not_pickle(self):
+        """
+        ``serialize_deployment`` uses the ``flocker.control._codec`` format
+        rather than ``pickle``.
+        """
+        self.assertTrue(is_encoded(serialize_deployment(TEST_DEPLOYMENT)))
+
+    def test_deserialize_pickle(self):
+        """
+        ``deserialize_deployment`` can load a ``Deployment`` serialized with
+        ``pickle`` by older versions.
+        """
+        self.assertEqual(deserialize_deployment(dumps(TEST_DEPLOYMENT)),
+                         TEST_DEPLOYMENT)
+
+
+class _QueueingThreadPool(object):
+    """
+    Thread pool look-alike that runs functions only when asked to.
+
+    :ivar list queue: Functions waiting to be run.
+    """
+    def __init__(self):
+        self.queue = []
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        def run():
+            try:
+                result = f(*args, **kwargs)
+            except Exception:
+                onResult(False, Failure())
+            else:
+                onResult(True, result)
+        self.queue.append(run)
+
+    def run_all(self):
+        """
+        Run all queued functions, including ones queued while running.
+        """
+        while self.queue:
+            self.queue.pop(0)()
+
+
+def node_with_datasets(hostname, count):
+    """
+    :param unicode hostname: The hostname of the node.
+    :param int count: The number of datasets.
+
+    :return Node: A node with ``count`` primary manifestations.
+    """
+    return Node(hostname=hostname, other_manifestations=frozenset(
+        Manifestation(dataset=Dataset(dataset_id=unicode(uuid4())),
+                      primary=True)
+        for i in range(count)))
+
+
+class JournalTests(SynchronousTestCase):
+    """
+    Tests for the journal of ``ConfigurationPersistenceService``.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        self.reactor = FakeThreadReactor()
+        self.pool = None
+
+    def use_queueing_pool(self):
+        """
+        Make the reactor's thread pool only run functions when
+        ``self.pool.run_all`` is called.
+        """
+        self.pool = _QueueingThreadPool()
+        self.reactor.getThreadPool = lambda: self.pool
+
+    def stop(self, service):
+        """
+        Stop a service, running any writes it has queued.
+
+        :param ConfigurationPersistenceService service: The service to stop.
+        """
+        stopping = service.stopService()
+        if self.pool is not None:
+            self.pool.run_all()
+        self.successResultOf(stopping)
+
+    def service(self):
+        """
+        Start a service using ``self.path``, schedule its stop.
+
+        :return: Started ``ConfigurationPersistenceService``.
+        """
+        service = ConfigurationPersistenceService(self.reactor, self.path)
+        service.startService()
+        self.addCleanup(lambda: service.running and self.stop(service))
+        return service
+
+    def restart(self, service):
+        """
+        Stop a service and start a new one using the same path.
+
+        :param ConfigurationPersistenceService service: The service to stop.
+
+        :return: The new ``ConfigurationPersistenceService``.
+        """
+        self.stop(service)
+        return self.service()
+
+    def test_save_appends(self):
+        """
+        Saving a configuration appends to the journal rather than rewriting
+        the snapshot.
+        """
+        service = self.service()
+        snapshot = self.path.child(b"configuration.snapshot").getContent()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        self.assertEqual(
+            (self.path.child(b"configuration.snapshot").getContent(),
+             self.path.child(b"configuration.journal").getsize() > 0),
+            (snapshot, True))
+
+    def test_write_scales_with_change(self):
+        """
+        The number of bytes appended to the journal depends on the size of
+        the change, not on the size of the configuration.
+        """
+        service = self.service()
+        big = Deployment(nodes=frozenset(
+            node_with_datasets(u"node%d" % (i,), 100) for i in range(20)))
+        self.successResultOf(service.save(big))
+        journal = self.path.child(b"configuration.journal")
+        before = journal.getsize()
+        self.successResultOf(service.save(
+            big.update_node(Node(hostname=u"node100"))))
+        self.assertTrue(journal.getsize() - before < 100)
+
+    def test_unchanged_not_written(self):
+        """
+        Saving the current configuration again doesn't write anything, but
+        does notify change callbacks.
+        """
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        journal = self.path.child(b"configuration.journal")
+        before = journal.getsize()
+        called = []
+        service.register(lambda: called.append(True))
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        self.assertEqual((journal.getsize(), called), (before, [True]))
+
+    def test_replay(self):
+        """
+        A new service applies the journal to the snapshot, so it loads the
+        latest saved configuration.
+        """
+        service = self.service()
+        node1 = node_with_datasets(u"node1", 2)
+        node2 = node_with_datasets(u"node2", 2)
+        self.successResultOf(service.save(
+            Deployment(nodes=frozenset([node1, node2]))))
+        self.successResultOf(service.save(
+            Deployment(nodes=frozenset([node2]))))
+        node2 = node_with_datasets(u"node2", 3)
+        latest = Deployment(nodes=frozenset([node2]))
+        self.successResultOf(service.save(latest))
+        self.assertEqual(self.restart(service).get(), latest)
+
+    def test_startup_compacts(self):
+        """
+        Starting a service writes the loaded configuration to a new snapshot
+        and empties the journal.
+        """
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        self.restart(service)
+        self.assertEqual(
+            (deserialize_deployment(
+                self.path.child(b"configuration.snapshot").getContent()),
+             self.path.child(b"configuration.journal").getContent()),
+            (TEST_DEPLOYMENT, b""))
+
+    def test_truncated_record_ignored(self):
+        """
+        A partially written record at the end of the journal, e.g. due to a
+        crash, is ignored.
+        """
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        self.successResultOf(service.save(
+            TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))))
+        self.successResultOf(service.stopService())
+        journal = self.path.child(b"configuration.journal")
+        journal.setContent(journal.getContent()[:-3])
+        self.assertEqual(self.service().get(), TEST_DEPLOYMENT)
+
+    def test_corrupt_record_ignored(self):
+        """
+        A record whose checksum doesn't match, and anything after it, is
+        ignored.
+        """
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        journal = self.path.child(b"configuration.journal")
+        size = journal.getsize()
+        self.successResultOf(service.save(
+            TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))))
+        self.successResultOf(service.save(
+            TEST_DEPLOYMENT.update_node(Node(hostname=u"node3"))))
+        self.successResultOf(service.stopService())
+        data = journal.getContent()
+        journal.setContent(data[:size + 8] + b"\0" + data[size + 9:])
+        self.assertEqual(self.service().get(), TEST_DEPLOYMENT)
+
+    def test_interrupted_compaction(self):
+        """
+        If the service stopped while compacting, leaving both an old journal
+        and a journal, both are applied to the snapshot.
+        """
+        latest = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        self.path.makedirs()
+        self.path.child(b"configuration.snapshot").setContent(
+            serialize_deployment(Deployment(nodes=frozenset())))
+        for name, old, new in [
+                (b"configuration.journal.old",
+                 Deployment(nodes=frozenset()), TEST_DEPLOYMENT),
+                (b"configuration.journal", TEST_DEPLOYMENT, latest)]:
+            journal = _Journal(self.path.child(name))
+            journal.append(encode(diff_deployments(old, new)))
+            journal.close()
+        self.assertEqual(
+            (self.service().get(),
+             self.path.child(b"configuration.journal.old").exists()),
+            (latest, False))
+
+    def test_compaction(self):
+        """
+        Once the journal is larger than the snapshot and the minimum
+        compaction size, it is compacted into a new snapshot.
+        """
+        self.patch(_persistence, "_MINIMUM_COMPACTION_SIZE", 0)
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        self.assertEqual(
+            (deserialize_deployment(
+                self.path.child(b"configuration.snapshot").getContent()),
+             self.path.child(b"configuration.journal").getContent(),
+             self.path.child(b"configuration.journal.old").exists()),
+            (TEST_DEPLOYMENT, b"", False))
+
+    def test_saves_after_compaction(self):
+        """
+        Configuration saved after a compaction is loaded by a new service.
+        """
+        self.patch(_persistence, "_MINIMUM_COMPACTION_SIZE", 0)
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        latest = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        self.successResultOf(service.save(latest))
+        self.assertEqual(self.restart(service).get(), latest)
+
+    def test_not_compacted_below_minimum(self):
+        """
+        The journal isn't compacted while it is smaller than the minimum
+        compaction size.
+        """
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        self.assertNotEqual(
+            self.path.child(b"configuration.journal").getContent(), b"")
+
+    def test_write_in_thread(self):
+        """
+        The journal is written in the reactor's thread pool. Until the write
+        is finished the returned ``Deferred`` doesn't fire and change
+        callbacks are not called, though ``get`` returns the new
+        configuration.
+        """
+        self.use_queueing_pool()
+        service = self.service()
+        called = []
+        service.register(lambda: called.append(True))
+        d = service.save(TEST_DEPLOYMENT)
+        journal = self.path.child(b"configuration.journal")
+        before = (journal.getContent(), called[:], service.get())
+        self.pool.run_all()
+        self.assertEqual(
+            (before, called, self.successResultOf(d)),
+            ((b"", [], TEST_DEPLOYMENT), [True], None))
+
+    def test_writes_ordered(self):
+        """
+        Records are appended to the journal in the order the configurations
+        were saved, one at a time.
+        """
+        self.use_queueing_pool()
+        service = self.service()
+        latest = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        service.save(TEST_DEPLOYMENT)
+        service.save(latest)
+        queued = len(self.pool.queue)
+        self.pool.run_all()
+        self.assertEqual((queued, self.restart(service).get()),
+                         (1, latest))
+
+    def fail_appends(self, service, count):
+        """
+        Make appends to the journal of a service fail with ``IOError``.
+
+        :param ConfigurationPersistenceService service: The service.
+        :param int count: The number of appends that fail before they
+            start succeeding again.
+        """
+        original = service._journal.append
+        failures = [IOError()] * count
+
+        def append(data):
+            if failures:
+                raise failures.pop()
+            return original(data)
+        self.patch(service._journal, "append", append)
+
+    def test_failed_write(self):
+        """
+        If a record can't be appended to the journal, saving fails and the
+        configuration on disk is current again, with a new generation.
+        """
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        generation = service.generation
+        self.fail_appends(service, 1)
+        self.failureResultOf(service.save(
+            TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))), IOError)
+        self.assertEqual(
+            (service.get(), service.generation, self.restart(service).get()),
+            (TEST_DEPLOYMENT, generation + 2, TEST_DEPLOYMENT))
+
+    def test_save_after_failed_write(self):
+        """
+        A configuration saved after one that failed to be written is
+        recorded relative to the configuration on disk, so it is loaded
+        correctly by a new service.
+        """
+        self.use_queueing_pool()
+        service = self.service()
+        self.fail_appends(service, 1)
+        first = service.save(TEST_DEPLOYMENT)
+        latest = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        second = service.save(latest)
+        self.pool.run_all()
+        self.failureResultOf(first, IOError)
+        self.successResultOf(second)
+        self.assertEqual((service.get(), self.restart(service).get()),
+                         (latest, latest))
+
+    def fail_write_partway(self):
+        """
+        Make the next write to a file write half of its data, then fail
+        with ``OSError``.
+        """
+        original = os.write
+        failed = []
+
+        def write(fd, data):
+            if failed:
+                return original(fd, data)
+            failed.append(True)
+            original(fd, data[:len(data) // 2])
+            raise OSError(EIO, os.strerror(EIO))
+        self.patch(os, "write", write)
+
+    def test_partial_write(self):
+        """
+        If appending a record to the journal fails partway, what was written
+        of it is removed, so a configuration saved afterwards is loaded by a
+        new service.
+        """
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        self.fail_write_partway()
+        self.failureResultOf(service.save(
+            TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))), OSError)
+        latest = TEST_DEPLOYMENT.update_node(Node(hostname=u"node3"))
+        self.successResultOf(service.save(latest))
+        self.assertEqual((service.get(), self.restart(service).get()),
+                         (latest, latest))
+
+    def test_partial_write_not_truncated(self):
+        """
+        If a partially written record can't be removed from the journal, the
+        journal file is replaced by one without it before anything else is
+        appended.
+        """
+        service = self.service()
+        self.successResultOf(service.save(TEST_DEPLOYMENT))
+        self.fail_write_partway()
+
+        def ftruncate(fd, length):
+            raise OSError(EIO, os.strerror(EIO))
+        self.patch(os, "ftruncate", ftruncate)
+        self.failureResultOf(service.save(
+            TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))), OSError)
+        latest = TEST_DEPLOYMENT.update_node(Node(hostname=u"node3"))
+        self.successResultOf(service.save(latest))
+        self.assertEqual((service.get(), self.restart(service).get()),
+                         (latest, latest))
+
+    def test_stop_waits_for_writes(self):
+        """
+        The ``Deferred`` returned by ``stopService`` fires once pending
+        writes are finished.
+        """
+        self.use_queueing_pool()
+        service = self.service()
+        service.save(TEST_DEPLOYMENT)
+        stopping = service.stopService()
+        self.assertNoResult(stopping)
+        self.pool.run_all()
+        self.successResultOf(stopping)
+
+
+class ModifyTests(SynchronousTestCase):
+    """
+    Tests for ``ConfigurationPersistenceService.modify``.
+    """
+    def setUp(self):
+        self.reactor = FakeThreadReactor()
+        self.pool = _QueueingThreadPool()
+        self.service = ConfigurationPersistenceService(
+            self.reactor, FilePath(self.mktemp()))
+        self.service.startService()
+        self.reactor.getThreadPool = lambda: self.pool
+        self.saved = []
+        original_save = self.service.save
+        self.patch(self.service, "save",
+                   lambda deployment: self.saved.append(deployment)
+                   or original_save(deployment))
+        self.notified = []
+        self.service.register(lambda: self.notified.append(True))
+
+    def tearDown(self):
+        stopping = self.service.stopService()
+        self.pool.run_all()
+        self.successResultOf(stopping)
+
+    def add_node(self, hostname):
+        """
+        :param unicode hostname: A hostname.
+
+        :return: A transform for ``modify`` which adds a node with the given
+            hostname.
+        """
+        return lambda deployment: deployment.update_node(
+            Node(hostname=hostname))
+
+    def test_modify(self):
+        """
+        The transform passed to ``modify`` is applied to the current
+        configuration and the result is saved.
+        """
+        self.service.save(TEST_DEPLOYMENT)
+        self.pool.run_all()
+        self.service.modify(self.add_node(u"node2"))
+        self.reactor.advance(0)
+        self.pool.run_all()
+        self.assertEqual(
+            self.service.get(),
+            TEST_DEPLOYMENT.update_node(Node(hostname=u"node2")))
+
+    def test_fires_when_durable(self):
+        """
+        The ``Deferred`` returned by ``modify`` fires with ``None`` once the
+        change is written to disk.
+        """
+        d = self.service.modify(self.add_node(u"node1"))
+        self.reactor.advance(0)
+        self.assertNoResult(d)
+        self.pool.run_all()
+        self.assertIs(self.successResultOf(d), None)
+
+    def test_grouped(self):
+        """
+        Modifications made in the same reactor iteration are applied in
+        order, saved with a single write and result in a single change
+        notification.
+        """
+        results = [self.service.modify(self.add_node(hostname))
+                   for hostname in [u"node1", u"node2", u"node3"]]
+        self.reactor.advance(0)
+        self.pool.run_all()
+        self.assertEqual(
+            (self.saved, self.notified,
+             [self.successResultOf(d) for d in results]),
+            ([Deployment(nodes=frozenset([
+                Node(hostname=u"node1"), Node(hostname=u"node2"),
+                Node(hostname=u"node3")]))],
+             [True], [None] * 3))
+
+    def test_transforms_see_earlier_changes(self):
+        """
+        Each transform is passed the result of the transforms of earlier
+        modifications.
+        """
+        seen = []
+
+        def record(deployment):
+            seen.append(deployment)
+            return deployment
+        self.service.modify(self.add_node(u"node1"))
+        self.service.modify(record)
+        self.reactor.advance(0)
+        self.assertEqual(
+            seen, [Deployment(nodes=frozenset([Node(hostname=u"node1")]))])
+
+    def test_failed_transform(self):
+        """
+        If a transform raises an exception the ``Deferred`` for that
+        modification fails with it, and other modifications in the same
+        group are still saved.
+        """
+        def fail(deployment):
+            raise ZeroDivisionError()
+        first = self.service.modify(self.add_node(u"node1"))
+        failing = self.service.modify(fail)
+        last = self.service.modify(self.add_node(u"node2"))
+        self.reactor.advance(0)
+        self.pool.run_all()
+        self.failureResultOf(failing, ZeroDivisionError)
+        self.assertEqual(
+            (self.successResultOf(first), self.successResultOf(last),
+             self.service.get()),
+            (None, None, Deployment(nodes=frozenset([
+                Node(hostname=u"node1"), Node(hostname=u"node2")]))))
+
+    def test_grouped_while_writing(self):
+        """
+        Modifications made while a group is being written are committed
+        together once the write finishes.
+        """
+        self.service.modify(self.add_node(u"node1"))
+        self.reactor.advance(0)
+        second = self.service.modify(self.add_node(u"node2"))
+        third = self.service.modify(self.add_node(u"node3"))
+        self.reactor.advance(0)
+        saved_while_writing = len(self.saved)
+        self.pool.run_all()
+        self.reactor.advance(0)
+        self.pool.run_all()
+        self.assertEqual(
+            (saved_while_writing, len(self.saved), self.notified,
+             self.successResultOf(second), self.successResultOf(third)),
+            (1, 2, [True, True], None, None))
+
+    def test_commit_delay(self):
+        """
+        Modifications are committed ``commit_delay`` seconds after the first
+        of a group.
+        """
+        self.service.commit_delay = 5
+        self.service.modify(self.add_node(u"node1"))
+        self.reactor.advance(4)
+        self.service.modify(self.add_node(u"node2"))
+        before = len(self.saved)
+        self.reactor.advance(1)
+        self.assertEqual((before, len(self.saved)), (0, 1))
+
+    @validateLogging(None)
+    def test_failed_change_callback(self, logger):
+        """
+        If a change callback raises an exception it is logged, and the other
+        callbacks are still called and the modification still succeeds.
+        """
+        self.service.logger = logger
+        self.service._change_callbacks.insert(0, lambda: 1 / 0)
+        d = self.service.modify(self.add_node(u"node1"))
+        self.reactor.advance(0)
+        self.pool.run_all()
+        self.assertEqual(
+            (self.successResultOf(d), self.notified,
+             len(logger.flushTracebacks(ZeroDivisionError))),
+            (None, [True], 1))
+
+    def test_stop_commits(self):
+        """
+        Stopping the service commits pending modifications.
+        """
+        self.service.commit_delay = 5
+        d = self.service.modify(self.add_node(u"node1"))
+        stopping = self.service.stopService()
+        self.pool.run_all()
+        self.successResultOf(stopping)
+        self.assertEqual(
+            (self.successResultOf(d), self.service.get()),
+            (None, Deployment(nodes=frozenset([Node(hostname=u"node1")]))))
+        self.service.startService()
+
+    def test_stop_while_committing(self):
+        """
+        Stopping the service while a commit is being written commits the
+        modifications made since before the journal is closed, and
+        schedules no further commits.
+        """
+        first = self.service.modify(self.add_node(u"node1"))
+        self.reactor.advance(0)
+        second = self.service.modify(self.add_node(u"node2"))
+        stopping = self.service.stopService()
+        self.pool.run_all()
+        self.successResultOf(stopping)
+        calls = self.reactor.getDelayedCalls()
+        self.service.startService()
+        self.assertEqual(
+            (self.successResultOf(first), self.successResultOf(second),
+             calls, self.service.get()),
+            (None, None, [], Deployment(nodes=frozenset([
+                Node(hostname=u"node1"), Node(hostname=u"node2")]))))
@@ -11,27 +11,38 @@ from zope.interface.verify import verifyObject
 
 from characteristic import attributes, Attribute
 
+from eliot.testing import validateLogging, LoggedMessage
+
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import StringTransport, MemoryReactor
-from twisted.protocols.amp import UnknownRemoteError, RemoteAmpError, AMP
+from twisted.protocols.amp import (
+    UnknownRemoteError, RemoteAmpError, AMP, MAX_VALUE_LENGTH, parseString,
+)
 from twisted.python.failure import Failure
 from twisted.internet.error import ConnectionLost
 from twisted.internet.endpoints import TCP4ServerEndpoint
-from twisted.internet.defer import succeed
+from twisted.internet.defer import succeed, fail, Deferred
 from twisted.python.filepath import FilePath
 from twisted.application.internet import StreamServerEndpointService
 
+from ...testtools import FakeThreadReactor
+from .. import _protocol
 from .._protocol import (
-    NodeStateArgument, DeploymentArgument,
-    VersionCommand, ClusterStatusCommand, NodeStateCommand, IConvergenceAgent,
-    AgentAMP, ControlAMPService, ControlAMP
+    NodeStateArgument, DeploymentArgument, NodesArgument,
+    VersionCommand, ClusterStatusCommand, ClusterStatusDeltaCommand,
+    NodeStateCommand, IConvergenceAgent, AgentAMP, ControlAMPService,
+    ControlAMP, UnknownGeneration, _KNOWN_GENERATIONS, _EncodingCache,
 )
+from .._codec import encode
+from .._logging import LOG_BROADCAST, LOG_SLOW_AGENT
 from .._clusterstate import ClusterStateService
 from .._model import (
     Deployment, Application, DockerImage, Node, NodeState, Manifestation,
     Dataset,
 )
-from .._persistence import ConfigurationPersistenceService
+from .._persistence import (
+    ConfigurationPersistenceService, serialize_deployment,
+)
 
 
 class LoopbackAMPClient(object):
@@ -90,7 +101,7 @@ MANIFESTATION = Manifestation(dataset=Dataset(dataset_id=unicode(uuid4())),
                               primary=True)
 NODE_STATE = NodeState(hostname=u'node1.example.com',
                        running=[APP1], not_running=[APP2],
-                       used_ports=[1, 2],
+                       used_ports=frozenset([1, 2]),
                        other_manifestations=frozenset([MANIFESTATION]))
 
 
@@ -117,24 +128,203 @@ class SerializationTests(SynchronousTestCase):
         self.assertEqual([bytes, TEST_DEPLOYMENT],
                          [type(as_bytes), deserialized])
 
+    def test_nodes(self):
+        """
+        ``NodesArgument`` can round-trip a ``frozenset`` of ``Node``
+        instances.
+        """
+        argument = NodesArgument()
+        as_bytes = argument.toString(TEST_DEPLOYMENT.nodes)
+        deserialized = argument.fromString(as_bytes)
+        self.assertEqual([bytes, TEST_DEPLOYMENT.nodes],
+                         [type(as_bytes), deserialized])
+
 
-def build_control_amp_service(test):
+def large_deployment(nodes=5000):
+    """
+    :param int nodes: The number of nodes.
+
+    :return Deployment: A deployment whose serialized form is larger than
+        the maximum size of an AMP value.
+    """
+    return Deployment(nodes=frozenset(
+        Node(hostname=u"node%d.example.com" % (i,),
+             other_manifestations=frozenset([
+                 Manifestation(dataset=Dataset(dataset_id=unicode(uuid4())),
+                               primary=True)]))
+        for i in range(nodes)))
+
+
+class ChunkedArgumentTests(SynchronousTestCase):
+    """
+    Tests for serialization of arguments larger than the maximum size of an
+    AMP value.
+    """
+    def roundtrip(self, command, arguments):
+        """
+        Serialize command arguments to the AMP wire format and parse them
+        back.
+
+        :param command: The ``Command`` subclass.
+        :param dict arguments: The arguments for the command.
+
+        :return: ``tuple`` of the number of keys in the serialized box and
+            the parsed arguments.
+        """
+        box = command.makeArguments(arguments, AMP())
+        [parsed] = parseString(box.serialize())
+        return len(parsed), command.parseArguments(parsed, AMP())
+
+    def test_large_deployment(self):
+        """
+        A ``Deployment`` whose serialized form is larger than AMP's maximum
+        value size can be sent in a ``ClusterStatusCommand``.
+        """
+        deployment = large_deployment()
+        self.assertTrue(len(encode(deployment)) > MAX_VALUE_LENGTH)
+        arguments = dict(configuration=deployment, state=deployment,
+                         generation=1)
+        keys, parsed = self.roundtrip(ClusterStatusCommand, arguments)
+        self.assertEqual((keys > 3, parsed), (True, arguments))
+
+    def test_large_node_state(self):
+        """
+        A ``NodeState`` whose serialized form is larger than AMP's maximum
+        value size can be sent in a ``NodeStateCommand``.
+        """
+        [node] = large_deployment(nodes=1).nodes
+        node_state = NodeState(
+            hostname=node.hostname, running=[], not_running=[],
+            other_manifestations=frozenset(
+                Manifestation(dataset=Dataset(dataset_id=unicode(uuid4())),
+                              primary=True)
+                for i in range(5000)))
+        self.assertTrue(len(encode(node_state)) > MAX_VALUE_LENGTH)
+        arguments = dict(node_state=node_state)
+        _, parsed = self.roundtrip(NodeStateCommand, arguments)
+        self.assertEqual(parsed, arguments)
+
+    def test_large_nodes(self):
+        """
+        A ``frozenset`` of ``Node``\ s whose serialized form is larger than
+        AMP's maximum value size can be sent in a
+        ``ClusterStatusDeltaCommand``.
+        """
+        nodes = large_deployment().nodes
+        arguments = dict(
+            generation=2, base_generation=1,
+            configuration_changed=nodes, configuration_removed=[],
+            state_changed=frozenset(), state_removed=[u"node"])
+        _, parsed = self.roundtrip(ClusterStatusDeltaCommand, arguments)
+        self.assertEqual(parsed, arguments)
+
+    def test_small_single_key(self):
+        """
+        Arguments smaller than AMP's maximum value size are stored in a
+        single key.
+        """
+        keys, _ = self.roundtrip(NodeStateCommand,
+                                 dict(node_state=NODE_STATE))
+        self.assertEqual(keys, 1)
+
+
+class EncodingCacheTests(SynchronousTestCase):
+    """
+    Tests for ``_EncodingCache``.
+    """
+    def setUp(self):
+        self.serialized = []
+
+    def serializer(self, obj):
+        """
+        Record and serialize an object.
+        """
+        self.serialized.append(obj)
+        return repr(obj)
+
+    def test_encode(self):
+        """
+        ``_EncodingCache.encode`` returns the result of the serializer.
+        """
+        cache = _EncodingCache(size=2)
+        self.assertEqual(cache.encode(self.serializer, [1, 2]), b"[1, 2]")
+
+    def test_same_object_encoded_once(self):
+        """
+        Encoding the same object multiple times only calls the serializer
+        once.
+        """
+        cache = _EncodingCache(size=2)
+        obj = [1, 2]
+        results = [cache.encode(self.serializer, obj) for i in range(3)]
+        self.assertEqual((results, self.serialized),
+                         ([b"[1, 2]"] * 3, [obj]))
+
+    def test_equal_objects_encoded_separately(self):
+        """
+        The cache is keyed on identity, so distinct but equal objects are
+        each serialized.
+        """
+        cache = _EncodingCache(size=2)
+        cache.encode(self.serializer, [1])
+        cache.encode(self.serializer, [1])
+        self.assertEqual(len(self.serialized), 2)
+
+    def test_least_recently_used_evicted(self):
+        """
+        Once the cache is full the least recently used object is evicted, and
+        will be serialized again if encoded.
+        """
+        cache = _EncodingCache(size=2)
+        first, second, third = [1], [2], [3]
+        cache.encode(self.serializer, first)
+        cache.encode(self.serializer, second)
+        cache.encode(self.serializer, first)
+        cache.encode(self.serializer, third)
+        cache.encode(self.serializer, first)
+        cache.encode(self.serializer, second)
+        self.assertEqual(self.serialized, [first, second, third, second])
+
+    def test_counters(self):
+        """
+        ``_EncodingCache.encoded_bytes`` counts all bytes returned, including
+        cached results, and ``_EncodingCache.encode_seconds`` accumulates
+        time spent serializing.
+        """
+        cache = _EncodingCache(size=2)
+        obj = [1, 2]
+        cache.encode(self.serializer, obj)
+        cache.encode(self.serializer, obj)
+        self.assertEqual(
+            (cache.encoded_bytes, type(cache.encode_seconds),
+             cache.encode_seconds >= 0),
+            (2 * len(b"[1, 2]"), float, True))
+
+
+def build_control_amp_service(test, broadcast_delay=0):
     """
     Create a new ``ControlAMPService``.
 
+    Broadcasts are scheduled using a ``FakeThreadReactor``, available as the
+    service's ``reactor`` attribute, which also runs the persistence
+    service's disk writes synchronously.
+
     :param TestCase test: The test this service is for.
+    :param float broadcast_delay: Passed on to ``ControlAMPService``.
 
     :return ControlAMPService: Not started.
     """
     cluster_state = ClusterStateService()
     cluster_state.startService()
     test.addCleanup(cluster_state.stopService)
+    reactor = FakeThreadReactor()
     persistence_service = ConfigurationPersistenceService(
-        None, FilePath(test.mktemp()))
+        reactor, FilePath(test.mktemp()))
     persistence_service.startService()
     test.addCleanup(persistence_service.stopService)
-    return ControlAMPService(cluster_state, persistence_service,
-                             TCP4ServerEndpoint(MemoryReactor(), 1234))
+    return ControlAMPService(reactor, cluster_state, persistence_service,
+                             TCP4ServerEndpoint(MemoryReactor(), 1234),
+                             broadcast_delay=broadcast_delay)
 
 
 class ControlAMPTests(SynchronousTestCase):
@@ -170,12 +360,14 @@ class ControlAMPTests(SynchronousTestCase):
         self.control_amp_service.cluster_state.update_node_state(NODE_STATE)
 
         self.protocol.makeConnection(StringTransport())
+        self.control_amp_service.reactor.advance(0)
         cluster_state = self.control_amp_service.cluster_state.as_deployment()
         self.assertEqual(
             sent[0],
             (((ClusterStatusCommand,),
               dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state))))
+                   state=cluster_state,
+                   generation=1))))
 
     def test_connection_lost(self):
         """
@@ -197,7 +389,7 @@ class ControlAMPTests(SynchronousTestCase):
         """
         self.assertEqual(
             self.successResultOf(self.client.callRemote(VersionCommand)),
-            {"major": 1})
+            {"major": 2})
 
     def test_nodestate_updates_node_state(self):
         """
@@ -219,9 +411,11 @@ class ControlAMPTests(SynchronousTestCase):
         """
         ``NodeStateCommand`` results in all connected ``ControlAMP``
         connections getting the updated cluster state along with the
-        desired configuration.
+        desired configuration, merged with any other pending updates.
         """
         self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        # Connections that never acknowledge any generation are always sent
+        # everything:
         self.protocol.makeConnection(StringTransport())
         another_protocol = ControlAMP(self.control_amp_service)
         another_protocol.makeConnection(StringTransport())
@@ -229,20 +423,135 @@ class ControlAMPTests(SynchronousTestCase):
         sent2 = []
         self.patch(self.protocol, "callRemote",
                    lambda *args, **kwargs: sent1.append((args, kwargs))
-                   or succeed(None))
+                   or Deferred())
         self.patch(another_protocol, "callRemote",
                    lambda *args, **kwargs: sent2.append((args, kwargs))
-                   or succeed(None))
+                   or Deferred())
 
         self.successResultOf(
             self.client.callRemote(NodeStateCommand,
                                    node_state=NODE_STATE))
+        self.control_amp_service.reactor.advance(0)
         cluster_state = self.control_amp_service.cluster_state.as_deployment()
         self.assertListEqual(
-            [sent1[-1], sent2[-1]],
-            [(((ClusterStatusCommand,),
-              dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state)))] * 2)
+            [sent1, sent2],
+            [[(((ClusterStatusCommand,),
+                dict(configuration=TEST_DEPLOYMENT,
+                     state=cluster_state,
+                     generation=1)))]] * 2)
+
+    def test_unchanged_nodestate_not_sent(self):
+        """
+        ``NodeStateCommand`` with a node state identical to the one already
+        known does not result in an update being sent to connections.
+        """
+        self.protocol.makeConnection(StringTransport())
+        self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE))
+        self.control_amp_service.reactor.advance(0)
+        sent = []
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: sent.append((args, kwargs))
+                   or succeed(None))
+        self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE))
+        self.control_amp_service.reactor.advance(0)
+        self.assertEqual(sent, [])
+
+    def test_acknowledged_sends_delta(self):
+        """
+        Once a connection has acknowledged a generation, later updates only
+        include the nodes that changed since that generation.
+        """
+        sent = []
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: sent.append((args, kwargs))
+                   or succeed(None))
+        self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        self.protocol.makeConnection(StringTransport())
+        self.control_amp_service.reactor.advance(0)
+        new_node = Node(hostname=u"node2.example.com")
+        self.control_amp_service.configuration_service.save(
+            TEST_DEPLOYMENT.update_node(new_node))
+        self.control_amp_service.reactor.advance(0)
+        self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE))
+        self.control_amp_service.reactor.advance(0)
+        state_node = NODE_STATE.to_node()
+        self.assertEqual(
+            sent[1:],
+            [((ClusterStatusDeltaCommand,),
+              dict(generation=2, base_generation=1,
+                   configuration_changed=frozenset([new_node]),
+                   configuration_removed=[],
+                   state_changed=frozenset(),
+                   state_removed=[])),
+             ((ClusterStatusDeltaCommand,),
+              dict(generation=3, base_generation=2,
+                   configuration_changed=frozenset(),
+                   configuration_removed=[],
+                   state_changed=frozenset([state_node]),
+                   state_removed=[]))])
+
+    def test_delta_removed_nodes(self):
+        """
+        Nodes which were removed since the acknowledged generation are sent
+        as hostnames.
+        """
+        sent = []
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: sent.append((args, kwargs))
+                   or succeed(None))
+        self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        self.protocol.makeConnection(StringTransport())
+        self.control_amp_service.reactor.advance(0)
+        self.control_amp_service.configuration_service.save(
+            Deployment(nodes=frozenset()))
+        self.control_amp_service.reactor.advance(0)
+        self.assertEqual(
+            sent[-1][1]["configuration_removed"], [u"node1.example.com"])
+
+    def test_failure_sends_full_status(self):
+        """
+        If a connection fails to process a cluster status because it doesn't
+        know the generation it was relative to, it is sent the full
+        configuration and state without waiting for a further change.
+        """
+        results = [succeed(None), fail(UnknownGeneration(1)), succeed(None)]
+        sent = []
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: sent.append((args, kwargs))
+                   or results.pop(0))
+        self.protocol.makeConnection(StringTransport())
+        self.control_amp_service.reactor.advance(0)
+        self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        self.control_amp_service.reactor.advance(0)
+        self.control_amp_service.reactor.advance(0)
+        self.assertEqual(
+            [command for ((command,), _) in sent],
+            [ClusterStatusCommand, ClusterStatusDeltaCommand,
+             ClusterStatusCommand])
+
+    def test_reconnect_sends_full_status(self):
+        """
+        A connection that was lost is forgotten, so a later connection using
+        the same protocol instance is sent everything.
+        """
+        sent = []
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: sent.append((args, kwargs))
+                   or succeed(None))
+        self.protocol.makeConnection(StringTransport())
+        self.control_amp_service.reactor.advance(0)
+        self.protocol.connectionLost(Failure(ConnectionLost()))
+        self.protocol.makeConnection(StringTransport())
+        self.control_amp_service.reactor.advance(0)
+        self.assertEqual(
+            [command for ((command,), _) in sent],
+            [ClusterStatusCommand, ClusterStatusCommand])
 
 
 class ControlAMPServiceTests(SynchronousTestCase):
@@ -304,10 +613,283 @@ class ControlAMPServiceTests(SynchronousTestCase):
                    lambda *args, **kwargs: sent.append((args, kwargs))
                    or succeed(None))
         service.configuration_service.save(TEST_DEPLOYMENT)
+        service.reactor.advance(0)
 
         self.assertEqual(sent, [((ClusterStatusCommand,),
                                  dict(configuration=TEST_DEPLOYMENT,
-                                      state=Deployment(nodes=frozenset())))])
+                                      state=Deployment(nodes=frozenset()),
+                                      generation=1))])
+
+    def test_changes_coalesced(self):
+        """
+        All changes that happen within the broadcast delay of the first
+        change result in a single update being sent to each connection,
+        including the latest configuration and state.
+        """
+        service = build_control_amp_service(self, broadcast_delay=5)
+        service.startService()
+        protocol = ControlAMP(service)
+        protocol.makeConnection(StringTransport())
+        sent = []
+        self.patch(protocol, "callRemote",
+                   lambda *args, **kwargs: sent.append((args, kwargs))
+                   or succeed(None))
+        service.configuration_service.save(TEST_DEPLOYMENT)
+        service.reactor.advance(4)
+        service.node_changed(NODE_STATE)
+        before_delay = sent[:]
+        service.reactor.advance(1)
+
+        self.assertEqual(
+            (before_delay, sent),
+            ([], [((ClusterStatusCommand,),
+                   dict(configuration=TEST_DEPLOYMENT,
+                        state=service.cluster_state.as_deployment(),
+                        generation=1))]))
+
+    def test_lost_connection_not_sent(self):
+        """
+        A connection that is lost before a scheduled broadcast happens is
+        not sent anything.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        protocol = ControlAMP(service)
+        protocol.makeConnection(StringTransport())
+        sent = []
+        self.patch(protocol, "callRemote",
+                   lambda *args, **kwargs: sent.append((args, kwargs))
+                   or succeed(None))
+        protocol.connectionLost(Failure(ConnectionLost()))
+        service.reactor.advance(0)
+        self.assertEqual(sent, [])
+
+    def test_serialized_once(self):
+        """
+        When the same configuration and state are sent to multiple
+        connections they are only serialized once.
+        """
+        serialized = []
+
+        def serialize(deployment):
+            serialized.append(deployment)
+            return encode(deployment)
+        self.patch(_protocol, "encode", serialize)
+        service = build_control_amp_service(self)
+        service.startService()
+        for i in range(3):
+            ControlAMP(service).makeConnection(StringTransport())
+        service.reactor.advance(0)
+        self.assertEqual(
+            serialized,
+            [service.configuration_service.get(),
+             Deployment(nodes=frozenset())])
+
+    def assert_broadcast_logged(self, logger):
+        """
+        A single broadcast to two connections was logged, including the
+        total serialized bytes sent.
+        """
+        configuration = serialize_deployment(Deployment(nodes=frozenset()))
+        [message] = LoggedMessage.ofType(logger.messages, LOG_BROADCAST)
+        self.assertEqual(
+            (message.message[u"generation"], message.message[u"connections"],
+             message.message[u"sent_bytes"],
+             message.message[u"encode_seconds"] >= 0),
+            (1, 2, 4 * len(configuration), True))
+
+    @validateLogging(assert_broadcast_logged)
+    def test_broadcast_logged(self, logger):
+        """
+        Every broadcast is logged with the number of connections, the
+        number of serialized bytes sent and the time spent serializing.
+        """
+        service = build_control_amp_service(self)
+        service.logger = logger
+        service.startService()
+        for i in range(2):
+            ControlAMP(service).makeConnection(StringTransport())
+        service.reactor.advance(0)
+
+    def test_stop_service_cancels_broadcast(self):
+        """
+        Stopping the service cancels any scheduled broadcast.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        protocol = ControlAMP(service)
+        protocol.makeConnection(StringTransport())
+        service.stopService()
+        self.assertEqual(service.reactor.getDelayedCalls(), [])
+
+
+class FlowControlTests(SynchronousTestCase):
+    """
+    Tests for ``ControlAMPService`` only having a single cluster status
+    outstanding per connection.
+    """
+    def setUp(self):
+        self.service = build_control_amp_service(self)
+        self.service.startService()
+        self.protocol = ControlAMP(self.service)
+        self.responses = []
+        self.sent = []
+
+        def call_remote(command, **kwargs):
+            self.sent.append((command, kwargs))
+            d = Deferred()
+            self.responses.append(d)
+            return d
+        self.patch(self.protocol, "callRemote", call_remote)
+        self.protocol.makeConnection(StringTransport())
+        self.service.reactor.advance(0)
+
+    def change_configuration(self, hostname):
+        """
+        Save a new configuration and let the resulting broadcast happen.
+
+        :param unicode hostname: The hostname of a node to add to the
+            configuration.
+        """
+        self.service.configuration_service.save(
+            self.service.configuration_service.get().update_node(
+                Node(hostname=hostname)))
+        self.service.reactor.advance(0)
+
+    def test_not_sent_while_outstanding(self):
+        """
+        No update is sent to a connection which hasn't responded to the
+        previous one.
+        """
+        self.change_configuration(u"node1")
+        self.change_configuration(u"node2")
+        self.assertEqual(len(self.sent), 1)
+
+    def test_latest_sent_on_response(self):
+        """
+        When a connection responds, it is sent a single update with the
+        latest configuration, relative to the generation it acknowledged.
+        """
+        self.change_configuration(u"node1")
+        self.change_configuration(u"node2")
+        self.responses[0].callback({})
+        self.service.reactor.advance(0)
+        self.assertEqual(
+            self.sent[1:],
+            [(ClusterStatusDeltaCommand,
+              dict(generation=2, base_generation=1,
+                   configuration_changed=frozenset([
+                       Node(hostname=u"node1"), Node(hostname=u"node2")]),
+                   configuration_removed=[],
+                   state_changed=frozenset(),
+                   state_removed=[]))])
+
+    def test_nothing_sent_if_no_updates(self):
+        """
+        When a connection responds and no updates happened in the meantime
+        it is not sent anything.
+        """
+        self.responses[0].callback({})
+        self.service.reactor.advance(0)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_latest_sent_on_failure(self):
+        """
+        When a connection fails to process an update, it is sent the full
+        latest cluster status.
+        """
+        self.change_configuration(u"node1")
+        self.responses[0].errback(UnknownGeneration(0))
+        self.service.reactor.advance(0)
+        self.assertEqual(
+            self.sent[1:],
+            [(ClusterStatusCommand,
+              dict(configuration=self.service.configuration_service.get(),
+                   state=Deployment(nodes=frozenset()),
+                   generation=2))])
+
+    def test_other_connections_unaffected(self):
+        """
+        A connection with an outstanding update doesn't stop other
+        connections being sent updates.
+        """
+        other = ControlAMP(self.service)
+        other.makeConnection(StringTransport())
+        sent = []
+        self.patch(other, "callRemote",
+                   lambda *args, **kwargs: sent.append((args, kwargs))
+                   or succeed(None))
+        self.change_configuration(u"node1")
+        self.change_configuration(u"node2")
+        # The initial update for the new connection is merged with the first
+        # configuration change:
+        self.assertEqual((len(self.sent), len(sent)), (1, 2))
+
+    def test_superseded_counted(self):
+        """
+        ``ControlAMPService.superseded_updates`` counts the updates that
+        were merged into a later one.
+        """
+        self.change_configuration(u"node1")
+        self.change_configuration(u"node2")
+        self.assertEqual(self.service.superseded_updates, 2)
+
+    def test_disconnect_forgets(self):
+        """
+        A lost connection no longer has an outstanding update, so on
+        reconnection it is sent the cluster status immediately.
+        """
+        self.protocol.connectionLost(Failure(ConnectionLost()))
+        self.protocol.makeConnection(StringTransport())
+        self.service.reactor.advance(0)
+        self.assertEqual([command for (command, _) in self.sent],
+                         [ClusterStatusCommand, ClusterStatusCommand])
+
+    def assert_slow_agent_logged(self, logger):
+        """
+        A response after two superseded updates was logged.
+        """
+        [message] = LoggedMessage.ofType(logger.messages, LOG_SLOW_AGENT)
+        self.assertEqual(
+            message.message,
+            dict(message.message, agent=unicode(
+                self.protocol.transport.getPeer()),
+                generation=1, response_seconds=3.0, superseded=2))
+
+    @validateLogging(assert_slow_agent_logged)
+    def test_slow_agent_logged(self, logger):
+        """
+        An agent which responds after further updates have been delayed is
+        logged, along with how long it took to respond and how many updates
+        it missed.
+        """
+        self.service.logger = logger
+        self.service.reactor.advance(3)
+        self.change_configuration(u"node1")
+        self.change_configuration(u"node2")
+        self.responses[0].callback({})
+
+    def assert_delayed_logged(self, logger):
+        """
+        The broadcast was logged as having one delayed connection.
+        """
+        [message] = LoggedMessage.ofType(logger.messages, LOG_BROADCAST)
+        self.assertEqual(
+            (message.message[u"connections"], message.message[u"delayed"]),
+            (1, 1))
+
+    @validateLogging(assert_delayed_logged)
+    def test_delayed_logged(self, logger):
+        """
+        Broadcasts are logged with the number of connections whose update
+        was delayed because they have an update outstanding.
+        """
+        self.service.logger = logger
+        other = ControlAMP(self.service)
+        other.makeConnection(StringTransport())
+        self.patch(other, "callRemote",
+                   lambda *args, **kwargs: succeed(None))
+        self.change_configuration(u"node1")
 
 
 @implementer(IConvergenceAgent)
@@ -379,13 +961,72 @@ class AgentClientTests(SynchronousTestCase):
         actual = Deployment(nodes=frozenset())
         d = self.server.callRemote(ClusterStatusCommand,
                                    configuration=TEST_DEPLOYMENT,
-                                   state=actual)
+                                   state=actual,
+                                   generation=1)
         self.successResultOf(d)
         self.assertEqual(self.agent, FakeAgent(is_connected=True,
                                                client=self.client,
                                                desired=TEST_DEPLOYMENT,
                                                actual=actual))
 
+    def test_cluster_changed(self):
+        """
+        ``ClusterStatusDeltaCommand`` sent to the ``AgentClient`` results in
+        the agent being given the full configuration and cluster state,
+        reconstructed from the generation the delta is based on.
+        """
+        self.client.makeConnection(StringTransport())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand, configuration=TEST_DEPLOYMENT,
+            state=TEST_DEPLOYMENT, generation=1))
+        new_node = Node(hostname=u"node2.example.com")
+        d = self.server.callRemote(
+            ClusterStatusDeltaCommand, generation=2, base_generation=1,
+            configuration_changed=frozenset([new_node]),
+            configuration_removed=[],
+            state_changed=frozenset(),
+            state_removed=[u"node1.example.com"])
+        self.successResultOf(d)
+        self.assertEqual(self.agent, FakeAgent(
+            is_connected=True, client=self.client,
+            desired=TEST_DEPLOYMENT.update_node(new_node),
+            actual=Deployment(nodes=frozenset())))
+
+    def test_cluster_changed_unknown_generation(self):
+        """
+        ``ClusterStatusDeltaCommand`` relative to a generation the agent
+        doesn't know about results in an ``UnknownGeneration`` error and the
+        agent is not notified.
+        """
+        self.client.makeConnection(StringTransport())
+        d = self.server.callRemote(
+            ClusterStatusDeltaCommand, generation=2, base_generation=1,
+            configuration_changed=frozenset(),
+            configuration_removed=[],
+            state_changed=frozenset(),
+            state_removed=[])
+        self.failureResultOf(d, UnknownGeneration)
+        self.assertEqual(self.agent, FakeAgent(is_connected=True,
+                                               client=self.client))
+
+    def test_old_generations_forgotten(self):
+        """
+        Only a limited number of generations are remembered by the agent.
+        """
+        self.client.makeConnection(StringTransport())
+        for generation in range(_KNOWN_GENERATIONS + 1):
+            self.successResultOf(self.server.callRemote(
+                ClusterStatusCommand, configuration=TEST_DEPLOYMENT,
+                state=TEST_DEPLOYMENT, generation=generation))
+        d = self.server.callRemote(
+            ClusterStatusDeltaCommand,
+            generation=_KNOWN_GENERATIONS + 1, base_generation=0,
+            configuration_changed=frozenset(),
+            configuration_removed=[],
+            state_changed=frozenset(),
+            state_removed=[])
+        self.failureResultOf(d, UnknownGeneration)
+
 
 def iconvergence_agent_tests_factory(fixture):
     """
@@ -3,6 +3,7 @@
 from twisted.web.server import Site
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
+from twisted.python.usage import UsageError
 
 from ..script import ControlOptions, ControlScript
 from ...testtools import MemoryCoreReactor, StandardOptionsTestsMixin
@@ -70,6 +71,50 @@ class ControlOptionsTests(StandardOptionsTestsMixin,
         options.parseOptions([b"--agent-port", b"1234"])
         self.assertEqual(options["agent-port"], 1234)
 
+    def test_default_broadcast_delay(self):
+        """
+        By default ``ControlOptions`` only coalesces cluster status updates
+        within a single reactor iteration.
+        """
+        options = ControlOptions()
+        options.parseOptions([])
+        self.assertEqual(options["broadcast-delay"], 0.0)
+
+    def test_custom_broadcast_delay(self):
+        """
+        The ``--broadcast-delay`` command-line option allows configuring how
+        long to wait for further changes before sending cluster status
+        updates.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--broadcast-delay", b"0.5"])
+        self.assertEqual(options["broadcast-delay"], 0.5)
+
+    def test_default_validate_output(self):
+        """
+        By default ``ControlOptions`` validates every API response.
+        """
+        options = ControlOptions()
+        options.parseOptions([])
+        self.assertEqual(options["validate-output"], 1)
+
+    def test_custom_validate_output(self):
+        """
+        The ``--validate-output`` command-line option allows configuring
+        how many API responses are validated.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--validate-output", b"100"])
+        self.assertEqual(options["validate-output"], 100)
+
+    def test_negative_validate_output(self):
+        """
+        A negative ``--validate-output`` is rejected.
+        """
+        options = ControlOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--validate-output", b"-1"])
+
 
 class ControlScriptEffectsTests(SynchronousTestCase):
     """
@@ -138,3 +183,31 @@ class ControlScriptEffectsTests(SynchronousTestCase):
         self.assertEqual(
             (port, protocol.__class__, protocol.control_amp_service.__class__),
             (8001, ControlAMP, ControlAMPService))
+
+    def test_control_amp_service_broadcast_delay(self):
+        """
+        ``ControlScript.main`` configures the AMP service with the given
+        broadcast delay and reactor.
+        """
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--broadcast-delay", b"2", b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        service = reactor.tcpServers[1][1].buildProtocol(
+            None).control_amp_service
+        self.assertEqual((service.reactor, service.broadcast_delay),
+                         (reactor, 2.0))
+
+    def test_output_validation(self):
+        """
+        ``ControlScript.main`` configures the HTTP API with the given output
+        validation sampling rate.
+        """
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--validate-output", b"0", b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        user = reactor.tcpServers[0][1].resource._v1_user
+        self.assertEqual(user.output_validation.sample_every, 0)
@@ -0,0 +1,169 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_backoff -*-
+
+"""
+Backoff for state changes that keep failing, so that e.g. an image that
+can't be pulled isn't pulled again on every convergence iteration.
+"""
+
+from random import random
+
+from ._logging import LOG_BACKOFF_STATE
+
+
+# The number of seconds to wait before retrying a change that failed once:
+DEFAULT_INITIAL_BACKOFF = 2.0
+
+# The longest a change that keeps failing is ever delayed, in seconds:
+DEFAULT_MAXIMUM_BACKOFF = 300.0
+
+
+class BackingOff(Exception):
+    """
+    A state change wasn't applied because it failed recently and its
+    backoff delay hasn't passed yet.
+
+    :ivar change: The ``IStateChange`` that was skipped.
+    :ivar float retry_in: The number of seconds until it may be retried.
+    """
+    def __init__(self, change, retry_in):
+        Exception.__init__(self, change, retry_in)
+        self.change = change
+        self.retry_in = retry_in
+
+
+class _Failures(object):
+    """
+    The failures of a single state change.
+
+    :ivar change: The ``IStateChange`` that failed.
+    :ivar int count: The number of consecutive failures.
+    :ivar float retry_at: The time before which the change shouldn't be
+        attempted again.
+    """
+    def __init__(self, change):
+        self.change = change
+        self.count = 0
+        self.retry_at = 0.0
+
+
+class ChangeBackoff(object):
+    """
+    Exponential backoff, with jitter, for retrying state changes that
+    failed.
+
+    Changes are identified by equality, so the same change calculated by a
+    later convergence iteration shares the backoff of an earlier one.
+    After ``n`` consecutive failures a change isn't retried for between half
+    of and all of ``initial * 2 ** (n - 1)`` seconds, up to ``maximum``
+    seconds.
+
+    :ivar clock: The ``IReactorTime`` provider used to tell the time.
+    :ivar float initial: The maximum delay after a single failure.
+    :ivar float maximum: The maximum delay after any number of failures.
+    :ivar list _failures: ``_Failures`` of the changes whose most recent
+        attempt failed.  State changes aren't necessarily hashable, so this
+        is searched by equality; only failing changes are included, so it
+        is short.
+    """
+    def __init__(self, clock=None, initial=DEFAULT_INITIAL_BACKOFF,
+                 maximum=DEFAULT_MAXIMUM_BACKOFF, random=random):
+        """
+        :param clock: The ``IReactorTime`` provider used to tell the time.
+            Defaults to the global reactor.
+        :param float initial: The maximum delay after a single failure.
+        :param float maximum: The maximum delay after any number of
+            failures.
+        :param random: A function returning random floats in ``[0, 1)``,
+            used for jitter.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.initial = initial
+        self.maximum = maximum
+        self._random = random
+        self._failures = []
+
+    def _find(self, change):
+        """
+        :param change: An ``IStateChange`` provider.
+
+        :return: The ``_Failures`` of the change, or ``None`` if its most
+            recent attempt didn't fail.
+        """
+        for failures in self._failures:
+            if failures.change == change:
+                return failures
+        return None
+
+    def _expire(self):
+        """
+        Forget changes that haven't been attempted again for much longer
+        than they were delayed, most likely because they are no longer
+        necessary.
+        """
+        now = self.clock.seconds()
+        self._failures = [
+            failures for failures in self._failures
+            if now - failures.retry_at < self.maximum]
+
+    def retry_in(self, change):
+        """
+        :param change: An ``IStateChange`` provider.
+
+        :return: The number of seconds until the change may be attempted
+            again, or ``0.0`` if it may be attempted now.
+        """
+        failures = self._find(change)
+        if failures is None:
+            return 0.0
+        return max(failures.retry_at - self.clock.seconds(), 0.0)
+
+    def failed(self, change):
+        """
+        Record an attempt to apply a change failing.
+
+        :param change: An ``IStateChange`` provider.
+        """
+        self._expire()
+        failures = self._find(change)
+        if failures is None:
+            failures = _Failures(change)
+            self._failures.append(failures)
+        failures.count += 1
+        delay = min(self.initial * 2 ** (failures.count - 1), self.maximum)
+        delay *= 0.5 + self._random() / 2
+        failures.retry_at = self.clock.seconds() + delay
+
+    def succeeded(self, change):
+        """
+        Record an attempt to apply a change succeeding.
+
+        :param change: An ``IStateChange`` provider.
+        """
+        failures = self._find(change)
+        if failures is not None:
+            self._failures.remove(failures)
+
+    def state(self):
+        """
+        :return: A ``list`` with a ``dict`` for each change that is backing
+            off, including its representation (``u"change"``), the number
+            of consecutive failures (``u"failures"``) and the number of
+            seconds until it may be retried (``u"retry_in"``).
+        """
+        self._expire()
+        return [
+            {u"change": unicode(repr(failures.change), "utf-8", "replace"),
+             u"failures": failures.count,
+             u"retry_in": self.retry_in(failures.change)}
+            for failures in self._failures]
+
+    def log_state(self, logger):
+        """
+        Log the current ``state()``.
+
+        :param eliot.Logger logger: The logger to write to.
+        """
+        LOG_BACKOFF_STATE(changes=self.state()).write(logger)
@@ -0,0 +1,155 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_concurrency -*-
+
+"""
+Limits on how many state changes using the same kind of resource run at
+once, so that e.g. fifty applications being started don't become fifty
+simultaneous Docker API calls.
+"""
+
+from heapq import heappush, heappop
+from itertools import count
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+from ._logging import LOG_CONCURRENCY_STATE
+
+
+# Resource classes:
+DOCKER = u"docker"
+ZFS = u"zfs"
+TRANSFER = u"transfer"
+
+# The default maximum number of changes of each resource class that run at
+# once:
+DEFAULT_LIMITS = {DOCKER: 8, ZFS: 4, TRANSFER: 2}
+
+
+class _ResourceQueue(object):
+    """
+    The changes using a single resource class.
+
+    :ivar int limit: The maximum number of changes that run at once.
+    :ivar int running: The number of changes running.
+    :ivar int max_queued: The largest number of changes that have been
+        waiting at once.
+    :ivar list waiting: A heap of ``(-priority, sequence, Deferred)`` for
+        the changes waiting to run, so the highest priority and then the
+        earliest change comes first.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.max_queued = 0
+        self.waiting = []
+
+
+class ConcurrencyLimits(object):
+    """
+    Bounded concurrency per resource class.
+
+    Once the limit of a resource class is reached, further changes using it
+    wait in a queue and are run in order of priority as running ones finish.
+    Changes of resource classes without a limit run immediately.
+
+    :ivar dict _queues: Map resource class names to their
+        ``_ResourceQueue``.
+    :ivar _sequence: Iterator of numbers used to run changes of the same
+        priority in the order they were queued.
+    """
+    def __init__(self, limits=None):
+        """
+        :param dict limits: Map resource class names to the maximum number
+            of changes using them that run at once.  Defaults to
+            ``DEFAULT_LIMITS``.
+        """
+        if limits is None:
+            limits = DEFAULT_LIMITS
+        self._queues = {resource_class: _ResourceQueue(limit)
+                        for resource_class, limit in limits.items()}
+        self._sequence = count()
+
+    def saturated(self, resource_class):
+        """
+        :param resource_class: The name of a resource class, or ``None``.
+
+        :return: Whether a change of the resource class would have to wait
+            before running.
+        """
+        queue = self._queues.get(resource_class)
+        if queue is None:
+            return False
+        return queue.running >= queue.limit
+
+    def queued(self, resource_class):
+        """
+        :param resource_class: The name of a resource class, or ``None``.
+
+        :return: The number of changes of the resource class waiting to run.
+        """
+        queue = self._queues.get(resource_class)
+        if queue is None:
+            return 0
+        return len(queue.waiting)
+
+    def run(self, resource_class, priority, f, *args, **kwargs):
+        """
+        Call a function once fewer than the limit of changes of a resource
+        class are running.
+
+        :param resource_class: The name of the resource class, or ``None``
+            if the call isn't limited.
+        :param int priority: Calls with higher priorities are made first.
+        :param f: The function to call. It may return a ``Deferred``.
+
+        :return: ``Deferred`` firing with the result of ``f``.
+        """
+        queue = self._queues.get(resource_class)
+        if queue is None:
+            return maybeDeferred(f, *args, **kwargs)
+        d = Deferred()
+        heappush(queue.waiting, (-priority, next(self._sequence), d))
+        self._dispatch(queue)
+        queue.max_queued = max(queue.max_queued, len(queue.waiting))
+        d.addCallback(lambda _: maybeDeferred(f, *args, **kwargs))
+
+        def finished(result):
+            queue.running -= 1
+            self._dispatch(queue)
+            return result
+        d.addBoth(finished)
+        return d
+
+    def _dispatch(self, queue):
+        """
+        Run waiting changes until the limit is reached.
+
+        :param _ResourceQueue queue: The queue to run changes from.
+        """
+        while queue.waiting and queue.running < queue.limit:
+            _, _, d = heappop(queue.waiting)
+            queue.running += 1
+            d.callback(None)
+
+    def state(self):
+        """
+        :return: A ``dict`` mapping resource class names to ``dict``\ s with
+            the limit (``u"limit"``), the number of changes running
+            (``u"running"``) and waiting (``u"queued"``), and the largest
+            number of changes that have been waiting at once
+            (``u"max_queued"``).
+        """
+        return {
+            resource_class: {u"limit": queue.limit,
+                             u"running": queue.running,
+                             u"queued": len(queue.waiting),
+                             u"max_queued": queue.max_queued}
+            for resource_class, queue in self._queues.items()}
+
+    def log_state(self, logger):
+        """
+        Log the current ``state()``.
+
+        :param eliot.Logger logger: The logger to write to.
+        """
+        LOG_CONCURRENCY_STATE(resources=self.state()).write(logger)
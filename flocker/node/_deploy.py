@@ -5,16 +5,20 @@
 Deploy applications on nodes.
 """
 
+from functools import partial
 from uuid import uuid4
 
 from zope.interface import Interface, implementer
 
 from characteristic import attributes
 
+from eliot import Logger
+
 from pyrsistent import pmap
 from pickle import loads, dumps
 
-from twisted.internet.defer import gatherResults, fail, succeed
+from twisted.internet.defer import Deferred, gatherResults, fail, succeed
+from twisted.python import log
 
 from ._docker import DockerClient, PortMap, Environment, Volume as DockerVolume
 from ..control._model import (
@@ -26,6 +30,16 @@ from ..volume._ipc import RemoteVolumeManager, standard_node
 from ..volume._model import VolumeSize
 from ..volume.service import VolumeName
 from ..common import gather_deferreds
+from ._logging import (
+    LOG_DISCOVER_STEP, LOG_STATE_CHANGE, LOG_BACKING_OFF, LOG_QUEUED,
+    )
+from ._timing import ConvergenceTimings, timed
+from ._backoff import ChangeBackoff, BackingOff
+from ._concurrency import ConcurrencyLimits, DOCKER, ZFS, TRANSFER
+from ._trace import ChangeTrace
+
+
+_logger = Logger()
 
 
 def _to_volume_name(dataset_id):
@@ -106,6 +120,81 @@ class IDeployer(Interface):
         """
 
 
+def run_state_change(change, deployer, priority=0):
+    """
+    Apply an ``IStateChange`` in a ``LOG_STATE_CHANGE`` Eliot action.
+
+    The action is written to the ``logger`` of the deployer, if it has one
+    that isn't ``None``.  If the deployer has ``timings`` that aren't
+    ``None`` the duration and outcome of the change are recorded there,
+    named after the type of the change.
+
+    If the deployer has a ``backoff`` that isn't ``None``, changes other
+    than ``Sequentially``, ``InParallel`` and ``InDependencyOrder`` that
+    failed recently are skipped until their backoff delay has passed,
+    failing with ``BackingOff`` without being applied.  A skipped change
+    isn't done, so changes that come after it in a ``Sequentially`` or
+    depend on it in an ``InDependencyOrder`` don't run either, while
+    unrelated changes go ahead.
+
+    If the deployer has ``limits`` that aren't ``None``, changes using the
+    Docker API, ZFS commands or network transfers wait while the
+    concurrency limit of their resource class is reached.
+
+    If the deployer has a ``trace`` that isn't ``None``, when the change
+    started and finished running is recorded there.
+
+    :param IStateChange change: The change to apply.
+    :param IDeployer deployer: The deployer to pass to the change.
+    :param int priority: Changes waiting for the same resource class run
+        in order of priority, highest first.
+
+    :return: ``Deferred`` firing when the change is done.
+    """
+    logger = getattr(deployer, "logger", None)
+    if logger is None:
+        logger = _logger
+    backoff = getattr(deployer, "backoff", None)
+    if isinstance(change, (Sequentially, InParallel, InDependencyOrder)):
+        backoff = None
+    if backoff is not None:
+        retry_in = backoff.retry_in(change)
+        if retry_in > 0:
+            LOG_BACKING_OFF(change=change, retry_in=retry_in).write(logger)
+            return fail(BackingOff(change, retry_in))
+
+    trace = getattr(deployer, "trace", None)
+
+    def apply_change():
+        if trace is None:
+            run = change.run
+        else:
+            run = partial(trace.measure, change, change.run)
+        return timed(getattr(deployer, "timings", None),
+                     u"change:" + type(change).__name__.decode("ascii"),
+                     LOG_STATE_CHANGE(logger, change=change),
+                     run, deployer)
+    limits = getattr(deployer, "limits", None)
+    if limits is None:
+        d = apply_change()
+    else:
+        resource_class = _resource_class(change)
+        if limits.saturated(resource_class):
+            LOG_QUEUED(change=change, resource_class=resource_class,
+                       queued=limits.queued(resource_class) + 1).write(logger)
+        d = limits.run(resource_class, priority, apply_change)
+    if backoff is not None:
+        def failed(reason):
+            backoff.failed(change)
+            return reason
+
+        def succeeded(result):
+            backoff.succeeded(change)
+            return result
+        d.addCallbacks(succeeded, failed)
+    return d
+
+
 @implementer(IStateChange)
 @attributes(["changes"])
 class Sequentially(object):
@@ -117,7 +206,8 @@ class Sequentially(object):
     def run(self, deployer):
         d = succeed(None)
         for change in self.changes:
-            d.addCallback(lambda _, change=change: change.run(deployer))
+            d.addCallback(
+                lambda _, change=change: run_state_change(change, deployer))
         return d
 
 
@@ -128,10 +218,398 @@ class InParallel(object):
     Run a series of changes in parallel.
 
     Failures in one change do not prevent other changes from continuing.
+    How many changes of each resource class actually run at once may be
+    bounded by the deployer's ``limits``; see ``run_state_change``.
     """
     def run(self, deployer):
         return gather_deferreds(
-            [change.run(deployer) for change in self.changes])
+            [run_state_change(change, deployer) for change in self.changes])
+
+
+@implementer(IStateChange)
+@attributes(["changes", "dependencies"])
+class InDependencyOrder(object):
+    """
+    Run a graph of changes, starting each change as soon as the changes it
+    depends on are done.
+
+    Failures in a change stop the changes that depend on it, directly or
+    indirectly, but not other changes.
+
+    :ivar list changes: The ``IStateChange`` providers to run.
+    :ivar frozenset dependencies: Pairs of indexes into ``changes``; in
+        each pair the change at the second index depends on the change at
+        the first.  The first index is always the smaller one, so there are
+        no cycles.
+    """
+    def run(self, deployer):
+        d = run_in_dependency_order(self, deployer)
+        d.addCallback(lambda _: None)
+        return d
+
+
+class _DependencyOrderRun(object):
+    """
+    A single run of an ``InDependencyOrder``.
+
+    :ivar InDependencyOrder plan: The changes being run.
+    :ivar IDeployer deployer: The deployer to pass to the changes.
+    :ivar stopping: A no-argument callable returning whether changes that
+        haven't started yet should be skipped.
+    :ivar list _waiting_on: For each change, the ``set`` of indexes of the
+        unfinished changes it depends on.
+    :ivar list _dependents: For each change, the indexes of the changes
+        depending on it.
+    :ivar list _priorities: For each change, the number of changes that
+        depend on it directly or indirectly, so that changes holding up the
+        most others are first to run when resources are limited.
+    :ivar set _unstarted: Indexes of the changes that haven't started.
+    :ivar int _running: The number of changes that have started but aren't
+        done.
+    :ivar list _failures: ``Failure``\ s of the changes that failed, in
+        the order they failed, including those that were skipped because
+        they are backing off.
+    :ivar bool _dispatching: Whether ``_dispatch`` is starting changes.
+    :ivar Deferred _done: Fires when no more changes will be started and
+        all started changes are done.
+    """
+    def __init__(self, plan, deployer, stopping):
+        self.plan = plan
+        self.deployer = deployer
+        self.stopping = stopping
+        self._waiting_on = [set() for _ in plan.changes]
+        self._dependents = [[] for _ in plan.changes]
+        for before, after in plan.dependencies:
+            self._waiting_on[after].add(before)
+            self._dependents[before].append(after)
+        # Dependents always come later, so work backwards:
+        downstream = [set() for _ in plan.changes]
+        for index in reversed(range(len(plan.changes))):
+            for dependent in self._dependents[index]:
+                downstream[index].add(dependent)
+                downstream[index] |= downstream[dependent]
+        self._priorities = [len(indexes) for indexes in downstream]
+        self._unstarted = set(range(len(plan.changes)))
+        self._running = 0
+        self._failures = []
+        self._dispatching = False
+        self._done = Deferred()
+
+    def start(self):
+        """
+        Start the changes that don't depend on any others.
+
+        :return: ``Deferred`` firing when the run is done, with the number
+            of changes skipped because of ``stopping``, or failing with the
+            first failure of a change.
+        """
+        self._dispatch()
+        return self._done
+
+    def _dispatch(self):
+        """
+        Start every change whose prerequisites are done, finishing the run
+        if nothing is left running.
+        """
+        if self._dispatching:
+            # A change finished synchronously while being started; the
+            # outer loop will pick up whatever it made ready.
+            return
+        self._dispatching = True
+        try:
+            while not self.stopping():
+                ready = [index for index in sorted(self._unstarted)
+                         if not self._waiting_on[index]]
+                if not ready:
+                    break
+                for index in ready:
+                    self._start(index)
+        finally:
+            self._dispatching = False
+        if self._running == 0 and not self._done.called:
+            self._finish()
+
+    def _start(self, index):
+        """
+        Start a single change.
+
+        :param int index: The index of the change.
+        """
+        self._unstarted.remove(index)
+        self._running += 1
+        d = run_state_change(self.plan.changes[index], self.deployer,
+                             self._priorities[index])
+        d.addCallbacks(self._succeeded, self._failed,
+                       callbackArgs=(index,), errbackArgs=(index,))
+
+    def _succeeded(self, result, index):
+        self._running -= 1
+        for dependent in self._dependents[index]:
+            self._waiting_on[dependent].discard(index)
+        self._dispatch()
+
+    def _failed(self, reason, index):
+        # The changes depending on this one never become ready, whether it
+        # failed or was skipped because it is backing off.
+        self._running -= 1
+        self._failures.append(reason)
+        self._dispatch()
+
+    def _finish(self):
+        """
+        Fire ``_done``, failing with the first failure of a change that was
+        run, or if there are none with the first ``BackingOff``, and logging
+        the other failures of changes that were run.
+
+        Skipped changes were already logged by ``run_state_change``.
+        """
+        if self._failures:
+            failures = [reason for reason in self._failures
+                        if not reason.check(BackingOff)]
+            if failures:
+                for reason in failures[1:]:
+                    log.err(reason)
+                self._done.errback(failures[0])
+            else:
+                self._done.errback(self._failures[0])
+        else:
+            self._done.callback(len(self._unstarted))
+
+
+def run_in_dependency_order(plan, deployer, stopping=lambda: False):
+    """
+    Run the changes of an ``InDependencyOrder``, each in a
+    ``run_state_change`` as soon as the changes it depends on are done.
+
+    Changes that are in progress are never interrupted, but once
+    ``stopping`` returns ``True`` no further changes are started.
+
+    :param InDependencyOrder plan: The changes to run.
+    :param IDeployer deployer: The deployer to pass to the changes.
+    :param stopping: A no-argument callable returning whether to stop
+        starting changes.
+
+    :return: ``Deferred`` firing with the number of changes that were
+        skipped because of ``stopping`` once all started changes are done,
+        or failing with the first failure if any change failed, or else
+        with ``BackingOff`` if any change was skipped because it is backing
+        off.
+    """
+    return _DependencyOrderRun(plan, deployer, stopping).start()
+
+
+def _resource_class(change):
+    """
+    :param IStateChange change: The change.
+
+    :return: The name of the resource class whose concurrency limit applies
+        to the change, or ``None`` if it isn't limited.
+    """
+    if isinstance(change, (StartApplication, StopApplication)):
+        return DOCKER
+    if isinstance(change, (CreateDataset, ResizeDataset)):
+        return ZFS
+    if isinstance(change, (PushDataset, HandoffDataset)):
+        return TRANSFER
+    return None
+
+
+def _state_change_resources(change):
+    """
+    Find the parts of local state a change uses, so that changes which
+    don't share any can run independently.
+
+    :param IStateChange change: The change.
+
+    :return: A ``frozenset`` of tuples identifying applications, datasets,
+        ports and the proxy configuration, or ``None`` if the change is of
+        an unknown type and so might use anything.
+    """
+    if isinstance(change, (Sequentially, InParallel)):
+        resources = frozenset()
+        for subchange in change.changes:
+            subresources = _state_change_resources(subchange)
+            if subresources is None:
+                return None
+            resources |= subresources
+        return resources
+    if isinstance(change, (StartApplication, StopApplication)):
+        application = change.application
+        resources = {(u"application", application.name)}
+        if application.volume is not None:
+            dataset = application.volume.manifestation.dataset
+            resources.add((u"dataset", dataset.dataset_id))
+        for port in application.ports or ():
+            resources.add((u"port", port.external_port))
+        if isinstance(change, StartApplication) and application.links:
+            # Links to applications on other nodes go through proxies:
+            resources.add((u"proxies",))
+        return frozenset(resources)
+    if isinstance(change, (CreateDataset, ResizeDataset, WaitForDataset,
+                           HandoffDataset, PushDataset)):
+        return frozenset([(u"dataset", change.dataset.dataset_id)])
+    if isinstance(change, SetProxies):
+        return frozenset([(u"proxies",)] + [
+            (u"port", proxy.port) for proxy in change.ports])
+    return None
+
+
+def _started_applications(change):
+    """
+    :param IStateChange change: The change.
+
+    :return: A ``list`` of the ``Application``\ s the change starts.
+    """
+    if isinstance(change, (Sequentially, InParallel)):
+        return [application for subchange in change.changes
+                for application in _started_applications(subchange)]
+    if isinstance(change, StartApplication):
+        return [change.application]
+    return []
+
+
+def _links_to(dependent, target):
+    """
+    :return: Whether an application started by ``dependent`` links to a
+        port of an application started by ``target``.
+    """
+    ports = {port.external_port
+             for application in _started_applications(target)
+             for port in application.ports or ()}
+    return any(link.remote_port in ports
+               for application in _started_applications(dependent)
+               for link in application.links)
+
+
+def _link_targets_first(changes):
+    """
+    Order changes so that those starting applications come after those
+    starting the applications they link to.  Link cycles are broken
+    arbitrarily.
+
+    :param list changes: ``IStateChange`` providers.
+
+    :return: A ``list`` of the same changes.
+    """
+    ordered = []
+    visiting = set()
+
+    def visit(index):
+        if index in visiting:
+            return
+        visiting.add(index)
+        for target, change in enumerate(changes):
+            if target != index and _links_to(changes[index], change):
+                visit(target)
+        ordered.append(changes[index])
+
+    for index in range(len(changes)):
+        visit(index)
+    return ordered
+
+
+def in_dependency_order(phases):
+    """
+    Turn phases of changes, which would each have to finish before the next
+    one starts, into a graph with explicit dependencies between the changes
+    that would have been run in parallel within each phase.
+
+    A change depends on every change in an earlier phase that uses some of
+    the same applications, datasets, ports or proxies, and on any change in
+    the same phase that starts an application it links to.  Changes of
+    unknown types depend on, and are depended on by, every change in other
+    phases.
+
+    :param list phases: ``IStateChange`` providers; the changes of an
+        ``InParallel`` are its own nodes in the graph, other changes are
+        single nodes.
+
+    :return: An ``InDependencyOrder``.
+    """
+    changes = []
+    phase_of = []
+    for phase_index, phase in enumerate(phases):
+        if isinstance(phase, InParallel):
+            nodes = _link_targets_first(phase.changes)
+        else:
+            nodes = [phase]
+        changes.extend(nodes)
+        phase_of.extend([phase_index] * len(nodes))
+
+    resources = [_state_change_resources(change) for change in changes]
+    dependencies = set()
+    for after in range(len(changes)):
+        for before in range(after):
+            if phase_of[before] == phase_of[after]:
+                depends = _links_to(changes[after], changes[before])
+            elif resources[before] is None or resources[after] is None:
+                depends = True
+            else:
+                depends = bool(resources[before] & resources[after])
+            if depends:
+                dependencies.add((before, after))
+    return InDependencyOrder(changes=changes,
+                             dependencies=frozenset(dependencies))
+
+
+def _finished_last(paths):
+    """
+    :param list paths: Lists of ``_Span``\ s, some of which may be empty.
+
+    :return: The index of the non-empty list whose last span finished last,
+        or ``None`` if they are all empty.
+    """
+    candidates = [index for index, path in enumerate(paths) if path]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda index: paths[index][-1].end)
+
+
+def critical_path(change, trace):
+    """
+    Find the chain of changes that determined how long applying a change
+    took: all changes of a ``Sequentially``, the slowest change of an
+    ``InParallel``, and for an ``InDependencyOrder`` the change that
+    finished last preceded by, in turn, whichever of its prerequisites
+    finished last.
+
+    :param IStateChange change: The change that was applied.
+    :param ChangeTrace trace: The trace the change and the changes making
+        it up were recorded in.
+
+    :return: A ``list`` of ``_Span``\ s of changes other than
+        ``Sequentially``, ``InParallel`` and ``InDependencyOrder``, in the
+        order they ran.  Changes that weren't run, e.g. because an earlier
+        change failed, are left out.
+    """
+    if isinstance(change, Sequentially):
+        return [span for subchange in change.changes
+                for span in critical_path(subchange, trace)]
+    if isinstance(change, InParallel):
+        paths = [critical_path(subchange, trace)
+                 for subchange in change.changes]
+        last = _finished_last(paths)
+        if last is None:
+            return []
+        return paths[last]
+    if isinstance(change, InDependencyOrder):
+        paths = [critical_path(subchange, trace)
+                 for subchange in change.changes]
+        prerequisites = [[] for _ in change.changes]
+        for before, after in change.dependencies:
+            prerequisites[after].append(before)
+        path = []
+        current = _finished_last(paths)
+        while current is not None:
+            path = paths[current] + path
+            current = _finished_last(
+                [paths[index] if index in prerequisites[current] else []
+                 for index in range(len(paths))])
+        return path
+    span = trace.span(change)
+    if span is None:
+        return []
+    return [span]
 
 
 @implementer(IStateChange)
@@ -359,10 +837,32 @@ class P2PNodeDeployer(object):
         deployment operations. Default ``DockerClient``.
     :ivar INetwork network: The network routing API to use in
         deployment operations. Default is iptables-based implementation.
+    :ivar ConvergenceTimings timings: Records the durations of discovery
+        steps and state changes.
+    :ivar eliot.Logger logger: The logger discovery steps and state changes
+        are logged to.
+    :ivar ChangeBackoff backoff: Delays retrying state changes that failed.
+    :ivar ConcurrencyLimits limits: Bounds the number of state changes of
+        each resource class that run at once.
+    :ivar ChangeTrace trace: Records when state changes start and finish.
     """
     def __init__(self, hostname, volume_service, docker_client=None,
-                 network=None):
+                 network=None, timings=None, backoff=None, limits=None,
+                 trace=None):
         self.hostname = hostname
+        if timings is None:
+            timings = ConvergenceTimings()
+        self.timings = timings
+        if backoff is None:
+            backoff = ChangeBackoff()
+        self.backoff = backoff
+        if limits is None:
+            limits = ConcurrencyLimits()
+        self.limits = limits
+        if trace is None:
+            trace = ChangeTrace()
+        self.trace = trace
+        self.logger = Logger()
         if docker_client is None:
             docker_client = DockerClient()
         self.docker_client = docker_client
@@ -371,6 +871,19 @@ class P2PNodeDeployer(object):
         self.network = network
         self.volume_service = volume_service
 
+    def _discovery_step(self, step, f):
+        """
+        Call a function discovering part of local state, in a
+        ``LOG_DISCOVER_STEP`` action and recording its duration.
+
+        :param unicode step: The name of the step.
+        :param f: The function to call. It may return a ``Deferred``.
+
+        :return: ``Deferred`` firing with the result of ``f``.
+        """
+        return timed(self.timings, u"discover:" + step,
+                     LOG_DISCOVER_STEP(self.logger, step=step), f)
+
     def discover_local_state(self):
         """
         List all the ``Application``\ s running on this node.
@@ -381,7 +894,8 @@ class P2PNodeDeployer(object):
         # Add real namespace support in
         # https://clusterhq.atlassian.net/browse/FLOC-737; for now we just
         # strip the namespace since there will only ever be one.
-        volumes = self.volume_service.enumerate()
+        volumes = self._discovery_step(
+            u"volumes", self.volume_service.enumerate)
 
         def map_volumes_to_size(volumes):
             primary_manifestations = {}
@@ -393,10 +907,15 @@ class P2PNodeDeployer(object):
                         volume.name.dataset_id, volume.size.maximum_size)
             return primary_manifestations
         volumes.addCallback(map_volumes_to_size)
-        d = gatherResults([self.docker_client.list(), volumes])
+        d = gatherResults([
+            self._discovery_step(u"containers", self.docker_client.list),
+            volumes,
+            self._discovery_step(
+                u"used_ports", self.network.enumerate_used_ports),
+        ])
 
         def applications_from_units(result):
-            units, available_manifestations = result
+            units, available_manifestations, used_ports = result
             running = []
             not_running = []
             for unit in units:
@@ -472,7 +991,7 @@ class P2PNodeDeployer(object):
                 hostname=self.hostname,
                 running=running,
                 not_running=not_running,
-                used_ports=self.network.enumerate_used_ports(),
+                used_ports=used_ports,
                 other_manifestations=other_manifestations,
             )
         d.addCallback(applications_from_units)
@@ -546,6 +1065,11 @@ class P2PNodeDeployer(object):
         5. Create volumes.
         6. Start and restart any relevant containers.
 
+        The phases aren't barriers: each change only waits for the changes
+        in earlier phases that involve the same applications, datasets,
+        ports or proxies, and for the applications it links to (see
+        ``in_dependency_order``).
+
         :param NodeState local_state: The local state of the node.
         :param Deployment desired_configuration: The intended
             configuration of all nodes.
@@ -556,7 +1080,7 @@ class P2PNodeDeployer(object):
         :param unicode hostname: The hostname of the node that this is running
             on.
 
-        :return: A ``IStateChange`` provider.
+        :return: An ``InDependencyOrder``.
         """
         # Current cluster state is likely out of date as regards the
         # local state, so update it accordingly:
@@ -686,7 +1210,7 @@ class P2PNodeDeployer(object):
         start_restart = start_containers + restart_containers
         if start_restart:
             phases.append(InParallel(changes=start_restart))
-        return Sequentially(changes=phases)
+        return in_dependency_order(phases)
 
 
 def change_node_state(deployer, desired_configuration,  current_cluster_state):
@@ -0,0 +1,147 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+This module defines the Eliot log events emitted by the convergence agent.
+"""
+
+__all__ = [
+    "LOG_CONVERGE",
+    "LOG_DISCOVER",
+    "LOG_DISCOVER_STEP",
+    "LOG_CALCULATE",
+    "LOG_STATE_CHANGE",
+    "LOG_PREEMPTED",
+    "LOG_BACKING_OFF",
+    "LOG_BACKOFF_STATE",
+    "LOG_TIMINGS",
+    "LOG_QUEUED",
+    "LOG_CONCURRENCY_STATE",
+    "LOG_CRITICAL_PATH",
+    ]
+
+from eliot import Field, ActionType, MessageType
+
+
+def _system(name):
+    return u"flocker:node:" + name
+
+
+STEP = Field.forTypes(
+    u"step", [unicode],
+    u"The part of local state being discovered.")
+
+CHANGE = Field(
+    u"change", lambda change: unicode(repr(change), "utf-8", "replace"),
+    u"The state change being applied.")
+
+SECONDS = Field.forTypes(
+    u"seconds", [float],
+    u"The time taken, in seconds.")
+
+REMAINING_PHASES = Field.forTypes(
+    u"remaining_phases", [int],
+    u"The number of phases of a plan that were not applied; for a plan "
+    u"in dependency order, the number of changes that were not started.")
+
+RETRY_IN = Field.forTypes(
+    u"retry_in", [float],
+    u"The number of seconds until a failed change may be retried.")
+
+BACKOFF_CHANGES = Field.forTypes(
+    u"changes", [list],
+    u"The changes that are backing off after failing, with the number of "
+    u"consecutive failures and seconds until they may be retried.")
+
+TIMINGS = Field.forTypes(
+    u"timings", [dict],
+    u"Percentiles of the durations of recent convergence operations, "
+    u"keyed by operation name.")
+
+RESOURCE_CLASS = Field.forTypes(
+    u"resource_class", [unicode],
+    u"The kind of resource a state change uses, e.g. the Docker API.")
+
+QUEUED = Field.forTypes(
+    u"queued", [int],
+    u"The number of changes of the same resource class waiting to run.")
+
+CONCURRENCY = Field.forTypes(
+    u"resources", [dict],
+    u"For each resource class, the concurrency limit and the number of "
+    u"changes running, waiting and the most that have waited at once.")
+
+CRITICAL_PATH = Field.forTypes(
+    u"path", [list],
+    u"The chain of changes that determined how long applying a plan took, "
+    u"each with its start, in seconds since the plan started, and "
+    u"duration.")
+
+
+LOG_CONVERGE = ActionType(
+    _system(u"converge"),
+    [],
+    [SECONDS],
+    u"A single iteration of the convergence loop.")
+
+LOG_DISCOVER = ActionType(
+    _system(u"discover"),
+    [],
+    [SECONDS],
+    u"Discovery of local state.")
+
+LOG_DISCOVER_STEP = ActionType(
+    _system(u"discover_step"),
+    [STEP],
+    [SECONDS],
+    u"Discovery of one part of local state.")
+
+LOG_CALCULATE = ActionType(
+    _system(u"calculate"),
+    [],
+    [SECONDS],
+    u"Calculation of the changes necessary to converge local state.")
+
+LOG_STATE_CHANGE = ActionType(
+    _system(u"state_change"),
+    [CHANGE],
+    [SECONDS],
+    u"A change to local state is being applied.")
+
+LOG_PREEMPTED = MessageType(
+    _system(u"preempted"),
+    [REMAINING_PHASES],
+    u"A newer desired configuration arrived while a plan was being "
+    u"applied, so its remaining phases were skipped and the changes "
+    u"necessary will be calculated again.")
+
+LOG_BACKING_OFF = MessageType(
+    _system(u"backing_off"),
+    [CHANGE, RETRY_IN],
+    u"A change that failed recently was skipped rather than retried.")
+
+LOG_BACKOFF_STATE = MessageType(
+    _system(u"backoff_state"),
+    [BACKOFF_CHANGES],
+    u"The changes currently backing off, logged on request.")
+
+LOG_TIMINGS = MessageType(
+    _system(u"timings"),
+    [TIMINGS],
+    u"A summary of recent convergence timings, logged on request.")
+
+LOG_QUEUED = MessageType(
+    _system(u"queued"),
+    [CHANGE, RESOURCE_CLASS, QUEUED],
+    u"A change is waiting to run because the concurrency limit of its "
+    u"resource class has been reached.")
+
+LOG_CONCURRENCY_STATE = MessageType(
+    _system(u"concurrency_state"),
+    [CONCURRENCY],
+    u"The use of each resource class's concurrency limit, logged on "
+    u"request.")
+
+LOG_CRITICAL_PATH = MessageType(
+    _system(u"critical_path"),
+    [SECONDS, CRITICAL_PATH],
+    u"The critical path of the changes applied by a convergence iteration.")
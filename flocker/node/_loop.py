@@ -15,7 +15,10 @@ control service, and sends inputs to the ConvergenceLoop state machine.
 
 from zope.interface import implementer
 
-from characteristic import attributes
+from characteristic import attributes, Attribute
+
+from eliot import Logger, writeFailure
+from eliot.twisted import DeferredContext
 
 from machinist import (
     trivialInput, TransitionTable, constructFiniteStateMachine,
@@ -24,11 +27,30 @@ from machinist import (
 
 from twisted.application.service import MultiService
 from twisted.python.constants import Names, NamedConstant
+from twisted.internet.defer import succeed
 from twisted.internet.protocol import ReconnectingClientFactory
 
 from ..control._protocol import (
     NodeStateCommand, IConvergenceAgent, AgentAMP,
     )
+from ._deploy import (
+    Sequentially, InDependencyOrder, run_state_change, run_in_dependency_order,
+    critical_path,
+    )
+from ._logging import (
+    LOG_CONVERGE, LOG_DISCOVER, LOG_CALCULATE, LOG_PREEMPTED,
+    )
+from ._timing import ConvergenceTimings, timed
+from ._backoff import BackingOff
+
+
+# The number of seconds to wait between convergence iterations when local
+# state, desired configuration or cluster state have recently changed:
+DEFAULT_CONVERGENCE_INTERVAL = 1.0
+
+# The number of seconds the wait between convergence iterations may back
+# off to while nothing is changing:
+DEFAULT_MAX_CONVERGENCE_INTERVAL = 30.0
 
 
 class ClusterStatusInputs(Names):
@@ -192,6 +214,14 @@ class ConvergenceLoopInputs(Names):
     # Finished applying necessary changes to local state, a single
     # iteration of the convergence loop:
     ITERATION_DONE = NamedConstant()
+    # Time to start another iteration.  Currently only produced when the
+    # wait between iterations is over; nothing watches for local events
+    # yet, so changes made outside the agent are noticed by the next timed
+    # iteration:
+    WAKEUP = NamedConstant()
+    # The remaining phases of an iteration were skipped because a newer
+    # desired configuration arrived:
+    ITERATION_PREEMPTED = NamedConstant()
 
 
 @attributes(["client", "configuration", "state"])
@@ -218,6 +248,8 @@ class ConvergenceLoopStates(Names):
     # Local state is being converged, and once that is done we will
     # immediately stop:
     CONVERGING_STOPPING = NamedConstant()
+    # Waiting before the next iteration:
+    SLEEPING = NamedConstant()
 
 
 class ConvergenceLoopOutputs(Names):
@@ -229,6 +261,24 @@ class ConvergenceLoopOutputs(Names):
     STORE_INFO = NamedConstant()
     # Start an iteration of the covergence loop:
     CONVERGE = NamedConstant()
+    # Arrange for a WAKEUP input once it is time for the next iteration:
+    SCHEDULE_WAKEUP = NamedConstant()
+    # Cancel the scheduled WAKEUP input, if any:
+    CLEAR_WAKEUP = NamedConstant()
+    # Something may have changed, so don't back off before the next
+    # iteration:
+    RESET_INTERVAL = NamedConstant()
+    # Skip the remaining phases of the current iteration's plan if the
+    # desired configuration it was calculated from is out of date:
+    PREEMPT = NamedConstant()
+
+
+# The plans calculated when local state already matches the desired
+# configuration:
+_NO_CHANGES = (
+    Sequentially(changes=[]),
+    InDependencyOrder(changes=[], dependencies=frozenset()),
+    )
 
 
 class ConvergenceLoop(object):
@@ -245,60 +295,287 @@ class ConvergenceLoop(object):
     :ivar Deployment state: Actual cluster state.  Initially ``None``.
 
     :ivar fsm: The finite state machine this is part of.
+
+    :ivar float _delay: The number of seconds to wait after the current
+        iteration. Doubles, up to ``max_interval``, after every iteration in
+        which nothing changed.
+    :ivar _last_local_state: The local state discovered by the previous
+        iteration, or ``None``.
+    :ivar IDelayedCall _wakeup_call: The scheduled ``WAKEUP`` input, or
+        ``None``.
+
+    :ivar int iterations: The number of iterations that discovered local
+        state.
+    :ivar int short_circuited_iterations: The number of those iterations
+        that skipped planning because nothing had changed since the
+        previous iteration and that iteration had nothing to do.
+    :ivar tuple _last_inputs: The local state, desired configuration and
+        cluster state the previous plan was calculated from, or ``None``.
+    :ivar IStateChange _last_plan: The plan calculated from
+        ``_last_inputs``, or ``None``.
+    :ivar tuple _last_sent: The client and local state of the most recent
+        ``NodeStateCommand``, or ``None``.
+
+    :ivar ConvergenceTimings timings: Records the durations of iterations
+        (``u"iteration"``) and of their discovery (``u"discover"``),
+        planning (``u"calculate"``) and execution (``u"run"``) phases.
+        These are the deployer's ``timings``, if it has any, so that they
+        are summarized along with whatever the deployer records.
+    :ivar eliot.Logger logger: The logger iterations are logged to.
+
+    :ivar int preempted_iterations: The number of iterations whose plan was
+        preempted by a newer desired configuration.
+    :ivar Deployment _planned_configuration: The desired configuration the
+        current iteration's plan was calculated from, or ``None`` if there
+        is no plan yet.
+    :ivar bool _preempted: Whether the current iteration's plan has been
+        preempted.
+
+    If the deployer has a ``trace`` that isn't ``None``, the critical path
+    of every plan with changes is reported once it has been applied.
     """
-    def __init__(self, deployer):
+    def __init__(self, reactor, deployer,
+                 interval=DEFAULT_CONVERGENCE_INTERVAL,
+                 max_interval=DEFAULT_MAX_CONVERGENCE_INTERVAL):
         """
+        :param IReactorTime reactor: Used to schedule iterations.
         :param IDeployer deployer: Used to discover local state and calcualte
             necessary changes to match desired configuration.
+        :param float interval: The minimum number of seconds to wait between
+            iterations.
+        :param float max_interval: The maximum number of seconds to wait
+            between iterations.
         """
+        self.reactor = reactor
         self.deployer = deployer
+        self.interval = interval
+        self.max_interval = max_interval
+        self._delay = interval
+        self._last_local_state = None
+        self._wakeup_call = None
+        self.iterations = 0
+        self.short_circuited_iterations = 0
+        self._last_inputs = None
+        self._last_plan = None
+        self._last_sent = None
+        self.timings = getattr(deployer, "timings", None)
+        if self.timings is None:
+            self.timings = ConvergenceTimings(reactor)
+        self.logger = Logger()
+        self.preempted_iterations = 0
+        self._planned_configuration = None
+        self._preempted = False
 
     def output_STORE_INFO(self, context):
         self.client, self.configuration, self.cluster_state = (
             context.client, context.configuration, context.state)
+        # The control service only sends updates when something changed:
+        self._delay = self.interval
+
+    def output_RESET_INTERVAL(self, context):
+        self._delay = self.interval
+
+    def output_SCHEDULE_WAKEUP(self, context):
+        self._wakeup_call = self.reactor.callLater(self._delay, self._wakeup)
+        self._delay = min(self._delay * 2, self.max_interval)
+
+    def output_CLEAR_WAKEUP(self, context):
+        if self._wakeup_call is not None:
+            self._wakeup_call.cancel()
+            self._wakeup_call = None
+
+    def _wakeup(self):
+        self._wakeup_call = None
+        self.fsm.receive(ConvergenceLoopInputs.WAKEUP)
+
+    def output_PREEMPT(self, context):
+        if (self._planned_configuration is not None and
+                self.configuration != self._planned_configuration):
+            self._preempted = True
 
     def output_CONVERGE(self, context):
-        d = self.deployer.discover_local_state()
+        self._planned_configuration = None
+        self._preempted = False
+        d = timed(self.timings, u"iteration", LOG_CONVERGE(self.logger),
+                  self._converge)
+        # Failed changes are retried by later iterations, subject to the
+        # deployer's backoff, so log the failure and carry on.  Changes
+        # skipped because they are backing off were logged when skipped:
+        d.addErrback(lambda reason: reason.trap(BackingOff))
+        d.addErrback(writeFailure, self.logger, u"flocker:node:loop")
+        d.addCallback(lambda _: self._iteration_finished())
+
+    def _iteration_finished(self):
+        """
+        Tell the FSM the current iteration is over, and whether it was
+        preempted.
+        """
+        self._planned_configuration = None
+        if self._preempted:
+            self._preempted = False
+            self.preempted_iterations += 1
+            self.fsm.receive(ConvergenceLoopInputs.ITERATION_PREEMPTED)
+        else:
+            self.fsm.receive(ConvergenceLoopInputs.ITERATION_DONE)
+
+    def _run_plan(self, plan):
+        """
+        Apply the phases of a plan one after the other, skipping the
+        remaining phases once the plan has been preempted.
+
+        A change in progress is never interrupted; preemption only takes
+        effect between phases.
+
+        :param IStateChange plan: The plan. The phases of a
+            ``Sequentially`` are its changes, and each change of an
+            ``InDependencyOrder`` is a phase of its own which starts as
+            soon as the changes it depends on are done.  Any other plan is
+            a single phase.
+
+        :return: ``Deferred`` firing when the plan is done or preempted.
+        """
+        if isinstance(plan, InDependencyOrder):
+            d = run_in_dependency_order(
+                plan, self.deployer, lambda: self._preempted)
+
+            def ran(skipped):
+                if skipped:
+                    LOG_PREEMPTED(remaining_phases=skipped).write(self.logger)
+            d.addCallback(ran)
+            return d
+
+        if isinstance(plan, Sequentially):
+            phases = list(plan.changes)
+        else:
+            phases = [plan]
+
+        def run_phases(ignored, remaining):
+            if not remaining:
+                return succeed(None)
+            if self._preempted:
+                LOG_PREEMPTED(remaining_phases=len(remaining)).write(
+                    self.logger)
+                return succeed(None)
+            d = run_state_change(remaining[0], self.deployer)
+            d.addCallback(run_phases, remaining[1:])
+            return d
+        return run_phases(None, phases)
+
+    def _converge(self):
+        """
+        Run a single iteration of the convergence loop: discover local
+        state, calculate the necessary changes and apply them.
+
+        :return: ``Deferred`` firing when the iteration is done.
+        """
+        d = DeferredContext(timed(
+            self.timings, u"discover", LOG_DISCOVER(self.logger),
+            self.deployer.discover_local_state))
 
         def got_local_state(local_state):
-            self.client.callRemote(NodeStateCommand, node_state=local_state)
-            action = self.deployer.calculate_necessary_state_changes(
-                local_state, self.configuration, self.cluster_state)
-            return action.run(self.deployer)
+            if local_state != self._last_local_state:
+                self._delay = self.interval
+            self._last_local_state = local_state
+            self.iterations += 1
+            # The control service already knows about unchanged local state,
+            # unless we've reconnected since we last told it:
+            sent = (self.client, local_state)
+            if sent != self._last_sent:
+                self.client.callRemote(NodeStateCommand,
+                                       node_state=local_state)
+                self._last_sent = sent
+            inputs = (local_state, self.configuration, self.cluster_state)
+            if inputs == self._last_inputs and self._last_plan in _NO_CHANGES:
+                self.short_circuited_iterations += 1
+                return
+            calculating = timed(
+                self.timings, u"calculate", LOG_CALCULATE(self.logger),
+                self.deployer.calculate_necessary_state_changes, *inputs)
+
+            def calculated(plan):
+                self._last_inputs = inputs
+                self._last_plan = plan
+                # The configuration may have changed while the plan was
+                # being calculated, in which case it is already out of date:
+                self._planned_configuration = inputs[1]
+                if self.configuration != self._planned_configuration:
+                    self._preempted = True
+                trace = getattr(self.deployer, "trace", None)
+                if trace is None or plan in _NO_CHANGES:
+                    return self.timings.measure(u"run", self._run_plan, plan)
+                trace.reset()
+                running = self.timings.measure(u"run", self._run_plan, plan)
+
+                def report(result):
+                    trace.report(critical_path(plan, trace), self.logger)
+                    return result
+                running.addBoth(report)
+                return running
+            calculating.addCallback(calculated)
+            return calculating
         d.addCallback(got_local_state)
-        d.addCallback(lambda _: self.fsm.receive(
-            ConvergenceLoopInputs.ITERATION_DONE))
-        # This needs error handling:
-        # https://clusterhq.atlassian.net/browse/FLOC-1357
+        return d.result
 
 
-def build_convergence_loop_fsm(deployer):
+def build_convergence_loop_fsm(reactor, deployer,
+                               interval=DEFAULT_CONVERGENCE_INTERVAL,
+                               max_interval=DEFAULT_MAX_CONVERGENCE_INTERVAL):
     """
     Create a convergence loop FSM.
 
+    Once an iteration is done the loop sleeps before starting the next one,
+    for ``interval`` seconds at first and then, as long as neither local
+    state nor the cluster status change, for twice as long each time up to
+    ``max_interval`` seconds.  A status update ends the sleep immediately.
+    The end of the sleep is itself signalled by a ``WAKEUP`` input, which
+    could also be used to react to local events, though nothing produces
+    it for them yet.
+
+    :param IReactorTime reactor: Used to schedule iterations.
     :param IDeployer deployer: Used to discover local state and calcualte
         necessary changes to match desired configuration.
+    :param float interval: The minimum number of seconds to wait between
+        iterations.
+    :param float max_interval: The maximum number of seconds to wait
+        between iterations.
     """
     I = ConvergenceLoopInputs
     O = ConvergenceLoopOutputs
     S = ConvergenceLoopStates
 
     table = TransitionTable()
-    table = table.addTransition(
-        S.STOPPED, I.STATUS_UPDATE, [O.STORE_INFO, O.CONVERGE], S.CONVERGING)
+    table = table.addTransitions(
+        S.STOPPED, {
+            I.STATUS_UPDATE: ([O.STORE_INFO, O.CONVERGE], S.CONVERGING),
+            I.WAKEUP: ([], S.STOPPED),
+        })
     table = table.addTransitions(
         S.CONVERGING, {
-            I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
+            I.STATUS_UPDATE: ([O.STORE_INFO, O.PREEMPT], S.CONVERGING),
             I.STOP: ([], S.CONVERGING_STOPPING),
-            I.ITERATION_DONE: ([O.CONVERGE], S.CONVERGING),
+            I.ITERATION_DONE: ([O.SCHEDULE_WAKEUP], S.SLEEPING),
+            # The plan was out of date, so replan immediately:
+            I.ITERATION_PREEMPTED: ([O.CONVERGE], S.CONVERGING),
+            # Discovery may already have happened, so make sure the next
+            # iteration isn't delayed any more than necessary:
+            I.WAKEUP: ([O.RESET_INTERVAL], S.CONVERGING),
         })
     table = table.addTransitions(
         S.CONVERGING_STOPPING, {
-            I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
+            I.STATUS_UPDATE: ([O.STORE_INFO, O.PREEMPT], S.CONVERGING),
             I.ITERATION_DONE: ([], S.STOPPED),
+            I.ITERATION_PREEMPTED: ([], S.STOPPED),
+            I.WAKEUP: ([], S.CONVERGING_STOPPING),
+        })
+    table = table.addTransitions(
+        S.SLEEPING, {
+            I.STATUS_UPDATE: ([O.STORE_INFO, O.CLEAR_WAKEUP, O.CONVERGE],
+                              S.CONVERGING),
+            I.STOP: ([O.CLEAR_WAKEUP], S.STOPPED),
+            I.WAKEUP: ([O.CLEAR_WAKEUP, O.CONVERGE], S.CONVERGING),
         })
 
-    loop = ConvergenceLoop(deployer)
+    loop = ConvergenceLoop(reactor, deployer, interval, max_interval)
     fsm = constructFiniteStateMachine(
         inputs=I, outputs=O, states=S, initial=S.STOPPED, table=table,
         richInputs=[_ClientStatusUpdate], inputContext={},
@@ -308,7 +585,10 @@ def build_convergence_loop_fsm(deployer):
 
 
 @implementer(IConvergenceAgent)
-@attributes(["reactor", "deployer", "host", "port"])
+@attributes(["reactor", "deployer", "host", "port",
+             Attribute("interval", default_value=DEFAULT_CONVERGENCE_INTERVAL),
+             Attribute("max_interval",
+                       default_value=DEFAULT_MAX_CONVERGENCE_INTERVAL)])
 class AgentLoopService(object, MultiService):
     """
     Service in charge of running the convergence loop.
@@ -318,13 +598,18 @@ class AgentLoopService(object, MultiService):
             then changing it.
     :ivar host: Host to connect to.
     :ivar port: Port to connect to.
+    :ivar float interval: The minimum number of seconds between convergence
+        iterations.
+    :ivar float max_interval: The maximum number of seconds between
+        convergence iterations while nothing changes.
     :ivar cluster_status: A cluster status FSM.
     :ivar factory: The factory used to connect to the control service.
     """
 
     def __init__(self):
         MultiService.__init__(self)
-        convergence_loop = build_convergence_loop_fsm(self.deployer)
+        convergence_loop = build_convergence_loop_fsm(
+            self.reactor, self.deployer, self.interval, self.max_interval)
         self.cluster_status = build_cluster_status_fsm(convergence_loop)
         self.factory = ReconnectingClientFactory.forProtocol(
             lambda: AgentAMP(self))
@@ -0,0 +1,161 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_timing -*-
+
+"""
+Timing of the operations making up convergence loop iterations.
+"""
+
+from collections import defaultdict, deque
+from math import ceil
+
+from eliot.twisted import DeferredContext
+
+from twisted.internet.defer import maybeDeferred
+from twisted.python.failure import Failure
+
+from ._logging import LOG_TIMINGS
+
+
+# The number of most recent durations of each operation that percentiles
+# are calculated from:
+DEFAULT_WINDOW = 100
+
+# The percentiles included in summaries:
+PERCENTILES = (50, 90, 99)
+
+
+def _percentile(ordered, percentile):
+    """
+    :param list ordered: Sorted, non-empty list of numbers.
+    :param int percentile: The percentile to find, between 0 and 100.
+
+    :return: The nearest-rank percentile of the numbers.
+    """
+    rank = int(ceil(percentile / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+class ConvergenceTimings(object):
+    """
+    Durations and outcomes of the most recent occurrences of named
+    operations, e.g. ``u"discover"`` or ``u"change:StartApplication"``.
+
+    :ivar clock: The ``IReactorTime`` provider used to time operations.
+    :ivar int window: The number of most recent durations kept for each
+        operation.
+    :ivar dict _durations: Map operation names to a ``deque`` of their most
+        recent durations, in seconds.
+    :ivar dict _failures: Map operation names to the number of times they
+        failed.
+    """
+    def __init__(self, clock=None, window=DEFAULT_WINDOW):
+        """
+        :param clock: The ``IReactorTime`` provider used to time operations.
+            Defaults to the global reactor.
+        :param int window: The number of most recent durations to calculate
+            percentiles from.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.window = window
+        self._durations = {}
+        self._failures = defaultdict(int)
+
+    def record(self, name, seconds, succeeded=True):
+        """
+        Record one occurrence of an operation.
+
+        :param unicode name: The name of the operation.
+        :param float seconds: How long it took.
+        :param bool succeeded: Whether it succeeded.
+        """
+        durations = self._durations.get(name)
+        if durations is None:
+            durations = self._durations[name] = deque(maxlen=self.window)
+        durations.append(seconds)
+        if not succeeded:
+            self._failures[name] += 1
+
+    def measure(self, name, f, *args, **kwargs):
+        """
+        Call a function, recording how long it takes for its result to be
+        available.
+
+        :param unicode name: The name of the operation.
+        :param f: The function to call. It may return a ``Deferred``.
+
+        :return: ``Deferred`` firing with the result of ``f``.
+        """
+        start = self.clock.seconds()
+        d = maybeDeferred(f, *args, **kwargs)
+
+        def done(result):
+            self.record(name, self.clock.seconds() - start,
+                        not isinstance(result, Failure))
+            return result
+        d.addBoth(done)
+        return d
+
+    def summary(self):
+        """
+        :return: A ``dict`` mapping the names of operations to ``dict``\ s
+            with the number of recorded durations (``u"count"``), the
+            number of failures (``u"failures"``), the ``u"p50"``, ``u"p90"``
+            and ``u"p99"`` percentiles of the durations and the longest
+            duration (``u"max"``).
+        """
+        result = {}
+        for name, durations in self._durations.items():
+            ordered = sorted(durations)
+            entry = {u"count": len(ordered),
+                     u"failures": self._failures[name],
+                     u"max": ordered[-1]}
+            for percentile in PERCENTILES:
+                entry[u"p%d" % (percentile,)] = _percentile(
+                    ordered, percentile)
+            result[name] = entry
+        return result
+
+    def log_summary(self, logger):
+        """
+        Log the current ``summary()``.
+
+        :param eliot.Logger logger: The logger to write to.
+        """
+        LOG_TIMINGS(timings=self.summary()).write(logger)
+
+
+def timed(timings, name, action, f, *args, **kwargs):
+    """
+    Call a function in the context of an Eliot action, finishing the action
+    with the number of seconds the call took once its result is available.
+
+    :param ConvergenceTimings timings: Where the duration and outcome of the
+        call are recorded, or ``None`` to time the call using the global
+        reactor without recording it.
+    :param unicode name: The name to record the call under.
+    :param eliot.Action action: A started action whose success fields
+        include ``seconds``.
+    :param f: The function to call. It may return a ``Deferred``.
+
+    :return: ``Deferred`` firing with the result of ``f``.
+    """
+    if timings is None:
+        from twisted.internet import reactor as clock
+    else:
+        clock = timings.clock
+    with action.context():
+        start = clock.seconds()
+        if timings is None:
+            d = maybeDeferred(f, *args, **kwargs)
+        else:
+            d = timings.measure(name, f, *args, **kwargs)
+        d = DeferredContext(d)
+
+        def succeeded(result):
+            action.addSuccessFields(seconds=float(clock.seconds() - start))
+            return result
+        d.addCallback(succeeded)
+        d.addActionFinish()
+        return d.result
@@ -0,0 +1,176 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_trace -*-
+
+"""
+Tracing of the state changes applied by a convergence iteration, so the
+chain of changes which determined how long the iteration took can be
+reported.
+"""
+
+from json import dumps
+
+from twisted.internet.defer import maybeDeferred
+from twisted.python.failure import Failure
+
+from ._logging import LOG_CRITICAL_PATH
+
+
+class _Span(object):
+    """
+    The run of a single state change.
+
+    :ivar change: The ``IStateChange`` that was run.
+    :ivar float start: When it started.
+    :ivar end: When it finished, or ``None`` if it hasn't.
+    :ivar succeeded: Whether it succeeded, or ``None`` if it hasn't
+        finished.
+    """
+    def __init__(self, change, start):
+        self.change = change
+        self.start = start
+        self.end = None
+        self.succeeded = None
+
+
+def _describe(change):
+    return unicode(repr(change), "utf-8", "replace")
+
+
+class ChangeTrace(object):
+    """
+    Start and end times of the state changes run since the trace was last
+    reset.
+
+    :ivar clock: The ``IReactorTime`` provider used to tell the time.
+    :ivar chrome_trace: A ``FilePath`` that reports are also written to in
+        the Chrome trace event format, or ``None``.
+    :ivar _started: When the trace was last reset or, if it hasn't been,
+        when the first change started; ``None`` before then.
+    :ivar list _spans: ``_Span``\ s of the changes run, in the order they
+        started.
+    :ivar dict _by_change: Map the ``id`` of changes to their most recent
+        ``_Span``.  Changes aren't necessarily hashable, and equal changes
+        can appear more than once in a plan, so they are identified by
+        identity; ``_spans`` keeps them alive.
+    """
+    def __init__(self, clock=None, chrome_trace=None):
+        """
+        :param clock: The ``IReactorTime`` provider used to tell the time.
+            Defaults to the global reactor.
+        :param chrome_trace: A ``FilePath`` to write Chrome trace event
+            files to, or ``None``.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.chrome_trace = chrome_trace
+        self._started = None
+        self._spans = []
+        self._by_change = {}
+
+    def reset(self):
+        """
+        Forget the changes run so far.
+        """
+        self._started = self.clock.seconds()
+        self._spans = []
+        self._by_change = {}
+
+    def measure(self, change, f, *args, **kwargs):
+        """
+        Call a function applying a state change, recording when it starts
+        and when its result is available.
+
+        :param IStateChange change: The change being applied.
+        :param f: The function to call. It may return a ``Deferred``.
+
+        :return: ``Deferred`` firing with the result of ``f``.
+        """
+        span = _Span(change, self.clock.seconds())
+        if self._started is None:
+            self._started = span.start
+        self._spans.append(span)
+        self._by_change[id(change)] = span
+        d = maybeDeferred(f, *args, **kwargs)
+
+        def done(result):
+            span.end = self.clock.seconds()
+            span.succeeded = not isinstance(result, Failure)
+            return result
+        d.addBoth(done)
+        return d
+
+    def span(self, change):
+        """
+        :param IStateChange change: A change.
+
+        :return: The ``_Span`` of the most recent run of the change if it
+            has finished, otherwise ``None``.
+        """
+        span = self._by_change.get(id(change))
+        if span is None or span.end is None:
+            return None
+        return span
+
+    def report(self, path, logger):
+        """
+        Log the critical path of the changes run since the trace was reset
+        in a ``LOG_CRITICAL_PATH`` message, and write all the changes to
+        ``chrome_trace`` if it isn't ``None``.
+
+        :param list path: The ``_Span``\ s making up the critical path, in
+            order, as found by ``critical_path``.
+        :param eliot.Logger logger: The logger to write to.
+        """
+        if path:
+            seconds = path[-1].end - path[0].start
+        else:
+            seconds = 0.0
+        LOG_CRITICAL_PATH(
+            seconds=float(seconds),
+            path=[{u"change": _describe(span.change),
+                   u"start": float(span.start - self._started),
+                   u"seconds": float(span.end - span.start)}
+                  for span in path]).write(logger)
+        if self.chrome_trace is not None:
+            self.chrome_trace.setContent(
+                dumps(self.chrome_trace_events(path)))
+
+    def chrome_trace_events(self, path):
+        """
+        Describe the changes run since the trace was reset in the Chrome
+        trace event format, as understood by ``chrome://tracing``.
+
+        Changes that overlap are put in different rows, and those on the
+        critical path are marked as such.
+
+        :param list path: The ``_Span``\ s making up the critical path.
+
+        :return: A ``dict`` that can be serialized as JSON.
+        """
+        critical = {id(span) for span in path}
+        # The time each row is free from:
+        rows = []
+        events = []
+        for span in self._spans:
+            if span.end is None:
+                continue
+            for row, free in enumerate(rows):
+                if free <= span.start:
+                    break
+            else:
+                row = len(rows)
+                rows.append(None)
+            rows[row] = span.end
+            events.append({
+                u"name": type(span.change).__name__.decode("ascii"),
+                u"ph": u"X",
+                u"pid": 1,
+                u"tid": row,
+                u"ts": int((span.start - self._started) * 1000000),
+                u"dur": int((span.end - span.start) * 1000000),
+                u"args": {u"change": _describe(span.change),
+                          u"succeeded": span.succeeded,
+                          u"critical": id(span) in critical},
+            })
+        return {u"traceEvents": events}
@@ -7,8 +7,10 @@ tools.
 """
 
 import sys
+from signal import SIGUSR1, signal
 
 from twisted.python.usage import Options, UsageError
+from twisted.python.filepath import FilePath
 
 
 from yaml import safe_load, safe_dump
@@ -16,6 +18,8 @@ from yaml.error import YAMLError
 
 from zope.interface import implementer
 
+from eliot import Logger
+
 from ..control._config import (
     FlockerConfiguration, marshal_configuration,
     )
@@ -30,7 +34,16 @@ from ..control import (
     ConfigurationError, current_from_configuration, model_from_configuration,
 )
 from . import P2PNodeDeployer, change_node_state
-from ._loop import AgentLoopService
+from ._loop import (
+    AgentLoopService, DEFAULT_CONVERGENCE_INTERVAL,
+    DEFAULT_MAX_CONVERGENCE_INTERVAL,
+)
+from ._timing import ConvergenceTimings
+from ._backoff import ChangeBackoff
+from ._concurrency import (
+    ConcurrencyLimits, DEFAULT_LIMITS, DOCKER, ZFS, TRANSFER,
+)
+from ._trace import ChangeTrace
 
 
 __all__ = [
@@ -234,6 +247,24 @@ class ZFSAgentOptions(Options):
     optParameters = [
         ["destination-port", "p", 4524,
          "The port on the control service to connect to.", int],
+        ["convergence-interval", None, DEFAULT_CONVERGENCE_INTERVAL,
+         "The minimum number of seconds between convergence iterations.",
+         float],
+        ["max-convergence-interval", None, DEFAULT_MAX_CONVERGENCE_INTERVAL,
+         "The maximum number of seconds between convergence iterations "
+         "while nothing changes.", float],
+        ["docker-concurrency", None, DEFAULT_LIMITS[DOCKER],
+         "The maximum number of Docker API operations to run at once.",
+         int],
+        ["zfs-concurrency", None, DEFAULT_LIMITS[ZFS],
+         "The maximum number of ZFS commands to run at once.", int],
+        ["transfer-concurrency", None, DEFAULT_LIMITS[TRANSFER],
+         "The maximum number of datasets to transfer to other nodes at "
+         "once.", int],
+        ["chrome-trace", None, None,
+         "A file to write the changes applied by the most recent "
+         "convergence iteration to, in the Chrome trace event format.",
+         FilePath],
     ]
 
     def parseArgs(self, hostname, host):
@@ -243,6 +274,41 @@ class ZFSAgentOptions(Options):
         self["hostname"] = unicode(hostname, "ascii")
         self["destination-host"] = unicode(host, "ascii")
 
+    def postOptions(self):
+        if self["convergence-interval"] <= 0:
+            raise UsageError("--convergence-interval must be positive.")
+        if self["max-convergence-interval"] < self["convergence-interval"]:
+            raise UsageError(
+                "--max-convergence-interval must not be less than "
+                "--convergence-interval.")
+        for option in ["docker-concurrency", "zfs-concurrency",
+                       "transfer-concurrency"]:
+            if self[option] < 1:
+                raise UsageError(
+                    "--{option} must be at least 1.".format(option=option))
+
+
+def log_diagnostics_on_signal(reactor, deployer, signum=SIGUSR1):
+    """
+    Log a summary of convergence timings, the state changes that are
+    backing off and the use of concurrency limits whenever the process
+    receives a signal.
+
+    :param IReactorThreads reactor: The reactor the diagnostics are logged
+        in.
+    :param P2PNodeDeployer deployer: The deployer whose ``timings``,
+        ``backoff`` and ``limits`` are logged.
+    :param int signum: The signal to handle.
+    """
+    logger = Logger()
+
+    def log_diagnostics():
+        deployer.timings.log_summary(logger)
+        deployer.backoff.log_state(logger)
+        deployer.limits.log_state(logger)
+    signal(signum, lambda signum, frame: reactor.callFromThread(
+        log_diagnostics))
+
 
 @implementer(ICommandLineVolumeScript)
 class ZFSAgentScript(object):
@@ -253,9 +319,21 @@ class ZFSAgentScript(object):
     def main(self, reactor, options, volume_service):
         host = options["destination-host"]
         port = options["destination-port"]
-        deployer = P2PNodeDeployer(options["hostname"], volume_service)
-        loop = AgentLoopService(reactor=reactor, deployer=deployer,
-                                host=host, port=port)
+        deployer = P2PNodeDeployer(
+            options["hostname"], volume_service,
+            timings=ConvergenceTimings(reactor),
+            backoff=ChangeBackoff(reactor),
+            limits=ConcurrencyLimits({
+                DOCKER: options["docker-concurrency"],
+                ZFS: options["zfs-concurrency"],
+                TRANSFER: options["transfer-concurrency"],
+            }),
+            trace=ChangeTrace(reactor, chrome_trace=options["chrome-trace"]))
+        log_diagnostics_on_signal(reactor, deployer)
+        loop = AgentLoopService(
+            reactor=reactor, deployer=deployer, host=host, port=port,
+            interval=options["convergence-interval"],
+            max_interval=options["max-convergence-interval"])
         volume_service.setServiceParent(loop)
         return main_for_service(reactor, loop)
 
@@ -0,0 +1,137 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.node._backoff``.
+"""
+
+from eliot.testing import validateLogging, LoggedMessage
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._backoff import ChangeBackoff
+from .._logging import LOG_BACKOFF_STATE
+
+
+class ChangeBackoffTests(SynchronousTestCase):
+    """
+    Tests for ``ChangeBackoff``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        # Random numbers used for jitter; once these run out, jitter is
+        # negligible:
+        self.random_values = []
+        self.backoff = ChangeBackoff(
+            self.clock, initial=2.0, maximum=10.0, random=self.random)
+
+    def random(self):
+        if self.random_values:
+            return self.random_values.pop(0)
+        return 0.999
+
+    def test_not_failed(self):
+        """
+        A change that hasn't failed may be attempted immediately.
+        """
+        self.assertEqual(self.backoff.retry_in(u"change"), 0.0)
+
+    def test_failed(self):
+        """
+        A change that failed once may not be attempted again for up to the
+        initial backoff.
+        """
+        self.backoff.failed(u"change")
+        self.assertAlmostEqual(self.backoff.retry_in(u"change"), 2.0, 2)
+
+    def test_exponential(self):
+        """
+        The backoff doubles with each consecutive failure, up to the maximum.
+        """
+        delays = []
+        for _ in range(4):
+            self.backoff.failed(u"change")
+            delays.append(round(self.backoff.retry_in(u"change"), 2))
+        self.assertEqual(delays, [2.0, 4.0, 8.0, 10.0])
+
+    def test_jitter(self):
+        """
+        The backoff is reduced by up to half, depending on a random number.
+        """
+        self.random_values.append(0.0)
+        self.backoff.failed(u"change")
+        self.assertEqual(self.backoff.retry_in(u"change"), 1.0)
+
+    def test_time_passes(self):
+        """
+        A change may be attempted again once its backoff has passed.
+        """
+        self.backoff.failed(u"change")
+        self.clock.advance(2.0)
+        self.assertEqual(self.backoff.retry_in(u"change"), 0.0)
+
+    def test_succeeded(self):
+        """
+        A change that succeeds after failing starts from the initial backoff
+        if it fails again.
+        """
+        for _ in range(3):
+            self.backoff.failed(u"change")
+        self.backoff.succeeded(u"change")
+        self.backoff.failed(u"change")
+        self.assertAlmostEqual(self.backoff.retry_in(u"change"), 2.0, 2)
+
+    def test_independent(self):
+        """
+        Changes back off independently of each other.
+        """
+        self.backoff.failed(u"change")
+        self.backoff.failed(u"change")
+        self.backoff.failed(u"other")
+        self.assertEqual(
+            [round(self.backoff.retry_in(change), 2)
+             for change in [u"change", u"other", u"unrelated"]],
+            [4.0, 2.0, 0.0])
+
+    def test_unhashable(self):
+        """
+        Changes are identified by equality, so they needn't be hashable.
+        """
+        self.backoff.failed([u"change"])
+        self.assertNotEqual(self.backoff.retry_in([u"change"]), 0.0)
+
+    def test_expired(self):
+        """
+        A change that isn't attempted again for the maximum backoff after it
+        may be retried is forgotten.
+        """
+        self.backoff.failed(u"change")
+        self.clock.advance(12.0)
+        self.assertEqual(self.backoff.state(), [])
+
+    def test_state(self):
+        """
+        ``ChangeBackoff.state`` describes the changes backing off.
+        """
+        self.backoff.failed(u"change")
+        self.clock.advance(0.5)
+        [state] = self.backoff.state()
+        self.assertEqual(
+            (state[u"change"], state[u"failures"],
+             round(state[u"retry_in"], 2)),
+            (u"u'change'", 1, 1.5))
+
+    def assert_state_logged(self, logger):
+        """
+        The state was logged in a ``LOG_BACKOFF_STATE`` message.
+        """
+        [message] = LoggedMessage.ofType(logger.messages, LOG_BACKOFF_STATE)
+        self.assertEqual(message.message[u"changes"], self.backoff.state())
+
+    @validateLogging(assert_state_logged)
+    def test_log_state(self, logger):
+        """
+        ``ChangeBackoff.log_state`` logs the state.
+        """
+        self.backoff.failed(u"change")
+        self.backoff.log_state(logger)
@@ -0,0 +1,167 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.node._concurrency``.
+"""
+
+from eliot.testing import validateLogging, LoggedMessage
+
+from twisted.internet.defer import Deferred, fail
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._concurrency import ConcurrencyLimits, DEFAULT_LIMITS
+from .._logging import LOG_CONCURRENCY_STATE
+
+
+class ConcurrencyLimitsTests(SynchronousTestCase):
+    """
+    Tests for ``ConcurrencyLimits``.
+    """
+    def setUp(self):
+        self.limits = ConcurrencyLimits({u"docker": 2})
+        self.called = []
+
+    def run_call(self, name, result, priority=0, resource_class=u"docker"):
+        """
+        Run a call through the limits, recording when it is made.
+
+        :param name: Identifies the call in ``called``.
+        :param result: The result of the call.
+
+        :return: ``Deferred`` firing with ``result``.
+        """
+        def f():
+            self.called.append(name)
+            return result
+        return self.limits.run(resource_class, priority, f)
+
+    def test_defaults(self):
+        """
+        By default the ``DEFAULT_LIMITS`` apply.
+        """
+        state = ConcurrencyLimits().state()
+        self.assertEqual(
+            {resource_class: state[resource_class][u"limit"]
+             for resource_class in state},
+            DEFAULT_LIMITS)
+
+    def test_within_limit(self):
+        """
+        Calls are made immediately until the limit is reached, and return the
+        result of the function.
+        """
+        result = Deferred()
+        first = self.run_call(1, result)
+        self.run_call(2, Deferred())
+        self.run_call(3, Deferred())
+        called = list(self.called)
+        result.callback(u"result")
+        self.assertEqual(
+            (called, self.successResultOf(first)), ([1, 2], u"result"))
+
+    def test_waits_for_limit(self):
+        """
+        Once the limit is reached, calls wait until an earlier one is done.
+        """
+        first = Deferred()
+        self.run_call(1, first)
+        self.run_call(2, Deferred())
+        third = self.run_call(3, u"result")
+        called = list(self.called)
+        first.callback(None)
+        self.assertEqual(
+            (called, self.called, self.successResultOf(third)),
+            ([1, 2], [1, 2, 3], u"result"))
+
+    def test_failure_frees_slot(self):
+        """
+        A failed call makes way for a waiting one, and its failure is
+        returned.
+        """
+        first = Deferred()
+        failing = self.run_call(1, first)
+        self.run_call(2, Deferred())
+        self.run_call(3, Deferred())
+        first.errback(RuntimeError())
+        self.failureResultOf(failing, RuntimeError)
+        self.assertEqual(self.called, [1, 2, 3])
+
+    def test_priority(self):
+        """
+        Waiting calls are made in order of priority, highest first, and in
+        the order they were made if their priorities are equal.
+        """
+        first, second = Deferred(), Deferred()
+        self.run_call(1, first)
+        self.run_call(2, second)
+        self.run_call(u"low", Deferred(), priority=0)
+        self.run_call(u"high", Deferred(), priority=5)
+        self.run_call(u"low2", Deferred(), priority=0)
+        first.callback(None)
+        second.callback(None)
+        self.assertEqual(self.called, [1, 2, u"high", u"low"])
+
+    def test_unlimited(self):
+        """
+        Calls of resource classes without a limit, or without a resource
+        class, are made immediately.
+        """
+        for name in range(3):
+            self.run_call(name, Deferred(), resource_class=None)
+            self.run_call(name, Deferred(), resource_class=u"network")
+        self.assertEqual(len(self.called), 6)
+
+    def test_synchronous_failure(self):
+        """
+        A call raising an exception fails the result and frees its slot.
+        """
+        d = self.limits.run(u"docker", 0, lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        self.failureResultOf(self.run_call(1, fail(RuntimeError())))
+        self.assertEqual(self.limits.state()[u"docker"][u"running"], 0)
+
+    def test_saturated(self):
+        """
+        ``ConcurrencyLimits.saturated`` returns whether a call of the resource
+        class would have to wait.
+        """
+        saturated = [self.limits.saturated(u"docker")]
+        self.run_call(1, Deferred())
+        saturated.append(self.limits.saturated(u"docker"))
+        self.run_call(2, Deferred())
+        saturated.extend([self.limits.saturated(u"docker"),
+                          self.limits.saturated(None)])
+        self.assertEqual(saturated, [False, False, True, False])
+
+    def test_state(self):
+        """
+        ``ConcurrencyLimits.state`` describes the limit, running and waiting
+        calls of each resource class and the most calls that have waited
+        at once.
+        """
+        running = Deferred()
+        self.run_call(1, running)
+        self.run_call(2, Deferred())
+        self.run_call(3, Deferred())
+        self.run_call(4, Deferred())
+        running.callback(None)
+        self.assertEqual(
+            (self.limits.state(), self.limits.queued(u"docker")),
+            ({u"docker": {u"limit": 2, u"running": 2, u"queued": 1,
+                          u"max_queued": 2}}, 1))
+
+    def assert_state_logged(self, logger):
+        """
+        The state was logged in a ``LOG_CONCURRENCY_STATE`` message.
+        """
+        [message] = LoggedMessage.ofType(
+            logger.messages, LOG_CONCURRENCY_STATE)
+        self.assertEqual(message.message[u"resources"], self.limits.state())
+
+    @validateLogging(assert_state_logged)
+    def test_log_state(self, logger):
+        """
+        ``ConcurrencyLimits.log_state`` logs the state.
+        """
+        self.run_call(1, Deferred())
+        self.limits.log_state(logger)
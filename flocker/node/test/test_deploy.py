@@ -9,9 +9,14 @@ from uuid import uuid4, UUID
 from zope.interface.verify import verifyObject
 from zope.interface import implementer
 
+from characteristic import attributes
+
 from pyrsistent import pmap
 
+from eliot.testing import validateLogging, LoggedAction, LoggedMessage
+
 from twisted.internet.defer import fail, FirstError, succeed, Deferred
+from twisted.internet.task import Clock
 from twisted.trial.unittest import SynchronousTestCase, TestCase
 from twisted.python.filepath import FilePath
 
@@ -22,7 +27,16 @@ from ...control import (
 from .._deploy import (
     IStateChange, Sequentially, InParallel, StartApplication, StopApplication,
     CreateDataset, WaitForDataset, HandoffDataset, SetProxies, PushDataset,
-    ResizeDataset, _link_environment, _to_volume_name, IDeployer)
+    ResizeDataset, _link_environment, _to_volume_name, IDeployer,
+    run_state_change, InDependencyOrder, in_dependency_order,
+    run_in_dependency_order, _resource_class, critical_path)
+from .._logging import (
+    LOG_DISCOVER_STEP, LOG_STATE_CHANGE, LOG_BACKING_OFF, LOG_QUEUED,
+    )
+from .._timing import ConvergenceTimings
+from .._backoff import ChangeBackoff, BackingOff
+from .._concurrency import ConcurrencyLimits, DOCKER, ZFS, TRANSFER
+from .._trace import ChangeTrace
 from ...control._model import AttachedVolume, Dataset, Manifestation
 from .._docker import (
     FakeDockerClient, AlreadyExists, Unit, PortMap, Environment,
@@ -77,6 +91,30 @@ class P2PNodeDeployerAttributesTests(SynchronousTestCase):
                             network=dummy_network).network
         )
 
+    def test_limits_default(self):
+        """
+        ``P2PNodeDeployer.limits`` is a ``ConcurrencyLimits`` by default.
+        """
+        self.assertIsInstance(P2PNodeDeployer(u'example.com', None).limits,
+                              ConcurrencyLimits)
+
+    def test_limits_override(self):
+        """
+        ``P2PNodeDeployer.limits`` can be overridden in the constructor.
+        """
+        limits = ConcurrencyLimits({DOCKER: 1})
+        self.assertIs(
+            limits,
+            P2PNodeDeployer(u'example.com', None, limits=limits).limits
+        )
+
+    def test_trace_default(self):
+        """
+        ``P2PNodeDeployer.trace`` is a ``ChangeTrace`` by default.
+        """
+        self.assertIsInstance(P2PNodeDeployer(u'example.com', None).trace,
+                              ChangeTrace)
+
 
 def make_istatechange_tests(klass, kwargs1, kwargs2):
     """
@@ -136,6 +174,9 @@ HandoffVolumeIStateChangeTests = make_istatechange_tests(
 PushVolumeIStateChangeTests = make_istatechange_tests(
     PushDataset, dict(dataset=1, hostname=b"123"),
     dict(dataset=2, hostname=b"123"))
+InDependencyOrderIStateChangeTests = make_istatechange_tests(
+    InDependencyOrder, dict(changes=[1], dependencies=frozenset()),
+    dict(changes=[2], dependencies=frozenset()))
 
 
 NOT_CALLED = object()
@@ -244,6 +285,460 @@ class SequentiallyTests(SynchronousTestCase):
         self.assertEqual(called, [False, False, exception])
 
 
+class TimedDeployer(object):
+    """
+    A deployer with ``timings`` and a ``logger``, as used by
+    ``run_state_change``.
+    """
+    def __init__(self, logger):
+        self.clock = Clock()
+        self.timings = ConvergenceTimings(self.clock)
+        self.logger = logger
+
+
+class RunStateChangeTests(SynchronousTestCase):
+    """
+    Tests for ``run_state_change``.
+    """
+    def test_result(self):
+        """
+        ``run_state_change`` returns the result of running the change with the
+        given deployer.
+        """
+        change = FakeChange(succeed(123))
+        deployer = object()
+        result = run_state_change(change, deployer)
+        self.assertEqual((self.successResultOf(result), change.deployer),
+                         (123, deployer))
+
+    def assert_change_logged(self, logger):
+        """
+        A successful ``LOG_STATE_CHANGE`` action was logged, including how
+        long the change took.
+        """
+        [action] = LoggedAction.ofType(logger.messages, LOG_STATE_CHANGE)
+        self.assertEqual(
+            (action.succeeded, action.endMessage[u"seconds"]), (True, 3.0))
+
+    @validateLogging(assert_change_logged)
+    def test_logged(self, logger):
+        """
+        ``run_state_change`` logs the change in a ``LOG_STATE_CHANGE`` action
+        using the deployer's logger.
+        """
+        deployer = TimedDeployer(logger)
+        result = Deferred()
+        run_state_change(FakeChange(result), deployer)
+        deployer.clock.advance(3)
+        result.callback(None)
+
+    @validateLogging(None)
+    def test_timed(self, logger):
+        """
+        ``run_state_change`` records the duration and outcome of the change in
+        the deployer's timings, named after the type of the change.
+        """
+        deployer = TimedDeployer(logger)
+        result = Deferred()
+        running = run_state_change(FakeChange(result), deployer)
+        deployer.clock.advance(3)
+        result.errback(RuntimeError())
+        self.failureResultOf(running, RuntimeError)
+        summary = deployer.timings.summary()[u"change:FakeChange"]
+        self.assertEqual((summary[u"count"], summary[u"failures"],
+                          summary[u"max"]),
+                         (1, 1, 3.0))
+
+    @validateLogging(None)
+    def test_nested(self, logger):
+        """
+        Changes run by ``Sequentially`` and ``InParallel`` are recorded
+        individually.
+        """
+        deployer = TimedDeployer(logger)
+        change = Sequentially(changes=[
+            InParallel(changes=[FakeChange(succeed(None))]),
+            FakeChange(succeed(None))])
+        run_state_change(change, deployer)
+        self.assertEqual(
+            dict((name, summary[u"count"]) for (name, summary)
+                 in deployer.timings.summary().items()),
+            {u"change:Sequentially": 1, u"change:InParallel": 1,
+             u"change:FakeChange": 2})
+
+
+@implementer(IStateChange)
+@attributes(["name"])
+class NamedChange(object):
+    """
+    A change identified by its name, which fails if the name is in the
+    deployer's ``failing`` set.
+    """
+    def run(self, deployer):
+        deployer.applied.append(self.name)
+        if self.name in deployer.failing:
+            return fail(RuntimeError(self.name))
+        return succeed(None)
+
+
+class BackoffDeployer(object):
+    """
+    A deployer with a ``backoff``, as used by ``run_state_change``.
+
+    :ivar set failing: The names of ``NamedChange``\ s that fail.
+    :ivar list applied: The names of the ``NamedChange``\ s that were run.
+    """
+    def __init__(self, logger=None):
+        self.clock = Clock()
+        self.backoff = ChangeBackoff(self.clock, random=lambda: 0.999)
+        self.logger = logger
+        self.failing = set()
+        self.applied = []
+
+
+class RunStateChangeBackoffTests(SynchronousTestCase):
+    """
+    Tests for backoff of failed changes by ``run_state_change``.
+    """
+    def test_failure_recorded(self):
+        """
+        A change that fails is skipped, failing with ``BackingOff`` without
+        being run, until its backoff has passed.
+        """
+        deployer = BackoffDeployer()
+        deployer.failing.add(u"a")
+        self.failureResultOf(
+            run_state_change(NamedChange(name=u"a"), deployer), RuntimeError)
+        skipped = run_state_change(NamedChange(name=u"a"), deployer)
+        self.failureResultOf(skipped, BackingOff)
+        deployer.clock.advance(2)
+        retried = run_state_change(NamedChange(name=u"a"), deployer)
+        self.failureResultOf(retried, RuntimeError)
+        self.assertEqual(deployer.applied, [u"a", u"a"])
+
+    def test_success_recorded(self):
+        """
+        A change that succeeds after failing is no longer backing off.
+        """
+        deployer = BackoffDeployer()
+        deployer.failing.add(u"a")
+        self.failureResultOf(
+            run_state_change(NamedChange(name=u"a"), deployer), RuntimeError)
+        deployer.failing.clear()
+        deployer.clock.advance(2)
+        self.successResultOf(
+            run_state_change(NamedChange(name=u"a"), deployer))
+        self.assertEqual(deployer.backoff.state(), [])
+
+    def test_unrelated_changes(self):
+        """
+        Changes in an ``InParallel`` that haven't failed are run while
+        others in it are backing off.
+        """
+        deployer = BackoffDeployer()
+        deployer.failing.add(u"a")
+        plan = InParallel(changes=[NamedChange(name=u"a"),
+                                   NamedChange(name=u"b")])
+        self.failureResultOf(run_state_change(plan, deployer), FirstError)
+        self.flushLoggedErrors(RuntimeError)
+        self.failureResultOf(run_state_change(plan, deployer), FirstError)
+        self.flushLoggedErrors(BackingOff)
+        self.assertEqual(deployer.applied, [u"a", u"b", u"b"])
+
+    def test_sequentially_stops(self):
+        """
+        Changes after a change that is backing off in a ``Sequentially``
+        aren't run, since they may rely on it, e.g. starting an application
+        after stopping its old version.
+        """
+        deployer = BackoffDeployer()
+        deployer.failing.add(u"a")
+        plan = Sequentially(changes=[NamedChange(name=u"a"),
+                                     NamedChange(name=u"b")])
+        self.failureResultOf(run_state_change(plan, deployer), RuntimeError)
+        deployer.failing.clear()
+        self.failureResultOf(run_state_change(plan, deployer), BackingOff)
+        self.assertEqual(deployer.applied, [u"a"])
+
+    def test_dependents_blocked(self):
+        """
+        Changes depending on a change that is backing off in an
+        ``InDependencyOrder`` aren't run, but unrelated changes are, and the
+        run fails with ``BackingOff``.
+        """
+        deployer = BackoffDeployer()
+        deployer.failing.add(u"a")
+        self.failureResultOf(
+            run_state_change(NamedChange(name=u"a"), deployer), RuntimeError)
+        deployer.failing.clear()
+        plan = InDependencyOrder(
+            changes=[NamedChange(name=u"a"), NamedChange(name=u"b"),
+                     NamedChange(name=u"c")],
+            dependencies=frozenset([(0, 1)]))
+        self.failureResultOf(
+            run_in_dependency_order(plan, deployer), BackingOff)
+        self.assertEqual(deployer.applied, [u"a", u"c"])
+
+    def test_failure_preferred(self):
+        """
+        If changes of an ``InDependencyOrder`` both fail and are skipped
+        because they are backing off, the run fails with the failure.
+        """
+        deployer = BackoffDeployer()
+        deployer.failing.add(u"a")
+        self.failureResultOf(
+            run_state_change(NamedChange(name=u"a"), deployer), RuntimeError)
+        deployer.failing.add(u"b")
+        plan = InDependencyOrder(
+            changes=[NamedChange(name=u"a"), NamedChange(name=u"b")],
+            dependencies=frozenset())
+        self.failureResultOf(
+            run_in_dependency_order(plan, deployer), RuntimeError)
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def assert_skip_logged(self, logger):
+        """
+        Skipping the change was logged with the time until it will be
+        retried.
+        """
+        [message] = LoggedMessage.ofType(logger.messages, LOG_BACKING_OFF)
+        self.assertEqual(
+            (message.message[u"change"], round(message.message[u"retry_in"])),
+            (NamedChange(name=u"a"), 2))
+
+    @validateLogging(assert_skip_logged)
+    def test_skip_logged(self, logger):
+        """
+        Skipping a change that is backing off is logged.
+        """
+        deployer = BackoffDeployer(logger)
+        deployer.failing.add(u"a")
+        self.failureResultOf(
+            run_state_change(NamedChange(name=u"a"), deployer), RuntimeError)
+        self.failureResultOf(
+            run_state_change(NamedChange(name=u"a"), deployer), BackingOff)
+
+
+class ControllableDockerClient(object):
+    """
+    A Docker client whose removals finish when the test says so.
+
+    :ivar dict removing: Map the names of units being removed to the
+        ``Deferred`` returned for their removal.
+    :ivar list removed: The names of units whose removal was started, in
+        order.
+    """
+    def __init__(self):
+        self.removing = {}
+        self.removed = []
+
+    def remove(self, unit_name):
+        self.removed.append(unit_name)
+        d = self.removing[unit_name] = Deferred()
+        return d
+
+
+class LimitedDeployer(object):
+    """
+    A deployer with concurrency ``limits``, as used by
+    ``run_state_change``.
+    """
+    def __init__(self, limits, logger=None):
+        self.limits = limits
+        self.logger = logger
+        self.docker_client = ControllableDockerClient()
+
+
+def stop(name):
+    """
+    :param unicode name: The name of an application.
+
+    :return: A ``StopApplication`` for the application.
+    """
+    return StopApplication(application=Application(
+        name=name, image=DockerImage.from_string(u"busybox")))
+
+
+class RunStateChangeLimitsTests(SynchronousTestCase):
+    """
+    Tests for concurrency limits applied by ``run_state_change``.
+    """
+    def test_resource_classes(self):
+        """
+        Docker API, ZFS and transfer changes have resource classes, other
+        changes don't.
+        """
+        changes = [
+            stop(u"a"),
+            StartApplication(application=APPLICATION_WITH_VOLUME,
+                             hostname=u"node1"),
+            CreateDataset(dataset=DATASET), ResizeDataset(dataset=DATASET),
+            PushDataset(dataset=DATASET, hostname=u"node2"),
+            HandoffDataset(dataset=DATASET, hostname=u"node2"),
+            WaitForDataset(dataset=DATASET), SetProxies(ports=frozenset()),
+            Sequentially(changes=[stop(u"a")]),
+        ]
+        self.assertEqual(
+            [_resource_class(change) for change in changes],
+            [DOCKER, DOCKER, ZFS, ZFS, TRANSFER, TRANSFER, None, None, None])
+
+    def test_limited(self):
+        """
+        Changes wait while the concurrency limit of their resource class is
+        reached.
+        """
+        deployer = LimitedDeployer(ConcurrencyLimits({DOCKER: 1}))
+        first = run_state_change(stop(u"a"), deployer)
+        second = run_state_change(stop(u"b"), deployer)
+        removed = list(deployer.docker_client.removed)
+        deployer.docker_client.removing[u"a"].callback(None)
+        self.successResultOf(first)
+        self.assertNoResult(second)
+        self.assertEqual(
+            (removed, deployer.docker_client.removed), ([u"a"], [u"a", u"b"]))
+
+    def test_dependency_order_priority(self):
+        """
+        Changes in dependency order that more changes depend on run first
+        when they have to wait for the same resource class.
+        """
+        deployer = LimitedDeployer(ConcurrencyLimits({DOCKER: 1}))
+        plan = InDependencyOrder(
+            changes=[stop(u"a"), stop(u"b"), stop(u"c"), stop(u"d")],
+            dependencies=frozenset([(2, 3)]))
+        plan.run(deployer)
+        deployer.docker_client.removing[u"a"].callback(None)
+        self.assertEqual(deployer.docker_client.removed, [u"a", u"c"])
+
+    def assert_queued_logged(self, logger):
+        """
+        Waiting was logged with the change, its resource class and the
+        number of changes waiting.
+        """
+        [message] = LoggedMessage.ofType(logger.messages, LOG_QUEUED)
+        self.assertEqual(
+            (message.message[u"change"], message.message[u"resource_class"],
+             message.message[u"queued"]),
+            (stop(u"b"), DOCKER, 1))
+
+    @validateLogging(assert_queued_logged)
+    def test_queued_logged(self, logger):
+        """
+        A change that has to wait for its resource class is logged.
+        """
+        deployer = LimitedDeployer(ConcurrencyLimits({DOCKER: 1}), logger)
+        run_state_change(stop(u"a"), deployer)
+        run_state_change(stop(u"b"), deployer)
+
+
+class TracedDeployer(object):
+    """
+    A deployer with a ``trace``, as used by ``run_state_change``.
+    """
+    def __init__(self):
+        self.clock = Clock()
+        self.trace = ChangeTrace(self.clock)
+
+
+class CriticalPathTests(SynchronousTestCase):
+    """
+    Tests for tracing by ``run_state_change`` and for ``critical_path``.
+    """
+    def setUp(self):
+        self.deployer = TracedDeployer()
+        self.results = {}
+
+    def change(self, name):
+        """
+        :return: A ``FakeChange`` that finishes when ``finish`` is called
+            with ``name``.
+        """
+        result = self.results[name] = Deferred()
+        return FakeChange(result)
+
+    def finish(self, *names):
+        """
+        Advance the clock by a second, then finish the named changes.
+        """
+        self.deployer.clock.advance(1)
+        for name in names:
+            self.results[name].callback(None)
+
+    def path(self, plan):
+        """
+        :return: The critical path of the plan, as ``(change, start, end)``
+            tuples.
+        """
+        return [(span.change, span.start, span.end)
+                for span in critical_path(plan, self.deployer.trace)]
+
+    def test_recorded(self):
+        """
+        ``run_state_change`` records when a change and the changes making it
+        up start and finish in the deployer's ``trace``.
+        """
+        a = self.change(u"a")
+        plan = Sequentially(changes=[a])
+        run_state_change(plan, self.deployer)
+        self.finish(u"a")
+        trace = self.deployer.trace
+        self.assertEqual(
+            [(span.start, span.end)
+             for span in [trace.span(plan), trace.span(a)]],
+            [(0, 1), (0, 1)])
+
+    def test_sequentially(self):
+        """
+        The critical path of a ``Sequentially`` is all of its changes.
+        """
+        a, b = self.change(u"a"), self.change(u"b")
+        plan = Sequentially(changes=[a, b])
+        run_state_change(plan, self.deployer)
+        self.finish(u"a")
+        self.finish(u"b")
+        self.assertEqual(self.path(plan), [(a, 0, 1), (b, 1, 2)])
+
+    def test_in_parallel(self):
+        """
+        The critical path of an ``InParallel`` is that of the change which
+        finished last.
+        """
+        a, b = self.change(u"a"), self.change(u"b")
+        plan = InParallel(changes=[Sequentially(changes=[a]), b])
+        run_state_change(plan, self.deployer)
+        self.finish(u"b")
+        self.finish(u"a")
+        self.assertEqual(self.path(plan), [(a, 0, 2)])
+
+    def test_dependency_order(self):
+        """
+        The critical path of an ``InDependencyOrder`` ends with the change
+        which finished last, preceded in turn by whichever of its
+        prerequisites finished last.
+        """
+        a, b, c, d = [self.change(name) for name in u"abcd"]
+        plan = InDependencyOrder(
+            changes=[a, b, c, d],
+            dependencies=frozenset([(0, 2), (1, 2), (1, 3)]))
+        run_state_change(plan, self.deployer)
+        self.finish(u"a", u"d")
+        self.finish(u"b")
+        self.finish(u"c")
+        self.assertEqual(self.path(plan), [(b, 0, 2), (c, 2, 3)])
+
+    def test_not_run(self):
+        """
+        Changes that weren't run aren't on the critical path.
+        """
+        a = self.change(u"a")
+        plan = Sequentially(changes=[a, FakeChange(succeed(None))])
+        d = run_state_change(plan, self.deployer)
+        self.deployer.clock.advance(1)
+        self.results[u"a"].errback(RuntimeError())
+        self.failureResultOf(d, RuntimeError)
+        self.assertEqual(self.path(plan), [(a, 0, 1)])
+
+
 class InParallelTests(SynchronousTestCase):
     """
     Tests for ``InParallel``.
@@ -319,6 +814,228 @@ class InParallelTests(SynchronousTestCase):
         )
 
 
+class InDependencyOrderTests(SynchronousTestCase):
+    """
+    Tests for ``InDependencyOrder`` and ``run_in_dependency_order``.
+    """
+    def test_subchanges_get_deployer(self):
+        """
+        ``InDependencyOrder.run`` runs sub-changes with the given deployer.
+        """
+        subchanges = [FakeChange(succeed(None)), FakeChange(succeed(None))]
+        change = InDependencyOrder(changes=subchanges,
+                                   dependencies=frozenset([(0, 1)]))
+        deployer = object()
+        change.run(deployer)
+        self.assertEqual([c.deployer for c in subchanges],
+                         [deployer, deployer])
+
+    def test_independent_in_parallel(self):
+        """
+        Changes that don't depend on each other are run in parallel.
+        """
+        subchanges = [FakeChange(Deferred()), FakeChange(succeed(None))]
+        change = InDependencyOrder(changes=subchanges,
+                                   dependencies=frozenset())
+        change.run(object())
+        self.assertEqual([c.was_run_called() for c in subchanges],
+                         [True, True])
+
+    def test_dependencies(self):
+        """
+        A change is run once all the changes it depends on are done,
+        without waiting for unrelated changes.
+        """
+        first, second, unrelated = Deferred(), Deferred(), Deferred()
+        subchanges = [FakeChange(first), FakeChange(second),
+                      FakeChange(unrelated), FakeChange(succeed(None))]
+        change = InDependencyOrder(
+            changes=subchanges, dependencies=frozenset([(0, 3), (1, 3)]))
+        result = change.run(object())
+        called = [subchanges[3].was_run_called()]
+        first.callback(None)
+        called.append(subchanges[3].was_run_called())
+        second.callback(None)
+        called.append(subchanges[3].was_run_called())
+        self.assertNoResult(result)
+        unrelated.callback(None)
+        self.successResultOf(result)
+        self.assertEqual(called, [False, False, True])
+
+    def test_failure_stops_dependents(self):
+        """
+        A failed change stops the changes that depend on it, directly or
+        indirectly, but not other changes, and the run fails with it once
+        the other changes are done.
+        """
+        not_done = Deferred()
+        subchanges = [FakeChange(fail(RuntimeError())),
+                      FakeChange(succeed(None)), FakeChange(succeed(None)),
+                      FakeChange(not_done)]
+        change = InDependencyOrder(
+            changes=subchanges, dependencies=frozenset([(0, 1), (1, 2)]))
+        result = change.run(object())
+        self.assertNoResult(result)
+        not_done.callback(None)
+        self.failureResultOf(result, RuntimeError)
+        self.assertEqual([c.was_run_called() for c in subchanges],
+                         [True, False, False, True])
+
+    def test_failure_all_logged(self):
+        """
+        The run fails with the first failure and any later failures are
+        logged.
+        """
+        subchanges = [FakeChange(fail(ZeroDivisionError())),
+                      FakeChange(fail(RuntimeError()))]
+        change = InDependencyOrder(changes=subchanges,
+                                   dependencies=frozenset())
+        result = change.run(object())
+        self.failureResultOf(result, ZeroDivisionError)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_stopping(self):
+        """
+        Once ``stopping`` returns ``True`` no more changes are started, and
+        ``run_in_dependency_order`` fires with the number of changes that
+        weren't, once changes in progress are done.
+        """
+        stopped = []
+        not_done = Deferred()
+        subchanges = [FakeChange(not_done), FakeChange(succeed(None)),
+                      FakeChange(succeed(None))]
+        plan = InDependencyOrder(
+            changes=subchanges, dependencies=frozenset([(0, 1), (1, 2)]))
+        result = run_in_dependency_order(plan, object(), lambda: stopped)
+        stopped.append(True)
+        not_done.callback(None)
+        self.assertEqual(
+            (self.successResultOf(result),
+             [c.was_run_called() for c in subchanges]),
+            (2, [True, False, False]))
+
+    def test_not_stopped(self):
+        """
+        ``run_in_dependency_order`` fires with ``0`` if all changes were run.
+        """
+        plan = InDependencyOrder(
+            changes=[FakeChange(succeed(None)), FakeChange(succeed(None))],
+            dependencies=frozenset([(0, 1)]))
+        self.assertEqual(
+            self.successResultOf(run_in_dependency_order(plan, object())), 0)
+
+
+class InDependencyOrderBuildingTests(SynchronousTestCase):
+    """
+    Tests for ``in_dependency_order``.
+    """
+    def test_parallel_changes_are_nodes(self):
+        """
+        Each change of an ``InParallel`` phase becomes a node of the graph,
+        other phases become a single node.
+        """
+        proxies = SetProxies(ports=frozenset())
+        restart = Sequentially(changes=[
+            StopApplication(application=APPLICATION_WITH_VOLUME),
+            StartApplication(application=APPLICATION_WITH_VOLUME,
+                             hostname=u"node1")])
+        stop = StopApplication(application=Application(
+            name=u"other", image=DockerImage.from_string(u"busybox")))
+        plan = in_dependency_order(
+            [proxies, InParallel(changes=[restart, stop])])
+        self.assertEqual(plan.changes, [proxies, restart, stop])
+
+    def test_unrelated_datasets_independent(self):
+        """
+        Creating a new dataset and starting the application using it doesn't
+        wait for an unrelated dataset to be handed off.
+        """
+        other = Dataset(dataset_id=unicode(uuid4()))
+        handoff = HandoffDataset(dataset=other, hostname=u"node2")
+        create = CreateDataset(dataset=DATASET)
+        start = StartApplication(application=APPLICATION_WITH_VOLUME,
+                                 hostname=u"node1")
+        plan = in_dependency_order([
+            InParallel(changes=[handoff]), InParallel(changes=[create]),
+            InParallel(changes=[start])])
+        self.assertEqual(plan, InDependencyOrder(
+            changes=[handoff, create, start],
+            dependencies=frozenset([(1, 2)])))
+
+    def test_same_dataset_ordered(self):
+        """
+        Changes to the same dataset in different phases depend on each
+        other.
+        """
+        push = PushDataset(dataset=DATASET, hostname=u"node2")
+        stop = StopApplication(application=APPLICATION_WITH_VOLUME)
+        handoff = HandoffDataset(dataset=DATASET, hostname=u"node2")
+        plan = in_dependency_order([
+            InParallel(changes=[push]), InParallel(changes=[stop]),
+            InParallel(changes=[handoff])])
+        self.assertEqual(plan.dependencies,
+                         frozenset([(0, 1), (0, 2), (1, 2)]))
+
+    def test_same_port_ordered(self):
+        """
+        Starting an application waits for stopping a different application
+        that uses the same external port.
+        """
+        image = DockerImage.from_string(u"busybox")
+        stop = StopApplication(application=Application(
+            name=u"old", image=image,
+            ports=frozenset([Port(internal_port=80, external_port=8080)])))
+        start = StartApplication(application=Application(
+            name=u"new", image=image,
+            ports=frozenset([Port(internal_port=81, external_port=8080)])),
+            hostname=u"node1")
+        plan = in_dependency_order([InParallel(changes=[stop]),
+                                    InParallel(changes=[start])])
+        self.assertEqual(plan.dependencies, frozenset([(0, 1)]))
+
+    def test_link_targets_first(self):
+        """
+        Starting an application that links to an application started in the
+        same phase waits for the latter to start first.
+        """
+        image = DockerImage.from_string(u"busybox")
+        client = StartApplication(application=Application(
+            name=u"client", image=image,
+            links=frozenset([Link(local_port=5432, remote_port=15432,
+                                  alias=u"db")])), hostname=u"node1")
+        server = StartApplication(application=Application(
+            name=u"server", image=image,
+            ports=frozenset([Port(internal_port=5432,
+                                  external_port=15432)])), hostname=u"node1")
+        plan = in_dependency_order([InParallel(changes=[client, server])])
+        self.assertEqual(plan, InDependencyOrder(
+            changes=[server, client], dependencies=frozenset([(0, 1)])))
+
+    def test_links_wait_for_proxies(self):
+        """
+        Starting an application with links waits for proxies to be set.
+        """
+        proxies = SetProxies(ports=frozenset())
+        start = StartApplication(application=Application(
+            name=u"client", image=DockerImage.from_string(u"busybox"),
+            links=frozenset([Link(local_port=5432, remote_port=15432,
+                                  alias=u"db")])), hostname=u"node1")
+        plan = in_dependency_order([proxies, InParallel(changes=[start])])
+        self.assertEqual(plan.dependencies, frozenset([(0, 1)]))
+
+    def test_unknown_changes_are_barriers(self):
+        """
+        Changes of unknown types depend on and are depended on by all
+        changes in other phases.
+        """
+        unknown = FakeChange(succeed(None))
+        create = CreateDataset(dataset=DATASET)
+        proxies = SetProxies(ports=frozenset())
+        plan = in_dependency_order([
+            InParallel(changes=[create]), unknown, proxies])
+        self.assertEqual(plan.dependencies, frozenset([(0, 1), (1, 2)]))
+
+
 class StartApplicationTests(SynchronousTestCase):
     """
     Tests for ``StartApplication``.
@@ -1126,6 +1843,39 @@ class DeployerDiscoverNodeConfigurationTests(SynchronousTestCase):
             state
         )
 
+    def assert_discovery_steps_logged(self, logger):
+        """
+        Each discovery step was logged in a successful ``LOG_DISCOVER_STEP``
+        action.
+        """
+        actions = LoggedAction.ofType(logger.messages, LOG_DISCOVER_STEP)
+        self.assertEqual(
+            sorted((action.startMessage[u"step"], action.succeeded)
+                   for action in actions),
+            [(u"containers", True), (u"used_ports", True),
+             (u"volumes", True)])
+
+    @validateLogging(assert_discovery_steps_logged)
+    def test_discovery_steps(self, logger):
+        """
+        ``P2PNodeDeployer.discover_local_state`` logs each discovery step and
+        records its duration in the deployer's ``timings``.
+        """
+        timings = ConvergenceTimings(Clock())
+        api = P2PNodeDeployer(
+            u'example.com',
+            self.volume_service,
+            docker_client=FakeDockerClient(),
+            network=self.network,
+            timings=timings,
+        )
+        api.logger = logger
+        self.successResultOf(api.discover_local_state())
+        self.assertEqual(
+            sorted(timings.summary()),
+            [u"discover:containers", u"discover:used_ports",
+             u"discover:volumes"])
+
     def test_discover_application_restart_policy(self):
         """
         An ``Application`` with the appropriate ``IRestartPolicy`` is
@@ -1225,7 +1975,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             self.successResultOf(api.discover_local_state()),
             desired_configuration=desired,
             current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[])
+        expected = in_dependency_order([])
         self.assertEqual(expected, result)
 
     def test_proxy_needs_creating(self):
@@ -1264,7 +2014,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             desired_configuration=desired, current_cluster_state=EMPTY)
         proxy = Proxy(ip=expected_destination_host,
                       port=expected_destination_port)
-        expected = Sequentially(changes=[SetProxies(ports=frozenset([proxy]))])
+        expected = in_dependency_order([SetProxies(ports=frozenset([proxy]))])
         self.assertEqual(expected, result)
 
     def test_proxy_empty(self):
@@ -1284,7 +2034,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         result = api.calculate_necessary_state_changes(
             self.successResultOf(api.discover_local_state()),
             desired_configuration=desired, current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[SetProxies(ports=frozenset())])
+        expected = in_dependency_order([SetProxies(ports=frozenset())])
         self.assertEqual(expected, result)
 
     def test_application_needs_stopping(self):
@@ -1309,7 +2059,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         to_stop = StopApplication(application=Application(
             name=unit.name, image=DockerImage.from_string(
                 unit.container_image)))
-        expected = Sequentially(changes=[InParallel(changes=[to_stop])])
+        expected = in_dependency_order([InParallel(changes=[to_stop])])
         self.assertEqual(expected, result)
 
     def test_application_needs_starting(self):
@@ -1340,7 +2090,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             self.successResultOf(api.discover_local_state()),
             desired_configuration=desired,
             current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[InParallel(
+        expected = in_dependency_order([InParallel(
             changes=[StartApplication(application=application,
                                       hostname="node.example.com")])])
         self.assertEqual(expected, result)
@@ -1373,7 +2123,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             self.successResultOf(api.discover_local_state()),
             desired_configuration=desired,
             current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[])
+        expected = in_dependency_order([])
         self.assertEqual(expected, result)
 
     def test_no_change_needed(self):
@@ -1411,7 +2161,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             self.successResultOf(api.discover_local_state()),
             desired_configuration=desired,
             current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[])
+        expected = in_dependency_order([])
         self.assertEqual(expected, result)
 
     def test_node_not_described(self):
@@ -1440,7 +2190,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                 image=DockerImage.from_string(unit.container_image)
             )
         )
-        expected = Sequentially(changes=[InParallel(changes=[to_stop])])
+        expected = in_dependency_order([InParallel(changes=[to_stop])])
         self.assertEqual(expected, result)
 
     def test_volume_created(self):
@@ -1485,7 +2235,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         volume = APPLICATION_WITH_VOLUME.volume
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[CreateDataset(dataset=volume.dataset)]),
             InParallel(changes=[StartApplication(
                 application=APPLICATION_WITH_VOLUME,
@@ -1537,7 +2287,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         volume = APPLICATION_WITH_VOLUME.volume
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[WaitForDataset(dataset=volume.dataset)]),
             InParallel(changes=[ResizeDataset(dataset=volume.dataset)]),
             InParallel(changes=[StartApplication(
@@ -1598,7 +2348,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         volume = APPLICATION_WITH_VOLUME.volume
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[PushDataset(
                 dataset=volume.dataset, hostname=another_node.hostname)]),
             InParallel(changes=[StopApplication(
@@ -1666,7 +2416,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[])
+        expected = in_dependency_order([])
         self.assertEqual(expected, changes)
 
     def test_volume_resize(self):
@@ -1725,7 +2475,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(
                 changes=[ResizeDataset(
                     dataset=APPLICATION_WITH_VOLUME_SIZE.volume.dataset,
@@ -1809,7 +2559,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         volume = APPLICATION_WITH_VOLUME_SIZE.volume
 
         # expected is: resize volume, push, stop application, handoff
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(
                 changes=[ResizeDataset(dataset=volume.dataset)],
             ),
@@ -1873,7 +2623,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         volume = APPLICATION_WITH_VOLUME_SIZE.volume
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[WaitForDataset(dataset=volume.dataset)]),
             InParallel(changes=[ResizeDataset(dataset=volume.dataset)]),
             InParallel(changes=[StartApplication(
@@ -1913,7 +2663,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             desired_configuration=desired,
             current_cluster_state=EMPTY)
 
-        expected = Sequentially(changes=[InParallel(changes=[
+        expected = in_dependency_order([InParallel(changes=[
             Sequentially(changes=[StopApplication(application=application),
                                   StartApplication(application=application,
                                                    hostname="n.example.com")]),
@@ -1945,7 +2695,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             name=unit.name,
             image=DockerImage.from_string(unit.container_image)
         )
-        expected = Sequentially(changes=[InParallel(changes=[
+        expected = in_dependency_order([InParallel(changes=[
             StopApplication(application=to_stop)])])
         self.assertEqual(expected, result)
 
@@ -2022,7 +2772,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[PushDataset(
                 dataset=volume.dataset, hostname=another_node.hostname)]),
             InParallel(changes=[StopApplication(
@@ -2090,7 +2840,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[
                 CreateDataset(dataset=new_postgres_app.volume.dataset)]),
             InParallel(changes=[
@@ -2150,7 +2900,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
+        expected = in_dependency_order([InParallel(changes=[
             Sequentially(changes=[
                 StopApplication(application=old_postgres_app),
                 StartApplication(application=new_postgres_app,
@@ -2220,7 +2970,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
+        expected = in_dependency_order([InParallel(changes=[
             Sequentially(changes=[
                 StopApplication(application=old_postgres_app),
                 StartApplication(application=new_postgres_app,
@@ -2288,7 +3038,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
+        expected = in_dependency_order([InParallel(changes=[
             Sequentially(changes=[
                 StopApplication(application=old_wordpress_app),
                 StartApplication(application=new_wordpress_app,
@@ -2363,7 +3113,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         # If we get a resize that means the code figured out that the
         # dataset only mentioned by name in desired config is the same as
         # the one with a specific dataset ID in the actual cluster state.
-        self.assertEqual(result.changes[0].changes[0],
+        self.assertEqual(result.changes[0],
                          ResizeDataset(
                              dataset=APPLICATION_WITH_VOLUME.volume.dataset))
 
@@ -2402,9 +3152,9 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             self.successResultOf(api.discover_local_state()), desired, actual)
 
         # CreateVolume:
-        dataset = result.changes[0].changes[0].dataset
+        dataset = result.changes[0].dataset
         # StartApplication:
-        dataset2 = result.changes[1].changes[0].application.volume.dataset
+        dataset2 = result.changes[1].application.volume.dataset
         # New UUID was generated, but only once:
         self.assertEqual(UUID(dataset.dataset_id), UUID(dataset2.dataset_id))
 
@@ -2447,7 +3197,7 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[CreateDataset(
                 dataset=MANIFESTATION.dataset)])])
         self.assertEqual(expected, changes)
@@ -2489,7 +3239,7 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[
                 WaitForDataset(dataset=MANIFESTATION.dataset)]),
             InParallel(changes=[
@@ -2537,7 +3287,7 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
 
         dataset = MANIFESTATION.dataset
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[PushDataset(
                 dataset=dataset, hostname=another_node.hostname)]),
             InParallel(changes=[HandoffDataset(
@@ -2577,7 +3327,7 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[])
+        expected = in_dependency_order([])
         self.assertEqual(expected, changes)
 
     def test_dataset_resize(self):
@@ -2617,7 +3367,7 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
             current_cluster_state=current,
         )
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(
                 changes=[ResizeDataset(
                     dataset=APPLICATION_WITH_VOLUME_SIZE.volume.dataset,
@@ -2676,7 +3426,7 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
         dataset = MANIFESTATION_WITH_SIZE.dataset
 
         # expected is: resize, push, handoff
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(
                 changes=[ResizeDataset(dataset=dataset)],
             ),
@@ -2740,7 +3490,7 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
 
         dataset = MANIFESTATION_WITH_SIZE.dataset
 
-        expected = Sequentially(changes=[
+        expected = in_dependency_order([
             InParallel(changes=[WaitForDataset(dataset=dataset)]),
             InParallel(changes=[ResizeDataset(dataset=dataset)]),
         ])
@@ -2783,7 +3533,7 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
 
         # If P2PNodeDeployer is buggy and not overriding cluster state
         # with local state this would result in a dataset creation action:
-        expected = Sequentially(changes=[])
+        expected = in_dependency_order([])
         self.assertEqual(expected, changes)
 
 
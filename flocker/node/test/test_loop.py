@@ -6,10 +6,13 @@ Tests for ``flocker.node._loop``.
 
 from zope.interface import implementer
 
+from eliot.testing import validateLogging, LoggedAction, LoggedMessage
+
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import StringTransport, MemoryReactorClock
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
-from twisted.internet.defer import succeed, Deferred
+from twisted.internet.defer import succeed, fail, Deferred
+from twisted.internet.task import Clock
 
 from ...testtools import FakeAMPClient
 from .._loop import (
@@ -18,11 +21,31 @@ from .._loop import (
     ConvergenceLoopStates, build_convergence_loop_fsm, AgentLoopService,
     ClusterStatus, ConvergenceLoop,
     )
-from .._deploy import IDeployer, IStateChange
+from .._deploy import (
+    IDeployer, IStateChange, Sequentially, InDependencyOrder,
+    )
+from .._logging import (
+    LOG_CONVERGE, LOG_DISCOVER, LOG_CALCULATE, LOG_STATE_CHANGE,
+    LOG_PREEMPTED, LOG_CRITICAL_PATH,
+    )
+from .._timing import ConvergenceTimings
+from .._trace import ChangeTrace
+from .._backoff import BackingOff
+from ...control import NodeState
 from ...control._protocol import NodeStateCommand, _AgentLocator, AgentAMP
 from ...control.test.test_protocol import iconvergence_agent_tests_factory
 
 
+def node_state(hostname):
+    """
+    :param unicode hostname: The hostname of the node.
+
+    :return: Hashable ``NodeState`` with no applications, suitable for
+        registering as an argument of a ``FakeAMPClient`` response.
+    """
+    return NodeState(hostname=hostname, running=(), not_running=())
+
+
 def build_protocol():
     """
     :return: ``Protocol`` hooked up to transport.
@@ -269,7 +292,8 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         """
         A newly created FSM is stopped.
         """
-        loop = build_convergence_loop_fsm(ControllableDeployer([], []))
+        loop = build_convergence_loop_fsm(
+            Clock(), ControllableDeployer([], []))
         self.assertEqual(loop.state, ConvergenceLoopStates.STOPPED)
 
     def test_new_status_update_starts_discovery(self):
@@ -277,7 +301,7 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         A stopped FSM that receives a status update starts discovery.
         """
         deployer = ControllableDeployer([Deferred()], [])
-        loop = build_convergence_loop_fsm(deployer)
+        loop = build_convergence_loop_fsm(Clock(), deployer)
         loop.receive(_ClientStatusUpdate(client=object(),
                                          configuration=object(),
                                          state=object()))
@@ -305,11 +329,11 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         discovered state to the control service using the last received
         client.
         """
-        local_state = object()
+        local_state = node_state(u"192.0.2.123")
         client = self.successful_amp_client([local_state])
         action = ControllableAction(Deferred())
         deployer = ControllableDeployer([succeed(local_state)], [action])
-        loop = build_convergence_loop_fsm(deployer)
+        loop = build_convergence_loop_fsm(Clock(), deployer)
         loop.receive(_ClientStatusUpdate(client=client,
                                          configuration=object(),
                                          state=object()))
@@ -322,7 +346,7 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         calculated changes using last received desired configuration and
         cluster state.
         """
-        local_state = object()
+        local_state = node_state(u"192.0.2.123")
         configuration = object()
         state = object()
         # Since this Deferred is unfired we never proceed to next
@@ -330,7 +354,7 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         # only configured one discovery result.
         action = ControllableAction(Deferred())
         deployer = ControllableDeployer([succeed(local_state)], [action])
-        loop = build_convergence_loop_fsm(deployer)
+        loop = build_convergence_loop_fsm(Clock(), deployer)
         loop.receive(_ClientStatusUpdate(
             client=self.successful_amp_client([local_state]),
             configuration=configuration, state=state))
@@ -340,11 +364,11 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
 
     def test_convergence_done_start_new_iteration(self):
         """
-        A FSM doing a convergence iteration does another iteration when
-        applying changes is done.
+        A FSM doing a convergence iteration does another iteration once
+        applying changes is done and the convergence interval has passed.
         """
-        local_state = object()
-        local_state2 = object()
+        local_state = node_state(u"192.0.2.123")
+        local_state2 = node_state(u"192.0.2.124")
         configuration = object()
         state = object()
         action = ControllableAction(succeed(None))
@@ -356,9 +380,11 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
             [succeed(local_state), succeed(local_state2)],
             [action, action2])
         client = self.successful_amp_client([local_state, local_state2])
-        loop = build_convergence_loop_fsm(deployer)
+        reactor = Clock()
+        loop = build_convergence_loop_fsm(reactor, deployer)
         loop.receive(_ClientStatusUpdate(
             client=client, configuration=configuration, state=state))
+        reactor.advance(1.0)
         # Calculating actions happened, result was run... and then we did
         # whole thing again:
         self.assertEqual((deployer.calculate_inputs, client.calls),
@@ -373,8 +399,8 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         client, desired configuration and cluster state, which are then
         used in next convergence iteration.
         """
-        local_state = object()
-        local_state2 = object()
+        local_state = node_state(u"192.0.2.123")
+        local_state2 = node_state(u"192.0.2.124")
         configuration = object()
         state = object()
         # Until this Deferred fires the first iteration won't finish:
@@ -385,7 +411,8 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
             [succeed(local_state), succeed(local_state2)],
             [action, action2])
         client = self.successful_amp_client([local_state])
-        loop = build_convergence_loop_fsm(deployer)
+        reactor = Clock()
+        loop = build_convergence_loop_fsm(reactor, deployer)
         loop.receive(_ClientStatusUpdate(
             client=client, configuration=configuration, state=state))
 
@@ -400,6 +427,7 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         # which happens with second set of client, desired configuration
         # and cluster state:
         action.result.callback(None)
+        reactor.advance(1.0)
         self.assertEqual(
             (deployer.calculate_inputs, client.calls, client2.calls),
             ([(local_state, configuration, state),
@@ -412,7 +440,7 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         A FSM doing convergence that receives a stop input stops when the
         convergence iteration finishes.
         """
-        local_state = object()
+        local_state = node_state(u"192.0.2.123")
         configuration = object()
         state = object()
         # Until this Deferred fires the first iteration won't finish:
@@ -422,7 +450,7 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         deployer = ControllableDeployer([succeed(local_state)],
                                         [action])
         client = self.successful_amp_client([local_state])
-        loop = build_convergence_loop_fsm(deployer)
+        loop = build_convergence_loop_fsm(Clock(), deployer)
         loop.receive(_ClientStatusUpdate(
             client=client, configuration=configuration, state=state))
 
@@ -446,8 +474,8 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         update continues on to to next convergence iteration (i.e. stop
         ends up being ignored).
         """
-        local_state = object()
-        local_state2 = object()
+        local_state = node_state(u"192.0.2.123")
+        local_state2 = node_state(u"192.0.2.124")
         configuration = object()
         state = object()
         # Until this Deferred fires the first iteration won't finish:
@@ -458,7 +486,8 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
             [succeed(local_state), succeed(local_state2)],
             [action, action2])
         client = self.successful_amp_client([local_state])
-        loop = build_convergence_loop_fsm(deployer)
+        reactor = Clock()
+        loop = build_convergence_loop_fsm(reactor, deployer)
         loop.receive(_ClientStatusUpdate(
             client=client, configuration=configuration, state=state))
 
@@ -475,6 +504,7 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
         # which happens with second set of client, desired configuration
         # and cluster state:
         action.result.callback(None)
+        reactor.advance(1.0)
         self.assertEqual(
             (deployer.calculate_inputs, client.calls, client2.calls),
             ([(local_state, configuration, state),
@@ -483,6 +513,627 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
              [(NodeStateCommand, dict(node_state=local_state2))]))
 
 
+class ConvergenceLoopSleepTests(SynchronousTestCase):
+    """
+    Tests for the waits between iterations of the FSM created by
+    ``build_convergence_loop_fsm``.
+    """
+    def setUp(self):
+        self.reactor = Clock()
+        self.local_state = node_state(u"192.0.2.123")
+        self.client = FakeAMPClient()
+        self.client.register_response(
+            NodeStateCommand, dict(node_state=self.local_state),
+            {"result": None})
+
+    def build_loop(self, local_states, interval=1.0, max_interval=30.0):
+        """
+        Create a convergence loop FSM whose iterations finish immediately.
+
+        :param list local_states: The node states discovered by successive
+            iterations.
+        :param float interval: The minimum wait between iterations.
+        :param float max_interval: The maximum wait between iterations.
+
+        :return: The FSM, along with the ``ControllableDeployer`` it uses.
+        """
+        for local_state in set(local_states) - {self.local_state}:
+            self.client.register_response(
+                NodeStateCommand, dict(node_state=local_state),
+                {"result": None})
+        deployer = ControllableDeployer(
+            [succeed(local_state) for local_state in local_states],
+            [ControllableAction(succeed(None)) for _ in local_states])
+        loop = build_convergence_loop_fsm(
+            self.reactor, deployer, interval, max_interval)
+        return loop, deployer
+
+    def status_update(self):
+        """
+        :return: A ``_ClientStatusUpdate`` using the test's client.
+        """
+        return _ClientStatusUpdate(
+            client=self.client, configuration=object(), state=object())
+
+    def delays(self):
+        """
+        :return: The number of seconds until each scheduled call.
+        """
+        return [call.getTime() - self.reactor.seconds()
+                for call in self.reactor.getDelayedCalls()]
+
+    def test_sleeps(self):
+        """
+        Once an iteration is done the FSM sleeps for the convergence interval
+        before starting the next one.
+        """
+        loop, deployer = self.build_loop([self.local_state] * 2,
+                                         interval=2.0)
+        loop.receive(self.status_update())
+        self.reactor.advance(1.5)
+        self.assertEqual(
+            (loop.state, len(deployer.calculate_inputs), self.delays()),
+            (ConvergenceLoopStates.SLEEPING, 1, [0.5]))
+
+    def test_backoff(self):
+        """
+        As long as local state doesn't change, the wait between iterations
+        doubles each time up to the maximum interval.
+        """
+        loop, deployer = self.build_loop([self.local_state] * 4,
+                                         interval=1.0, max_interval=3.0)
+        loop.receive(self.status_update())
+        delays = self.delays()
+        for _ in range(3):
+            self.reactor.advance(delays[-1])
+            delays.extend(self.delays())
+        self.assertEqual(delays, [1.0, 2.0, 3.0, 3.0])
+
+    def test_local_state_changed(self):
+        """
+        An iteration discovering changed local state resets the wait before
+        the next iteration to the convergence interval.
+        """
+        loop, deployer = self.build_loop(
+            [self.local_state, self.local_state, node_state(u"192.0.2.124")])
+        loop.receive(self.status_update())
+        self.reactor.advance(1.0)
+        self.reactor.advance(2.0)
+        self.assertEqual(self.delays(), [1.0])
+
+    def test_status_update_while_converging(self):
+        """
+        A status update received during an iteration resets the wait before
+        the next iteration to the convergence interval.
+        """
+        action = ControllableAction(Deferred())
+        deployer = ControllableDeployer(
+            [succeed(self.local_state), succeed(self.local_state)],
+            [ControllableAction(succeed(None)), action])
+        loop = build_convergence_loop_fsm(self.reactor, deployer)
+        configuration = object()
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=configuration,
+            state=object()))
+        self.reactor.advance(1.0)
+        # Only cluster state changed, so the iteration isn't preempted:
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=configuration,
+            state=object()))
+        action.result.callback(None)
+        self.assertEqual(self.delays(), [1.0])
+
+    def test_wakeup_while_converging(self):
+        """
+        A ``WAKEUP`` input received during an iteration resets the wait before
+        the next iteration to the convergence interval.
+        """
+        action = ControllableAction(Deferred())
+        deployer = ControllableDeployer(
+            [succeed(self.local_state), succeed(self.local_state)],
+            [ControllableAction(succeed(None)), action])
+        loop = build_convergence_loop_fsm(self.reactor, deployer)
+        loop.receive(self.status_update())
+        self.reactor.advance(1.0)
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        action.result.callback(None)
+        self.assertEqual(
+            (loop.state, self.delays()),
+            (ConvergenceLoopStates.SLEEPING, [1.0]))
+
+    def test_status_update_while_sleeping(self):
+        """
+        A status update received while sleeping starts the next iteration
+        immediately, replacing the scheduled wakeup.
+        """
+        loop, deployer = self.build_loop([self.local_state] * 2)
+        loop.receive(self.status_update())
+        loop.receive(self.status_update())
+        self.assertEqual(
+            (len(deployer.calculate_inputs),
+             len(self.reactor.getDelayedCalls())),
+            (2, 1))
+
+    def test_wakeup_while_sleeping(self):
+        """
+        A ``WAKEUP`` input received while sleeping starts the next iteration
+        immediately, replacing the scheduled wakeup.
+        """
+        loop, deployer = self.build_loop([self.local_state] * 2)
+        loop.receive(self.status_update())
+        self.reactor.advance(0.5)
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        self.assertEqual(
+            (len(deployer.calculate_inputs),
+             len(self.reactor.getDelayedCalls())),
+            (2, 1))
+
+    @validateLogging(None)
+    def test_failed_iteration(self, logger):
+        """
+        An iteration that fails is logged, and the FSM sleeps before the next
+        iteration as it would after a successful one.
+        """
+        deployer = ControllableDeployer(
+            [succeed(self.local_state)],
+            [ControllableAction(fail(RuntimeError()))])
+        loop = build_convergence_loop_fsm(self.reactor, deployer)
+        loop._fsm._world.original.logger = logger
+        loop.receive(self.status_update())
+        self.assertEqual(
+            (loop.state, self.delays(),
+             len(logger.flushTracebacks(RuntimeError))),
+            (ConvergenceLoopStates.SLEEPING, [1.0], 1))
+
+    @validateLogging(None)
+    def test_backing_off_iteration(self, logger):
+        """
+        An iteration that fails only because changes are backing off isn't
+        logged as a failure, since the skipped changes were already logged.
+        """
+        deployer = ControllableDeployer(
+            [succeed(self.local_state)],
+            [ControllableAction(fail(BackingOff(object(), 1.0)))])
+        loop = build_convergence_loop_fsm(self.reactor, deployer)
+        loop._fsm._world.original.logger = logger
+        loop.receive(self.status_update())
+        self.assertEqual((loop.state, self.delays()),
+                         (ConvergenceLoopStates.SLEEPING, [1.0]))
+
+    def test_stop_while_sleeping(self):
+        """
+        A stop input received while sleeping stops the FSM without any
+        further iterations.
+        """
+        loop, deployer = self.build_loop([self.local_state])
+        loop.receive(self.status_update())
+        loop.receive(ConvergenceLoopInputs.STOP)
+        self.assertEqual(
+            (loop.state, self.reactor.getDelayedCalls()),
+            (ConvergenceLoopStates.STOPPED, []))
+
+    def test_wakeup_while_stopped(self):
+        """
+        A ``WAKEUP`` input received while stopped is ignored.
+        """
+        loop, deployer = self.build_loop([])
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        self.assertEqual(loop.state, ConvergenceLoopStates.STOPPED)
+
+
+class ConvergenceLoopShortCircuitTests(SynchronousTestCase):
+    """
+    Tests for the FSM created by ``build_convergence_loop_fsm`` skipping work
+    when nothing has changed.
+    """
+    def setUp(self):
+        self.reactor = Clock()
+        self.local_state = node_state(u"192.0.2.123")
+        self.configuration = object()
+        self.cluster_state = object()
+
+    def client(self):
+        """
+        :return: A ``FakeAMPClient`` that can respond successfully to a
+            ``NodeStateCommand`` with the test's local state.
+        """
+        client = FakeAMPClient()
+        client.register_response(
+            NodeStateCommand, dict(node_state=self.local_state),
+            {"result": None})
+        return client
+
+    def status_update(self, client):
+        """
+        :param client: The client to use.
+
+        :return: A ``_ClientStatusUpdate`` with the test's desired
+            configuration and cluster state.
+        """
+        return _ClientStatusUpdate(
+            client=client, configuration=self.configuration,
+            state=self.cluster_state)
+
+    def run_iterations(self, plans, client):
+        """
+        Run a convergence loop FSM for as many iterations as there are plans,
+        discovering the same local state each time.
+
+        :param list plans: ``IStateChange`` providers for the deployer to
+            calculate.
+        :param client: The client to use.
+
+        :return: The ``ConvergenceLoop`` world of the FSM, along with the
+            ``ControllableDeployer`` it uses.
+        """
+        deployer = ControllableDeployer(
+            [succeed(self.local_state) for _ in plans], list(plans))
+        loop = build_convergence_loop_fsm(self.reactor, deployer)
+        loop.receive(self.status_update(client))
+        for _ in plans[1:]:
+            self.reactor.advance(self.reactor.getDelayedCalls()[0].getTime()
+                                 - self.reactor.seconds())
+        return loop._fsm._world.original, deployer
+
+    def test_unchanged_without_changes(self):
+        """
+        An iteration whose local state, desired configuration and cluster
+        state are unchanged since an iteration which calculated no changes
+        skips calculating changes, and is counted as short-circuited.
+        """
+        world, deployer = self.run_iterations(
+            [Sequentially(changes=[]), Sequentially(changes=[]),
+             Sequentially(changes=[])], self.client())
+        self.assertEqual(
+            (deployer.calculate_inputs, world.iterations,
+             world.short_circuited_iterations),
+            ([(self.local_state, self.configuration, self.cluster_state)],
+             3, 2))
+
+    def test_unchanged_with_changes(self):
+        """
+        An iteration whose inputs are unchanged since an iteration which
+        calculated some changes calculates changes again.
+        """
+        world, deployer = self.run_iterations(
+            [ControllableAction(succeed(None)),
+             ControllableAction(succeed(None))], self.client())
+        self.assertEqual(
+            (len(deployer.calculate_inputs),
+             world.short_circuited_iterations),
+            (2, 0))
+
+    def test_changed_configuration(self):
+        """
+        An iteration following a status update calculates changes again even
+        if the previous iteration calculated no changes.
+        """
+        client = self.client()
+        deployer = ControllableDeployer(
+            [succeed(self.local_state), succeed(self.local_state)],
+            [Sequentially(changes=[]), Sequentially(changes=[])])
+        loop = build_convergence_loop_fsm(self.reactor, deployer)
+        loop.receive(self.status_update(client))
+        configuration = self.configuration
+        self.configuration = object()
+        loop.receive(self.status_update(client))
+        self.assertEqual(
+            deployer.calculate_inputs,
+            [(self.local_state, configuration, self.cluster_state),
+             (self.local_state, self.configuration, self.cluster_state)])
+
+    def test_unchanged_local_state_not_sent(self):
+        """
+        Local state that is unchanged since the previous iteration is not sent
+        to the control service again.
+        """
+        client = self.client()
+        self.run_iterations(
+            [Sequentially(changes=[]), Sequentially(changes=[])], client)
+        self.assertEqual(
+            client.calls,
+            [(NodeStateCommand, dict(node_state=self.local_state))])
+
+    def test_unchanged_local_state_new_client(self):
+        """
+        Local state that is unchanged since the previous iteration is sent to
+        the control service again if the client has changed.
+        """
+        client = self.client()
+        client2 = self.client()
+        deployer = ControllableDeployer(
+            [succeed(self.local_state), succeed(self.local_state)],
+            [Sequentially(changes=[]), Sequentially(changes=[])])
+        loop = build_convergence_loop_fsm(self.reactor, deployer)
+        loop.receive(self.status_update(client))
+        loop.receive(self.status_update(client2))
+        self.assertEqual(
+            (client.calls, client2.calls),
+            ([(NodeStateCommand, dict(node_state=self.local_state))],
+             [(NodeStateCommand, dict(node_state=self.local_state))]))
+
+
+class ConvergenceLoopTimingTests(SynchronousTestCase):
+    """
+    Tests for the timing of iterations of the FSM created by
+    ``build_convergence_loop_fsm``.
+    """
+    def run_iteration(self, logger=None, trace=False):
+        """
+        Run a single iteration, in which discovery takes 1 second and
+        applying changes takes 2 seconds, using a deployer which has
+        ``timings`` and a ``logger`` like ``P2PNodeDeployer`` does.
+
+        :param logger: The logger to use, or ``None`` for the default.
+        :param bool trace: Whether the deployer has a ``trace`` too.
+
+        :return: The ``ConvergenceLoop`` world of the FSM.
+        """
+        self.reactor = Clock()
+        local_state = node_state(u"192.0.2.123")
+        client = FakeAMPClient()
+        client.register_response(
+            NodeStateCommand, dict(node_state=local_state), {"result": None})
+        discovering = Deferred()
+        applying = Deferred()
+        deployer = ControllableDeployer(
+            [discovering], [ControllableAction(applying)])
+        deployer.timings = ConvergenceTimings(self.reactor)
+        deployer.logger = logger
+        if trace:
+            deployer.trace = ChangeTrace(self.reactor)
+        loop = build_convergence_loop_fsm(self.reactor, deployer)
+        world = loop._fsm._world.original
+        if logger is not None:
+            world.logger = logger
+        loop.receive(_ClientStatusUpdate(
+            client=client, configuration=object(), state=object()))
+        self.reactor.advance(1)
+        discovering.callback(local_state)
+        self.reactor.advance(2)
+        applying.callback(None)
+        return world
+
+    def test_timings(self):
+        """
+        The duration of the iteration and of its discovery, planning and
+        execution phases are recorded in the loop's ``timings``.
+        """
+        world = self.run_iteration()
+        self.assertEqual(
+            dict((name, summary[u"max"]) for (name, summary)
+                 in world.timings.summary().items()),
+            {u"iteration": 3.0, u"discover": 1.0, u"calculate": 0.0,
+             u"run": 2.0, u"change:ControllableAction": 2.0})
+
+    def test_deployer_timings(self):
+        """
+        The loop records timings in the deployer's ``timings``, if it has
+        any.
+        """
+        deployer = ControllableDeployer([], [])
+        deployer.timings = ConvergenceTimings(Clock())
+        loop = build_convergence_loop_fsm(Clock(), deployer)
+        self.assertIs(loop._fsm._world.original.timings, deployer.timings)
+
+    def assert_iteration_logged(self, logger):
+        """
+        The iteration was logged in a ``LOG_CONVERGE`` action containing
+        ``LOG_DISCOVER``, ``LOG_CALCULATE`` and ``LOG_STATE_CHANGE``
+        actions.
+        """
+        [action] = LoggedAction.ofType(logger.messages, LOG_CONVERGE)
+        self.assertEqual(
+            (action.succeeded, action.endMessage[u"seconds"],
+             [(child.startMessage[u"action_type"],
+               child.endMessage[u"seconds"])
+              for child in action.children]),
+            (True, 3.0,
+             [(LOG_DISCOVER.action_type, 1.0),
+              (LOG_CALCULATE.action_type, 0.0),
+              (LOG_STATE_CHANGE.action_type, 2.0)]))
+
+    @validateLogging(assert_iteration_logged)
+    def test_logged(self, logger):
+        """
+        Each iteration is logged, along with its phases.
+        """
+        self.run_iteration(logger)
+
+    def assert_critical_path_logged(self, logger):
+        """
+        The critical path of the applied changes was logged.
+        """
+        [message] = LoggedMessage.ofType(logger.messages, LOG_CRITICAL_PATH)
+        self.assertEqual(
+            (message.message[u"seconds"],
+             [(change[u"start"], change[u"seconds"])
+              for change in message.message[u"path"]]),
+            (2.0, [(0.0, 2.0)]))
+
+    @validateLogging(assert_critical_path_logged)
+    def test_critical_path(self, logger):
+        """
+        If the deployer has a ``trace``, the critical path of the changes
+        applied by each iteration is logged.
+        """
+        self.run_iteration(logger, trace=True)
+
+    @validateLogging(None)
+    def test_no_changes_not_traced(self, logger):
+        """
+        Iterations with nothing to do don't log a critical path.
+        """
+        local_state = node_state(u"192.0.2.123")
+        client = FakeAMPClient()
+        client.register_response(
+            NodeStateCommand, dict(node_state=local_state), {"result": None})
+        deployer = ControllableDeployer(
+            [succeed(local_state)], [Sequentially(changes=[])])
+        deployer.trace = ChangeTrace(Clock())
+        loop = build_convergence_loop_fsm(Clock(), deployer)
+        loop._fsm._world.original.logger = logger
+        loop.receive(_ClientStatusUpdate(
+            client=client, configuration=object(), state=object()))
+        self.assertEqual(
+            LoggedMessage.ofType(logger.messages, LOG_CRITICAL_PATH), [])
+
+
+class ConvergenceLoopPreemptionTests(SynchronousTestCase):
+    """
+    Tests for preemption of out of date plans by the FSM created by
+    ``build_convergence_loop_fsm``.
+    """
+    def setUp(self):
+        self.reactor = Clock()
+        self.local_state = node_state(u"192.0.2.123")
+        self.client = FakeAMPClient()
+        self.client.register_response(
+            NodeStateCommand, dict(node_state=self.local_state),
+            {"result": None})
+        self.configuration = object()
+        self.cluster_state = object()
+        self.first_phase = ControllableAction(Deferred())
+        self.later_phases = [ControllableAction(succeed(None)),
+                             ControllableAction(succeed(None))]
+        self.replan = ControllableAction(Deferred())
+        self.discovering = Deferred()
+        self.deployer = ControllableDeployer(
+            [self.discovering, succeed(self.local_state)],
+            [self.plan(), self.replan])
+        self.loop = build_convergence_loop_fsm(self.reactor, self.deployer)
+        self.loop.receive(self.status_update())
+
+    def plan(self):
+        """
+        :return: The plan whose first phase is ``first_phase``, followed by
+            ``later_phases``.
+        """
+        return Sequentially(changes=[self.first_phase] + self.later_phases)
+
+    def status_update(self):
+        """
+        :return: A ``_ClientStatusUpdate`` with the test's current desired
+            configuration and cluster state.
+        """
+        return _ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=self.cluster_state)
+
+    def test_new_configuration(self):
+        """
+        If a status update with a different desired configuration is received
+        while a plan is being applied, the remaining phases are skipped once
+        the current one is done and changes are calculated again
+        immediately.
+        """
+        self.discovering.callback(self.local_state)
+        self.configuration = object()
+        self.loop.receive(self.status_update())
+        called = self.first_phase.called
+        self.first_phase.result.callback(None)
+        self.assertEqual(
+            (called, [phase.called for phase in self.later_phases],
+             self.replan.called, self.deployer.calculate_inputs[-1][1],
+             self.loop._fsm._world.original.preempted_iterations),
+            (True, [False, False], True, self.configuration, 1))
+
+    def test_new_cluster_state(self):
+        """
+        A status update that only changes cluster state doesn't preempt the
+        current plan.
+        """
+        self.discovering.callback(self.local_state)
+        self.cluster_state = object()
+        self.loop.receive(self.status_update())
+        self.first_phase.result.callback(None)
+        self.assertEqual(
+            ([phase.called for phase in self.later_phases],
+             self.replan.called, self.loop.state),
+            ([True, True], False, ConvergenceLoopStates.SLEEPING))
+
+    def test_new_configuration_before_planning(self):
+        """
+        A status update received before the plan is calculated doesn't
+        preempt the plan, since it is calculated from the newer desired
+        configuration.
+        """
+        self.configuration = object()
+        self.loop.receive(self.status_update())
+        self.discovering.callback(self.local_state)
+        self.first_phase.result.callback(None)
+        self.assertEqual(
+            ([phase.called for phase in self.later_phases],
+             self.replan.called, self.deployer.calculate_inputs[0][1]),
+            ([True, True], False, self.configuration))
+
+    def test_new_configuration_while_planning(self):
+        """
+        A status update with a different desired configuration received
+        while the plan is being calculated preempts the plan before any of
+        it is applied, since it was calculated from the older
+        configuration.
+        """
+        planning = Deferred()
+        plan = self.deployer.calculated_actions[0]
+        self.deployer.calculated_actions[0] = planning
+        self.discovering.callback(self.local_state)
+        self.configuration = object()
+        self.loop.receive(self.status_update())
+        planning.callback(plan)
+        self.assertEqual(
+            (self.first_phase.called, self.replan.called,
+             self.deployer.calculate_inputs[-1][1]),
+            (False, True, self.configuration))
+
+    def test_stop(self):
+        """
+        A preempted iteration of a loop that is stopping doesn't calculate
+        changes again.
+        """
+        self.discovering.callback(self.local_state)
+        self.configuration = object()
+        self.loop.receive(self.status_update())
+        self.loop.receive(ConvergenceLoopInputs.STOP)
+        self.first_phase.result.callback(None)
+        self.assertEqual(
+            (self.replan.called, self.loop.state),
+            (False, ConvergenceLoopStates.STOPPED))
+
+    def assert_preemption_logged(self, logger):
+        """
+        The number of phases that were skipped was logged.
+        """
+        [message] = LoggedMessage.ofType(logger.messages, LOG_PREEMPTED)
+        self.assertEqual(message.message[u"remaining_phases"], 2)
+
+    @validateLogging(assert_preemption_logged)
+    def test_logged(self, logger):
+        """
+        Preempting a plan is logged.
+        """
+        self.loop._fsm._world.original.logger = logger
+        self.discovering.callback(self.local_state)
+        self.configuration = object()
+        self.loop.receive(self.status_update())
+        self.first_phase.result.callback(None)
+
+
+class ConvergenceLoopDependencyOrderPreemptionTests(
+        ConvergenceLoopPreemptionTests):
+    """
+    Tests for preemption of out of date plans in dependency order, where
+    each change is a phase of its own.
+    """
+    def plan(self):
+        """
+        :return: A plan where ``later_phases`` depend on ``first_phase``.
+        """
+        return InDependencyOrder(
+            changes=[self.first_phase] + self.later_phases,
+            dependencies=frozenset([(0, 1), (0, 2)]))
+
+
 class AgentLoopServiceTests(SynchronousTestCase):
     """
     Tests for ``AgentLoopService``.
@@ -503,6 +1154,23 @@ class AgentLoopServiceTests(SynchronousTestCase):
                           convergence_loop_fsm_world.deployer),
                          (ClusterStatus, ConvergenceLoop, deployer))
 
+    def test_initialization_intervals(self):
+        """
+        The convergence loop FSM of a newly created service uses the service's
+        reactor and convergence intervals.
+        """
+        reactor = Clock()
+        service = AgentLoopService(
+            reactor=reactor, deployer=object(), host=u"example.com",
+            port=1234, interval=2.0, max_interval=20.0)
+        cluster_status_fsm_world = service.cluster_status._fsm._world.original
+        convergence_loop_fsm_world = (
+            cluster_status_fsm_world.convergence_loop_fsm._fsm._world.original)
+        self.assertEqual((convergence_loop_fsm_world.reactor,
+                          convergence_loop_fsm_world.interval,
+                          convergence_loop_fsm_world.max_interval),
+                         (reactor, 2.0, 20.0))
+
     def test_start_service(self):
         """
         Starting the service starts a reconnecting TCP client to given host
@@ -5,13 +5,17 @@ Tests for :module:`flocker.node.script`.
 """
 
 from StringIO import StringIO
+from signal import SIGUSR1
 
 from pyrsistent import pmap
 
+from eliot.testing import validateLogging, LoggedMessage
+
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.usage import UsageError
 from twisted.python.filepath import FilePath
 from twisted.application.service import Service
+from twisted.internet.task import Clock
 
 from yaml import safe_dump, safe_load
 from ...testtools import StandardOptionsTestsMixin, MemoryCoreReactor
@@ -21,7 +25,7 @@ from ...route import make_memory_network
 from ..script import (
     ZFSAgentOptions, ZFSAgentScript,
     ChangeStateOptions, ChangeStateScript,
-    ReportStateOptions, ReportStateScript)
+    ReportStateOptions, ReportStateScript, log_diagnostics_on_signal)
 from .. import script as script_module
 from .._docker import FakeDockerClient, Unit
 from ...control._model import (
@@ -29,6 +33,12 @@ from ...control._model import (
     Manifestation)
 from .._loop import AgentLoopService
 from .._deploy import P2PNodeDeployer
+from .._logging import (
+    LOG_TIMINGS, LOG_BACKOFF_STATE, LOG_CONCURRENCY_STATE,
+)
+from .._timing import ConvergenceTimings
+from .._backoff import ChangeBackoff
+from .._concurrency import ConcurrencyLimits, DOCKER, ZFS, TRANSFER
 
 from ...volume.testtools import create_volume_service
 
@@ -410,6 +420,11 @@ class ZFSAgentScriptTests(SynchronousTestCase):
     """
     Tests for ``ZFSAgentScript``.
     """
+    def setUp(self):
+        # Don't install signal handlers in the test process:
+        self.signal_handlers = {}
+        self.patch(script_module, "signal", self.signal_handlers.__setitem__)
+
     def test_main_starts_service(self):
         """
         ``ZFSAgentScript.main`` starts the given service.
@@ -436,8 +451,10 @@ class ZFSAgentScriptTests(SynchronousTestCase):
         """
         service = Service()
         options = ZFSAgentOptions()
-        options.parseOptions([b"--destination-port", b"1234", b"1.2.3.4",
-                              b"example.com"])
+        options.parseOptions([b"--destination-port", b"1234",
+                              b"--convergence-interval", b"2",
+                              b"--max-convergence-interval", b"20",
+                              b"1.2.3.4", b"example.com"])
         test_reactor = MemoryCoreReactor()
         ZFSAgentScript().main(test_reactor, options, service)
         parent_service = service.parent
@@ -451,9 +468,112 @@ class ZFSAgentScriptTests(SynchronousTestCase):
                          (AgentLoopService(reactor=test_reactor,
                                            deployer=None,
                                            host=u"example.com",
-                                           port=1234),
+                                           port=1234,
+                                           interval=2.0,
+                                           max_interval=20.0),
                           P2PNodeDeployer, b"1.2.3.4", service, True))
 
+    def test_concurrency_limits(self):
+        """
+        ``ZFSAgentScript.main`` limits the concurrency of the deployer's
+        changes as configured on the command line.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"--docker-concurrency", b"3",
+                              b"--zfs-concurrency", b"2",
+                              b"--transfer-concurrency", b"1",
+                              b"1.2.3.4", b"example.com"])
+        ZFSAgentScript().main(MemoryCoreReactor(), options, service)
+        state = service.parent.deployer.limits.state()
+        self.assertEqual(
+            {resource_class: state[resource_class][u"limit"]
+             for resource_class in state},
+            {DOCKER: 3, ZFS: 2, TRANSFER: 1})
+
+    def test_trace(self):
+        """
+        ``ZFSAgentScript.main`` traces the deployer's changes with the given
+        reactor, writing Chrome trace events to the file given on the
+        command line.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"--chrome-trace", b"/tmp/trace.json",
+                              b"1.2.3.4", b"example.com"])
+        test_reactor = MemoryCoreReactor()
+        ZFSAgentScript().main(test_reactor, options, service)
+        trace = service.parent.deployer.trace
+        self.assertEqual((trace.clock, trace.chrome_trace),
+                         (test_reactor, FilePath(b"/tmp/trace.json")))
+
+    def test_logs_diagnostics_on_signal(self):
+        """
+        ``ZFSAgentScript.main`` arranges for the deployer's diagnostics to be
+        logged when the process receives ``SIGUSR1``, and times changes and
+        their backoff with the given reactor.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        test_reactor = MemoryCoreReactor()
+        ZFSAgentScript().main(test_reactor, options, service)
+        calls = []
+        test_reactor.callFromThread = lambda f, *args: calls.append(f)
+        self.signal_handlers[SIGUSR1](SIGUSR1, None)
+        deployer = service.parent.deployer
+        self.assertEqual(
+            (len(calls), deployer.timings.clock, deployer.backoff.clock),
+            (1, test_reactor, test_reactor))
+
+
+class LogDiagnosticsOnSignalTests(SynchronousTestCase):
+    """
+    Tests for ``log_diagnostics_on_signal``.
+    """
+    def assert_diagnostics_logged(self, logger):
+        """
+        A summary of the timings, the backoff state and the use of
+        concurrency limits were logged.
+        """
+        [timings] = LoggedMessage.ofType(logger.messages, LOG_TIMINGS)
+        [backoff] = LoggedMessage.ofType(logger.messages, LOG_BACKOFF_STATE)
+        [limits] = LoggedMessage.ofType(
+            logger.messages, LOG_CONCURRENCY_STATE)
+        self.assertEqual(
+            (timings.message[u"timings"][u"discover"][u"count"],
+             [change[u"failures"] for change in backoff.message[u"changes"]],
+             limits.message[u"resources"][u"zfs"][u"limit"]),
+            (1, [1], 1))
+
+    @validateLogging(assert_diagnostics_logged)
+    def test_signal(self, logger):
+        """
+        When the given signal is received, the deployer's timings, backoff
+        state and concurrency limits are logged in the reactor thread.
+        """
+        handlers = {}
+        self.patch(script_module, "signal", handlers.__setitem__)
+        self.patch(script_module, "Logger", lambda: logger)
+        calls = []
+
+        class FakeReactor(object):
+            def callFromThread(self, f, *args):
+                calls.append((f, args))
+
+        clock = Clock()
+        deployer = P2PNodeDeployer(
+            u"example.com", None, docker_client=FakeDockerClient(),
+            network=make_memory_network(),
+            timings=ConvergenceTimings(clock), backoff=ChangeBackoff(clock),
+            limits=ConcurrencyLimits({ZFS: 1}))
+        deployer.timings.record(u"discover", 1.0)
+        deployer.backoff.failed(object())
+        log_diagnostics_on_signal(FakeReactor(), deployer, SIGUSR1)
+        handlers[SIGUSR1](SIGUSR1, None)
+        [(f, args)] = calls
+        f(*args)
+
 
 class ZFSAgentOptionsTests(make_volume_options_tests(
         ZFSAgentOptions, [b"1.2.3.4", b"example.com"])):
@@ -496,3 +616,108 @@ class ZFSAgentOptionsTests(make_volume_options_tests(
         options = ZFSAgentOptions()
         options.parseOptions([b"5.6.7.8", b"control.example.com"])
         self.assertEqual(options["hostname"], u"5.6.7.8")
+
+    def test_default_convergence_intervals(self):
+        """
+        By default the convergence loop waits between 1 and 30 seconds
+        between iterations.
+        """
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        self.assertEqual(
+            (options["convergence-interval"],
+             options["max-convergence-interval"]),
+            (1.0, 30.0))
+
+    def test_custom_convergence_intervals(self):
+        """
+        The ``--convergence-interval`` and ``--max-convergence-interval``
+        command-line options allow configuring the wait between convergence
+        iterations.
+        """
+        options = ZFSAgentOptions()
+        options.parseOptions([b"--convergence-interval", b"0.5",
+                              b"--max-convergence-interval", b"5",
+                              b"1.2.3.4", b"example.com"])
+        self.assertEqual(
+            (options["convergence-interval"],
+             options["max-convergence-interval"]),
+            (0.5, 5.0))
+
+    def test_convergence_interval_not_positive(self):
+        """
+        A ``UsageError`` is raised if ``--convergence-interval`` is not
+        positive.
+        """
+        options = ZFSAgentOptions()
+        self.assertRaises(
+            UsageError, options.parseOptions,
+            [b"--convergence-interval", b"0", b"1.2.3.4", b"example.com"])
+
+    def test_max_convergence_interval_too_small(self):
+        """
+        A ``UsageError`` is raised if ``--max-convergence-interval`` is less
+        than ``--convergence-interval``.
+        """
+        options = ZFSAgentOptions()
+        self.assertRaises(
+            UsageError, options.parseOptions,
+            [b"--convergence-interval", b"5",
+             b"--max-convergence-interval", b"2",
+             b"1.2.3.4", b"example.com"])
+
+    def test_default_concurrency(self):
+        """
+        By default at most 8 Docker API operations, 4 ZFS commands and 2
+        transfers run at once.
+        """
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        self.assertEqual(
+            (options["docker-concurrency"], options["zfs-concurrency"],
+             options["transfer-concurrency"]),
+            (8, 4, 2))
+
+    def test_custom_concurrency(self):
+        """
+        The ``--docker-concurrency``, ``--zfs-concurrency`` and
+        ``--transfer-concurrency`` command-line options allow configuring
+        the concurrency limits.
+        """
+        options = ZFSAgentOptions()
+        options.parseOptions([b"--docker-concurrency", b"20",
+                              b"--zfs-concurrency", b"1",
+                              b"--transfer-concurrency", b"5",
+                              b"1.2.3.4", b"example.com"])
+        self.assertEqual(
+            (options["docker-concurrency"], options["zfs-concurrency"],
+             options["transfer-concurrency"]),
+            (20, 1, 5))
+
+    def test_concurrency_not_positive(self):
+        """
+        A ``UsageError`` is raised if a concurrency limit is less than 1.
+        """
+        options = ZFSAgentOptions()
+        self.assertRaises(
+            UsageError, options.parseOptions,
+            [b"--transfer-concurrency", b"0", b"1.2.3.4", b"example.com"])
+
+    def test_default_chrome_trace(self):
+        """
+        By default no Chrome trace file is written.
+        """
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        self.assertEqual(options["chrome-trace"], None)
+
+    def test_custom_chrome_trace(self):
+        """
+        The ``--chrome-trace`` command-line option allows configuring a file
+        to write Chrome trace events to.
+        """
+        options = ZFSAgentOptions()
+        options.parseOptions([b"--chrome-trace", b"/tmp/trace.json",
+                              b"1.2.3.4", b"example.com"])
+        self.assertEqual(options["chrome-trace"],
+                         FilePath(b"/tmp/trace.json"))
@@ -0,0 +1,150 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.node._timing``.
+"""
+
+from eliot.testing import validateLogging, LoggedAction, LoggedMessage
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._logging import LOG_CALCULATE, LOG_TIMINGS
+from .._timing import ConvergenceTimings, timed
+
+
+class ConvergenceTimingsTests(SynchronousTestCase):
+    """
+    Tests for ``ConvergenceTimings``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.timings = ConvergenceTimings(self.clock)
+
+    def test_empty(self):
+        """
+        A new ``ConvergenceTimings`` has an empty summary.
+        """
+        self.assertEqual(self.timings.summary(), {})
+
+    def test_summary(self):
+        """
+        ``ConvergenceTimings.summary`` includes the count, number of failures,
+        50th, 90th and 99th percentiles and maximum of the recorded
+        durations of each operation.
+        """
+        for seconds in range(1, 11):
+            self.timings.record(u"discover", float(seconds),
+                                succeeded=seconds != 5)
+        self.timings.record(u"calculate", 0.5)
+        self.assertEqual(
+            self.timings.summary(),
+            {u"discover": {u"count": 10, u"failures": 1, u"p50": 5.0,
+                           u"p90": 9.0, u"p99": 10.0, u"max": 10.0},
+             u"calculate": {u"count": 1, u"failures": 0, u"p50": 0.5,
+                            u"p90": 0.5, u"p99": 0.5, u"max": 0.5}})
+
+    def test_window(self):
+        """
+        Percentiles are calculated from the most recent durations only.
+        """
+        timings = ConvergenceTimings(self.clock, window=2)
+        for seconds in [100.0, 1.0, 2.0]:
+            timings.record(u"discover", seconds)
+        summary = timings.summary()[u"discover"]
+        self.assertEqual((summary[u"count"], summary[u"max"]), (2, 2.0))
+
+    def test_measure_success(self):
+        """
+        ``ConvergenceTimings.measure`` returns the result of the function,
+        recording the time until it is available.
+        """
+        result = Deferred()
+        measuring = self.timings.measure(u"run", lambda: result)
+        self.clock.advance(2.5)
+        result.callback(123)
+        self.assertEqual(
+            (self.successResultOf(measuring),
+             self.timings.summary()[u"run"][u"max"]),
+            (123, 2.5))
+
+    def test_measure_failure(self):
+        """
+        ``ConvergenceTimings.measure`` records the function failing.
+        """
+        measuring = self.timings.measure(u"run", lambda: 1 / 0)
+        self.failureResultOf(measuring, ZeroDivisionError)
+        self.assertEqual(self.timings.summary()[u"run"][u"failures"], 1)
+
+    def assert_summary_logged(self, logger):
+        """
+        The summary was logged in a ``LOG_TIMINGS`` message.
+        """
+        [message] = LoggedMessage.ofType(logger.messages, LOG_TIMINGS)
+        self.assertEqual(message.message[u"timings"],
+                         self.timings.summary())
+
+    @validateLogging(assert_summary_logged)
+    def test_log_summary(self, logger):
+        """
+        ``ConvergenceTimings.log_summary`` logs the summary.
+        """
+        self.timings.record(u"discover", 1.0)
+        self.timings.log_summary(logger)
+
+
+class TimedTests(SynchronousTestCase):
+    """
+    Tests for ``timed``.
+    """
+    def assert_seconds_logged(self, logger):
+        """
+        The action succeeded, with the time taken as a success field.
+        """
+        [action] = LoggedAction.ofType(logger.messages, LOG_CALCULATE)
+        self.assertEqual(
+            (action.succeeded, action.endMessage[u"seconds"]), (True, 4.0))
+
+    @validateLogging(assert_seconds_logged)
+    def test_action(self, logger):
+        """
+        ``timed`` finishes the action when the function's result is
+        available, records the duration and returns the result.
+        """
+        clock = Clock()
+        timings = ConvergenceTimings(clock)
+        result = Deferred()
+        d = timed(timings, u"calculate", LOG_CALCULATE(logger),
+                  lambda: result)
+        clock.advance(4)
+        result.callback(u"plan")
+        self.assertEqual(
+            (self.successResultOf(d),
+             timings.summary()[u"calculate"][u"count"]),
+            (u"plan", 1))
+
+    def assert_failure_logged(self, logger):
+        """
+        The action failed.
+        """
+        [action] = LoggedAction.ofType(logger.messages, LOG_CALCULATE)
+        self.assertFalse(action.succeeded)
+
+    @validateLogging(assert_failure_logged)
+    def test_failure(self, logger):
+        """
+        ``timed`` fails the action if the function fails.
+        """
+        d = timed(ConvergenceTimings(Clock()), u"calculate",
+                  LOG_CALCULATE(logger), lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+
+    @validateLogging(None)
+    def test_no_timings(self, logger):
+        """
+        ``timed`` can be used without recording the duration.
+        """
+        d = timed(None, u"calculate", LOG_CALCULATE(logger),
+                  lambda: succeed(u"plan"))
+        self.assertEqual(self.successResultOf(d), u"plan")
@@ -0,0 +1,165 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.node._trace``.
+"""
+
+from json import loads
+
+from eliot.testing import validateLogging, LoggedMessage
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._logging import LOG_CRITICAL_PATH
+from .._trace import ChangeTrace
+
+
+class ChangeTraceTests(SynchronousTestCase):
+    """
+    Tests for ``ChangeTrace``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(100)
+        self.trace = ChangeTrace(self.clock)
+        self.trace.reset()
+
+    def start(self, change):
+        """
+        Start measuring a change.
+
+        :return: A ``Deferred`` to fire when the change is done.
+        """
+        done = Deferred()
+        self.trace.measure(change, lambda: done).addErrback(lambda _: None)
+        return done
+
+    def run_change(self, change, seconds):
+        """
+        Measure a change that takes ``seconds`` seconds.
+
+        :return: The ``_Span`` of the change.
+        """
+        done = self.start(change)
+        self.clock.advance(seconds)
+        done.callback(None)
+        return self.trace.span(change)
+
+    def test_measure(self):
+        """
+        ``ChangeTrace.measure`` returns the result of the function, recording
+        when the change started and finished.
+        """
+        result = Deferred()
+        measuring = self.trace.measure(u"change", lambda: result)
+        self.clock.advance(2)
+        result.callback(123)
+        span = self.trace.span(u"change")
+        self.assertEqual(
+            (self.successResultOf(measuring), span.change, span.start,
+             span.end, span.succeeded),
+            (123, u"change", 100, 102, True))
+
+    def test_failure(self):
+        """
+        ``ChangeTrace.measure`` records the change failing.
+        """
+        measuring = self.trace.measure(u"change", lambda: 1 / 0)
+        self.failureResultOf(measuring, ZeroDivisionError)
+        self.assertEqual(self.trace.span(u"change").succeeded, False)
+
+    def test_unfinished(self):
+        """
+        ``ChangeTrace.span`` returns ``None`` for a change that hasn't
+        finished, or wasn't run.
+        """
+        self.trace.measure(u"change", Deferred)
+        self.assertEqual((self.trace.span(u"change"), self.trace.span(u"x")),
+                         (None, None))
+
+    def test_identity(self):
+        """
+        Changes are identified by identity rather than equality.
+        """
+        first, second = [u"a"], [u"a"]
+        self.run_change(first, 1)
+        self.assertEqual(
+            (self.trace.span(second), self.trace.span(first).change),
+            (None, first))
+
+    def test_reset(self):
+        """
+        ``ChangeTrace.reset`` forgets the changes run so far.
+        """
+        change = [u"change"]
+        self.run_change(change, 1)
+        self.trace.reset()
+        self.assertEqual(self.trace.span(change), None)
+
+    def assert_path_logged(self, logger):
+        """
+        The critical path was logged with its duration, and the start and
+        duration of each change on it.
+        """
+        [message] = LoggedMessage.ofType(logger.messages, LOG_CRITICAL_PATH)
+        self.assertEqual(
+            (message.message[u"seconds"], message.message[u"path"]),
+            (5.0, [{u"change": u"u'first'", u"start": 1.0, u"seconds": 2.0},
+                   {u"change": u"u'second'", u"start": 4.0,
+                    u"seconds": 2.0}]))
+
+    @validateLogging(assert_path_logged)
+    def test_report(self, logger):
+        """
+        ``ChangeTrace.report`` logs the given critical path.
+        """
+        self.clock.advance(1)
+        first = self.run_change(u"first", 2)
+        self.clock.advance(1)
+        path = [first, self.run_change(u"second", 2)]
+        self.trace.report(path, logger)
+
+    def test_chrome_trace_events(self):
+        """
+        ``ChangeTrace.chrome_trace_events`` describes each finished change as
+        a complete event, in microseconds since the trace was reset, putting
+        overlapping changes in different rows and marking those on the
+        critical path.
+        """
+        first = self.start(1)
+        self.clock.advance(1)
+        second = self.start(2.5)
+        self.clock.advance(1)
+        first.callback(None)
+        third = self.start(3)
+        self.clock.advance(1)
+        second.errback(RuntimeError())
+        third.callback(None)
+        path = [self.trace.span(1)]
+        events = self.trace.chrome_trace_events(path)[u"traceEvents"]
+        self.assertEqual(
+            [(event[u"name"], event[u"ph"], event[u"tid"], event[u"ts"],
+              event[u"dur"], event[u"args"])
+             for event in events],
+            [(u"int", u"X", 0, 0, 2000000,
+              {u"change": u"1", u"succeeded": True, u"critical": True}),
+             (u"float", u"X", 1, 1000000, 2000000,
+              {u"change": u"2.5", u"succeeded": False, u"critical": False}),
+             (u"int", u"X", 0, 2000000, 1000000,
+              {u"change": u"3", u"succeeded": True, u"critical": False})])
+
+    @validateLogging(None)
+    def test_write_chrome_trace(self, logger):
+        """
+        If ``ChangeTrace`` was given a ``chrome_trace`` file,
+        ``ChangeTrace.report`` writes the Chrome trace events to it.
+        """
+        path = FilePath(self.mktemp())
+        trace = ChangeTrace(self.clock, chrome_trace=path)
+        trace.measure(u"change", lambda: None)
+        trace.report([trace.span(u"change")], logger)
+        self.assertEqual(loads(path.getContent()),
+                         trace.chrome_trace_events([trace.span(u"change")]))
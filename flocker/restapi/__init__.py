@@ -5,13 +5,14 @@ Infrastructure for publishing a REST HTTP API.
 """
 
 from ._infrastructure import (
-    structured, EndpointResponse, user_documentation,
+    structured, EndpointResponse, OutputValidation, user_documentation,
     )
 
 from ._error import makeBadRequest as make_bad_request
+from ._metrics import RequestMetrics
 
 
 __all__ = [
-    "structured", "EndpointResponse", "user_documentation",
-    "make_bad_request",
+    "structured", "EndpointResponse", "OutputValidation",
+    "user_documentation", "make_bad_request", "RequestMetrics",
 ]
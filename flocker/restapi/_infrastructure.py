@@ -6,15 +6,24 @@ This module implements tools for exposing Python methods as API endpoints.
 from __future__ import absolute_import
 
 __all__ = [
-    "EndpointResponse", "structured", "user_documentation",
+    "EndpointResponse", "OutputValidation", "structured",
+    "user_documentation",
     ]
 
+from collections import Iterator
 from functools import wraps
+from weakref import WeakKeyDictionary
 
 from json import loads, dumps
 
-from twisted.internet.defer import maybeDeferred
-from twisted.web.http import OK, INTERNAL_SERVER_ERROR
+from zope.interface import implementer
+
+from twisted.internet.defer import (
+    CancelledError, Deferred, maybeDeferred, succeed)
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import TaskFinished, TaskStopped, cooperate
+from twisted.python.failure import Failure
+from twisted.web.http import OK, INTERNAL_SERVER_ERROR, NOT_MODIFIED
 
 from eliot import Logger, writeFailure
 from eliot.twisted import DeferredContext
@@ -22,13 +31,18 @@ from eliot.twisted import DeferredContext
 from ._error import (
     ILLEGAL_CONTENT_TYPE, DECODING_ERROR, BadRequest, InvalidRequestJSON)
 from ._logging import LOG_SYSTEM, REQUEST
-from ._schema import getValidator
+from ._schema import getValidator, getItemValidator
+from ._metrics import _metered
 
 _ASCENDING = b"ascending"
 _DESCENDING = b"descending"
 
 _logger = Logger()
 
+# The number of items of a streamed response encoded before giving other
+# requests a chance to be served:
+STREAM_CHUNK_SIZE = 100
+
 
 class EndpointResponse(object):
     """
@@ -47,6 +61,59 @@ class EndpointResponse(object):
         self.result = result
 
 
+class OutputValidation(object):
+    """
+    A policy deciding which responses have their bodies validated against
+    the endpoint's output schema.
+
+    Validating large responses can cost more than producing them, so in
+    production it may be worth only validating some of them, or none.
+
+    An endpoint's policy is its C{self}'s C{output_validation} attribute.  If
+    there is no such attribute, or it is L{None}, every response is
+    validated.
+    """
+    def __init__(self, sample_every=1):
+        """
+        @param sample_every: Validate one in this many responses, starting
+            with the first.  C{1} validates every response and C{0}
+            disables validation.
+        @type sample_every: L{int}
+        """
+        if sample_every < 0:
+            raise ValueError("sample_every must not be negative")
+        self.sample_every = sample_every
+        self._responses = 0
+
+    def should_validate(self):
+        """
+        Decide whether to validate the next response.
+
+        @return: L{True} if the response should be validated.
+        """
+        if not self.sample_every:
+            return False
+        sample = self._responses % self.sample_every == 0
+        self._responses += 1
+        return sample
+
+
+# The policy of endpoints that don't have one:
+_VALIDATE_ALWAYS = OutputValidation()
+
+
+def _output_validation(endpoint):
+    """
+    @param endpoint: The C{self} of an endpoint method.
+
+    @return: The L{OutputValidation} used for the endpoint's responses.
+    """
+    policy = getattr(endpoint, "output_validation", None)
+    if policy is None:
+        return _VALIDATE_ALWAYS
+    return policy
+
+
 def _logging(original):
     """
     Decorate a method which implements an API endpoint to add Eliot-based
@@ -79,6 +146,14 @@ def _logging(original):
             d = DeferredContext(original(self, request, **routeArguments))
 
         def failure(reason):
+            if request.startedWriting:
+                # Part of a streamed response has already been sent, so the
+                # error can't be reported to the client.  Make sure the
+                # truncated body isn't mistaken for a complete one:
+                if not reason.check(CancelledError):
+                    writeFailure(reason, logger, LOG_SYSTEM)
+                _abortConnection(request)
+                return None
             if reason.check(BadRequest):
                 code = reason.value.code
                 result = reason.value.result
@@ -97,38 +172,296 @@ def _logging(original):
     return logger
 
 
-def _serialize(outputValidator):
+def _abortConnection(request):
+    """
+    Close the connection a request was received on without sending any more
+    data.
+
+    @param request: The request.
+    """
+    transport = request.channel.transport
+    abort = getattr(transport, "abortConnection", transport.loseConnection)
+    abort()
+
+
+def _cooperator(endpoint):
+    """
+    @param endpoint: The C{self} of an endpoint method.
+
+    @return: A callable like L{cooperate}, used to stream the endpoint's
+        responses.  It is the C{cooperate} method of the endpoint's
+        C{cooperator} attribute, if it has one that isn't L{None}, or the
+        global L{cooperate}.
+    """
+    cooperator = getattr(endpoint, "cooperator", None)
+    if cooperator is None:
+        return cooperate
+    return cooperator.cooperate
+
+
+@implementer(IPushProducer)
+class _JSONArrayProducer(object):
+    """
+    Write the items from an iterator to a request as a JSON array, encoding
+    them a chunk at a time and letting other work happen in between.
+
+    Unless the chunks are kept, only one chunk of the encoded response is
+    held in memory at a time; how much of the rest is held depends on the
+    iterator.
+
+    @ivar _task: The L{CooperativeTask} writing the array.
+
+    @ivar _written: The chunks written so far, if they are kept, otherwise
+        L{None}.
+    """
+    def __init__(self, request, items, itemValidator, cooperate,
+                 chunkSize=STREAM_CHUNK_SIZE, keep=False):
+        """
+        @param request: The request to write to.
+
+        @param items: An iterator of the JSON-encodable items of the array.
+
+        @param itemValidator: A L{jsonschema} validator for each item, or
+            L{None} to skip validation.
+
+        @param cooperate: A callable like L{cooperate}.
+
+        @param chunkSize: The number of items written at a time.
+        @type chunkSize: L{int}
+
+        @param keep: Whether to keep the chunks written, so that the whole
+            encoded array is available once it has been written.
+        @type keep: L{bool}
+        """
+        self._request = request
+        self._items = items
+        self._itemValidator = itemValidator
+        self._cooperate = cooperate
+        self._chunkSize = chunkSize
+        self._task = None
+        self._written = [] if keep else None
+
+    def start(self):
+        """
+        Start writing the array.
+
+        @return: A L{Deferred} that fires once the whole array has been
+            written, with the encoded array if the chunks are kept and
+            L{None} otherwise, or fails if an item can't be encoded, is
+            invalid or the iterator raises an exception.  Cancelling it, or
+            the connection being lost, stops writing and fails it with
+            L{CancelledError}.
+        """
+        done = Deferred(lambda _: self.stopProducing())
+        self._task = self._cooperate(self._write())
+        self._request.registerProducer(self, True)
+
+        def finished(result):
+            self._request.unregisterProducer()
+            if isinstance(result, Failure):
+                if result.check(TaskStopped):
+                    result = Failure(CancelledError())
+                done.errback(result)
+            elif self._written is None:
+                done.callback(None)
+            else:
+                done.callback(b"".join(self._written))
+        self._task.whenDone().addBoth(finished)
+        return done
+
+    def _write(self):
+        """
+        Write the array, yielding after each chunk.
+        """
+        separator = b"["
+        chunk = []
+        for item in self._items:
+            if self._itemValidator is not None:
+                self._itemValidator.validate(item)
+            chunk.append(dumps(item))
+            if len(chunk) == self._chunkSize:
+                self._writeChunk(separator + b",".join(chunk))
+                separator = b","
+                chunk = []
+                yield
+        if chunk:
+            self._writeChunk(separator + b",".join(chunk) + b"]")
+        elif separator == b"[":
+            self._writeChunk(b"[]")
+        else:
+            self._writeChunk(b"]")
+
+    def _writeChunk(self, data):
+        """
+        Write part of the encoded array to the request, keeping it if the
+        chunks are kept.
+
+        @param data: The encoded part.
+        @type data: L{bytes}
+        """
+        self._request.write(data)
+        if self._written is not None:
+            self._written.append(data)
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        try:
+            self._task.stop()
+        except TaskFinished:
+            pass
+
+
+def _serialize(outputValidator, itemValidator, keepStreamed=False):
     """
     Decorate a function so that its return value is automatically JSON encoded
     into a structure indicating a successful result.
 
+    If the return value is an iterator it is streamed as a JSON array by a
+    L{_JSONArrayProducer}, validating each item rather than the whole array,
+    so the encoded response needn't be held in memory all at once unless
+    it is kept.
+
     @param outputValidator: A L{jsonschema} validator for the returned JSON.
+        Whether it is used for a particular response depends on the
+        endpoint's L{OutputValidation} policy.
+
+    @param itemValidator: A L{jsonschema} validator for the items of a
+        returned iterator.
+
+    @param keepStreamed: Whether to keep the chunks of streamed responses,
+        so that their encoded body is available, e.g. to the body cache of
+        L{_conditional}.
+    @type keepStreamed: L{bool}
 
     @return: A decorator that decorates a function with the signature
-        of a Klein route endpoint that may return a Deferred.
+        of a Klein route endpoint that may return a Deferred.  The
+        L{Deferred} it returns fires with the encoded response body, which
+        has already been written if it was streamed, or L{None} if it was
+        streamed and not kept.
     """
     def deco(original):
-        def success(result, request):
+        def success(result, request, validation, cooperate):
             code = OK
             if isinstance(result, EndpointResponse):
                 code = result.code
                 result = result.result
-            outputValidator.validate(result)
             request.responseHeaders.setRawHeaders(
                 b"content-type", [b"application/json"])
+            if isinstance(result, Iterator):
+                request.setResponseCode(code)
+                return _JSONArrayProducer(
+                    request, result,
+                    itemValidator if validation.should_validate() else None,
+                    cooperate, keep=keepStreamed).start()
+            if validation.should_validate():
+                outputValidator.validate(result)
             request.setResponseCode(code)
             return dumps(result)
 
         def doit(self, request, **routeArguments):
             result = maybeDeferred(original, self, request, **routeArguments)
-            result.addCallback(success, request)
+            result.addCallback(success, request, _output_validation(self),
+                               _cooperator(self))
+            return result
+
+        return doit
+    return deco
+
+
+def _matches(request, tag):
+    """
+    Determine whether the client already has the current version of a
+    response.
+
+    @param request: The request being responded to.
+
+    @param tag: The quoted entity tag of the current version of the response.
+    @type tag: L{bytes}
+
+    @return: L{True} if the request's C{If-None-Match} header includes the
+        tag (using weak comparison, as the RFC requires) or C{*}.
+    """
+    for value in request.requestHeaders.getRawHeaders(b"if-none-match", []):
+        for candidate in value.split(b","):
+            candidate = candidate.strip()
+            if candidate.startswith(b"W/"):
+                candidate = candidate[2:]
+            if candidate in (tag, b"*"):
+                return True
+    return False
+
+
+def _conditional(etag):
+    """
+    Decorate a function so that C{GET} responses carry an C{ETag} header,
+    requests with a matching C{If-None-Match} header get an empty C{304}
+    response, and the encoded response body is reused for as long as the
+    tag stays the same.
+
+    Only the most recent response is kept for each instance of the
+    endpoint's class, since a tag that is no longer current will never be
+    served again.
+
+    @param etag: L{None} to disable conditional responses, or a
+        one-argument callable that is passed the endpoint's C{self} and
+        returns L{bytes} identifying the current version of the response.
+        It must change whenever the response would, and must not be reused
+        for a different response, e.g. after a restart.
+
+    @return: A decorator that decorates a function with the signature
+        of a Klein route endpoint that returns a L{Deferred} firing with an
+        encoded response body, which may have been streamed already.
+    """
+    def deco(original):
+        if etag is None:
+            return original
+        # Map the endpoint's self to the tag and URI, code and body of its
+        # latest response:
+        cache = WeakKeyDictionary()
+
+        def respond(self, request, **routeArguments):
+            if request.method != b"GET":
+                return original(self, request, **routeArguments)
+            tag = b'"' + etag(self) + b'"'
+            request.responseHeaders.setRawHeaders(b"etag", [tag])
+            if _matches(request, tag):
+                request.setResponseCode(NOT_MODIFIED)
+                return succeed(b"")
+            # Query arguments can select different responses with the same
+            # tag, so the whole URI identifies the cached response:
+            key = (tag, request.uri)
+            cached_key, code, body = cache.get(self, (None, None, None))
+            if cached_key == key:
+                request.responseHeaders.setRawHeaders(
+                    b"content-type", [b"application/json"])
+                request.setResponseCode(code)
+                return succeed(body)
+
+            def store(body):
+                if body is not None:
+                    cache[self] = (key, request.code, body)
+                if request.startedWriting:
+                    # The response was streamed, so it has been written
+                    # already; its body is only returned to be kept:
+                    return None
+                return body
+            result = original(self, request, **routeArguments)
+            result.addCallback(store)
             return result
 
+        def doit(self, request, **routeArguments):
+            return maybeDeferred(respond, self, request, **routeArguments)
         return doit
     return deco
 
 
-def structured(inputSchema, outputSchema, schema_store=None):
+def structured(inputSchema, outputSchema, schema_store=None, etag=None,
+               query_arguments=()):
     """
     Decorate a Klein-style endpoint method so that the request body is
     automatically decoded and the response body is automatically encoded.
@@ -144,23 +477,43 @@ def structured(inputSchema, outputSchema, schema_store=None):
         original(foo="bar")
 
     The encoded form of the object returned by C{original} will define the
-    response body.
+    response body.  If C{original} returns an iterator the response body is
+    a JSON array of its items, encoded and written a chunk at a time using
+    the endpoint's C{cooperator} attribute if it has one (see
+    L{_cooperator}), and each item is validated against the C{items} of
+    C{outputSchema}.
 
     :param inputSchema: JSON Schema describing the request body.
     :param outputSchema: JSON Schema describing the response body.
     :param schema_store: A mapping between schema paths
         (e.g. ``b/v1/types.json``) and the JSON schema structure, allowing
         input/output schemas to just be references.
+    :param etag: A one-argument callable which is passed the endpoint's
+        ``self`` and returns ``bytes`` identifying the current version of
+        the response, enabling conditional ``GET`` requests and caching of
+        the encoded response body, streamed or not; see ``_conditional``.
+        ``None`` (the default) disables both.
+    :param query_arguments: The names (``bytes``) of query arguments to pass
+        to the decorated function as keyword arguments.  Each is passed as a
+        ``list`` of ``unicode`` values, and only if it is present in the
+        request.  Other query arguments are ignored.
+
+    Requests are recorded in the endpoint's ``RequestMetrics``, if it has
+    one, under the name of the decorated function.
     """
     if schema_store is None:
         schema_store = {}
     inputValidator = getValidator(inputSchema, schema_store)
     outputValidator = getValidator(outputSchema, schema_store)
+    itemValidator = getItemValidator(outputSchema, schema_store)
 
     def deco(original):
         @wraps(original)
+        @_metered(original.__name__)
         @_logging
-        @_serialize(outputValidator)
+        @_conditional(etag)
+        @_serialize(outputValidator, itemValidator,
+                    keepStreamed=etag is not None)
         def loadAndDispatch(self, request, **routeArguments):
             if request.method in (b"GET", b"DELETE"):
                 objects = {}
@@ -182,6 +535,15 @@ def structured(inputSchema, outputSchema, schema_store=None):
                 if errors:
                     raise InvalidRequestJSON(errors=errors, schema=inputSchema)
 
+            for name in query_arguments:
+                if name in request.args:
+                    try:
+                        objects[name] = [
+                            value.decode("utf-8")
+                            for value in request.args[name]]
+                    except UnicodeDecodeError:
+                        raise DECODING_ERROR
+
             # Just assume there are no conflicts between these collections
             # of arguments right now.  When there is a schema for the JSON
             # hopefully we can do some static verification that no routing
@@ -0,0 +1,244 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Aggregate statistics about the requests handled by API endpoints, exposed
+in the Prometheus text exposition format (version 0.0.4).
+
+See http://prometheus.io/docs/instrumenting/exposition_formats/.
+"""
+
+from __future__ import absolute_import
+
+__all__ = [
+    "RequestMetrics",
+    ]
+
+from collections import defaultdict
+from functools import wraps
+
+from twisted.internet.defer import maybeDeferred
+
+# Upper bounds of the request latency histogram buckets, in seconds:
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Upper bounds of the response size histogram buckets, in bytes:
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+
+class _Histogram(object):
+    """
+    Counts of observed values falling into buckets.
+
+    @ivar buckets: The upper bounds of the buckets, in increasing order.
+    @ivar counts: The number of values in each bucket, not counting smaller
+        buckets, followed by the number larger than the last bound.
+    @ivar sum: The sum of the observed values.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        Record a value.
+
+        @param value: The observed value.
+        """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+
+
+def _formatValue(value):
+    """
+    @param value: A number.
+
+    @return: The number as L{bytes} in the exposition format.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return b"%d" % (value,)
+
+
+def _formatLabels(labels):
+    """
+    @param labels: A L{list} of pairs of label names and values.
+
+    @return: The labels as L{bytes} in the exposition format.
+    """
+    return b"{" + b",".join(
+        b'%s="%s"' % (name, bytes(value).replace(b"\\", b"\\\\").replace(
+            b'"', b'\\"').replace(b"\n", b"\\n"))
+        for (name, value) in labels) + b"}"
+
+
+class RequestMetrics(object):
+    """
+    Per-route statistics about requests: how long they took to respond to,
+    how many are in progress, the sizes of the responses and their response
+    codes.
+
+    Endpoints decorated with L{structured} record their requests in the
+    L{RequestMetrics} that is the C{metrics} attribute of their C{self}, if
+    it has one that isn't L{None}.  The route is identified by the name of
+    the endpoint method.
+
+    @cvar CONTENT_TYPE: The content type of the output of L{render}.
+
+    @ivar _inFlight: Map routes to the number of requests in progress.
+    @ivar _latency: Map routes to L{_Histogram}s of response times.
+    @ivar _sizes: Map routes to L{_Histogram}s of response body sizes.
+    @ivar _responses: Map pairs of route and response code to the number of
+        responses.
+    """
+    CONTENT_TYPE = b"text/plain; version=0.0.4"
+
+    def __init__(self, clock, latencyBuckets=LATENCY_BUCKETS,
+                 sizeBuckets=SIZE_BUCKETS):
+        """
+        @param clock: An L{IReactorTime} provider used to time requests.
+
+        @param latencyBuckets: The upper bounds of the request latency
+            histogram buckets, in seconds.
+
+        @param sizeBuckets: The upper bounds of the response size histogram
+            buckets, in bytes.
+        """
+        self._clock = clock
+        self._inFlight = defaultdict(int)
+        self._latency = defaultdict(lambda: _Histogram(latencyBuckets))
+        self._sizes = defaultdict(lambda: _Histogram(sizeBuckets))
+        self._responses = defaultdict(int)
+
+    def requestStarted(self, route):
+        """
+        Record the start of a request.
+
+        @param route: The name of the route handling the request.
+        @type route: L{bytes}
+
+        @return: A value to pass to L{requestFinished}.
+        """
+        self._inFlight[route] += 1
+        return self._clock.seconds()
+
+    def requestFinished(self, route, started, code, size):
+        """
+        Record the end of a request.
+
+        @param route: The name of the route handling the request.
+        @type route: L{bytes}
+
+        @param started: The result of the L{requestStarted} call for the
+            request.
+
+        @param code: The response code.
+        @type code: L{int}
+
+        @param size: The size of the response body in bytes.
+        @type size: L{int}
+        """
+        self._inFlight[route] -= 1
+        self._latency[route].observe(self._clock.seconds() - started)
+        self._sizes[route].observe(size)
+        self._responses[route, code] += 1
+
+    def _histogramLines(self, name, histograms):
+        """
+        @param name: The name of the metric.
+        @param histograms: Map routes to L{_Histogram}s.
+
+        @return: An iterator of L{bytes} lines of samples.
+        """
+        for route, histogram in sorted(histograms.items()):
+            total = 0
+            for bound, count in zip(
+                    histogram.buckets + (float("inf"),), histogram.counts):
+                total += count
+                le = b"+Inf" if bound == float("inf") else _formatValue(
+                    float(bound))
+                yield b"%s_bucket%s %d" % (
+                    name, _formatLabels([(b"route", route), (b"le", le)]),
+                    total)
+            labels = _formatLabels([(b"route", route)])
+            yield b"%s_sum%s %s" % (name, labels, _formatValue(histogram.sum))
+            yield b"%s_count%s %d" % (name, labels, total)
+
+    def render(self):
+        """
+        @return: L{bytes} giving the current metrics in the Prometheus text
+            exposition format.
+        """
+        lines = [
+            b"# HELP flocker_api_requests_in_flight "
+            b"Requests currently being handled.",
+            b"# TYPE flocker_api_requests_in_flight gauge",
+        ]
+        lines.extend(
+            b"flocker_api_requests_in_flight%s %d" % (
+                _formatLabels([(b"route", route)]), count)
+            for (route, count) in sorted(self._inFlight.items()))
+        lines.extend([
+            b"# HELP flocker_api_responses_total Responses sent, by code.",
+            b"# TYPE flocker_api_responses_total counter",
+        ])
+        lines.extend(
+            b"flocker_api_responses_total%s %d" % (
+                _formatLabels([(b"route", route), (b"code", code)]), count)
+            for ((route, code), count) in sorted(self._responses.items()))
+        lines.extend([
+            b"# HELP flocker_api_request_duration_seconds "
+            b"Time taken to respond to requests.",
+            b"# TYPE flocker_api_request_duration_seconds histogram",
+        ])
+        lines.extend(self._histogramLines(
+            b"flocker_api_request_duration_seconds", self._latency))
+        lines.extend([
+            b"# HELP flocker_api_response_size_bytes "
+            b"Size of response bodies.",
+            b"# TYPE flocker_api_response_size_bytes histogram",
+        ])
+        lines.extend(self._histogramLines(
+            b"flocker_api_response_size_bytes", self._sizes))
+        return b"\n".join(lines) + b"\n"
+
+
+def _metered(route):
+    """
+    Decorate a function so its requests are recorded in the endpoint's
+    L{RequestMetrics}.
+
+    @param route: The name identifying the route in the metrics.
+    @type route: L{bytes}
+
+    @return: A decorator that decorates a function with the signature of a
+        Klein route endpoint which handles its own errors, returning the
+        response body or a L{Deferred} firing with it once the response
+        code is set.
+    """
+    def deco(original):
+        @wraps(original)
+        def metered(self, request, **routeArguments):
+            metrics = getattr(self, "metrics", None)
+            if metrics is None:
+                return original(self, request, **routeArguments)
+            started = metrics.requestStarted(route)
+
+            def finished(result):
+                # Streamed responses were written by the endpoint already:
+                size = request.sentLength
+                if isinstance(result, bytes):
+                    size += len(result)
+                metrics.requestFinished(route, started, request.code, size)
+                return result
+            result = maybeDeferred(original, self, request, **routeArguments)
+            result.addBoth(finished)
+            return result
+        return metered
+    return deco
@@ -10,10 +10,13 @@ __all__ = [
     "SchemaNotProvided",
     "LocalRefResolver",
     "getValidator",
+    "getItemValidator",
     "resolveSchema",
 ]
 
 import copy
+from json import dumps
+from urlparse import urljoin
 
 from jsonschema.validators import RefResolver, validator_for
 from jsonschema import draft4_format_checker
@@ -33,30 +36,74 @@ class LocalRefResolver(RefResolver):
         raise SchemaNotProvided(uri)
 
 
+# Map the schemas and stores passed to getValidator to the store, kept
+# alive so its id isn't reused, and the validator:
+_validators = {}
+
+
 def getValidator(schema, schema_store):
     """
     Get a L{jsonschema} validator for C{schema}.
 
+    I{$ref} references are resolved once, when the validator is created,
+    rather than every time something is validated.  Validators are cached,
+    so the same validator is returned for equal schemas and the same store;
+    the store must not change once it has been used.
+
     @param schema: The JSON Schema to validate against.
     @type schema: L{dict}
 
     @param dict schema_store: A mapping between schema paths
         (e.g. ``b/v1/types.json``) and the JSON schema structure.
     """
+    key = (dumps(schema, sort_keys=True), id(schema_store))
+    try:
+        return _validators[key][1]
+    except KeyError:
+        pass
     # The base_uri here isn't correct for the schema,
     # but does give proper relative paths.
     resolver = LocalRefResolver(
         base_uri=b'',
         referrer=schema, store=schema_store)
     resolver.resolution_scope = b''
-    return validator_for(schema)(
-        schema, resolver=resolver, format_checker=draft4_format_checker)
+    # Recursive references are left in the resolved schema, for the
+    # validator to follow:
+    resolved = resolveSchema(schema, schema_store)
+    validator = validator_for(resolved)(
+        resolved, resolver=resolver, format_checker=draft4_format_checker)
+    _validators[key] = (schema_store, validator)
+    return validator
+
+
+def getItemValidator(schema, schema_store):
+    """
+    Get a L{jsonschema} validator for the items of arrays matching
+    C{schema}.
+
+    @param schema: The JSON Schema of an array, whose C{items} are
+        described by a single schema.
+    @type schema: L{dict}
+
+    @param dict schema_store: A mapping between schema paths
+        (e.g. ``b/v1/types.json``) and the JSON schema structure.
+
+    @return: A validator for the items, which accepts anything if C{schema}
+        doesn't describe them.
+    """
+    items = getValidator(schema, schema_store).schema.get(u"items", {})
+    return getValidator(items, schema_store)
 
 
 def resolveSchema(schema, schemaStore):
     """
     Recursively resolve all I{$ref} JSON references in a JSON Schema.
 
+    A reference to a schema that is already being resolved, i.e. a
+    recursive reference, can't be inlined; it is left in place, made
+    absolute, so that a validator can follow it.  Neither C{schema} nor
+    C{schemaStore} is modified.
+
     @param schema: A L{dict} with a JSON Schema.
 
     @param schemaStore: A L{dict} mapping file paths to JSON Schema loaded
@@ -69,22 +116,35 @@ def resolveSchema(schema, schemaStore):
     resolver = LocalRefResolver(base_uri=b'', referrer=schema,
                                 store=schemaStore)
 
-    def resolve(obj):
+    def resolve(obj, resolving):
+        """
+        Resolve references in part of a copy of the schema, in place.
+
+        @param resolving: The absolute URIs of the references being
+            resolved.
+        @type resolving: L{frozenset}
+        """
         if isinstance(obj, list):
             for item in obj:
-                resolve(item)
+                resolve(item, resolving)
             return
 
         if isinstance(obj, dict):
             if "$ref" in obj:
-                with resolver.resolving(obj[u'$ref']) as resolved:
-                    resolve(resolved)
-                    obj.clear()
-                    obj.update(resolved)
+                uri = urljoin(resolver.resolution_scope, obj[u'$ref'])
+                obj.clear()
+                if uri in resolving:
+                    obj[u'$ref'] = uri
+                    return
+                with resolver.resolving(uri) as resolved:
+                    # The referenced schema belongs to the store:
+                    resolved = copy.deepcopy(resolved)
+                    resolve(resolved, resolving | frozenset([uri]))
+                obj.update(resolved)
             else:
                 for value in obj.values():
-                    resolve(value)
+                    resolve(value, resolving)
 
-    resolve(result)
+    resolve(result, frozenset())
     result["$schema"] = "http://json-schema.org/draft-04/schema#"
     return result
@@ -297,6 +297,7 @@ def _formatRouteBody(data, schema_store):
     baseSubstitutions = {
         u"DOMAIN": u"example.com",
         u"NODE_0": u"192.0.2.1",
+        u"NODE_1": u"192.0.2.2",
         }
 
     for line in data['description']:
@@ -9,15 +9,18 @@ from klein import Klein
 from twisted.python.constants import Names, NamedConstant
 from twisted.python.failure import Failure
 from twisted.internet.defer import succeed, fail
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Cooperator
 from twisted.web.http_headers import Headers
 from twisted.web.http import (
     BAD_REQUEST, INTERNAL_SERVER_ERROR, PAYMENT_REQUIRED, GONE,
-    NOT_ALLOWED, NOT_FOUND)
+    NOT_ALLOWED, NOT_FOUND, OK, CREATED, NOT_MODIFIED)
 
 from twisted.trial.unittest import SynchronousTestCase
 
 from .._infrastructure import (
-    EndpointResponse, user_documentation, structured)
+    EndpointResponse, OutputValidation, user_documentation, structured,
+    STREAM_CHUNK_SIZE)
 from .._logging import REQUEST
 from .._error import (
     ILLEGAL_CONTENT_TYPE_DESCRIPTION, DECODING_ERROR_DESCRIPTION,
@@ -512,6 +515,519 @@ class StructuredJSONTests(SynchronousTestCase):
             {"jsonValue": True, "routingValue": "quux"}, app.kwargs)
 
 
+class OutputValidationTests(SynchronousTestCase):
+    """
+    Tests for L{OutputValidation}.
+    """
+    def test_every(self):
+        """
+        By default every response is validated.
+        """
+        validation = OutputValidation()
+        self.assertEqual([validation.should_validate() for _ in range(3)],
+                         [True, True, True])
+
+    def test_sampled(self):
+        """
+        Given a number I{N}, one in I{N} responses is validated, starting
+        with the first.
+        """
+        validation = OutputValidation(3)
+        self.assertEqual([validation.should_validate() for _ in range(7)],
+                         [True, False, False, True, False, False, True])
+
+    def test_disabled(self):
+        """
+        Given C{0}, no responses are validated.
+        """
+        validation = OutputValidation(0)
+        self.assertEqual([validation.should_validate() for _ in range(3)],
+                         [False, False, False])
+
+    def test_negative(self):
+        """
+        A negative sampling rate is rejected.
+        """
+        self.assertRaises(ValueError, OutputValidation, -1)
+
+
+class BadResponseApplication(object):
+    """
+    An application with an endpoint whose responses don't match its output
+    schema.
+
+    @ivar output_validation: The L{OutputValidation} policy to use.
+    """
+    app = Klein()
+
+    def __init__(self, logger, output_validation):
+        self.logger = logger
+        self.output_validation = output_validation
+
+    @app.route(b"/foo")
+    @structured({}, {u"type": u"string"})
+    def foo(self):
+        return {}
+
+
+def _flushValidationErrors(count):
+    """
+    @param count: The number of failed validations expected.
+
+    @return: A L{validateLogging} assertion that the given number of
+        response validation failures were logged.
+    """
+    def assertion(test, logger):
+        test.assertEqual(len(logger.flushTracebacks(ValidationError)), count)
+    return assertion
+
+
+class StructuredOutputValidationTests(SynchronousTestCase):
+    """
+    Tests for the L{structured} behavior related to the endpoint's
+    L{OutputValidation} policy.
+    """
+    def codes(self, logger, output_validation, requests):
+        """
+        Issue requests to a L{BadResponseApplication}.
+
+        @param output_validation: The application's L{OutputValidation}.
+        @param requests: The number of requests to issue.
+
+        @return: A L{list} of the response codes.
+        """
+        resource = BadResponseApplication(
+            logger, output_validation).app.resource()
+        codes = []
+        for _ in range(requests):
+            request = dummyRequest(b"GET", b"/foo", Headers(), b"")
+            render(resource, request)
+            codes.append(request.code)
+        return codes
+
+    @validateLogging(_flushValidationErrors(2))
+    def test_sampled(self, logger):
+        """
+        Only the responses the policy samples are validated.
+        """
+        self.assertEqual(
+            self.codes(logger, OutputValidation(2), 4),
+            [INTERNAL_SERVER_ERROR, OK, INTERNAL_SERVER_ERROR, OK])
+
+    @validateLogging(_flushValidationErrors(0))
+    def test_disabled(self, logger):
+        """
+        No responses are validated if validation is disabled.
+        """
+        self.assertEqual(self.codes(logger, OutputValidation(0), 2), [OK, OK])
+
+    @validateLogging(_flushValidationErrors(2))
+    def test_no_policy(self, logger):
+        """
+        Every response is validated if the endpoint has no policy.
+        """
+        self.assertEqual(self.codes(logger, None, 2),
+                         [INTERNAL_SERVER_ERROR, INTERNAL_SERVER_ERROR])
+
+
+class StreamingApplication(object):
+    """
+    Endpoints returning an iterator, without and with an entity tag.
+
+    @ivar items: The items the endpoints return.
+    @ivar cooperator: A L{Cooperator} which only does work when its
+        scheduled calls are run by the test, one chunk at a time.
+    @ivar calls: The calls scheduled by C{cooperator}.
+    @ivar conditional_calls: The number of times the endpoint with an
+        entity tag has been called.
+    """
+    app = Klein()
+
+    def __init__(self, logger, items, output_validation=None):
+        self.logger = logger
+        self.items = items
+        self.output_validation = output_validation
+        self.calls = []
+        self.cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.calls.append)
+        self.conditional_calls = 0
+
+    @app.route(b"/foo")
+    @structured({}, {u"type": u"array", u"items": {u"type": u"integer"}})
+    def foo(self):
+        return iter(self.items)
+
+    @app.route(b"/conditional")
+    @structured({}, {u"type": u"array", u"items": {u"type": u"integer"}},
+                etag=lambda self: b"1")
+    def conditional(self):
+        self.conditional_calls += 1
+        return iter(self.items)
+
+
+class StreamingTests(SynchronousTestCase):
+    """
+    Tests for the L{structured} behavior related to endpoints returning
+    iterators.
+    """
+    def get(self, logger, items, output_validation=None):
+        """
+        Start a request to a L{StreamingApplication}.
+
+        The L{Deferred} returned by L{render} is kept as C{self.rendering}.
+
+        @return: The application and the request.
+        """
+        application = StreamingApplication(logger, items, output_validation)
+        return application, self.request(application, b"/foo")
+
+    def request(self, application, path):
+        """
+        Start a request to an existing L{StreamingApplication}.
+
+        The L{Deferred} returned by L{render} is kept as C{self.rendering}.
+
+        @param path: The path of the request.
+
+        @return: The request.
+        """
+        request = dummyRequest(b"GET", path, Headers(), b"")
+        self.rendering = render(application.app.resource(), request)
+        return request
+
+    def tick(self, application):
+        """
+        Let the application write one more chunk.
+        """
+        calls, application.calls[:] = application.calls[:], []
+        for call in calls:
+            call()
+
+    def finish(self, application):
+        """
+        Let the application write all of the response.
+        """
+        while application.calls:
+            self.tick(application)
+
+    @validateLogging(None)
+    def test_streamed(self, logger):
+        """
+        The items are written as a JSON array, a chunk at a time.
+        """
+        items = range(STREAM_CHUNK_SIZE * 2 + 1)
+        application, request = self.get(logger, items)
+        self.tick(application)
+        first = request._responseBody
+        self.finish(application)
+        self.assertEqual(
+            (first, request.code,
+             request.responseHeaders.getRawHeaders(b"content-type"),
+             loads(request._responseBody), request._finished),
+            (b"[" + b",".join(dumps(i) for i in items[:STREAM_CHUNK_SIZE]),
+             OK, [b"application/json"], items, True))
+
+    @validateLogging(None)
+    def test_whole_chunks(self, logger):
+        """
+        The array is terminated correctly if the last chunk is full.
+        """
+        items = range(STREAM_CHUNK_SIZE * 2)
+        application, request = self.get(logger, items)
+        self.finish(application)
+        self.assertEqual(loads(request._responseBody), items)
+
+    @validateLogging(None)
+    def test_empty(self, logger):
+        """
+        An empty iterator results in an empty array.
+        """
+        application, request = self.get(logger, [])
+        self.finish(application)
+        self.assertEqual((request._responseBody, request._finished),
+                         (b"[]", True))
+
+    @validateLogging(_flushValidationErrors(1))
+    def test_invalid_before_writing(self, logger):
+        """
+        If an item in the first chunk is invalid nothing has been sent yet,
+        so the response is an I{INTERNAL SERVER ERROR}.
+        """
+        application, request = self.get(logger, [1, u"two", 3])
+        self.finish(application)
+        self.assertEqual(
+            (request.code, request.channel.transport.disconnecting),
+            (INTERNAL_SERVER_ERROR, False))
+
+    @validateLogging(_flushValidationErrors(1))
+    def test_invalid_after_writing(self, logger):
+        """
+        If an item is invalid after part of the response has been sent, the
+        connection is closed without completing the response.
+        """
+        items = range(STREAM_CHUNK_SIZE) + [u"invalid"]
+        application, request = self.get(logger, items)
+        self.finish(application)
+        self.assertEqual(
+            (request._responseBody,
+             request.channel.transport.disconnecting),
+            (b"[" + b",".join(dumps(i) for i in items[:-1]), True))
+
+    @validateLogging(None)
+    def test_validation_disabled(self, logger):
+        """
+        Items aren't validated if the endpoint's output validation policy
+        says not to.
+        """
+        application, request = self.get(
+            logger, [1, u"two"], OutputValidation(0))
+        self.finish(application)
+        self.assertEqual(loads(request._responseBody), [1, u"two"])
+
+    @validateLogging(None)
+    def test_paused(self, logger):
+        """
+        Nothing is written while the transport has paused the producer.
+        """
+        application, request = self.get(
+            logger, range(STREAM_CHUNK_SIZE * 2))
+        producer = request.channel.transport.producer
+        producer.pauseProducing()
+        self.finish(application)
+        paused = request._responseBody
+        producer.resumeProducing()
+        self.finish(application)
+        self.assertEqual((paused, loads(request._responseBody)),
+                         (b"", range(STREAM_CHUNK_SIZE * 2)))
+
+    @validateLogging(None)
+    def test_connection_lost(self, logger):
+        """
+        Writing stops if the client disconnects.
+        """
+        application, request = self.get(
+            logger, range(STREAM_CHUNK_SIZE * 3))
+        self.tick(application)
+        written = request._responseBody
+        request._finishedChannel.errback(Failure(ConnectionDone()))
+        self.failureResultOf(self.rendering, ConnectionDone)
+        self.finish(application)
+        self.assertEqual(
+            (request._responseBody, request.channel.transport.producer),
+            (written, None))
+
+    @validateLogging(None)
+    def test_cached(self, logger):
+        """
+        The body of a streamed response with an entity tag is written once,
+        and reused for later requests while the tag stays the same.
+        """
+        items = range(STREAM_CHUNK_SIZE * 2 + 1)
+        application = StreamingApplication(logger, items)
+        first = self.request(application, b"/conditional")
+        self.finish(application)
+        second = self.request(application, b"/conditional")
+        self.assertEqual(
+            (loads(first._responseBody), second._responseBody,
+             second.code, application.conditional_calls),
+            (items, first._responseBody, OK, 1))
+
+
+class ConditionalApplication(object):
+    """
+    An application with an endpoint supporting conditional requests.
+
+    @ivar version: The entity tag of the endpoint's current response.
+    @ivar calls: The number of times the endpoint has been called.
+    @ivar code: The response code the endpoint returns.
+    """
+    app = Klein()
+    logger = None
+
+    def __init__(self):
+        self.version = b"1"
+        self.calls = 0
+        self.code = OK
+
+    @app.route(b"/foo", methods={b"GET", b"POST"})
+    @structured({}, {}, etag=lambda self: self.version,
+                query_arguments=(b"name",))
+    def foo(self, name=None):
+        self.calls += 1
+        return EndpointResponse(
+            self.code, {u"version": self.version, u"name": name})
+
+
+class QueryArgumentsTests(SynchronousTestCase):
+    """
+    Tests for the L{structured} behavior related to query arguments.
+    """
+    def get(self, path):
+        """
+        Issue a I{GET} request to a L{ConditionalApplication}.
+
+        @param path: The path and query of the request.
+
+        @return: The rendered request.
+        """
+        request = dummyRequest(b"GET", path, Headers(), b"")
+        render(ConditionalApplication().app.resource(), request)
+        return request
+
+    def test_passed(self):
+        """
+        The values of the named query arguments are decoded from UTF-8 and
+        passed to the decorated function as a list.
+        """
+        request = self.get(b"/foo?name=a&name=%E2%98%83")
+        self.assertEqual(loads(request._responseBody)[u"name"],
+                         [u"a", u"\N{SNOWMAN}"])
+
+    def test_other_ignored(self):
+        """
+        Query arguments that weren't named are not passed to the decorated
+        function.
+        """
+        request = self.get(b"/foo?other=a")
+        self.assertEqual(loads(request._responseBody)[u"name"], None)
+
+    def test_not_utf8(self):
+        """
+        Query arguments which aren't UTF-8 result in a I{BAD REQUEST}
+        response.
+        """
+        request = self.get(b"/foo?name=%FF")
+        self.assertEqual(
+            (request.code, loads(request._responseBody)),
+            (BAD_REQUEST, {u"description": DECODING_ERROR_DESCRIPTION}))
+
+
+class ConditionalTests(SynchronousTestCase):
+    """
+    Tests for the L{structured} behavior related to entity tags and
+    conditional I{GET} requests.
+    """
+    def setUp(self):
+        self.application = ConditionalApplication()
+
+    def get(self, headers=None, method=b"GET", path=b"/foo"):
+        """
+        Issue a request to the application.
+
+        @param headers: A L{dict} of request headers.
+        @param method: The HTTP method of the request.
+        @param path: The path and query of the request.
+
+        @return: The rendered request.
+        """
+        headers = dict(headers or {})
+        headers[b"content-type"] = [b"application/json"]
+        request = dummyRequest(method, path, Headers(headers), b"{}")
+        render(self.application.app.resource(), request)
+        return request
+
+    def test_etag(self):
+        """
+        I{GET} responses include the quoted entity tag.
+        """
+        request = self.get()
+        self.assertEqual(
+            (request.code, request.responseHeaders.getRawHeaders(b"etag"),
+             loads(request._responseBody)),
+            (OK, [b'"1"'], {u"version": u"1", u"name": None}))
+
+    def test_not_modified(self):
+        """
+        A I{GET} request whose I{If-None-Match} header matches the entity
+        tag receives an empty I{NOT MODIFIED} response without calling the
+        endpoint.
+        """
+        request = self.get({b"if-none-match": [b'"1"']})
+        self.assertEqual(
+            (request.code, request.responseHeaders.getRawHeaders(b"etag"),
+             request._responseBody, self.application.calls),
+            (NOT_MODIFIED, [b'"1"'], b"", 0))
+
+    def test_not_modified_list(self):
+        """
+        The I{If-None-Match} header may list several entity tags, weak or
+        strong.
+        """
+        codes = [
+            self.get({b"if-none-match": [value]}).code
+            for value in [b'"0", "1"', b'"0",W/"1"', b'*']]
+        self.assertEqual(codes, [NOT_MODIFIED] * 3)
+
+    def test_modified(self):
+        """
+        A I{GET} request whose I{If-None-Match} header doesn't match the
+        entity tag receives the full response.
+        """
+        self.get()
+        self.application.version = b"2"
+        request = self.get({b"if-none-match": [b'"1"']})
+        self.assertEqual(
+            (request.code, request.responseHeaders.getRawHeaders(b"etag"),
+             loads(request._responseBody)),
+            (OK, [b'"2"'], {u"version": u"2", u"name": None}))
+
+    def test_cached(self):
+        """
+        While the entity tag stays the same the encoded response is reused
+        without calling the endpoint again.
+        """
+        first = self.get()
+        second = self.get()
+        self.assertEqual(
+            (second.code,
+             second.responseHeaders.getRawHeaders(b"content-type"),
+             second._responseBody, self.application.calls),
+            (OK, [b"application/json"], first._responseBody, 1))
+
+    def test_cached_code(self):
+        """
+        The cached response is sent with the response code of the original
+        response.
+        """
+        self.application.code = CREATED
+        self.get()
+        self.assertEqual(self.get().code, CREATED)
+
+    def test_cached_per_uri(self):
+        """
+        Requests with different query arguments don't get each other's cached
+        responses, even though the entity tag is the same.
+        """
+        self.get(path=b"/foo?name=a")
+        request = self.get(path=b"/foo?name=b")
+        self.assertEqual(loads(request._responseBody)[u"name"], [u"b"])
+
+    def test_cache_invalidated(self):
+        """
+        Once the entity tag changes the endpoint is called again.
+        """
+        self.get()
+        self.application.version = b"2"
+        self.get()
+        self.assertEqual(self.application.calls, 2)
+
+    def test_other_methods(self):
+        """
+        Requests using methods other than I{GET} are neither conditional nor
+        cached.
+        """
+        requests = [
+            self.get({b"if-none-match": [b'"1"']}, method=b"POST")
+            for _ in range(2)]
+        self.assertEqual(
+            ([request.code for request in requests],
+             [request.responseHeaders.getRawHeaders(b"etag")
+              for request in requests],
+             self.application.calls),
+            ([OK, OK], [None, None], 2))
+
+
 class UserDocumentationTests(SynchronousTestCase):
     """
     Tests for L{user_documentation}.
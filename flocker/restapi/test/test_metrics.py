@@ -0,0 +1,234 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+"""
+Tests for ``flocker.restapi._metrics``.
+"""
+
+from klein import Klein
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock, Cooperator
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.http import OK, PAYMENT_REQUIRED, INTERNAL_SERVER_ERROR
+from twisted.web.http_headers import Headers
+
+from eliot.testing import validateLogging
+
+from .. import RequestMetrics, structured
+from .._error import BadRequest
+from ..testtools import dummyRequest, render
+
+from .utils import _assertTracebackLogged
+
+
+class RequestMetricsTests(SynchronousTestCase):
+    """
+    Tests for L{RequestMetrics}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = RequestMetrics(
+            self.clock, latencyBuckets=(0.1, 1.0), sizeBuckets=(10,))
+
+    def samples(self):
+        """
+        @return: The lines of samples from the rendered metrics, leaving out
+            comments.
+        """
+        return [line for line in self.metrics.render().splitlines()
+                if not line.startswith(b"#")]
+
+    def test_empty(self):
+        """
+        Before any requests the rendered metrics only describe the metric
+        types.
+        """
+        self.assertEqual(self.metrics.render(), b"\n".join([
+            b"# HELP flocker_api_requests_in_flight "
+            b"Requests currently being handled.",
+            b"# TYPE flocker_api_requests_in_flight gauge",
+            b"# HELP flocker_api_responses_total Responses sent, by code.",
+            b"# TYPE flocker_api_responses_total counter",
+            b"# HELP flocker_api_request_duration_seconds "
+            b"Time taken to respond to requests.",
+            b"# TYPE flocker_api_request_duration_seconds histogram",
+            b"# HELP flocker_api_response_size_bytes "
+            b"Size of response bodies.",
+            b"# TYPE flocker_api_response_size_bytes histogram",
+        ]) + b"\n")
+
+    def test_in_flight(self):
+        """
+        Requests that have started but not finished are counted as in
+        flight.
+        """
+        self.metrics.requestStarted(b"foo")
+        self.metrics.requestStarted(b"foo")
+        self.metrics.requestStarted(b"bar")
+        self.assertEqual(self.samples(), [
+            b'flocker_api_requests_in_flight{route="bar"} 1',
+            b'flocker_api_requests_in_flight{route="foo"} 2',
+        ])
+
+    def test_finished(self):
+        """
+        Finished requests are no longer in flight, and their response codes,
+        latency and size are recorded, with cumulative histogram buckets.
+        """
+        first = self.metrics.requestStarted(b"foo")
+        self.clock.advance(0.5)
+        second = self.metrics.requestStarted(b"foo")
+        self.clock.advance(1.5)
+        self.metrics.requestFinished(b"foo", first, OK, 5)
+        self.metrics.requestFinished(b"foo", second, INTERNAL_SERVER_ERROR, 20)
+        self.assertEqual(self.samples(), [
+            b'flocker_api_requests_in_flight{route="foo"} 0',
+            b'flocker_api_responses_total{route="foo",code="200"} 1',
+            b'flocker_api_responses_total{route="foo",code="500"} 1',
+            b'flocker_api_request_duration_seconds_bucket'
+            b'{route="foo",le="0.1"} 0',
+            b'flocker_api_request_duration_seconds_bucket'
+            b'{route="foo",le="1.0"} 0',
+            b'flocker_api_request_duration_seconds_bucket'
+            b'{route="foo",le="+Inf"} 2',
+            b'flocker_api_request_duration_seconds_sum{route="foo"} 3.5',
+            b'flocker_api_request_duration_seconds_count{route="foo"} 2',
+            b'flocker_api_response_size_bytes_bucket'
+            b'{route="foo",le="10.0"} 1',
+            b'flocker_api_response_size_bytes_bucket'
+            b'{route="foo",le="+Inf"} 2',
+            b'flocker_api_response_size_bytes_sum{route="foo"} 25',
+            b'flocker_api_response_size_bytes_count{route="foo"} 2',
+        ])
+
+    def test_label_escaping(self):
+        """
+        Backslashes, quotes and newlines in label values are escaped.
+        """
+        self.metrics.requestStarted(b'a\\b"c\nd')
+        self.assertEqual(self.samples(), [
+            b'flocker_api_requests_in_flight{route="a\\\\b\\"c\\nd"} 1'])
+
+
+class MeteredApplication(object):
+    """
+    An application recording metrics about its requests.
+
+    @ivar result: The L{Deferred} the C{foo} endpoint returns.
+    """
+    app = Klein()
+    logger = None
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.result = Deferred()
+
+    @app.route(b"/foo")
+    @structured({}, {})
+    def foo(self):
+        return self.result
+
+    @app.route(b"/badrequest")
+    @structured({}, {})
+    def badrequest(self):
+        raise BadRequest(PAYMENT_REQUIRED, u"pay up")
+
+    @app.route(b"/exception")
+    @structured({}, {})
+    def exception(self):
+        raise ZeroDivisionError()
+
+    @app.route(b"/stream")
+    @structured({}, {})
+    def stream(self):
+        return iter([])
+
+
+class StructuredMetricsTests(SynchronousTestCase):
+    """
+    Tests for the L{structured} behavior related to the endpoint's
+    L{RequestMetrics}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = RequestMetrics(self.clock)
+        self.application = MeteredApplication(self.metrics)
+
+    def get(self, path):
+        """
+        Issue a request to the application.
+
+        @param path: The path of the request.
+
+        @return: The rendered request.
+        """
+        request = dummyRequest(b"GET", path, Headers(), b"")
+        render(self.application.app.resource(), request)
+        return request
+
+    def assertSamples(self, expected):
+        """
+        Assert the rendered metrics include the given samples.
+
+        @param expected: L{list} of L{bytes} lines.
+        """
+        samples = self.metrics.render().splitlines()
+        self.assertEqual([line for line in expected if line in samples],
+                         expected)
+
+    def test_in_flight(self):
+        """
+        A request is in flight until its response is ready.
+        """
+        self.get(b"/foo")
+        self.assertSamples([b'flocker_api_requests_in_flight{route="foo"} 1'])
+
+    def test_finished(self):
+        """
+        Once the response is ready the request's latency, response code and
+        size are recorded under the name of the endpoint method.
+        """
+        self.get(b"/foo")
+        self.clock.advance(2)
+        self.application.result.callback({u"a": 1})
+        self.assertSamples([
+            b'flocker_api_requests_in_flight{route="foo"} 0',
+            b'flocker_api_responses_total{route="foo",code="200"} 1',
+            b'flocker_api_request_duration_seconds_sum{route="foo"} 2.0',
+            b'flocker_api_response_size_bytes_sum{route="foo"} 8',
+        ])
+
+    def test_bad_request(self):
+        """
+        The response code of a L{BadRequest} is recorded.
+        """
+        self.get(b"/badrequest")
+        self.assertSamples([
+            b'flocker_api_responses_total{route="badrequest",code="402"} 1'])
+
+    @validateLogging(_assertTracebackLogged(ZeroDivisionError))
+    def test_error(self, logger):
+        """
+        Unexpected errors are recorded as I{INTERNAL SERVER ERROR}
+        responses.
+        """
+        self.application.logger = logger
+        self.get(b"/exception")
+        self.assertSamples([
+            b'flocker_api_responses_total{route="exception",code="500"} 1'])
+
+    def test_streamed(self):
+        """
+        The size of streamed responses is recorded.
+        """
+        self.application.cooperator = Cooperator(scheduler=lambda f: f())
+        self.get(b"/stream")
+        self.assertSamples([
+            b'flocker_api_response_size_bytes_sum{route="stream"} 2'])
+
+    def test_no_metrics(self):
+        """
+        Endpoints without metrics still work.
+        """
+        self.application.metrics = None
+        request = self.get(b"/badrequest")
+        self.assertEqual(request.code, PAYMENT_REQUIRED)
@@ -10,7 +10,8 @@ from twisted.trial.unittest import SynchronousTestCase
 from jsonschema.exceptions import RefResolutionError, ValidationError
 
 from .._schema import (
-    LocalRefResolver, SchemaNotProvided, getValidator, resolveSchema)
+    LocalRefResolver, SchemaNotProvided, getValidator, getItemValidator,
+    resolveSchema)
 
 
 class LocalResolverTests(SynchronousTestCase):
@@ -64,6 +65,86 @@ class GetValidatorTests(SynchronousTestCase):
                                  {'schema.json': {'type': 'string'}})
         self.assertRaises(ValidationError, validator.validate, {})
 
+    def test_cached(self):
+        """
+        L{getValidator} returns the same validator when called again with
+        an equal schema and the same schema store.
+        """
+        store = {'schema.json': {'type': 'string'}}
+        self.assertIs(getValidator({u'$ref': u'schema.json'}, store),
+                      getValidator({u'$ref': u'schema.json'}, store))
+
+    def test_cachedPerStore(self):
+        """
+        L{getValidator} returns different validators for the same schema
+        with different schema stores.
+        """
+        schema = {u'$ref': u'schema.json'}
+        validator = getValidator(schema, {'schema.json': {'type': 'string'}})
+        other = getValidator(schema, {'schema.json': {'type': 'object'}})
+        self.assertEqual(
+            (len(list(validator.iter_errors({}))),
+             len(list(other.iter_errors({})))),
+            (1, 0))
+
+    def test_referencesResolved(self):
+        """
+        The validator returned by L{getValidator} uses a schema with the
+        references already resolved.
+        """
+        store = {'schema.json': {'type': 'string'}}
+        validator = getValidator({u'$ref': u'schema.json'}, store)
+        self.assertEqual(validator.schema,
+                         resolveSchema({u'$ref': u'schema.json'}, store))
+
+    def test_recursiveReferences(self):
+        """
+        L{getValidator} returns a working validator for a schema that refers
+        to itself, which can't have its references resolved in advance.
+        """
+        store = {'tree.json': {'type': 'array',
+                               'items': {'$ref': 'tree.json'}}}
+        validator = getValidator({u'$ref': u'tree.json'}, store)
+        validator.validate([[], [[]]])
+        self.assertRaises(ValidationError, validator.validate, [[1]])
+
+    def test_storeUnmodified(self):
+        """
+        L{getValidator} doesn't modify the schema store.
+        """
+        store = {'schema.json': {'type': 'object',
+                                 'properties': {'a': {'$ref': 'a.json'}}},
+                 'a.json': {'type': 'string'}}
+        original = copy.deepcopy(store)
+        getValidator({u'$ref': u'schema.json'}, store)
+        self.assertEqual(store, original)
+
+
+class GetItemValidatorTests(SynchronousTestCase):
+    """
+    Tests for L{getItemValidator}.
+    """
+    def test_items(self):
+        """
+        L{getItemValidator} returns a validator for the items of an array
+        schema, following references.
+        """
+        validator = getItemValidator(
+            {u'$ref': u'schema.json'},
+            {'schema.json': {'type': 'array',
+                             'items': {'$ref': 'item.json'}},
+             'item.json': {'type': 'string'}})
+        validator.validate(u'abc')
+        self.assertRaises(ValidationError, validator.validate, [])
+
+    def test_noItems(self):
+        """
+        L{getItemValidator} returns a validator accepting anything if the
+        schema doesn't describe the items of arrays.
+        """
+        validator = getItemValidator({u'type': u'array'}, {})
+        validator.validate({})
+
 
 class ResolveSchemaTests(SynchronousTestCase):
     """
@@ -197,3 +278,28 @@ class ResolveSchemaTests(SynchronousTestCase):
         original = copy.deepcopy(self.STORE)
         resolveSchema(schema, self.STORE)
         self.assertEqual(self.STORE, original)
+
+    def test_referencedStoreUnmodified(self):
+        """
+        References within a referenced document are resolved without
+        modifying the document in the store.
+        """
+        store = {b"/path/types.json": {
+            "nested": {"key": {"$ref": "#/actual"}},
+            "actual": {"hello": "there"}}}
+        original = copy.deepcopy(store)
+        resolveSchema({"$ref": "/path/types.json#/nested"}, store)
+        self.assertEqual(store, original)
+
+    def test_recursiveReference(self):
+        """
+        A reference to a schema that is already being resolved is left in
+        place, made absolute, rather than being resolved forever.
+        """
+        store = {b"/path/tree.json": {
+            "node": {"type": "array", "items": {"$ref": "#/node"}}}}
+        result = resolveSchema({"$ref": "/path/tree.json#/node"}, store)
+        self.assertEqual(result,
+                         {"$schema": "http://json-schema.org/draft-04/schema#",
+                          "type": "array",
+                          "items": {"$ref": "/path/tree.json#/node"}})
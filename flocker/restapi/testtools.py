@@ -332,6 +332,10 @@ class _DummyRequest(Request):
         err(reason, "Processing _DummyRequest %d failed" % (self._counter,))
 
     def write(self, data):
+        # Keep the same state as the inherited implementation, which error
+        # handling and metrics rely on:
+        self.startedWriting = 1
+        self.sentLength += len(data)
         self._responseBody += data
 
     def render(self, resource):
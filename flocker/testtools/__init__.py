@@ -23,9 +23,10 @@ from zope.interface import implementer
 from zope.interface.verify import verifyClass, verifyObject
 
 from twisted.internet.interfaces import (
-    IProcessTransport, IReactorProcess, IReactorCore,
+    IProcessTransport, IReactorProcess, IReactorCore, IReactorThreads,
     )
 from twisted.python.filepath import FilePath, Permissions
+from twisted.python.failure import Failure
 from twisted.internet.task import Clock, deferLater
 from twisted.internet.defer import maybeDeferred, Deferred, succeed
 from twisted.internet.error import ConnectionDone
@@ -105,6 +106,50 @@ class FakeProcessReactor(Clock):
 verifyClass(IReactorProcess, FakeProcessReactor)
 
 
+class _SynchronousThreadPool(object):
+    """
+    Thread pool look-alike that runs functions immediately in the calling
+    thread.
+    """
+    def callInThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)
+
+
+@implementer(IReactorThreads)
+class FakeThreadReactor(Clock):
+    """
+    Fake reactor whose thread pool runs functions immediately in the
+    calling thread, so code using ``deferToThreadPool`` can be tested
+    synchronously.
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self._pool = _SynchronousThreadPool()
+
+    def getThreadPool(self):
+        return self._pool
+
+    def callInThread(self, f, *args, **kwargs):
+        self._pool.callInThread(f, *args, **kwargs)
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+    def suggestThreadPoolSize(self, size):
+        pass
+
+
+verifyClass(IReactorThreads, FakeThreadReactor)
+
+
 @contextmanager
 def assertNoFDsLeaked(test_case):
     """Context manager that asserts no file descriptors are leaked.
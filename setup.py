@@ -59,7 +59,8 @@ setup(
     # This setuptools helper will find everything that looks like a *Python*
     # package (in other words, things that can be imported) which are part of
     # the Flocker package.
-    packages=find_packages(exclude=('admin', 'admin.*')),
+    packages=find_packages(exclude=('admin', 'admin.*',
+                                    'benchmark', 'benchmark.*')),
 
     package_data={
         'flocker.node.functional': [